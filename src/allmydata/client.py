@@ -15,7 +15,11 @@ from allmydata.crypto.util import remove_prefix
 from allmydata.storage.server import StorageServer
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.uploadcache import get_upload_cache
+from allmydata.immutable.uploadresume import get_upload_resume_db
+from allmydata.immutable.downloadcache import get_download_cache
 from allmydata.immutable.offloaded import Helper
+from allmydata.immutable.downloader.segcache import SegmentCache
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
 from allmydata.util import (hashutil, base32, pollmixin, log, idlib, yamlutil)
@@ -43,6 +47,11 @@ def _valid_config_sections():
     cfg = node._common_config_sections()
     cfg.update({
         "client": (
+            "download.metadata_cache",
+            "download.metadata_cache.max_entries",
+            "download.readahead",
+            "download.readahead_memory",
+            "download.segment_cache_size",
             "helper.furl",
             "introducer.furl",
             "key_generator.furl",
@@ -52,6 +61,16 @@ def _valid_config_sections():
             "shares.needed",
             "shares.total",
             "stats_gatherer.furl",
+            "upload.adaptive_segment_size",
+            "upload.dedup_cache",
+            "upload.dedup_cache.max_entries",
+            "upload.dedup_cache.ttl",
+            "upload.pipeline_memory",
+            "upload.query_servers",
+            "upload.query_timeout",
+            "upload.resumable",
+            "upload.segments_in_flight",
+            "upload.threads",
         ),
         "drop_upload": (  # deprecated already?
             "enabled",
@@ -63,17 +82,25 @@ def _valid_config_sections():
             "port",
         ),
         "storage": (
+            "backend",
+            "buffered_writes",
             "debug_discard",
             "enabled",
             "expire.cutoff_date",
             "expire.enabled",
             "expire.immutable",
+            "expire.io_rate",
             "expire.mode",
             "expire.mode",
             "expire.mutable",
             "expire.override_lease_duration",
+            "expire.threads",
+            "fsync",
+            "incoming_grace_period",
+            "leasedb.enabled",
             "readonly",
             "reserved_space",
+            "share_index",
             "storage_dir",
         ),
         "sftpd": (
@@ -86,6 +113,7 @@ def _valid_config_sections():
         ),
         "helper": (
             "enabled",
+            "pipelined",
         ),
         "magic_folder": (
             "download.umask",
@@ -565,6 +593,22 @@ class _Client(node.Node, pollmixin.PollMixin):
         if self.config.get_config("storage", "expire.mutable", True, boolean=True):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
+        expiration_threads = int(self.config.get_config("storage",
+                                                        "expire.threads", 0))
+        expiration_io_rate = self.config.get_config("storage", "expire.io_rate",
+                                                    None)
+        if expiration_io_rate is not None:
+            expiration_io_rate = int(expiration_io_rate)
+
+        use_leasedb = self.config.get_config("storage", "leasedb.enabled",
+                                             False, boolean=True)
+        share_index = self.config.get_config("storage", "share_index", None)
+        buffered_writes = self.config.get_config("storage", "buffered_writes",
+                                                 False, boolean=True)
+        fsync = self.config.get_config("storage", "fsync", "none")
+        backend = self.config.get_config("storage", "backend", "disk")
+        incoming_grace_period = int(self.config.get_config(
+            "storage", "incoming_grace_period", 0))
 
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
@@ -575,7 +619,15 @@ class _Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           expiration_threads=expiration_threads,
+                           expiration_io_rate=expiration_io_rate,
+                           use_leasedb=use_leasedb,
+                           share_index=share_index,
+                           buffered_writes=buffered_writes,
+                           fsync=fsync,
+                           backend=backend,
+                           incoming_grace_period=incoming_grace_period)
         ss.setServiceParent(self)
 
         furl_file = self.config.get_private_path("storage.furl").encode(get_filesystem_encoding())
@@ -599,6 +651,45 @@ class _Client(node.Node, pollmixin.PollMixin):
         # for the CLI to authenticate to local JSON endpoints
         self._create_auth_token()
 
+        segments_in_flight = self.config.get_config("client",
+                                                    "upload.segments_in_flight",
+                                                    None)
+        if segments_in_flight is not None:
+            segments_in_flight = int(segments_in_flight)
+        data = self.config.get_config("client", "upload.pipeline_memory", None)
+        try:
+            pipeline_memory = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]upload.pipeline_memory= contains unparseable value %s"
+                    % data)
+            raise
+        upload_threads = int(self.config.get_config("client", "upload.threads", 0))
+        query_servers = self.config.get_config("client", "upload.query_servers",
+                                               None)
+        if query_servers is not None:
+            query_servers = int(query_servers)
+        query_timeout = self.config.get_config("client", "upload.query_timeout",
+                                               None)
+        if query_timeout is not None:
+            query_timeout = float(query_timeout)
+        adaptive_segment_size = self.config.get_config(
+            "client", "upload.adaptive_segment_size", False, boolean=True)
+        upload_cache = None
+        if self.config.get_config("client", "upload.dedup_cache", False,
+                                  boolean=True):
+            max_entries = int(self.config.get_config(
+                "client", "upload.dedup_cache.max_entries", 10000))
+            ttl = parse_duration(self.config.get_config(
+                "client", "upload.dedup_cache.ttl", "7 days"))
+            upload_cache = get_upload_cache(
+                self.config.get_private_path("upload-cache.sqlite"),
+                max_entries=max_entries, ttl=ttl)
+        resume_db = None
+        if self.config.get_config("client", "upload.resumable", False,
+                                  boolean=True):
+            resume_db = get_upload_resume_db(
+                self.config.get_private_path("upload-resume.sqlite"))
+
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
@@ -606,6 +697,14 @@ class _Client(node.Node, pollmixin.PollMixin):
             helper_furl,
             self.stats_provider,
             self.history,
+            segments_in_flight=segments_in_flight,
+            pipeline_memory=pipeline_memory,
+            threads=upload_threads,
+            upload_cache=upload_cache,
+            query_servers=query_servers,
+            query_timeout=query_timeout,
+            adaptive_segment_size=adaptive_segment_size,
+            resume_db=resume_db,
         )
         uploader.setServiceParent(self)
         self.init_blacklist()
@@ -663,6 +762,40 @@ class _Client(node.Node, pollmixin.PollMixin):
             self.mutable_file_default = MDMF_VERSION
         else:
             self.mutable_file_default = SDMF_VERSION
+        readahead = self.config.get_config("client", "download.readahead",
+                                           None)
+        if readahead is not None:
+            readahead = int(readahead)
+        data = self.config.get_config("client", "download.readahead_memory",
+                                      None)
+        try:
+            readahead_memory = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]download.readahead_memory= contains unparseable value %s"
+                    % data)
+            raise
+        data = self.config.get_config("client", "download.segment_cache_size",
+                                      "0")
+        try:
+            segment_cache_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]download.segment_cache_size= contains unparseable value %s"
+                    % data)
+            raise
+        self.segment_cache = None
+        if segment_cache_size:
+            self.segment_cache = SegmentCache(segment_cache_size)
+            self.stats_provider.register_producer(self.segment_cache)
+        metadata_cache = None
+        if self.config.get_config("client", "download.metadata_cache", False,
+                                  boolean=True):
+            max_entries = int(self.config.get_config(
+                "client", "download.metadata_cache.max_entries", 10000))
+            metadata_cache = get_download_cache(
+                self.config.get_private_path("download-cache.sqlite"),
+                max_entries=max_entries)
+            if metadata_cache is not None:
+                self.stats_provider.register_producer(metadata_cache)
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
@@ -671,7 +804,21 @@ class _Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   readahead=readahead,
+                                   readahead_memory=readahead_memory,
+                                   segment_cache=self.segment_cache,
+                                   metadata_cache=metadata_cache)
+
+    def stopService(self):
+        d = node.Node.stopService(self)
+        def _close_metadata_cache(res):
+            # after the Terminator has stopped any downloads that use it
+            if self.nodemaker.metadata_cache is not None:
+                self.nodemaker.metadata_cache.close()
+            return res
+        d.addBoth(_close_metadata_cache)
+        return d
 
     def get_history(self):
         return self.history
@@ -683,9 +830,12 @@ class _Client(node.Node, pollmixin.PollMixin):
         self.config.write_private_config("control.furl", control_url + "\n")
 
     def init_helper(self):
+        pipelined = self.config.get_config("helper", "pipelined", False,
+                                           boolean=True)
         self.helper = Helper(self.config.get_config_path("helper"),
                              self.storage_broker, self._secret_holder,
-                             self.stats_provider, self.history)
+                             self.stats_provider, self.history,
+                             pipelined=pipelined)
         # TODO: this is confusing. BASEDIR/private/helper.furl is created by
         # the helper. BASEDIR/helper.furl is consumed by the client who wants
         # to use the helper. I like having the filename be the same, since
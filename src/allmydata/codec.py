@@ -4,6 +4,7 @@ from zope.interface import implementer
 from twisted.internet import defer
 from allmydata.util import mathutil
 from allmydata.util.assertutil import precondition
+from allmydata.util.deferredutil import run_in_threadpool
 from allmydata.interfaces import ICodecEncoder, ICodecDecoder
 import zfec
 
@@ -11,6 +12,10 @@ import zfec
 class CRSEncoder(object):
     ENCODER_TYPE = "crs"
 
+    def __init__(self, threadpool=None):
+        # if set, zfec runs in one of these threads
+        self.threadpool = threadpool
+
     def set_params(self, data_size, required_shares, max_shares):
         assert required_shares <= max_shares
         self.data_size = data_size
@@ -41,9 +46,13 @@ class CRSEncoder(object):
 
         for inshare in inshares:
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
-        shares = self.encoder.encode(inshares, desired_share_ids)
-
-        return defer.succeed((shares, desired_share_ids))
+        if self.threadpool is None:
+            shares = self.encoder.encode(inshares, desired_share_ids)
+            return defer.succeed((shares, desired_share_ids))
+        d = run_in_threadpool(self.threadpool, self.encoder.encode,
+                              inshares, desired_share_ids)
+        d.addCallback(lambda shares: (shares, desired_share_ids))
+        return d
 
 @implementer(ICodecDecoder)
 class CRSDecoder(object):
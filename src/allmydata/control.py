@@ -16,6 +16,7 @@ def get_memory_usage():
     stat_names = ("VmPeak",
                   "VmSize",
                   #"VmHWM",
+                  "VmRSS",
                   "VmData")
     stats = {}
     try:
@@ -29,6 +30,7 @@ def get_memory_usage():
         # Probably not on (a compatible version of) Linux
         stats['VmSize'] = 0
         stats['VmPeak'] = 0
+        stats['VmRSS'] = 0
     return stats
 
 def log_memory_usage(where=""):
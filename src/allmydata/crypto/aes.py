@@ -8,6 +8,8 @@ functions from allmydata.crypto.aes and not rely on features of any
 objects that `cryptography` documents.
 """
 
+import binascii
+
 import six
 
 from cryptography.hazmat.backends import default_backend
@@ -44,7 +46,7 @@ class IDecryptor(Interface):
     """
 
 
-def create_encryptor(key, iv=None):
+def create_encryptor(key, iv=None, offset=0):
     """
     Create and return a new object which can do AES encryptions with
     the given key and initialization vector (IV). The default IV is 16
@@ -56,10 +58,15 @@ def create_encryptor(key, iv=None):
     :param bytes iv: the Initialization Vector consisting of 16 bytes,
         or None for the default (which is 16 zero bytes)
 
+    :param int offset: the position in the key stream to start at. The
+        encryptor encrypts data as if `offset` bytes had already been
+        encrypted with it, so a stream can be encrypted starting in the
+        middle.
+
     :returns: an object suitable for use with :func:`encrypt_data` (an
         :class:`IEncryptor`)
     """
-    cryptor = _create_cryptor(key, iv)
+    cryptor = _create_cryptor(key, iv, offset)
     directlyProvides(cryptor, IEncryptor)
     return cryptor
 
@@ -83,7 +90,7 @@ def encrypt_data(encryptor, plaintext):
     return encryptor.update(plaintext)
 
 
-def create_decryptor(key, iv=None):
+def create_decryptor(key, iv=None, offset=0):
     """
     Create and return a new object which can do AES decryptions with
     the given key and initialization vector (IV). The default IV is 16
@@ -95,10 +102,13 @@ def create_decryptor(key, iv=None):
     :param bytes iv: the Initialization Vector consisting of 16 bytes,
         or None for the default (which is 16 zero bytes)
 
+    :param int offset: the position in the key stream to start at, as
+        for :func:`create_encryptor`
+
     :returns: an object suitable for use with :func:`decrypt_data` (an
         :class:`IDecryptor` instance)
     """
-    cryptor = _create_cryptor(key, iv)
+    cryptor = _create_cryptor(key, iv, offset)
     directlyProvides(cryptor, IDecryptor)
     return cryptor
 
@@ -122,7 +132,7 @@ def decrypt_data(decryptor, plaintext):
     return decryptor.update(plaintext)
 
 
-def _create_cryptor(key, iv):
+def _create_cryptor(key, iv, offset=0):
     """
     Internal helper.
 
@@ -130,12 +140,23 @@ def _create_cryptor(key, iv):
     """
     key = _validate_key(key)
     iv = _validate_iv(iv)
+    offset = _validate_offset(offset)
+    blocks, skip = divmod(offset, 16)
+    if blocks:
+        # in CTR mode, the IV is the counter for the first block, and it
+        # goes up by one (as a 128-bit big-endian number) for each block
+        counter = (int(binascii.hexlify(iv), 16) + blocks) % 2**128
+        iv = binascii.unhexlify("%032x" % counter)
     cipher = Cipher(
         algorithms.AES(key),
         modes.CTR(iv),
         backend=default_backend()
     )
-    return cipher.encryptor()
+    cryptor = cipher.encryptor()
+    if skip:
+        # throw away the start of the key stream for that block
+        cryptor.update(b"\x00" * skip)
+    return cryptor
 
 
 def _validate_cryptor(cryptor, encrypt=True):
@@ -165,6 +186,18 @@ def _validate_key(key):
     return key
 
 
+def _validate_offset(offset):
+    """
+    confirm `offset` is a suitable key stream position, or raise
+    ValueError
+    """
+    if not isinstance(offset, six.integer_types):
+        raise TypeError('Offset must be an integer')
+    if offset < 0:
+        raise ValueError('Offset must not be negative')
+    return offset
+
+
 def _validate_iv(iv):
     """
     Returns a suitable initialiation vector. If `iv` is `None`, a
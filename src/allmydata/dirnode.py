@@ -12,7 +12,7 @@ from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
-     ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
+     IImmutableFileNode, ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
      MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
@@ -22,7 +22,8 @@ from allmydata.util.encodingutil import quote_output
 from allmydata.util.assertutil import precondition
 from allmydata.util.netstring import netstring, split_netstring
 from allmydata.util.consumer import download_to_data
-from allmydata.uri import wrap_dirnode_cap
+from allmydata.uri import wrap_dirnode_cap, CHKFileVerifierURI
+from allmydata.immutable.checker import prefetch_buckets
 from allmydata.util.dictutil import AuxValueDict
 
 from eliot import (
@@ -829,10 +830,12 @@ class DirectoryNode(object):
         return self.deep_traverse(DeepStats(self))
 
     def start_deep_check(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
+        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease,
+                                              storage_broker=self._nodemaker.storage_broker))
 
     def start_deep_check_and_repair(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease))
+        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease,
+                                              storage_broker=self._nodemaker.storage_broker))
 
 
 class ManifestWalker(DeepStats):
@@ -861,8 +864,20 @@ class ManifestWalker(DeepStats):
                 }
 
 
+# DeepChecker asks the servers about this many immutable files at a time
+DEEP_CHECK_PREFETCH = 300
+
 class DeepChecker(object):
-    def __init__(self, root, verify, repair, add_lease):
+    """I check (and maybe repair) every node that deep_traverse() finds.
+
+    If I am given a storage_broker, then I ask every server about the
+    immutable file children of each directory DEEP_CHECK_PREFETCH at a time
+    (see immutable.checker.prefetch_buckets), so that checking a directory
+    full of files costs a few round-trips per server rather than one per
+    file. The next group is only asked about once the walk reaches it, so a
+    huge directory does not hold the answers for all of its files at once.
+    """
+    def __init__(self, root, verify, repair, add_lease, storage_broker=None):
         root_si = root.get_storage_index()
         if root_si:
             root_si_base32 = base32.b2a(root_si)
@@ -879,23 +894,75 @@ class DeepChecker(object):
         else:
             self._results = DeepCheckResults(root_si)
         self._stats = DeepStats(root)
+        self._storage_broker = storage_broker
+        # deep_traverse() processes all the file children of a directory
+        # before it enters the next one, so we only need to remember the
+        # storage indexes of the current directory, and the answers for the
+        # group of them that is being checked
+        self._to_prefetch = [] # storage indexes, in the order of the walk
+        self._prefetch_positions = {} # k: storage_index, v: index
+        self._prefetched_buckets = {} # k: storage_index, v: {serverid: buckets}
 
     def set_monitor(self, monitor):
         self.monitor = monitor
         monitor.set_status(self._results)
 
     def add_node(self, node, childpath):
+        if IImmutableFileNode.providedBy(node):
+            si = node.get_storage_index()
+            if si in self._prefetch_positions:
+                # the first file of a group that has not been asked about
+                d = self._prefetch_from(self._prefetch_positions[si])
+                d.addCallback(lambda ign: self._check_node(node, childpath))
+                return d
+        return self._check_node(node, childpath)
+
+    def _check_node(self, node, childpath):
+        kwargs = {}
+        if IImmutableFileNode.providedBy(node):
+            prefetched = self._prefetched_buckets.pop(node.get_storage_index(),
+                                                      None)
+            if prefetched is not None:
+                kwargs["prefetched_buckets"] = prefetched
         if self._repair:
-            d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
+            d = node.check_and_repair(self.monitor, self._verify, self._add_lease,
+                                      **kwargs)
             d.addCallback(self._results.add_check_and_repair, childpath)
         else:
-            d = node.check(self.monitor, self._verify, self._add_lease)
+            d = node.check(self.monitor, self._verify, self._add_lease, **kwargs)
             d.addCallback(self._results.add_check, childpath)
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
         return d
 
     def enter_directory(self, parent, children):
-        return self._stats.enter_directory(parent, children)
+        self._stats.enter_directory(parent, children)
+        self._to_prefetch = []
+        self._prefetch_positions = {}
+        self._prefetched_buckets = {}
+        if self._storage_broker is None:
+            return
+        # deep_traverse() visits the children in order of their names
+        for name, (child, metadata) in sorted(children.iteritems()):
+            if (IImmutableFileNode.providedBy(child)
+                and isinstance(child.get_verify_cap(), CHKFileVerifierURI)):
+                si = child.get_storage_index()
+                if si not in self._prefetch_positions:
+                    self._prefetch_positions[si] = len(self._to_prefetch)
+                    self._to_prefetch.append(si)
+
+    def _prefetch_from(self, start):
+        storage_indexes = self._to_prefetch[start:start+DEEP_CHECK_PREFETCH]
+        for si in storage_indexes:
+            del self._prefetch_positions[si]
+        # answers left over from the last group belong to files that were
+        # skipped, e.g. because they were already seen in another directory
+        self._prefetched_buckets = {}
+        servers = self._storage_broker.get_connected_servers()
+        d = prefetch_buckets(servers, storage_indexes)
+        def _prefetched(results):
+            self._prefetched_buckets = results
+        d.addCallback(_prefetched)
+        return d
 
     def finish(self):
         log.msg("deep-check done", parent=self._lp)
@@ -2,7 +2,8 @@ from zope.interface import implementer
 from twisted.internet import defer
 from foolscap.api import DeadReferenceError, RemoteException
 from allmydata import hashtree, codec, uri
-from allmydata.interfaces import IValidatedThingProxy, IVerifierURI
+from allmydata.interfaces import IValidatedThingProxy, IVerifierURI, \
+     MAX_BUCKETS_BATCH
 from allmydata.hashtree import IncompleteHashTree
 from allmydata.check_results import CheckResults
 from allmydata.uri import CHKFileVerifierURI
@@ -440,6 +441,57 @@ class ValidatedReadBucketProxy(log.PrefixingLogMixin):
         return blockdata
 
 
+def prefetch_buckets(servers, storage_indexes):
+    """Ask each server that offers get_buckets_batch() about all of the
+    given storage indexes, using as few round-trips as possible. This is for
+    deep-check, which would otherwise send one get_buckets() query per file
+    to every server.
+
+    Returns a Deferred that fires with a dict mapping storage_index to
+    {serverid: {sharenum: bucket}}, suitable for the 'prefetched_buckets'
+    argument of Checker. Servers that do not offer the batch query, or that
+    fail to answer it, are left out, so the Checker will ask them
+    individually. The Deferred never errbacks."""
+    storage_indexes = list(storage_indexes)
+    results = dict([(si, {}) for si in storage_indexes])
+    ds = []
+    for s in servers:
+        storage_server = s.get_storage_server()
+        if storage_server is None:
+            continue
+        v1 = (s.get_version() or {}).get(
+            "http://allmydata.org/tahoe/protocols/storage/v1", {})
+        if not v1.get("get-buckets-batch", False):
+            continue
+        # each server gets one batch at a time, so that a large directory
+        # does not put hundreds of queries in flight at once
+        d = defer.succeed(None)
+        for i in range(0, len(storage_indexes), MAX_BUCKETS_BATCH):
+            batch = storage_indexes[i:i+MAX_BUCKETS_BATCH]
+            d.addCallback(lambda ign, storage_server=storage_server,
+                          batch=batch: storage_server.get_buckets_batch(batch))
+            d.addCallbacks(_record_batch, _batch_failed,
+                           callbackArgs=(s, batch, results),
+                           errbackArgs=(s,))
+        ds.append(d)
+    d = defer.DeferredList(ds)
+    d.addCallback(lambda ignored: results)
+    return d
+
+def _record_batch(buckets, server, batch, results):
+    serverid = server.get_serverid()
+    for si in batch:
+        results[si][serverid] = buckets.get(si, {})
+
+def _batch_failed(f, server):
+    level = log.WEIRD
+    if f.check(DeadReferenceError):
+        level = log.UNUSUAL
+    log.msg(format="failure from server %(name)s on 'get_buckets_batch'",
+            name=server.get_name(), facility="tahoe.immutable.checker",
+            failure=f, level=level, umid="bNr8Cw")
+
+
 class Checker(log.PrefixingLogMixin):
     """I query all servers to see if M uniquely-numbered shares are
     available.
@@ -460,9 +512,14 @@ class Checker(log.PrefixingLogMixin):
     Before I send any new request to a server, I always ask the 'monitor'
     object that was passed into my constructor whether this task has been
     cancelled (by invoking its raise_if_cancelled() method).
+
+    If 'prefetched_buckets' is provided, it maps serverid to the
+    {sharenum: bucket} dict that the server already returned for this
+    storage index (see prefetch_buckets()), and those servers will not be
+    asked again.
     """
     def __init__(self, verifycap, servers, verify, add_lease, secret_holder,
-                 monitor):
+                 monitor, prefetched_buckets=None):
         assert precondition(isinstance(verifycap, CHKFileVerifierURI), verifycap, type(verifycap))
 
         prefix = "%s" % base32.b2a_l(verifycap.get_storage_index()[:8], 60)
@@ -474,6 +531,7 @@ class Checker(log.PrefixingLogMixin):
         self._servers = servers
         self._verify = verify # bool: verify what the servers claim, or not?
         self._add_lease = add_lease
+        self._prefetched_buckets = prefetched_buckets or {}
 
         frs = file_renewal_secret_hash(secret_holder.get_renewal_secret(),
                                        self._verifycap.get_storage_index())
@@ -508,7 +566,11 @@ class Checker(log.PrefixingLogMixin):
             )
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
-        d = storage_server.get_buckets(storageindex)
+        serverid = s.get_serverid()
+        if serverid in self._prefetched_buckets:
+            d = defer.succeed(self._prefetched_buckets[serverid])
+        else:
+            d = storage_server.get_buckets(storageindex)
         def _wrap_results(res):
             return (res, True)
 
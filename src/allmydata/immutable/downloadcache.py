@@ -0,0 +1,167 @@
+"""
+A client-side record of what recent immutable downloads learned about their
+files.
+
+Before a DownloadNode can fetch its first block, it has to find the shares,
+and fetch and validate the UEB (to learn the segment size and the roots of
+the hash trees) and the hash chains that lead from those roots to the
+blocks. The DownloadCache remembers, for each file that this client has
+read, the UEB, the nodes of the share hash tree and the ciphertext hash tree
+that were validated, and which servers held which shares. A new
+DownloadNode for the same file starts with all of that, so its first round
+trip to each share fetches blocks (and their block hashes) instead of
+metadata, and its first DYHB queries go to the servers that held shares
+last time.
+
+None of this has to be trusted: the verifycap contains the hash of the UEB,
+the UEB contains the roots of the hash trees, and every node is checked
+against them again when it is loaded. The server list is only a hint.
+
+The least recently used entries are evicted once there are more than
+'max_entries' of them.
+"""
+
+from __future__ import print_function
+
+import json, sys, time
+
+from zope.interface import implementer
+
+from allmydata.interfaces import IStatsProducer
+from allmydata.util import base32
+from allmydata.util.dbutil import get_db, DBError
+
+# download cache schema version 1
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE files
+(
+ storage_index   VARCHAR(32),  -- base32
+ ueb_hash        VARCHAR(52),  -- base32, from the verifycap
+ ueb             TEXT,         -- base32
+ share_hashes    TEXT,         -- JSON {hashnum: base32 hash}
+ crypttext_hashes TEXT,        -- JSON {hashnum: base32 hash}
+ servers         TEXT,         -- JSON {shnum: [base32 serverid]}
+ last_used       TIMESTAMP,
+ PRIMARY KEY (storage_index, ueb_hash)
+);
+
+CREATE INDEX files_last_used ON files (last_used);
+"""
+
+
+def get_download_cache(dbfile, stderr=sys.stderr, max_entries=10000):
+    # Open or create the given download cache file. The parent directory
+    # must exist. Returns None if the file cannot be used.
+    try:
+        (sqlite3, db) = get_db(dbfile, stderr, create_version=(SCHEMA_v1, 1),
+                               dbname="download cache")
+        return DownloadCache(sqlite3, db, max_entries=max_entries)
+    except DBError as e:
+        print(e, file=stderr)
+        return None
+
+
+def _pack_hashes(hashes):
+    return json.dumps(dict([(str(hashnum), base32.b2a(h))
+                            for (hashnum, h) in hashes.items()]))
+
+def _unpack_hashes(hashes):
+    return dict([(int(hashnum), base32.a2b(str(h)))
+                 for (hashnum, h) in json.loads(hashes).items()])
+
+
+@implementer(IStatsProducer)
+class DownloadCache(object):
+    """I map the storage index and UEB hash of an immutable file to its UEB,
+    the hash tree nodes that were validated while reading it, and the
+    servers that held its shares."""
+
+    def __init__(self, sqlite_module, connection, max_entries=10000):
+        self.sqlite_module = sqlite_module
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.max_entries = max_entries
+        # a hit is a DownloadNode that started with a (valid) entry, a miss
+        # is one that found no entry, and a bad entry is one that did not
+        # validate (it is removed, and that node counts as a miss too)
+        self.counters = {"hits": 0, "misses": 0, "bad": 0}
+
+    def _now(self):
+        return time.time()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, storage_index, ueb_hash):
+        """Return (UEB, share_hashes, crypttext_hashes, servers) for the
+        given file, or None if there is no entry for it. The hashes are dicts
+        mapping hashnum to hash, and servers is a dict mapping shnum to a set
+        of serverids."""
+        key = (base32.b2a(storage_index), base32.b2a(ueb_hash))
+        c = self.cursor
+        c.execute("SELECT ueb, share_hashes, crypttext_hashes, servers"
+                  " FROM files WHERE storage_index=? AND ueb_hash=?", key)
+        row = c.fetchone()
+        if not row:
+            return None
+        (ueb, share_hashes, crypttext_hashes, servers) = row
+        c.execute("UPDATE files SET last_used=?"
+                  " WHERE storage_index=? AND ueb_hash=?",
+                  (self._now(),) + key)
+        self.connection.commit()
+        servers = dict([(int(shnum), set([base32.a2b(str(s))
+                                          for s in serverids]))
+                        for (shnum, serverids) in json.loads(servers).items()])
+        return (base32.a2b(str(ueb)), _unpack_hashes(share_hashes),
+                _unpack_hashes(crypttext_hashes), servers)
+
+    def add(self, storage_index, ueb_hash, ueb, share_hashes,
+            crypttext_hashes, servers):
+        """Remember what was learned about the given file. This replaces any
+        earlier entry for it."""
+        servers = json.dumps(dict([(str(shnum), sorted([base32.b2a(s)
+                                                        for s in serverids]))
+                                   for (shnum, serverids) in servers.items()]))
+        self.cursor.execute("INSERT OR REPLACE INTO files"
+                            " (storage_index, ueb_hash, ueb, share_hashes,"
+                            "  crypttext_hashes, servers, last_used)"
+                            " VALUES (?,?,?,?,?,?,?)",
+                            (base32.b2a(storage_index), base32.b2a(ueb_hash),
+                             base32.b2a(ueb), _pack_hashes(share_hashes),
+                             _pack_hashes(crypttext_hashes), servers,
+                             self._now()))
+        self._evict()
+        self.connection.commit()
+
+    def remove(self, storage_index, ueb_hash):
+        self.cursor.execute("DELETE FROM files"
+                            " WHERE storage_index=? AND ueb_hash=?",
+                            (base32.b2a(storage_index), base32.b2a(ueb_hash)))
+        self.connection.commit()
+
+    def _evict(self):
+        c = self.cursor
+        c.execute("SELECT COUNT(*) FROM files")
+        excess = c.fetchone()[0] - self.max_entries
+        if excess > 0:
+            c.execute("DELETE FROM files WHERE rowid IN"
+                      " (SELECT rowid FROM files"
+                      "  ORDER BY last_used ASC LIMIT ?)", (excess,))
+
+    def count(self, name):
+        self.counters[name] += 1
+
+    def get_entries(self):
+        self.cursor.execute("SELECT COUNT(*) FROM files")
+        return self.cursor.fetchone()[0]
+
+    def get_stats(self):
+        stats = {"downloader.metadata_cache.entries": self.get_entries()}
+        for (name, value) in self.counters.items():
+            stats["downloader.metadata_cache.%s" % name] = value
+        return stats
@@ -262,3 +262,88 @@ class SegmentFetcher(object):
             pass
 
         eventually(self.loop)
+
+
+class SegmentSizeFetcher(object):
+    """I am responsible for getting a valid UEB, so that my parent node
+    learns the segment size (and the rest of the file's layout) without
+    fetching a segment. I ask the Share instances passed to my add_shares()
+    method for it, one at a time, in order of "goodness", and move on to the
+    next one if a share fails. I call my parent's want_more_shares() method
+    when I run out, and expect to see add_shares() or no_more_shares()
+    afterwards.
+
+    My parent will stop() me once it has stored a valid UEB (whether it came
+    from me or from a SegmentFetcher). If none of the shares can provide
+    one, I call my parent's segsize_failed() method with (self, f)."""
+
+    def __init__(self, node, logparent):
+        self._node = node # _Node
+        self._shares = [] # unused Share instances, sorted like
+                          # SegmentFetcher._shares
+        self._active = None # (Share, EventStreamObserver)
+        self._lp = logparent
+        self._no_more_shares = False
+        self._last_failure = None
+        self._running = True
+
+    def stop(self):
+        log.msg("SegmentSizeFetcher(%s).stop" % self._node._si_prefix,
+                level=log.NOISY, parent=self._lp, umid="Wl2V3w")
+        if self._active:
+            (share, o) = self._active
+            o.cancel()
+            self._active = None
+        self._running = False
+        self._shares = []
+
+    def add_shares(self, shares):
+        self._shares.extend(shares)
+        self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
+        eventually(self.loop)
+
+    def no_more_shares(self):
+        self._no_more_shares = True
+        eventually(self.loop)
+
+    def loop(self):
+        try:
+            self._do_loop()
+        except BaseException:
+            self._node.segsize_failed(self, Failure())
+            raise
+
+    def _do_loop(self):
+        if not self._running or self._active:
+            return
+        while self._shares:
+            share = self._shares.pop(0)
+            if share.is_alive():
+                o = share.get_UEB()
+                self._active = (share, o)
+                o.subscribe(self._UEB_request_activity, share=share)
+                return
+        if not self._no_more_shares:
+            self._node.want_more_shares()
+            return
+        format = ("no shares could provide the UEB."
+                  " Last failure: %(last_failure)s")
+        args = {"last_failure": self._last_failure}
+        log.msg(format=format,
+                level=log.UNUSUAL, parent=self._lp, umid="zJ1fJw", **args)
+        f = Failure(NoSharesError(format % args))
+        self.stop()
+        self._node.segsize_failed(self, f)
+
+    def _UEB_request_activity(self, share, state, f=None):
+        if not self._running:
+            return
+        log.msg("SegmentSizeFetcher(%s)._UEB_request_activity: %s -> %s" %
+                (self._node._si_prefix, repr(share), state),
+                level=log.NOISY, parent=self._lp, umid="d2Xb6A")
+        if state is DEAD:
+            self._last_failure = f
+        if state in (COMPLETE, DEAD):
+            self._active = None
+            # if COMPLETE, our parent will stop us before the next loop
+            eventually(self.loop)
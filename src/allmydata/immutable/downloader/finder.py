@@ -38,6 +38,7 @@ class ShareFinder(object):
         self._hungry = False
 
         self._commonshares = {} # shnum to CommonShare instance
+        self._preferred_serverids = frozenset()
         self.pending_requests = set()
         self.overdue_requests = set() # subset of pending_requests
         self.overdue_timers = {}
@@ -56,6 +57,11 @@ class ShareFinder(object):
         for cs in self._commonshares.values():
             cs.set_authoritative_num_segments(numsegs)
 
+    def prefer_servers(self, serverids):
+        # ask these servers (which held shares of this file before) first,
+        # then the rest in permuted order
+        self._preferred_serverids = frozenset(serverids)
+
     def start_finding_servers(self):
         # don't get servers until somebody uses us: creating the
         # ImmutableFileNode should not cause work to happen yet. Test case is
@@ -63,6 +69,10 @@ class ShareFinder(object):
         if not self._started:
             si = self.verifycap.storage_index
             servers = self._storage_broker.get_servers_for_psi(si)
+            if self._preferred_serverids:
+                preferred = self._preferred_serverids
+                servers = sorted(servers, key=lambda s:
+                                 s.get_serverid() not in preferred)
             self._servers = iter(servers)
             self._started = True
 
@@ -7,14 +7,14 @@ from twisted.internet import defer
 from foolscap.api import eventually
 from allmydata import uri
 from allmydata.codec import CRSDecoder
-from allmydata.util import base32, log, hashutil, mathutil, observer
+from allmydata.util import base32, log, hashutil, mathutil
 from allmydata.interfaces import DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.hashtree import IncompleteHashTree, BadHashError, \
      NotEnoughHashesError
 
 # local imports
 from finder import ShareFinder
-from fetcher import SegmentFetcher
+from fetcher import SegmentFetcher, SegmentSizeFetcher
 from segmentation import Segmentation
 from common import BadCiphertextHashError
 
@@ -33,14 +33,27 @@ class Cancel(object):
             self.active = False
             self._f(self)
 
+def _known_hashes(hashtree):
+    # the nodes of an IncompleteHashTree that are filled in, as a dict
+    return dict([(hashnum, h) for (hashnum, h) in enumerate(hashtree)
+                 if h is not None])
+
 
 class DownloadNode(object):
     """Internal class which manages downloads and holds state. External
     callers use CiphertextFileNode instead."""
 
+    # when a read() spans several segments, up to READAHEAD segments beyond
+    # the one it is waiting for are fetched at the same time, as long as
+    # they take no more than READAHEAD_MEMORY bytes
+    READAHEAD = 0
+    READAHEAD_MEMORY = 8*1024*1024
+
     # Share._node points to me
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history, download_status):
+                 terminator, history, download_status,
+                 readahead=None, readahead_memory=None, segment_cache=None,
+                 metadata_cache=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
@@ -57,6 +70,20 @@ class DownloadNode(object):
         self._secret_holder = secret_holder
         self._history = history
         self._download_status = download_status
+        if readahead is None:
+            readahead = self.READAHEAD
+        self._readahead = readahead
+        if readahead_memory is None:
+            readahead_memory = self.READAHEAD_MEMORY
+        self._readahead_memory = readahead_memory
+        # a SegmentCache, shared with the other DownloadNodes of our client
+        self._segment_cache = segment_cache
+        self._cache_key = (verifycap.storage_index,
+                           verifycap.uri_extension_hash)
+        # a DownloadCache, which remembers the UEB, hashes and servers of
+        # the files we have read, and primes new nodes with them
+        self._metadata_cache = metadata_cache
+        self._saved_metadata = None
 
         self.share_hash_tree = IncompleteHashTree(self._verifycap.total_shares)
 
@@ -69,6 +96,7 @@ class DownloadNode(object):
 
         # filled in when we parse a valid UEB
         self.have_UEB = False
+        self._UEB_s = None
         self.segment_size = None
         self.tail_segment_size = None
         self.tail_segment_padded = None
@@ -80,9 +108,12 @@ class DownloadNode(object):
 
         # _segment_requests can have duplicates
         self._segment_requests = [] # (segnum, d, cancel_handle, seg_ev, lp)
-        self._active_segment = None # a SegmentFetcher, with .segnum
+        self._active_segments = {} # maps segnum to SegmentFetcher
 
-        self._segsize_observers = observer.OneShotObserverList()
+        # get_segsize() callers wait for a SegmentSizeFetcher, which fetches
+        # a UEB but no segment
+        self._segsize_requests = [] # Deferreds
+        self._segsize_fetcher = None
 
         # we create one top-level logparent for this _Node, and another one
         # for each read() call. Segmentation and get_segment() messages are
@@ -102,6 +133,59 @@ class DownloadNode(object):
                                         self._download_status, lp)
         self._shares = set()
 
+        if self._metadata_cache is not None:
+            self._load_metadata()
+
+    def _load_metadata(self):
+        cache = self._metadata_cache
+        entry = cache.get(*self._cache_key)
+        if entry is None:
+            cache.count("misses")
+            return
+        (UEB_s, share_hashes, crypttext_hashes, servers) = entry
+        try:
+            # these are all checked against our verifycap again
+            self.validate_and_store_UEB(UEB_s)
+            self.process_share_hashes(share_hashes)
+            self.process_ciphertext_hashes(crypttext_hashes)
+        except (BadHashError, NotEnoughHashesError):
+            log.msg(format="bad download cache entry for SI=%(si)s",
+                    si=self._si_prefix, failure=Failure(),
+                    level=log.UNUSUAL, parent=self._lp, umid="r5Hhxg")
+            cache.remove(*self._cache_key)
+            cache.count("bad")
+            cache.count("misses")
+            return
+        cache.count("hits")
+        # our Shares can use the real segment size to find their offsets
+        self.guessed_segment_size = self.segment_size
+        self.guessed_num_segments = self.num_segments
+        # and the ShareFinder can ask the servers that had them first
+        serverids = set()
+        for shnum_serverids in servers.values():
+            serverids.update(shnum_serverids)
+        self._sharefinder.prefer_servers(serverids)
+        self._saved_metadata = (share_hashes, crypttext_hashes, servers)
+
+    def _save_metadata(self):
+        if self._metadata_cache is None or not self.have_UEB:
+            return
+        share_hashes = _known_hashes(self.share_hash_tree)
+        crypttext_hashes = _known_hashes(self.ciphertext_hash_tree)
+        servers = {}
+        for share in self._shares:
+            if share.is_alive():
+                servers.setdefault(share._shnum, set()).add(
+                    share._server.get_serverid())
+        metadata = (share_hashes, crypttext_hashes, servers)
+        if metadata == self._saved_metadata:
+            return
+        self._metadata_cache.add(self._verifycap.storage_index,
+                                 self._verifycap.uri_extension_hash,
+                                 self._UEB_s, share_hashes, crypttext_hashes,
+                                 servers)
+        self._saved_metadata = metadata
+
     def _build_guessed_tables(self, max_segment_size):
         size = min(self._verifycap.size, max_segment_size)
         s = mathutil.next_multiple(size, self._verifycap.needed_shares)
@@ -118,9 +202,12 @@ class DownloadNode(object):
 
     def stop(self):
         # called by the Terminator at shutdown, mostly for tests
-        if self._active_segment:
-            self._active_segment.stop()
-            self._active_segment = None
+        for fetcher in self._active_segments.values():
+            fetcher.stop()
+        self._active_segments = {}
+        if self._segsize_fetcher:
+            self._segsize_fetcher.stop()
+            self._segsize_fetcher = None
         self._sharefinder.stop()
 
     # things called by outside callers, via CiphertextFileNode. get_segment()
@@ -175,6 +262,8 @@ class DownloadNode(object):
         d = s.start()
         def _done(res):
             read_ev.finished(now())
+            if not isinstance(res, Failure):
+                self._save_metadata()
             return res
         d.addBoth(_done)
         return d
@@ -204,36 +293,69 @@ class DownloadNode(object):
         seg_ev = self._download_status.add_segment_request(segnum, now())
         d = defer.Deferred()
         c = Cancel(self._cancel_request)
+        cached = self._get_cached_segment(segnum)
+        if cached is not None:
+            (offset, segment) = cached
+            when = now()
+            seg_ev.activate(when)
+            seg_ev.deliver(when, offset, len(segment), 0)
+            eventually(self._deliver, d, c, (offset, segment, 0))
+            return (d, c)
         self._segment_requests.append( (segnum, d, c, seg_ev, lp) )
         self._start_new_segment()
         return (d, c)
 
+    def _get_cached_segment(self, segnum):
+        # Segmentation can only recover from asking for the wrong segnum
+        # (which it does while it has to guess the segment size) once we
+        # know the real segment size, so until then we fetch everything
+        if self._segment_cache is None or self.segment_size is None:
+            return None
+        return self._segment_cache.get(self._cache_key, segnum)
+
     def get_segsize(self):
         """Return a Deferred that fires when we know the real segment size."""
         if self.segment_size:
             return defer.succeed(self.segment_size)
-        # TODO: this downloads (and discards) the first segment of the file.
-        # We could make this more efficient by writing
-        # fetcher.SegmentSizeFetcher, with the job of finding a single valid
-        # share and extracting the UEB. We'd add Share.get_UEB() to request
-        # just the UEB.
-        (d,c) = self.get_segment(0)
-        # this ensures that an error during get_segment() will errback the
-        # caller, so Repair won't wait forever on completely missing files
-        d.addCallback(lambda ign: self._segsize_observers.when_fired())
+        # this only fetches the offset table and the UEB from one share. If
+        # no share can provide them, the Deferred errbacks, so Repair won't
+        # wait forever on completely missing files
+        d = defer.Deferred()
+        self._segsize_requests.append(d)
+        if self._segsize_fetcher is None:
+            log.msg(format="%(node)s.get_segsize: fetching the UEB",
+                    node=repr(self), level=log.NOISY, parent=self._lp,
+                    umid="l9Ypcw")
+            self._segsize_fetcher = SegmentSizeFetcher(self, self._lp)
+            active_shares = [s for s in self._shares if s.is_alive()]
+            self._segsize_fetcher.add_shares(active_shares)
         return d
 
+    def get_readahead_window(self):
+        """Return how many segments beyond the one that a read() is waiting
+        for may be fetched at the same time."""
+        segment_size = self.segment_size or self.guessed_segment_size
+        return max(0, min(self._readahead,
+                          self._readahead_memory // segment_size))
+
     # things called by the Segmentation object used to transform
     # arbitrary-sized read() calls into quantized segment fetches
 
     def _start_new_segment(self):
-        if self._active_segment is None and self._segment_requests:
-            (segnum, d, c, seg_ev, lp) = self._segment_requests[0]
+        # the oldest requests are fetched first, and at most
+        # 1+get_readahead_window() of them at a time
+        max_active = 1 + self.get_readahead_window()
+        for (segnum, d, c, seg_ev, lp) in self._segment_requests:
+            if len(self._active_segments) >= max_active:
+                break
+            if segnum in self._active_segments:
+                continue
             k = self._verifycap.needed_shares
             log.msg(format="%(node)s._start_new_segment: segnum=%(segnum)d",
                     node=repr(self), segnum=segnum,
                     level=log.NOISY, parent=lp, umid="wAlnHQ")
-            self._active_segment = fetcher = SegmentFetcher(self, segnum, k, lp)
+            fetcher = SegmentFetcher(self, segnum, k, lp)
+            self._active_segments[segnum] = fetcher
             seg_ev.activate(now())
             active_shares = [s for s in self._shares if s.is_alive()]
             fetcher.add_shares(active_shares) # this triggers the loop
@@ -242,12 +364,16 @@ class DownloadNode(object):
     # called by our child ShareFinder
     def got_shares(self, shares):
         self._shares.update(shares)
-        if self._active_segment:
-            self._active_segment.add_shares(shares)
+        for fetcher in self._active_segments.values():
+            fetcher.add_shares(shares)
+        if self._segsize_fetcher:
+            self._segsize_fetcher.add_shares(shares)
     def no_more_shares(self):
         self._no_more_shares = True
-        if self._active_segment:
-            self._active_segment.no_more_shares()
+        for fetcher in self._active_segments.values():
+            fetcher.no_more_shares()
+        if self._segsize_fetcher:
+            self._segsize_fetcher.no_more_shares()
 
     # things called by our Share instances
 
@@ -258,6 +384,7 @@ class DownloadNode(object):
         if h != self._verifycap.uri_extension_hash:
             raise BadHashError
         self._parse_and_store_UEB(UEB_s) # sets self._stuff
+        self._UEB_s = UEB_s
         # TODO: a malformed (but authentic) UEB could throw an assertion in
         # _parse_and_store_UEB, and we should abandon the download.
         self.have_UEB = True
@@ -267,6 +394,14 @@ class DownloadNode(object):
         # instances, and will populate new ones with the correct value.
         self._sharefinder.update_num_segments()
 
+        # and tell anyone who was waiting for the segment size
+        if self._segsize_fetcher:
+            self._segsize_fetcher.stop()
+            self._segsize_fetcher = None
+        requests, self._segsize_requests = self._segsize_requests, []
+        for d in requests:
+            eventually(d.callback, self.segment_size)
+
     def _parse_and_store_UEB(self, UEB_s):
         # Note: the UEB contains needed_shares and total_shares. These are
         # redundant and inferior (the filecap contains the authoritative
@@ -289,7 +424,6 @@ class DownloadNode(object):
         k, N = self._verifycap.needed_shares, self._verifycap.total_shares
 
         self.segment_size = d['segment_size']
-        self._segsize_observers.fire(self.segment_size)
 
         r = self._calculate_sizes(self.segment_size)
         self.tail_segment_size = r["tail_segment_size"]
@@ -395,13 +529,20 @@ class DownloadNode(object):
     def want_more_shares(self):
         self._sharefinder.hungry()
 
+    def segsize_failed(self, ssf, f):
+        assert ssf is self._segsize_fetcher
+        self._segsize_fetcher = None
+        requests, self._segsize_requests = self._segsize_requests, []
+        for d in requests:
+            eventually(d.errback, f)
+
     def fetch_failed(self, sf, f):
-        assert sf is self._active_segment
+        assert sf is self._active_segments.get(sf.segnum)
         # deliver error upwards
         for (d,c,seg_ev) in self._extract_requests(sf.segnum):
             seg_ev.error(now())
             eventually(self._deliver, d, c, f)
-        self._active_segment = None
+        del self._active_segments[sf.segnum]
         self._start_new_segment()
 
     def process_blocks(self, segnum, blocks):
@@ -421,6 +562,9 @@ class DownloadNode(object):
                     eventually(self._deliver, d, c, result)
             else:
                 (offset, segment, decodetime) = result
+                if self._segment_cache is not None:
+                    self._segment_cache.add(self._cache_key, segnum,
+                                            offset, segment)
                 for (d,c,seg_ev) in self._extract_requests(segnum):
                     # when we have two requests for the same segment, the
                     # second one will not be "activated" before the data is
@@ -433,7 +577,7 @@ class DownloadNode(object):
                     seg_ev.deliver(when, offset, len(segment), decodetime)
                     eventually(self._deliver, d, c, result)
             self._download_status.add_misc_event("process_block", start, now())
-            self._active_segment = None
+            self._active_segments.pop(segnum, None)
             self._start_new_segment()
         d.addBoth(_deliver)
         d.addErrback(log.err, "unhandled error during process_blocks",
@@ -478,7 +622,7 @@ class DownloadNode(object):
     def _check_ciphertext_hash(self, segment_and_decodetime, segnum):
         (segment, decodetime) = segment_and_decodetime
         start = now()
-        assert self._active_segment.segnum == segnum
+        assert segnum in self._active_segments
         assert self.segment_size is not None
         offset = segnum * self.segment_size
 
@@ -520,11 +664,13 @@ class DownloadNode(object):
         self._segment_requests = [t for t in self._segment_requests
                                   if t[2] != cancel]
         segnums = [segnum for (segnum,d,c,seg_ev,lp) in self._segment_requests]
-        # self._active_segment might be None in rare circumstances, so make
-        # sure we tolerate it
-        if self._active_segment and self._active_segment.segnum not in segnums:
-            self._active_segment.stop()
-            self._active_segment = None
+        stopped = False
+        for (segnum, fetcher) in self._active_segments.items():
+            if segnum not in segnums:
+                fetcher.stop()
+                del self._active_segments[segnum]
+                stopped = True
+        if stopped:
             self._start_new_segment()
 
     # called by ShareFinder to choose hashtree sizes in CommonShares, and by
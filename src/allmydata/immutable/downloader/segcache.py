@@ -0,0 +1,58 @@
+
+from collections import OrderedDict
+from zope.interface import implementer
+from allmydata.interfaces import IStatsProducer
+
+@implementer(IStatsProducer)
+class SegmentCache(object):
+    """I hold recently downloaded immutable segments, for all of the
+    DownloadNodes of a client, so that a segment which one read() just
+    fetched does not have to be fetched and decoded again by the next.
+
+    Segments are stored after they have been checked against the ciphertext
+    hash tree, and are still encrypted. They are keyed by the storage index
+    and the UEB hash of the verifycap that they were checked against (two
+    files with the same storage index are not necessarily the same file)
+    and by the segment number. When they take more than max_size bytes, the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._segments = OrderedDict() # (key, segnum) -> (offset, segment)
+        self._size = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, segnum):
+        """Return (offset, segment) for the given segment, or None if it is
+        not cached."""
+        entry = self._segments.pop((key, segnum), None)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        self._segments[(key, segnum)] = entry # now the most recently used
+        return entry
+
+    def add(self, key, segnum, offset, segment):
+        if len(segment) > self.max_size:
+            return
+        old = self._segments.pop((key, segnum), None)
+        if old is not None:
+            self._size -= len(old[1])
+        self._segments[(key, segnum)] = (offset, segment)
+        self._size += len(segment)
+        while self._size > self.max_size:
+            (ign, (ign, evicted)) = self._segments.popitem(last=False)
+            self._size -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def get_size(self):
+        return self._size
+
+    def get_stats(self):
+        stats = {"downloader.segment_cache.entries": len(self._segments),
+                 "downloader.segment_cache.size": self._size}
+        for (name, value) in self.counters.items():
+            stats["downloader.segment_cache.%s" % name] = value
+        return stats
@@ -18,6 +18,11 @@ class Segmentation(object):
     (from my CiphertextDownloader) in order, and trim the segments down to
     match the offset+size span. I use the Producer/Consumer interface to only
     request one segment at a time.
+
+    Once I have delivered the first segment of a read that spans several,
+    the read is sequential, so I also request up to the node's read-ahead
+    window of the segments that come after the one I am waiting for. They
+    are fetched at the same time, and handed to the consumer in order.
     """
     def __init__(self, node, offset, size, consumer, read_ev, logparent=None):
         self._node = node
@@ -33,6 +38,8 @@ class Segmentation(object):
         self._read_ev = read_ev
         self._start_pause = None
         self._lp = logparent
+        self._sequential = False
+        self._readahead = {} # maps segnum to (d, c) of get_segment()
 
     def start(self):
         self._alive = True
@@ -43,9 +50,17 @@ class Segmentation(object):
         return self._deferred
 
     def _done(self, res):
+        self._cancel_readahead()
         self._consumer.unregisterProducer()
         return res
 
+    def _cancel_readahead(self):
+        for (d, c) in self._readahead.values():
+            c.cancel()
+            # it may have failed before it was cancelled
+            d.addErrback(lambda f: None)
+        self._readahead = {}
+
     def _maybe_fetch_next(self):
         if not self._alive or not self._hungry:
             return
@@ -76,8 +91,13 @@ class Segmentation(object):
                 offset=self._offset, guess=guess_s, segnum=wanted_segnum,
                 level=log.NOISY, parent=self._lp, umid="5WfN0w")
         self._active_segnum = wanted_segnum
-        d,c = n.get_segment(wanted_segnum, self._lp)
+        if wanted_segnum in self._readahead:
+            d,c = self._readahead.pop(wanted_segnum)
+        else:
+            d,c = n.get_segment(wanted_segnum, self._lp)
         self._cancel_segment_request = c
+        if have_actual_segment_size and self._sequential:
+            self._read_ahead(wanted_segnum)
         d.addBoth(self._request_retired)
         d.addCallback(self._got_segment, wanted_segnum)
         if not have_actual_segment_size:
@@ -85,6 +105,15 @@ class Segmentation(object):
             d.addErrback(self._retry_bad_segment)
         d.addErrback(self._error)
 
+    def _read_ahead(self, segnum):
+        n = self._node
+        window = n.get_readahead_window()
+        last_segnum = (self._offset + self._size - 1) // n.segment_size
+        for ahead in range(segnum+1, min(segnum+window, last_segnum)+1):
+            if ahead not in self._readahead:
+                self._readahead[ahead] = n.get_segment(ahead, self._lp)
+        self._read_ev.update_readahead(len(self._readahead))
+
     def _request_retired(self, res):
         self._active_segnum = None
         self._cancel_segment_request = None
@@ -121,6 +150,9 @@ class Segmentation(object):
 
         self._offset += len(desired_data)
         self._size -= len(desired_data)
+        if self._size:
+            # we will want the following segments too
+            self._sequential = True
         self._consumer.write(desired_data)
         # the consumer might call our .pauseProducing() inside that write()
         # call, setting self._hungry=False
@@ -143,6 +175,7 @@ class Segmentation(object):
                 level=log.WEIRD, parent=self._lp, umid="EYlXBg")
         self._alive = False
         self._hungry = False
+        self._cancel_readahead()
         self._deferred.errback(f)
 
     def stopProducing(self):
@@ -154,6 +187,7 @@ class Segmentation(object):
         if self._cancel_segment_request:
             self._cancel_segment_request.cancel()
             self._cancel_segment_request = None
+        self._cancel_readahead()
         e = DownloadStopped("our Consumer called stopProducing()")
         self._deferred.errback(e)
 
@@ -84,6 +84,7 @@ class Share(object):
         # download can re-fetch it.
 
         self._requested_blocks = [] # (segnum, set(observer2..))
+        self._UEB_observers = set() # from get_UEB()
         v = server.get_version()
         ver = v["http://allmydata.org/tahoe/protocols/storage/v1"]
         self._overrun_ok = ver["tolerates-immutable-read-overrun"]
@@ -170,6 +171,26 @@ class Share(object):
         self.schedule_loop()
         return o
 
+    def get_UEB(self):
+        """Ask for the offset table and the UEB, but no block. This lets
+        our DownloadNode learn the segment size without fetching (and
+        decoding) a whole segment.
+
+        I return an EventStreamObserver, like get_block(), which will see
+        state=COMPLETE once the node has a valid UEB, or state=DEAD (with f=)
+        if this share cannot provide one.
+        """
+        log.msg("%s.get_UEB()" % repr(self),
+                level=log.NOISY, parent=self._lp, umid="0Hc4Vg")
+        o = EventStreamObserver()
+        o.set_canceler(self, "_cancel_UEB_request")
+        self._UEB_observers.add(o)
+        self.schedule_loop()
+        return o
+
+    def _cancel_UEB_request(self, o):
+        self._UEB_observers.discard(o)
+
     def _cancel_block_request(self, o):
         new_requests = []
         for e in self._requested_blocks:
@@ -299,6 +320,9 @@ class Share(object):
             # guessed wrong, we might stil be working on a bogus segnum
             # (beyond the real range). We catch this and signal BADSEGNUM
             # before invoking any further code that touches hashtrees.
+        for o in self._UEB_observers:
+            o.notify(state=COMPLETE)
+        self._UEB_observers.clear()
         self.actual_segment_size = self._node.segment_size # might be updated
         assert self.actual_segment_size is not None
 
@@ -544,15 +568,14 @@ class Share(object):
         # this block is being retired, either as COMPLETE or CORRUPT, since
         # no further data reads will help
         assert self._requested_blocks[0][0] == segnum
+        delivered = False
         try:
             self._commonshare.check_block(segnum, block)
             # hurrah, we have a valid block. Deliver it.
             for o in observers:
                 # goes to SegmentFetcher._block_request_activity
                 o.notify(state=COMPLETE, block=block)
-            # now clear our received data, to dodge the #1170 spans.py
-            # complexity bug
-            self._received = DataSpans()
+            delivered = True
         except (BadHashError, NotEnoughHashesError) as e:
             # rats, we have a corrupt block. Notify our clients that they
             # need to look elsewhere, and advise the server. Unlike
@@ -568,10 +591,33 @@ class Share(object):
             self.had_corruption = True
         # in either case, we've retired this block
         self._requested_blocks.pop(0)
+        if delivered:
+            # now clear our received data, to dodge the #1170 spans.py
+            # complexity bug. Only the data that was read ahead for the
+            # blocks that are still requested is kept.
+            self._received = self._received_for_requested_blocks()
         # popping the request keeps us from turning around and wanting the
         # block again right away
         return True # got satisfaction
 
+    def _received_for_requested_blocks(self):
+        keep = Spans()
+        if self._requested_blocks and self.actual_offsets:
+            o = self.actual_offsets
+            segsize = self._node.segment_size
+            r = self._node._calculate_sizes(segsize)
+            for (segnum, observers) in self._requested_blocks:
+                if segnum < r["num_segments"]:
+                    self._desire_block_hashes((keep, keep, keep), o, segnum)
+                    self._desire_data((keep, keep, keep), o, r, segnum,
+                                      segsize)
+        received = DataSpans()
+        for (start, data) in self._received.get_chunks():
+            for (keep_start, keep_length) in keep & Spans(start, len(data)):
+                offset = keep_start - start
+                received.add(keep_start, data[offset:offset+keep_length])
+        return received
+
     def _desire(self):
         segnum, observers = self._active_segnum_and_observers() # maybe None
 
@@ -608,13 +654,23 @@ class Share(object):
         if self.actual_offsets or self._overrun_ok:
             if not self._node.have_UEB:
                 self._desire_UEB(desire, o)
-            self._desire_share_hashes(desire, o)
             if segnum is not None:
+                # a get_UEB() request does not need the share hashes
+                self._desire_share_hashes(desire, o)
                 # They might be asking for a segment number that is beyond
                 # what we guess the file contains, but _desire_block_hashes
                 # and _desire_data will tolerate that.
                 self._desire_block_hashes(desire, o, segnum)
                 self._desire_data(desire, o, r, segnum, segsize)
+            if self.actual_offsets and self._node.have_UEB:
+                # the blocks of any later segments that have been requested
+                # (by a read-ahead) are merely wanted, so they can share
+                # this round trip without being able to fail the share
+                readahead = (want_it, want_it, gotta_gotta_have_it)
+                for (later, observers) in self._requested_blocks[1:]:
+                    if later < r["num_segments"]:
+                        self._desire_block_hashes(readahead, o, later)
+                        self._desire_data(readahead, o, r, later, segsize)
 
         log.msg("end _desire: want_it=%s need_it=%s gotta=%s"
                 % (want_it.dump(), need_it.dump(), gotta_gotta_have_it.dump()),
@@ -823,6 +879,9 @@ class Share(object):
         for (segnum, observers) in self._requested_blocks:
             for o in observers:
                 o.notify(state=DEAD, f=f)
+        for o in self._UEB_observers:
+            o.notify(state=DEAD, f=f)
+        self._UEB_observers.clear()
 
 
 class CommonShare(object):
@@ -14,6 +14,9 @@ class ReadEvent(object):
         self._ev["decrypt_time"] += decrypttime
         self._ev["paused_time"] += pausetime
 
+    def update_readahead(self, segments):
+        self._ev["readahead"] = max(self._ev["readahead"], segments)
+
     def finished(self, finishtime):
         self._ev["finish_time"] = finishtime
         self._ds.update_last_timestamp(finishtime)
@@ -107,6 +110,8 @@ class DownloadStatus(object):
         #  bytes_returned (starts at 0, grows as segments are delivered)
         #  decrypt_time (time spent in decrypt, None for ciphertext-only reads)
         #  paused_time (time spent paused by client via pauseProducing)
+        #  readahead (most segments fetched ahead of the one being waited
+        #             for, 0 unless the read was sequential)
         self.read_events = []
 
         # self.segment_events tracks segment requests and their resolution.
@@ -162,6 +167,7 @@ class DownloadStatus(object):
               "bytes_returned": 0,
               "decrypt_time": 0,
               "paused_time": 0,
+              "readahead": 0,
               }
         self.read_events.append(r)
         return ReadEvent(r, self)
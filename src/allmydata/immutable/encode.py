@@ -3,12 +3,13 @@
 import time
 from zope.interface import implementer
 from twisted.internet import defer
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, eventually
 from allmydata import uri
 from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
 from allmydata.util import mathutil, hashutil, base32, log, happinessutil
 from allmydata.util.assertutil import _assert, precondition
+from allmydata.util.deferredutil import run_in_threadpool
 from allmydata.codec import CRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
      IEncryptedUploadable, IUploadStatus, UploadUnhappinessError
@@ -38,9 +39,13 @@ log(number of segments)).
 Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
-information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+information necessary to validate the data upon retrieval. Segments are
+read and encoded one at a time, in order, but several of them can be in
+flight at once: while the blocks for segment A are being delivered, segment
+B can be encoded and segment C read. The number of segments in flight is
+limited by 'segments_in_flight', and by the memory that they would hold
+('pipeline_memory'). With segments_in_flight=1, all blocks for segment A are
+delivered before any work is begun on segment B.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -76,9 +81,22 @@ PiB=1024*TiB
 
 @implementer(IEncoder)
 class Encoder(object):
-
-    def __init__(self, log_parent=None, upload_status=None, progress=None):
+    # how many segments may be read, encoded or sent at the same time
+    segments_in_flight = 3
+    # ... and how much memory (ciphertext plus encoded blocks) they may use
+    pipeline_memory = 8*MiB
+
+    def __init__(self, log_parent=None, upload_status=None, progress=None,
+                 segments_in_flight=None, pipeline_memory=None,
+                 threadpool=None):
         object.__init__(self)
+        # if set, the crypttext is hashed and zfec runs in one of these
+        # threads, so that the reactor can get on with other things
+        self._threadpool = threadpool
+        if segments_in_flight is not None:
+            self.segments_in_flight = segments_in_flight
+        if pipeline_memory is not None:
+            self.pipeline_memory = pipeline_memory
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
@@ -90,6 +108,11 @@ class Encoder(object):
                                    facility="tahoe.encoder", parent=log_parent)
         self._aborted = False
         self._progress = progress
+        # blocks that the shareholders already hold, from an earlier attempt
+        # at this upload: shareid -> set(segnum). They are still encoded,
+        # because the hash trees need them, but they are not sent again.
+        self._present_blocks = {}
+        self._skipped_blocks = 0
 
     def __repr__(self):
         if hasattr(self, "_storage_index"):
@@ -137,7 +160,7 @@ class Encoder(object):
         self.num_segments = mathutil.div_ceil(self.file_size,
                                               self.segment_size)
 
-        self._codec = CRSEncoder()
+        self._codec = CRSEncoder(self._threadpool)
         self._codec.set_params(self.segment_size,
                                self.required_shares, self.num_shares)
 
@@ -165,7 +188,7 @@ class Encoder(object):
         # the tail codec is responsible for encoding tail_size bytes
         padded_tail_size = mathutil.next_multiple(tail_size,
                                                   self.required_shares)
-        self._tail_codec = CRSEncoder()
+        self._tail_codec = CRSEncoder(self._threadpool)
         self._tail_codec.set_params(padded_tail_size,
                                     self.required_shares, self.num_shares)
         data['tail_codec_params'] = self._tail_codec.get_serialized_params()
@@ -209,6 +232,14 @@ class Encoder(object):
             assert isinstance(v, set)
         self.servermap = servermap.copy()
 
+    def set_present_blocks(self, present_blocks):
+        """present_blocks maps shareid to a set of segment numbers whose
+        blocks that shareholder already has."""
+        self._present_blocks = present_blocks
+
+    def get_skipped_blocks(self):
+        return self._skipped_blocks
+
     @log_call_deferred(action_type=u"immutable:encode:start")
     def start(self):
         """ Returns a Deferred that will fire with the verify cap (an instance of
@@ -225,9 +256,17 @@ class Encoder(object):
         # that we sent to that landlord.
         self.share_root_hashes = [None] * self.num_shares
 
+        # cumulative_reading is included in cumulative_encoding. When
+        # segments overlap, stage_overlap is the part of cumulative_encoding
+        # plus cumulative_sending that did not add to segment_pipeline, the
+        # wall-clock time from reading the first segment to having sent the
+        # last one.
         self._times = {
+            "cumulative_reading": 0.0,
             "cumulative_encoding": 0.0,
             "cumulative_sending": 0.0,
+            "segment_pipeline": 0.0,
+            "stage_overlap": 0.0,
             "hashes_and_close": 0.0,
             "total_encode_and_push": 0.0,
             }
@@ -236,20 +275,7 @@ class Encoder(object):
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
-
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
-
+        d.addCallback(lambda res: self._push_all_segments())
         d.addCallback(lambda res: self.finish_hashing())
 
         d.addCallback(lambda res:
@@ -304,6 +330,84 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
+    def get_segment_window(self):
+        """Return the number of segments that may be in flight at once."""
+        # until they have been sent, a segment's ciphertext and its blocks
+        # for all shares are kept in memory
+        segment_memory = (self.segment_size +
+                          self._codec.get_block_size() * self.num_shares)
+        window = min(self.segments_in_flight,
+                     self.pipeline_memory // segment_memory)
+        return max(window, 1)
+
+    def _push_all_segments(self):
+        # Each segment is read, encoded, and then sent. Reading and encoding
+        # happen in order, one segment at a time, in a single chain. Sending
+        # is started as soon as a segment has been encoded, but the chain
+        # goes on to the next segment without waiting for the shareholders
+        # to accept its blocks, as long as fewer than _window segments are
+        # in flight.
+        self._window = self.get_segment_window()
+        self.log("pushing %d segments, up to %d at a time"
+                 % (self.num_segments, self._window), level=log.NOISY)
+        self._in_flight = 0
+        self._room = None # fires when a segment has been sent
+        self._push_failure = None
+        self._sends = []
+        start = time.time()
+
+        d = defer.succeed(None)
+        for i in range(self.num_segments-1):
+            # note to self: this form doesn't work, because lambda only
+            # captures the slot, not the value
+            #d.addCallback(lambda res: self.do_segment(i))
+            # use this form instead:
+            d.addCallback(self._wait_for_room)
+            d.addCallback(lambda res, i=i: self._encode_segment(i))
+            d.addCallback(self._start_sending, i)
+            d.addCallback(self._turn_barrier)
+        last_segnum = self.num_segments - 1
+        d.addCallback(self._wait_for_room)
+        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
+        d.addCallback(self._start_sending, last_segnum)
+        d.addCallback(lambda res: defer.DeferredList(self._sends))
+        def _sent(res):
+            if self._push_failure:
+                return self._push_failure
+            elapsed = time.time() - start
+            self._times["segment_pipeline"] = elapsed
+            busy = (self._times["cumulative_encoding"] +
+                    self._times["cumulative_sending"])
+            self._times["stage_overlap"] = max(busy - elapsed, 0.0)
+        d.addCallback(_sent)
+        d.addCallback(self._turn_barrier)
+        return d
+
+    def _wait_for_room(self, res):
+        if self._push_failure:
+            # one of the segments could not be sent
+            return self._push_failure
+        if self._in_flight < self._window:
+            self._in_flight += 1
+            return None
+        self._room = defer.Deferred()
+        self._room.addCallback(self._wait_for_room)
+        return self._room
+
+    def _start_sending(self, shares_and_shareids, segnum):
+        d = self._send_segment(shares_and_shareids, segnum)
+        def _failed(f):
+            if not self._push_failure:
+                self._push_failure = f
+        d.addErrback(_failed)
+        def _sent(res):
+            self._in_flight -= 1
+            if self._room:
+                room, self._room = self._room, None
+                eventually(room.callback, None)
+        d.addCallback(_sent)
+        self._sends.append(d)
+
     def _encode_segment(self, segnum):
         codec = self._codec
         start = time.time()
@@ -404,27 +508,39 @@ class Encoder(object):
         if self._aborted:
             raise UploadAborted()
 
+        start = time.time()
         read_size = num_chunks * input_chunk_size
         d = self._uploadable.read_encrypted(read_size, hash_only=False)
         def _got(data):
             assert isinstance(data, (list,tuple))
             if self._aborted:
                 raise UploadAborted()
-            data = "".join(data)
-            precondition(len(data) <= read_size, len(data), read_size)
-            if not allow_short:
-                precondition(len(data) == read_size, len(data), read_size)
-            crypttext_segment_hasher.update(data)
-            self._crypttext_hasher.update(data)
-            if allow_short and len(data) < read_size:
-                # padding
-                data += "\x00" * (read_size - len(data))
-            encrypted_pieces = [data[i:i+input_chunk_size]
-                                for i in range(0, len(data), input_chunk_size)]
-            return encrypted_pieces
+            return run_in_threadpool(self._threadpool, self._hash_and_split,
+                                     data, read_size, input_chunk_size,
+                                     crypttext_segment_hasher, allow_short)
         d.addCallback(_got)
+        def _done(encrypted_pieces):
+            self._times["cumulative_reading"] += time.time() - start
+            return encrypted_pieces
+        d.addCallback(_done)
         return d
 
+    def _hash_and_split(self, data, read_size, input_chunk_size,
+                        crypttext_segment_hasher, allow_short):
+        # this may run in a thread (see _threadpool): no logging here
+        data = "".join(data)
+        precondition(len(data) <= read_size, len(data), read_size)
+        if not allow_short:
+            precondition(len(data) == read_size, len(data), read_size)
+        crypttext_segment_hasher.update(data)
+        self._crypttext_hasher.update(data)
+        if allow_short and len(data) < read_size:
+            # padding
+            data += "\x00" * (read_size - len(data))
+        encrypted_pieces = [data[i:i+input_chunk_size]
+                            for i in range(0, len(data), input_chunk_size)]
+        return encrypted_pieces
+
     def _send_segment(self, shares_and_shareids, segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
@@ -480,6 +596,9 @@ class Encoder(object):
     def send_block(self, shareid, segment_num, block, lognum):
         if shareid not in self.landlords:
             return defer.succeed(None)
+        if segment_num in self._present_blocks.get(shareid, ()):
+            self._skipped_blocks += 1
+            return defer.succeed(None)
         sh = self.landlords[shareid]
         lognum2 = self.log("put_block to %s" % self.landlords[shareid],
                            parent=lognum, level=log.NOISY)
@@ -1,5 +1,4 @@
 
-import binascii
 from time import time as now
 
 from zope.interface import implementer
@@ -23,13 +22,18 @@ from allmydata.immutable.downloader.status import DownloadStatus
 
 class CiphertextFileNode(object):
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history):
+                 terminator, history, readahead=None, readahead_memory=None,
+                 segment_cache=None, metadata_cache=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._terminator = terminator
         self._history = history
+        self._readahead = readahead
+        self._readahead_memory = readahead_memory
+        self._segment_cache = segment_cache
+        self._metadata_cache = metadata_cache
         self._download_status = None
         self._node = None # created lazily, on read()
 
@@ -44,7 +48,11 @@ class CiphertextFileNode(object):
             self._node = DownloadNode(self._verifycap, self._storage_broker,
                                       self._secret_holder,
                                       self._terminator,
-                                      self._history, self._download_status)
+                                      self._history, self._download_status,
+                                      readahead=self._readahead,
+                                      readahead_memory=self._readahead_memory,
+                                      segment_cache=self._segment_cache,
+                                      metadata_cache=self._metadata_cache)
 
     def read(self, consumer, offset=0, size=None):
         """I am the main entry point, from which FileNode.read() can get
@@ -90,12 +98,13 @@ class CiphertextFileNode(object):
     def is_mutable(self):
         return False
 
-    def check_and_repair(self, monitor, verify=False, add_lease=False):
+    def check_and_repair(self, monitor, verify=False, add_lease=False,
+                         prefetched_buckets=None):
         c = Checker(verifycap=self._verifycap,
                     servers=self._storage_broker.get_connected_servers(),
                     verify=verify, add_lease=add_lease,
                     secret_holder=self._secret_holder,
-                    monitor=monitor)
+                    monitor=monitor, prefetched_buckets=prefetched_buckets)
         d = c.start()
         d.addCallback(self._maybe_repair, monitor)
         return d
@@ -171,7 +180,8 @@ class CiphertextFileNode(object):
         crr.post_repair_results = prr
         return crr
 
-    def check(self, monitor, verify=False, add_lease=False):
+    def check(self, monitor, verify=False, add_lease=False,
+              prefetched_buckets=None):
         verifycap = self._verifycap
         sb = self._storage_broker
         servers = sb.get_connected_servers()
@@ -179,7 +189,7 @@ class CiphertextFileNode(object):
 
         v = Checker(verifycap=verifycap, servers=servers,
                     verify=verify, add_lease=add_lease, secret_holder=sh,
-                    monitor=monitor)
+                    monitor=monitor, prefetched_buckets=prefetched_buckets)
         return v.start()
 
 @implementer(IConsumer, IDownloadStatusHandlingConsumer)
@@ -193,17 +203,7 @@ class DecryptingConsumer(object):
         self._consumer = consumer
         self._read_ev = None
         self._download_status = None
-        # TODO: pycryptopp CTR-mode needs random-access operations: I want
-        # either a=AES(readkey, offset) or better yet both of:
-        #  a=AES(readkey, offset=0)
-        #  a.process(ciphertext, offset=xyz)
-        # For now, we fake it with the existing iv= argument.
-        offset_big = offset // 16
-        offset_small = offset % 16
-        iv = binascii.unhexlify("%032x" % offset_big)
-        self._decryptor = aes.create_decryptor(readkey, iv)
-        # this is just to advance the counter
-        aes.decrypt_data(self._decryptor, b"\x00" * offset_small)
+        self._decryptor = aes.create_decryptor(readkey, offset=offset)
 
     def set_download_status_read_event(self, read_ev):
         self._read_ev = read_ev
@@ -233,11 +233,16 @@ class ImmutableFileNode(object):
 
     # I wrap a CiphertextFileNode with a decryption key
     def __init__(self, filecap, storage_broker, secret_holder, terminator,
-                 history):
+                 history, readahead=None, readahead_memory=None,
+                 segment_cache=None, metadata_cache=None):
         assert isinstance(filecap, uri.CHKFileURI)
         verifycap = filecap.get_verify_cap()
         self._cnode = CiphertextFileNode(verifycap, storage_broker,
-                                         secret_holder, terminator, history)
+                                         secret_holder, terminator, history,
+                                         readahead=readahead,
+                                         readahead_memory=readahead_memory,
+                                         segment_cache=segment_cache,
+                                         metadata_cache=metadata_cache)
         assert isinstance(filecap, uri.CHKFileURI)
         self.u = filecap
         self._readkey = filecap.key
@@ -265,6 +270,10 @@ class ImmutableFileNode(object):
         d.addCallback(lambda dc: consumer)
         return d
 
+    def get_segment_size(self):
+        # return a Deferred that fires with the file's real segment size
+        return self._cnode.get_segment_size()
+
     def raise_error(self):
         pass
 
@@ -311,11 +320,15 @@ class ImmutableFileNode(object):
     def is_allowed_in_immutable_directory(self):
         return True
 
-    def check_and_repair(self, monitor, verify=False, add_lease=False):
-        return self._cnode.check_and_repair(monitor, verify, add_lease)
+    def check_and_repair(self, monitor, verify=False, add_lease=False,
+                         prefetched_buckets=None):
+        return self._cnode.check_and_repair(monitor, verify, add_lease,
+                                            prefetched_buckets)
 
-    def check(self, monitor, verify=False, add_lease=False):
-        return self._cnode.check(monitor, verify, add_lease)
+    def check(self, monitor, verify=False, add_lease=False,
+              prefetched_buckets=None):
+        return self._cnode.check(monitor, verify, add_lease,
+                                 prefetched_buckets)
 
     def get_best_readable_version(self):
         """
@@ -1,4 +1,5 @@
 
+from collections import deque
 from Queue import PriorityQueue
 
 
@@ -52,6 +53,76 @@ def bfs(graph, s):
         color[n] = BLACK
     return predecessor
 
+def maximum_matching(graph):
+    """
+    I return a maximum matching of the bipartite graph represented by my
+    graph argument, a dict mapping each vertex on the left side (a server)
+    to a list of the vertices on the right side (shares) that it is
+    connected to. The matching is a dict mapping left vertices to the
+    right vertex each one is matched with; unmatched vertices are left out.
+
+    This is the Hopcroft-Karp algorithm: each phase finds a maximal set of
+    shortest augmenting paths at once, with one BFS and a DFS from every
+    free left vertex, so it takes O(E*sqrt(V)) steps instead of the
+    O(V*E^2) (and O(V^2) memory) of running Edmonds-Karp on the flow
+    network.
+    """
+    lefts = sorted(graph)
+    match_left = {}
+    match_right = {}
+    while True:
+        # BFS from all free left vertices, numbering the layers of left
+        # vertices that alternating paths from them can reach
+        dist = {}
+        queue = deque()
+        for u in lefts:
+            if u not in match_left:
+                dist[u] = 0
+                queue.append(u)
+        found = False
+        while queue:
+            u = queue.popleft()
+            for v in graph[u]:
+                w = match_right.get(v)
+                if w is None:
+                    found = True
+                elif w not in dist:
+                    dist[w] = dist[u] + 1
+                    queue.append(w)
+        if not found:
+            return match_left
+        # DFS along those layers from each free left vertex
+        for u in lefts:
+            if u not in match_left:
+                _augment(graph, u, dist, match_left, match_right)
+
+def _augment(graph, root, dist, match_left, match_right):
+    # an iterative DFS, since recursion could go as deep as there are
+    # servers
+    stack = [(root, iter(graph[root]))]
+    path = [] # path[i] is the right vertex between stack[i] and stack[i+1]
+    while stack:
+        (u, neighbors) = stack[-1]
+        for v in neighbors:
+            w = match_right.get(v)
+            if w is None:
+                path.append(v)
+                for ((left, ignored), right) in zip(stack, path):
+                    match_left[left] = right
+                    match_right[right] = left
+                return True
+            if dist.get(w) == dist[u] + 1:
+                path.append(v)
+                stack.append((w, iter(graph[w])))
+                break
+        else:
+            # a dead end: don't try it again in this phase
+            dist[u] = None
+            stack.pop()
+            if path:
+                path.pop()
+    return False
+
 def residual_network(graph, f):
     """
     I return the residual network and residual capacity function of the
@@ -121,44 +192,28 @@ def _calculate_mappings(peers, shares, servermap=None):
 
 def _compute_maximum_graph(graph, shareIndices):
     """
-    This is an implementation of the Ford-Fulkerson method for finding
-    a maximum flow in a flow network applied to a bipartite graph.
-    Specifically, it is the Edmonds-Karp algorithm, since it uses a
-    BFS to find the shortest augmenting path at each iteration, if one
-    exists.
-
-    The implementation here is an adapation of an algorithm described in
-    "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
+    I find a maximum flow in the flow network built from a bipartite graph
+    of servers and shares (by _flow_network or _servermap_flow_graph),
+    which is the same thing as a maximum matching of that bipartite graph.
+    I return a dict mapping each share index to the index of the server it
+    was matched with, or to None.
+
+    This used to run Edmonds-Karp on the flow network, rebuilding the
+    residual network (an O(V^2) matrix) after every edge of every
+    augmenting path. Now the servers' edges are handed to
+    maximum_matching().
     """
 
     if graph == []:
         return {}
 
-    dim = len(graph)
-    flow_function = [[0 for sh in xrange(dim)] for s in xrange(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(residual_function[u][v] for (u, v) in path)
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-            residual_graph, residual_function = residual_network(graph,flow_function)
+    bipartite = dict([(peerIndex, graph[peerIndex]) for peerIndex in graph[0]])
+    share_to_peer = dict([(shareIndex, peerIndex) for (peerIndex, shareIndex)
+                          in maximum_matching(bipartite).items()])
 
     new_mappings = {}
     for shareIndex in shareIndices:
-        peer = residual_graph[shareIndex]
-        if peer == [dim - 1]:
-            new_mappings.setdefault(shareIndex, None)
-        else:
-            new_mappings.setdefault(shareIndex, peer[0])
+        new_mappings.setdefault(shareIndex, share_to_peer.get(shareIndex))
 
     return new_mappings
 
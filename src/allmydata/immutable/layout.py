@@ -1,9 +1,10 @@
-import struct
+import struct, time
 from zope.interface import implementer
 from twisted.internet import defer
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
      FileTooLargeError, HASH_SIZE
 from allmydata.util import mathutil, observer, pipeline
+from allmydata.util.spans import Spans
 from allmydata.util.assertutil import precondition
 from allmydata.storage.server import si_b2a
 
@@ -233,8 +234,20 @@ class WriteBucketProxy(object):
         # reduce the number of round trips, so it might not be worth the
         # effort.
 
-        return self._pipeline.add(len(data),
-                                  self._rref.callRemote, "write", offset, data)
+        return self._pipeline.add(len(data), self._timed_write, offset, data)
+
+    def _timed_write(self, offset, data):
+        # let uploads pick a segment size to suit the link (see
+        # upload.adaptive_segment_size)
+        started = time.time()
+        d = self._rref.callRemote("write", offset, data)
+        def _written(res):
+            if self._server is not None:
+                self._server.get_link_estimate().record_transfer(
+                    len(data), time.time() - started)
+            return res
+        d.addCallback(_written)
+        return d
 
     def close(self):
         d = self._pipeline.add(0, self._rref.callRemote, "close")
@@ -244,6 +257,22 @@ class WriteBucketProxy(object):
     def abort(self):
         return self._rref.callRemoteOnly("abort")
 
+    def get_written_blocks(self):
+        d = self._rref.callRemote("get_written")
+        def _got_written(runs):
+            written = Spans()
+            for (start, length) in runs:
+                written.add(start, length)
+            present = set()
+            for segnum in range(self._num_segments):
+                start = segnum * self._block_size
+                length = min(self._block_size, self._data_size - start)
+                if (self._offsets['data'] + start, length) in written:
+                    present.add(segnum)
+            return present
+        d.addCallback(_got_written)
+        return d
+
 
     def get_servername(self):
         return self._server.get_name()
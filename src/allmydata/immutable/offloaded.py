@@ -10,11 +10,15 @@ from allmydata.immutable import upload
 from allmydata.immutable.layout import ReadBucketProxy
 from allmydata.util.assertutil import precondition
 from allmydata.util import log, observer, fileutil, hashutil, dictutil
+from allmydata.util.rrefutil import add_version_to_remote_reference
 
 
 class NotEnoughWritersError(Exception):
     pass
 
+class ShortReadError(Exception):
+    pass
+
 
 class CHKCheckerAndUEBFetcher(object):
     """I check to see if a file is already present in the grid. I also fetch
@@ -136,7 +140,7 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
     def __init__(self, storage_index,
                  helper, storage_broker, secret_holder,
                  incoming_file, encoding_file,
-                 log_number, progress=None):
+                 log_number, progress=None, pipelined=False):
         upload.CHKUploader.__init__(self, storage_broker, secret_holder, progress=progress)
         self._storage_index = storage_index
         self._helper = helper
@@ -155,17 +159,30 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._fetcher = CHKCiphertextFetcher(self, incoming_file, encoding_file,
-                                             self._log_number)
+                                             self._log_number,
+                                             pipelined=pipelined)
         self._reader = LocalCiphertextReader(self, storage_index, encoding_file)
         self._finished_observers = observer.OneShotObserverList()
 
         self._started = time.time()
-        d = self._fetcher.when_done()
-        d.addCallback(lambda res: self._reader.start())
-        d.addCallback(lambda res: self.start_encrypted(self._reader))
+        if pipelined:
+            # start encoding as soon as the ciphertext starts to arrive
+            d = self._fetcher.when_started()
+            d.addCallback(lambda res: self._reader.start_streaming(self._fetcher))
+            d.addCallback(lambda res: self.start_encrypted(self._reader))
+            d.addCallback(self._wait_for_fetcher)
+        else:
+            d = self._fetcher.when_done()
+            d.addCallback(lambda res: self._reader.start())
+            d.addCallback(lambda res: self.start_encrypted(self._reader))
         d.addCallback(self._finished)
         d.addErrback(self._failed)
 
+    def _wait_for_fetcher(self, ur):
+        d = self._fetcher.when_done()
+        d.addCallback(lambda ign: ur)
+        return d
+
     def log(self, *args, **kwargs):
         if 'facility' not in kwargs:
             kwargs['facility'] = "tahoe.helper.chk"
@@ -230,11 +247,19 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
         hur.verifycapstr = vcapstr
 
         self._reader.close()
-        os.unlink(self._encoding_file)
+        os.unlink(self._reader.get_filename())
+        self._record_timings(hur.timings)
         self._finished_observers.fire(hur)
         self._helper.upload_finished(self._storage_index, v.size)
         del self._reader
 
+    def _record_timings(self, timings):
+        h = self._helper
+        h.count("chk_upload_helper.fetch_time", timings["total_fetch"])
+        h.count("chk_upload_helper.encode_and_push_time",
+                timings.get("total_encode_and_push", 0.0))
+        h.count("chk_upload_helper.upload_time", time.time() - self._started)
+
     def _failed(self, f):
         self.log(format="CHKUploadHelper(%(si)s) failed",
                  si=si_b2a(self._storage_index)[:5],
@@ -279,18 +304,32 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
 
     I fire my when_done() Deferred (with None) immediately after I have moved
     the ciphertext to 'encoded_file'.
+
+    If 'pipelined' is True, I keep up to FETCH_WINDOW reads outstanding (if
+    the readers can take them), and my when_started() Deferred fires as soon
+    as the ciphertext file exists, so that a LocalCiphertextReader can read
+    it while I am still fetching the rest (see when_fetched). The file is
+    then left in 'incoming_file'.
     """
 
-    def __init__(self, helper, incoming_file, encoded_file, logparent):
+    # in pipelined mode, this many read_encrypted() calls can be outstanding
+    FETCH_WINDOW = 4
+
+    def __init__(self, helper, incoming_file, encoded_file, logparent,
+                 pipelined=False):
         self._upload_helper = helper
         self._incoming_file = incoming_file
         self._encoding_file = encoded_file
         self._upload_id = helper._upload_id
         self._log_parent = logparent
         self._done_observers = observer.OneShotObserverList()
+        self._started_observers = observer.OneShotObserverList()
         self._readers = []
         self._started = False
         self._f = None
+        self._pipelined = pipelined
+        self._finished = False
+        self._waiters = [] # (offset, Deferred), for when_fetched()
         self._times = {
             "cumulative_fetch": 0.0,
             "total": 0.0,
@@ -305,8 +344,38 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
         return log.msg(*args, **kwargs)
 
     def add_reader(self, reader):
-        AskUntilSuccessMixin.add_reader(self, reader)
-        eventually(self._start)
+        if not self._pipelined:
+            AskUntilSuccessMixin.add_reader(self, reader)
+            eventually(self._start)
+            return
+        # find out whether this reader can take several reads at once
+        d = add_version_to_remote_reference(reader, self.READER_VERSION)
+        def _got_version(reader):
+            AskUntilSuccessMixin.add_reader(self, reader)
+            self._start()
+        def _failed(f):
+            # treat it like a reader without get_version(): if it is really
+            # gone, the first read will fail the upload
+            self.log("unable to get the version of reader %s" % reader,
+                     failure=f, level=log.UNUSUAL)
+            reader.version = self.READER_VERSION
+            _got_version(reader)
+        d.addCallbacks(_got_version, _failed)
+
+    READER_VERSION = { "http://allmydata.org/tahoe/protocols/helper/chk-upload/v1" :
+                        { "pipelined-reads": False,
+                          },
+                       "application-version": "unknown: no get_version()",
+                       }
+
+    def _get_window(self):
+        if not self._pipelined:
+            return 1
+        for reader in self._readers:
+            v1 = reader.version["http://allmydata.org/tahoe/protocols/helper/chk-upload/v1"]
+            if not v1.get("pipelined-reads"):
+                return 1
+        return self.FETCH_WINDOW
 
     def _start(self):
         if self._started:
@@ -317,6 +386,8 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
         if os.path.exists(self._encoding_file):
             self.log("ciphertext already present, bypassing fetch",
                      level=log.UNUSUAL)
+            self._finished = True
+            self._started_observers.fire(None)
             d = defer.succeed(None)
         else:
             # first, find out how large the file is going to be
@@ -343,10 +414,18 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
             self.log("we do not have any ciphertext yet", level=log.NOISY)
         self.log("starting ciphertext fetch", level=log.NOISY)
         self._f = open(self._incoming_file, "ab")
+        self._started_observers.fire(None)
 
         # now loop to pull the data from the readers
         d = defer.Deferred()
-        self._loop(d)
+        if self._pipelined:
+            self._next_offset = self._have
+            self._outstanding = 0
+            self._fetched = {} # offset -> ciphertext_v, not yet written
+            self._fire_when_done = d
+            self._fill_window()
+        else:
+            self._loop(d)
         # this Deferred will be fired once the last byte has been written to
         # self._f
         return d
@@ -405,46 +484,136 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
                  level=log.NOISY)
         d = self.call("read_encrypted", self._have, fetch_size)
         def _got_data(ciphertext_v):
-            for data in ciphertext_v:
-                self._f.write(data)
-                self._have += len(data)
-                self._ciphertext_fetched += len(data)
-                self._upload_helper._helper.count("chk_upload_helper.fetched_bytes", len(data))
-                self._upload_helper._upload_status.set_progress(1, percent)
+            self._write(ciphertext_v)
+            self._upload_helper._upload_status.set_progress(1, percent)
             return False # not done
         d.addCallback(_got_data)
         return d
 
+    def _write(self, ciphertext_v):
+        for data in ciphertext_v:
+            self._f.write(data)
+            self._have += len(data)
+            self._ciphertext_fetched += len(data)
+            self._upload_helper._helper.count("chk_upload_helper.fetched_bytes", len(data))
+        if self._pipelined:
+            # let a LocalCiphertextReader see it
+            self._f.flush()
+            self._wake_waiters()
+
+    def _fill_window(self):
+        # in pipelined mode, ask for the next pieces while earlier ones are
+        # still on their way. The replies are written out in order.
+        while (self._outstanding < self._get_window() and
+               self._next_offset < self._expected_size):
+            offset = self._next_offset
+            fetch_size = min(self.CHUNK_SIZE, self._expected_size - offset)
+            self._next_offset += fetch_size
+            self._outstanding += 1
+            self.log(format="fetching [%(si)s] %(start)d-%(end)d of %(total)d",
+                     si=self._upload_id, start=offset, end=offset+fetch_size,
+                     total=self._expected_size, level=log.NOISY)
+            d = defer.maybeDeferred(self.call, "read_encrypted",
+                                    offset, fetch_size)
+            d.addCallback(self._got_piece, offset, fetch_size, time.time())
+            d.addErrback(self._fetch_failed)
+        if (self._have == self._expected_size and
+            not self._fire_when_done.called):
+            self._upload_helper._upload_status.set_progress(1, 1.0)
+            self.log("finished reading ciphertext", level=log.NOISY)
+            self._fire_when_done.callback(None)
+
+    def _got_piece(self, ciphertext_v, offset, fetch_size, started):
+        self._times["cumulative_fetch"] += time.time() - started
+        self._outstanding -= 1
+        if self._fire_when_done.called:
+            return # an earlier piece failed
+        if sum([len(data) for data in ciphertext_v]) != fetch_size:
+            raise ShortReadError("asked for %d bytes at %d, got %d"
+                                 % (fetch_size, offset,
+                                    sum([len(data) for data in ciphertext_v])))
+        self._fetched[offset] = ciphertext_v
+        while self._have in self._fetched:
+            self._write(self._fetched.pop(self._have))
+        if self._expected_size:
+            self._upload_helper._upload_status.set_progress(
+                1, 1.0 * self._have / self._expected_size)
+        self._fill_window()
+
+    def _fetch_failed(self, f):
+        self.log(format="[%(si)s] ciphertext read failed",
+                 si=self._upload_id, failure=f, level=log.UNUSUAL)
+        if not self._fire_when_done.called:
+            self._fire_when_done.errback(f)
+
     def _done(self, res):
         self._f.close()
         self._f = None
         self.log(format="done fetching ciphertext, size=%(size)d",
                  size=os.stat(self._incoming_file)[stat.ST_SIZE],
                  level=log.NOISY)
-        os.rename(self._incoming_file, self._encoding_file)
+        if not self._pipelined:
+            os.rename(self._incoming_file, self._encoding_file)
 
     def _done2(self, _ignored, started):
         self.log("done2", level=log.NOISY)
         elapsed = time.time() - started
         self._times["total"] = elapsed
         self._readers = []
+        self._finished = True
+        self._wake_waiters()
         self._done_observers.fire(None)
 
     def _failed(self, f):
         if self._f:
             self._f.close()
         self._readers = []
+        self._started_observers.fire_if_not_fired(f)
+        waiters, self._waiters = self._waiters, []
+        for (offset, d) in waiters:
+            d.errback(f)
         self._done_observers.fire(f)
 
     def when_done(self):
         return self._done_observers.when_fired()
 
+    def when_started(self):
+        return self._started_observers.when_fired()
+
+    def when_fetched(self, offset):
+        """Return a Deferred that fires once the first 'offset' bytes of
+        ciphertext are in the file (or all of it, if it is shorter)."""
+        if self._fetched_through(offset):
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append((offset, d))
+        return d
+
+    def _fetched_through(self, offset):
+        if self._finished:
+            return True
+        return self._have >= min(offset, self._expected_size)
+
+    def _wake_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for (offset, d) in waiters:
+            if self._fetched_through(offset):
+                d.callback(None)
+            else:
+                self._waiters.append((offset, d))
+
     def get_times(self):
         return self._times
 
     def get_ciphertext_fetched(self):
         return self._ciphertext_fetched
 
+    def get_expected_size(self):
+        return self._expected_size
+
+    def get_incoming_file(self):
+        return self._incoming_file
+
 
 @implementer(interfaces.IEncryptedUploadable)
 class LocalCiphertextReader(AskUntilSuccessMixin):
@@ -454,6 +623,8 @@ class LocalCiphertextReader(AskUntilSuccessMixin):
         self._upload_helper = upload_helper
         self._storage_index = storage_index
         self._encoding_file = encoding_file
+        self._filename = encoding_file
+        self._fetcher = None
         self._status = None
 
     def start(self):
@@ -461,6 +632,21 @@ class LocalCiphertextReader(AskUntilSuccessMixin):
         self._size = os.stat(self._encoding_file)[stat.ST_SIZE]
         self.f = open(self._encoding_file, "rb")
 
+    def start_streaming(self, fetcher):
+        """Read the ciphertext while 'fetcher' is still fetching it."""
+        if os.path.exists(self._encoding_file):
+            # an earlier attempt fetched all of it
+            return self.start()
+        self._upload_helper._upload_status.set_status("fetching and pushing")
+        self._fetcher = fetcher
+        self._size = fetcher.get_expected_size()
+        self._filename = fetcher.get_incoming_file()
+        self._offset = 0
+        self.f = open(self._filename, "rb")
+
+    def get_filename(self):
+        return self._filename
+
     def get_size(self):
         return defer.succeed(self._size)
 
@@ -472,8 +658,16 @@ class LocalCiphertextReader(AskUntilSuccessMixin):
 
     def read_encrypted(self, length, hash_only):
         assert hash_only is False
-        d = defer.maybeDeferred(self.f.read, length)
-        d.addCallback(lambda data: [data])
+        if self._fetcher is None:
+            d = defer.maybeDeferred(self.f.read, length)
+            d.addCallback(lambda data: [data])
+            return d
+        d = self._fetcher.when_fetched(self._offset + length)
+        def _fetched(ign):
+            data = self.f.read(length)
+            self._offset += len(data)
+            return [data]
+        d.addCallback(_fetched)
         return d
 
     def close(self):
@@ -499,8 +693,11 @@ class Helper(Referenceable):
     MAX_UPLOAD_STATUSES = 10
 
     def __init__(self, basedir, storage_broker, secret_holder,
-                 stats_provider, history):
+                 stats_provider, history, pipelined=False):
         self._basedir = basedir
+        # fetch ciphertext several pieces at a time, and encode it as it
+        # arrives (see CHKCiphertextFetcher)
+        self._pipelined = pipelined
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._chk_incoming = os.path.join(basedir, "CHK_incoming")
@@ -518,6 +715,10 @@ class Helper(Referenceable):
                           "chk_upload_helper.resumes": 0,
                           "chk_upload_helper.fetched_bytes": 0,
                           "chk_upload_helper.encoded_bytes": 0,
+                          # seconds, summed over all finished uploads
+                          "chk_upload_helper.fetch_time": 0.0,
+                          "chk_upload_helper.encode_and_push_time": 0.0,
+                          "chk_upload_helper.upload_time": 0.0,
                           }
         self._history = history
 
@@ -640,7 +841,7 @@ class Helper(Referenceable):
                              self._storage_broker,
                              self._secret_holder,
                              incoming_file, encoding_file,
-                             lp)
+                             lp, pipelined=self._pipelined)
         return uh
 
     def _add_upload(self, uh):
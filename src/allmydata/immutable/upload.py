@@ -2,7 +2,9 @@ import os, time, weakref, itertools
 from zope.interface import implementer
 from twisted.python import failure
 from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
 from twisted.application import service
+from twisted.python.threadpool import ThreadPool
 from foolscap.api import Referenceable, Copyable, RemoteCopy, fireEventually
 
 from allmydata.crypto import aes
@@ -10,7 +12,8 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
      file_cancel_secret_hash, bucket_renewal_secret_hash, \
      bucket_cancel_secret_hash, plaintext_hasher, \
      storage_index_hash, plaintext_segment_hasher, convergence_hasher
-from allmydata.util.deferredutil import timeout_call
+from allmydata.util.deferredutil import timeout_call, run_in_threadpool
+import allmydata # for __full_version__
 from allmydata import hashtree, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import encode
@@ -260,8 +263,13 @@ class ServerTracker(object):
     def get_name(self):
         return self._server.get_name()
 
+    def _record_round_trip(self, res, started):
+        self._server.get_link_estimate().record_round_trip(time.time() - started)
+        return res
+
     def query(self, sharenums):
         storage_server = self._server.get_storage_server()
+        started = time.time()
         d = storage_server.allocate_buckets(
             self.storage_index,
             self.renew_secret,
@@ -270,12 +278,16 @@ class ServerTracker(object):
             self.allocated_size,
             canary=Referenceable(),
         )
+        d.addCallback(self._record_round_trip, started)
         d.addCallback(self._buckets_allocated)
         return d
 
     def ask_about_existing_shares(self):
         storage_server = self._server.get_storage_server()
-        return storage_server.get_buckets(self.storage_index)
+        started = time.time()
+        d = storage_server.get_buckets(self.storage_index)
+        d.addCallback(self._record_round_trip, started)
+        return d
 
     def _buckets_allocated(self, alreadygot_and_buckets):
         #log.msg("%s._got_reply(%s)" % (self, (alreadygot, buckets)))
@@ -394,8 +406,20 @@ class _QueryStatistics(object):
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None):
+    # how long to wait for each server to answer a query
+    QUERY_TIMEOUT = 15
+
+    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None,
+                 query_servers=None, query_timeout=None):
         self.upload_id = upload_id
+        # the first query_servers servers in the permuted list are all asked
+        # about existing shares at the same time, and are the only ones
+        # offered shares. None means twice as many servers as there are
+        # shares.
+        self._query_servers = query_servers
+        if query_timeout is None:
+            query_timeout = self.QUERY_TIMEOUT
+        self._query_timeout = query_timeout
         self._query_stats = _QueryStatistics()
         self.last_failure_msg = None
         self._status = IUploadStatus(upload_status)
@@ -516,6 +540,10 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # 0. Start with an ordered list of servers. Maybe *2N* of them.
         #
 
+        query_servers = self._query_servers
+        if query_servers is None:
+            query_servers = 2 * total_shares
+
         all_servers = storage_broker.get_servers_for_psi(storage_index)
         if not all_servers:
             raise NoServersError("client gave us zero servers")
@@ -527,7 +555,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             )
 
         readonly_trackers, write_trackers = self._create_trackers(
-            all_servers[:(2 * total_shares)],
+            all_servers[:query_servers],
             allocated_size,
             file_renewal_secret,
             file_cancel_secret,
@@ -556,7 +584,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
         for tracker in readonly_trackers:
             assert isinstance(tracker, ServerTracker)
-            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
+            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(),
+                             self._query_timeout)
             d.addBoth(self._handle_existing_response, tracker)
             ds.append(d)
             self.log("asking server %s for any existing shares" %
@@ -564,7 +593,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
         for tracker in write_trackers:
             assert isinstance(tracker, ServerTracker)
-            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
+            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(),
+                             self._query_timeout)
 
             def timed_out(f, tracker):
                 # print("TIMEOUT {}: {}".format(tracker, f))
@@ -637,7 +667,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 if shares_to_ask != set(tracker.buckets.keys()) or tracker in readonly_trackers:
                     self._query_stats.total += 1
                     self._query_stats.contacted += 1
-                    d = timeout_call(self._reactor, tracker.query(shares_to_ask), 15)
+                    d = timeout_call(self._reactor, tracker.query(shares_to_ask),
+                                     self._query_timeout)
                     d.addBoth(self._buckets_allocated, tracker, shares_to_ask)
                     d.addErrback(lambda f, tr: _bad_server(f, tr), tracker)
                     d.addCallback(lambda x, tr: _make_readonly(tr) if not x else x, tracker)
@@ -886,12 +917,19 @@ class EncryptAnUploadable(object):
     IEncryptedUploadable."""
     CHUNKSIZE = 50*1024
 
-    def __init__(self, original, log_parent=None, progress=None):
+    def __init__(self, original, log_parent=None, progress=None,
+                 threadpool=None):
         precondition(original.default_params_set,
                      "set_default_encoding_parameters not called on %r before wrapping with EncryptAnUploadable" % (original,))
         self.original = IUploadable(original)
         self._log_number = log_parent
+        # if set, the plaintext is hashed and encrypted in one of these
+        # threads
+        self._threadpool = threadpool
+        self._key = None
         self._encryptor = None
+        # the offset of the next byte that self._encryptor will encrypt
+        self._encryptor_offset = 0
         self._plaintext_hasher = plaintext_hasher()
         self._plaintext_segment_hasher = None
         self._plaintext_segment_hashes = []
@@ -933,6 +971,8 @@ class EncryptAnUploadable(object):
         def _got(encoding_parameters):
             (k, happy, n, segsize) = encoding_parameters
             self._segment_size = segsize # used by segment hashers
+            if self._status:
+                self._status.set_segment_size(segsize)
             self._encoding_parameters = encoding_parameters
             self.log("my encoding parameters: %s" % (encoding_parameters,),
                      level=log.NOISY)
@@ -946,6 +986,7 @@ class EncryptAnUploadable(object):
 
         d = self.original.get_encryption_key()
         def _got(key):
+            self._key = key
             self._encryptor = aes.create_encryptor(key)
 
             storage_index = storage_index_hash(key)
@@ -985,20 +1026,22 @@ class EncryptAnUploadable(object):
             self._plaintext_segment_hashed_bytes += this_segment
 
             if self._plaintext_segment_hashed_bytes == self._segment_size:
-                # we've filled this segment
+                # we've filled this segment. It is logged by
+                # _log_segment_hashes.
                 self._plaintext_segment_hashes.append(p.digest())
                 self._plaintext_segment_hasher = None
-                self.log("closed hash [%d]: %dB" %
-                         (len(self._plaintext_segment_hashes)-1,
-                          self._plaintext_segment_hashed_bytes),
-                         level=log.NOISY)
-                self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
-                         segnum=len(self._plaintext_segment_hashes)-1,
-                         hash=base32.b2a(p.digest()),
-                         level=log.NOISY)
 
             offset += this_segment
 
+    def _log_segment_hashes(self, first):
+        for segnum in range(first, len(self._plaintext_segment_hashes)):
+            self.log("closed hash [%d]: %dB" % (segnum, self._segment_size),
+                     level=log.NOISY)
+            self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
+                     segnum=segnum,
+                     hash=base32.b2a(self._plaintext_segment_hashes[segnum]),
+                     level=log.NOISY)
+
 
     def read_encrypted(self, length, hash_only):
         # make sure our parameters have been set up first
@@ -1038,10 +1081,27 @@ class EncryptAnUploadable(object):
         def _good(plaintext):
             # and encrypt it..
             # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
-            ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
-            ciphertext.extend(ct)
-            self._read_encrypted(remaining, ciphertext, hash_only,
-                                 fire_when_done)
+            assert isinstance(plaintext, (tuple, list)), type(plaintext)
+            for chunk in plaintext:
+                self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
+                         level=log.NOISY)
+            if hash_only:
+                self.log("  skipping encryption", level=log.NOISY)
+            hashed_segments = len(self._plaintext_segment_hashes)
+            d2 = run_in_threadpool(self._threadpool,
+                                   self._hash_and_encrypt_plaintext,
+                                   plaintext, hash_only)
+            def _encrypted(ct):
+                self._log_segment_hashes(hashed_segments)
+                if self._status:
+                    progress = (float(self._ciphertext_bytes_read) /
+                                self._file_size)
+                    self._status.set_progress(1, progress)
+                ciphertext.extend(ct)
+                self._read_encrypted(remaining, ciphertext, hash_only,
+                                     fire_when_done)
+            d2.addCallback(_encrypted)
+            return d2
         def _err(why):
             fire_when_done.errback(why)
         d.addCallback(_good)
@@ -1049,6 +1109,8 @@ class EncryptAnUploadable(object):
         return None
 
     def _hash_and_encrypt_plaintext(self, data, hash_only):
+        # this may run in a thread (see _threadpool), so it must not log or
+        # update the upload status: _read_encrypted does that
         assert isinstance(data, (tuple, list)), type(data)
         data = list(data)
         cryptdata = []
@@ -1057,27 +1119,21 @@ class EncryptAnUploadable(object):
         bytes_processed = 0
         while data:
             chunk = data.pop(0)
-            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
-                     level=log.NOISY)
+            offset = self._ciphertext_bytes_read + bytes_processed
             bytes_processed += len(chunk)
             self._plaintext_hasher.update(chunk)
             self._update_segment_hash(chunk)
-            # TODO: we have to encrypt the data (even if hash_only==True)
-            # because the AES-CTR implementation doesn't offer a
-            # way to change the counter value. Once it acquires
-            # this ability, change this to simply update the counter
-            # before each call to (hash_only==False) encrypt_data
-            ciphertext = aes.encrypt_data(self._encryptor, chunk)
-            if hash_only:
-                self.log("  skipping encryption", level=log.NOISY)
-            else:
-                cryptdata.append(ciphertext)
-            del ciphertext
+            if not hash_only:
+                if offset != self._encryptor_offset:
+                    # a hash-only read skipped over some of the data
+                    # without encrypting it, so pick up the AES-CTR key
+                    # stream where this chunk starts
+                    self._encryptor = aes.create_encryptor(self._key,
+                                                           offset=offset)
+                cryptdata.append(aes.encrypt_data(self._encryptor, chunk))
+                self._encryptor_offset = offset + len(chunk)
             del chunk
         self._ciphertext_bytes_read += bytes_processed
-        if self._status:
-            progress = float(self._ciphertext_bytes_read) / self._file_size
-            self._status.set_progress(1, progress)
         return cryptdata
 
 
@@ -1113,6 +1169,7 @@ class UploadStatus(object):
     def __init__(self):
         self.storage_index = None
         self.size = None
+        self.segment_size = None
         self.helper = False
         self.status = "Not started"
         self.progress = [0.0, 0.0, 0.0]
@@ -1127,6 +1184,8 @@ class UploadStatus(object):
         return self.storage_index
     def get_size(self):
         return self.size
+    def get_segment_size(self):
+        return self.segment_size
     def using_helper(self):
         return self.helper
     def get_status(self):
@@ -1144,6 +1203,8 @@ class UploadStatus(object):
         self.storage_index = si
     def set_size(self, size):
         self.size = size
+    def set_segment_size(self, segment_size):
+        self.segment_size = segment_size
     def set_helper(self, helper):
         self.helper = helper
     def set_status(self, status):
@@ -1158,10 +1219,23 @@ class UploadStatus(object):
 
 class CHKUploader(object):
 
-    def __init__(self, storage_broker, secret_holder, progress=None, reactor=None):
+    def __init__(self, storage_broker, secret_holder, progress=None, reactor=None,
+                 segments_in_flight=None, pipeline_memory=None,
+                 threadpool=None, upload_cache=None, query_servers=None,
+                 query_timeout=None, resume_db=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._query_servers = query_servers
+        self._query_timeout = query_timeout
+        self._segments_in_flight = segments_in_flight
+        self._pipeline_memory = pipeline_memory
+        self._threadpool = threadpool
+        # an UploadCache, only given for convergent uploads
+        self._upload_cache = upload_cache
+        # an UploadResumeDB, likewise
+        self._resume_db = resume_db
+        self._resume_placement = {}
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -1224,17 +1298,206 @@ class CHKUploader(object):
             self._log_number,
             self._upload_status,
             progress=self._progress,
+            segments_in_flight=self._segments_in_flight,
+            pipeline_memory=self._pipeline_memory,
+            threadpool=self._threadpool,
         )
         # this just returns itself
         yield self._encoder.set_encrypted_uploadable(eu)
+        if self._upload_cache is not None:
+            results = yield self._check_upload_cache(eu, started)
+            if results is not None:
+                defer.returnValue(results)
+        if self._resume_db is not None:
+            self._start_resumable()
         with LOCATE_ALL_SHAREHOLDERS() as action:
             (upload_trackers, already_serverids) = yield self.locate_all_shareholders(self._encoder, started)
             action.add_success_fields(upload_trackers=upload_trackers, already_serverids=already_serverids)
         self.set_shareholders(upload_trackers, already_serverids, self._encoder)
+        if self._resume_db is not None:
+            yield self._find_written_blocks(upload_trackers)
         verifycap = yield self._encoder.start()
         results = self._encrypted_done(verifycap)
+        if self._upload_cache is not None:
+            self._upload_cache.add(self._encoder.get_param("storage_index"),
+                                   results.get_verifycapstr(),
+                                   self._encoder.servermap)
+        if self._resume_db is not None:
+            self._resume_db.remove(self._encoder.get_param("storage_index"))
         defer.returnValue(results)
 
+    def _start_resumable(self):
+        """
+        Look up an earlier, interrupted upload of this file, and start
+        recording this one in its place.
+        """
+        db = self._resume_db
+        storage_index = self._encoder.get_param("storage_index")
+        k, happy, n = self._encoder.get_param("share_counts")
+        params = (k, happy, n, self._encoder.get_param("segment_size"))
+        entry = db.get(storage_index)
+        if entry is not None and entry[0] == params:
+            (ign, self._resume_placement) = entry
+            self.log("resuming upload of %s, which had placed %d shares"
+                     % (si_b2a(storage_index)[:5],
+                        len(self._resume_placement)),
+                     level=log.OPERATIONAL)
+        db.start(storage_index, params)
+
+    @inline_callbacks
+    def _find_written_blocks(self, upload_trackers):
+        """
+        Record where each share is going. Then ask the servers that were
+        given the same shares by an interrupted upload of this file which
+        blocks they kept, and tell the encoder not to send those again.
+        """
+        storage_index = self._encoder.get_param("storage_index")
+        placement = {}
+        for tracker in upload_trackers:
+            for shnum in tracker.buckets:
+                placement[shnum] = tracker.get_serverid()
+        self._resume_db.set_placement(storage_index, placement)
+
+        shnums = []
+        dl = []
+        for tracker in upload_trackers:
+            v1 = tracker.get_server().get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+            if not v1.get("incoming-grace-period"):
+                continue
+            for (shnum, bucket) in tracker.buckets.items():
+                if self._resume_placement.get(shnum) != tracker.get_serverid():
+                    continue
+                d = bucket.get_written_blocks()
+                def _failed(f, tracker=tracker):
+                    self.log("unable to ask %s about partial shares"
+                             % tracker.get_name(), failure=f,
+                             level=log.UNUSUAL)
+                    return set()
+                d.addErrback(_failed)
+                shnums.append(shnum)
+                dl.append(d)
+        if not dl:
+            return
+        self._upload_status.set_status("Looking for partial shares")
+        found = yield defer.gatherResults(dl)
+        present = dict([(shnum, segnums)
+                        for (shnum, segnums) in zip(shnums, found)
+                        if segnums])
+        if present:
+            self.log("servers already hold %d blocks of %d shares"
+                     % (sum([len(segnums) for segnums in present.values()]),
+                        len(present)),
+                     level=log.OPERATIONAL)
+            self._encoder.set_present_blocks(present)
+
+    @inline_callbacks
+    def _check_upload_cache(self, eu, started):
+        """
+        If this file was uploaded before and enough of its shares are still
+        where we put them, renew their leases instead of uploading it again.
+
+        :return: a Deferred that fires with an UploadResults instance, or
+            with None if the file must be uploaded.
+        """
+        cache = self._upload_cache
+        storage_index = self._encoder.get_param("storage_index")
+        entry = cache.get(storage_index)
+        if entry is None:
+            cache.count("misses")
+            defer.returnValue(None)
+        (verifycapstr, placement) = entry
+        self._upload_status.set_status("Checking for previous upload")
+        found = yield self._find_cached_shares(storage_index, placement)
+        k, happy, n = self._encoder.get_param("share_counts")
+        serverids = dict([(shnum, set([s.get_serverid() for s in servers]))
+                          for (shnum, servers) in found.items()])
+        if servers_of_happiness(serverids) < happy:
+            self.log("previous upload of %s is gone, uploading it again"
+                     % si_b2a(storage_index)[:5], level=log.NOISY)
+            cache.remove(storage_index)
+            cache.count("stale")
+            cache.count("misses")
+            defer.returnValue(None)
+        cache.count("hits")
+        self.log("found %d shares of a previous upload, skipping the upload"
+                 % len(found), level=log.OPERATIONAL)
+        eu.close()
+        sharemap = dictutil.DictOfSets()
+        servermap = dictutil.DictOfSets()
+        for (shnum, servers) in found.items():
+            for server in servers:
+                sharemap.add(shnum, server)
+                servermap.add(server, shnum)
+        now = time.time()
+        timings = {}
+        timings["total"] = now - self._started
+        timings["storage_index"] = now - started
+        ur = UploadResults(file_size=self._encoder.file_size,
+                           ciphertext_fetched=0,
+                           preexisting_shares=len(found),
+                           pushed_shares=0,
+                           sharemap=sharemap,
+                           servermap=servermap,
+                           timings=timings,
+                           uri_extension_data=None,
+                           uri_extension_hash=None,
+                           verifycapstr=verifycapstr)
+        self._upload_status.set_status("Finished")
+        self._upload_status.set_progress(1, 1.0)
+        self._upload_status.set_progress(2, 1.0)
+        self._upload_status.set_results(ur)
+        if self._progress:
+            self._progress.set_progress(self._encoder.file_size)
+        defer.returnValue(ur)
+
+    def _find_cached_shares(self, storage_index, placement):
+        """
+        Ask the connected servers in placement which shares they still hold,
+        and renew our lease on the ones that do.
+
+        :return: a Deferred that fires with a dict mapping shnum to a set of
+            servers.
+        """
+        file_renewal_secret = file_renewal_secret_hash(
+            self._secret_holder.get_renewal_secret(), storage_index)
+        file_cancel_secret = file_cancel_secret_hash(
+            self._secret_holder.get_cancel_secret(), storage_index)
+        wanted = set()
+        for serverids in placement.values():
+            wanted.update(serverids)
+        found = dictutil.DictOfSets()
+        dl = []
+        for server in self._storage_broker.get_connected_servers():
+            if server.get_serverid() not in wanted:
+                continue
+            seed = server.get_lease_seed()
+            renew = bucket_renewal_secret_hash(file_renewal_secret, seed)
+            cancel = bucket_cancel_secret_hash(file_cancel_secret, seed)
+            d = self._check_server(server, storage_index, renew, cancel)
+            d.addCallback(lambda shnums, server=server:
+                          [found.add(shnum, server) for shnum in shnums])
+            dl.append(d)
+        d = defer.DeferredList(dl)
+        d.addCallback(lambda ign: found)
+        return d
+
+    def _check_server(self, server, storage_index, renew, cancel):
+        storage_server = server.get_storage_server()
+        d = defer.maybeDeferred(storage_server.get_buckets, storage_index)
+        def _got_buckets(buckets):
+            if not buckets:
+                return []
+            d2 = storage_server.add_lease(storage_index, renew, cancel)
+            d2.addCallback(lambda ign: buckets.keys())
+            return d2
+        d.addCallback(_got_buckets)
+        def _failed(f):
+            self.log("unable to check for previous shares on %s"
+                     % server.get_name(), failure=f, level=log.UNUSUAL)
+            return []
+        d.addErrback(_failed)
+        return d
+
     def locate_all_shareholders(self, encoder, started):
         server_selection_started = now = time.time()
         self._storage_index_elapsed = now - started
@@ -1249,6 +1512,8 @@ class CHKUploader(object):
             self._log_number,
             self._upload_status,
             reactor=self._reactor,
+            query_servers=self._query_servers,
+            query_timeout=self._query_timeout,
         )
 
         share_size = encoder.get_param("share_size")
@@ -1408,10 +1673,17 @@ class LiteralUploader(object):
 
 @implementer(RIEncryptedUploadable)
 class RemoteEncryptedUploadable(Referenceable):
+    VERSION = { "http://allmydata.org/tahoe/protocols/helper/chk-upload/v1" :
+                 { "pipelined-reads": True,
+                   },
+                "application-version": str(allmydata.__full_version__),
+                }
 
     def __init__(self, encrypted_uploadable, upload_status):
         self._eu = IEncryptedUploadable(encrypted_uploadable)
         self._offset = 0
+        # the read that must finish before the next one can start
+        self._reading = defer.succeed(None)
         self._bytes_sent = 0
         self._status = IUploadStatus(upload_status)
         # we are responsible for updating the status string while we run, and
@@ -1428,6 +1700,9 @@ class RemoteEncryptedUploadable(Referenceable):
         d.addCallback(_got_size)
         return d
 
+    def remote_get_version(self):
+        return self.VERSION
+
     def remote_get_size(self):
         return self.get_size()
     def remote_get_all_encoding_parameters(self):
@@ -1446,6 +1721,17 @@ class RemoteEncryptedUploadable(Referenceable):
         return d
 
     def remote_read_encrypted(self, offset, length):
+        # a helper can ask for several pieces at once: they are read one at
+        # a time, in the order they were asked for
+        result = defer.Deferred()
+        def _read(ign):
+            d = defer.maybeDeferred(self._read_at, offset, length)
+            d.addBoth(result.callback)
+            return d
+        self._reading.addCallback(_read)
+        return result
+
+    def _read_at(self, offset, length):
         # we don't support seek backwards, but we allow skipping forwards
         precondition(offset >= 0, offset)
         precondition(length >= 0, length)
@@ -1632,6 +1918,49 @@ class AssistedUploader(object):
     def get_upload_status(self):
         return self._upload_status
 
+# With [client]upload.adaptive_segment_size, large files get segments of up
+# to this size, so that they have at most ADAPTIVE_SEGMENTS segments.
+ADAPTIVE_MAX_SEGMENT_SIZE = 1024*1024
+ADAPTIVE_SEGMENTS = 256
+
+def adaptive_segment_size(file_size, k, max_segment_size,
+                          round_trip_time=None, bandwidth=None):
+    """
+    Pick a segment size for a file of file_size bytes, to be encoded with
+    k-of-N encoding, instead of always using max_segment_size.
+
+    Every segment adds hashes to each share and costs each server a write,
+    so large files get larger segments, up to ADAPTIVE_MAX_SEGMENT_SIZE.
+    Given the round-trip time (seconds) and write bandwidth (bytes per
+    second) of the servers, segments are also made large enough that
+    sending a block takes longer than a round trip. Then the file is split
+    into segments of equal size, so that the last one is not a tiny
+    leftover. The result is a multiple of k.
+    """
+    target = max(max_segment_size,
+                 mathutil.div_ceil(file_size, ADAPTIVE_SEGMENTS))
+    if round_trip_time and bandwidth:
+        target = max(target, int(k * round_trip_time * bandwidth))
+    target = min(target, max(max_segment_size, ADAPTIVE_MAX_SEGMENT_SIZE))
+    num_segments = max(mathutil.div_ceil(file_size, target), 1)
+    segsize = mathutil.div_ceil(file_size, num_segments)
+    return mathutil.next_multiple(segsize, k)
+
+def _median(values):
+    values = sorted([v for v in values if v is not None])
+    if not values:
+        return None
+    return values[len(values) // 2]
+
+def estimate_link(servers):
+    """
+    Return (round_trip_time, bandwidth), the medians of what has been
+    measured for the given servers (either may be None).
+    """
+    estimates = [s.get_link_estimate() for s in servers]
+    return (_median([e.get_round_trip_time() for e in estimates]),
+            _median([e.get_bandwidth() for e in estimates]))
+
 class BaseUploadable(object):
     # this is overridden by max_segment_size
     default_max_segment_size = DEFAULT_MAX_SEGMENT_SIZE
@@ -1788,6 +2117,128 @@ class Data(FileHandle):
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, StringIO(data), convergence=convergence)
 
+@implementer(IUploadable, IConsumer)
+class StreamingUploadable(BaseUploadable):
+    """
+    I upload data that is written to me as it arrives, such as the body of
+    a web-API PUT, instead of reading it from a file that already holds all
+    of it. The size must be known in advance. The encryption key is always
+    random, since a convergent key is a hash of the whole plaintext.
+
+    I keep at most about 'buffer_size' bytes that the uploader has not read
+    yet: when I have more than that, I pause the producer that was given to
+    registerProducer() until the uploader catches up. A read() that asks for
+    more than I have buffered keeps the producer running until it can be
+    satisfied, even if that takes more than 'buffer_size' bytes.
+    """
+    convergence = None
+
+    def __init__(self, size, buffer_size=2*DEFAULT_MAX_SEGMENT_SIZE):
+        self._size = size
+        self._buffer_size = buffer_size
+        self._key = None
+        self._buffer = []
+        self._buffered = 0
+        self._received = 0
+        self._failure = None
+        self._closed = False
+        self._producer = None
+        self._paused = False
+        # (length, Deferred) for a read() that is waiting for more data
+        self._pending_read = None
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+
+    def unregisterProducer(self):
+        self._producer = None
+
+    def write(self, data):
+        if self._failure is not None or self._closed:
+            return
+        self._received += len(data)
+        if self._received > self._size:
+            self.fail(failure.Failure(ValueError(
+                "got more than the %d bytes that were promised" % self._size)))
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._satisfy_read()
+        if (self._buffered > self._buffer_size and self._pending_read is None
+            and self._producer is not None and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def finish(self):
+        """The producer has no more data for me."""
+        if self._received < self._size:
+            self.fail(failure.Failure(EOFError(
+                "got only %d of %d bytes" % (self._received, self._size))))
+
+    def is_finished(self):
+        return self._received == self._size or self._failure is not None
+
+    def fail(self, why):
+        """The data will never arrive: make read() errback with 'why'."""
+        if self._failure is None:
+            self._failure = why
+        self._satisfy_read()
+
+    def get_encryption_key(self):
+        if self._key is None:
+            self._key = os.urandom(16)
+        return defer.succeed(self._key)
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def read(self, length):
+        assert self._pending_read is None
+        d = defer.Deferred()
+        self._pending_read = (length, d)
+        self._satisfy_read()
+        return d
+
+    def _satisfy_read(self):
+        if self._pending_read is None:
+            return
+        (length, d) = self._pending_read
+        if self._failure is not None:
+            self._pending_read = None
+            d.errback(self._failure)
+            return
+        if self._buffered < length and self._received < self._size:
+            # this read is longer than the buffer: it would wait forever for
+            # a paused producer
+            if self._paused and self._producer is not None:
+                self._paused = False
+                self._producer.resumeProducing()
+            return
+        self._pending_read = None
+        data = []
+        while self._buffer and length > 0:
+            piece = self._buffer.pop(0)
+            if len(piece) > length:
+                self._buffer.insert(0, piece[length:])
+                piece = piece[:length]
+            data.append(piece)
+            length -= len(piece)
+            self._buffered -= len(piece)
+        if (self._paused and self._buffered <= self._buffer_size
+            and self._producer is not None):
+            self._paused = False
+            self._producer.resumeProducing()
+        d.callback(data)
+
+    def close(self):
+        # anything that arrives from now on is thrown away
+        self._closed = True
+        self._buffer = []
+        self._buffered = 0
+        if self._paused and self._producer is not None:
+            self._paused = False
+            self._producer.resumeProducing()
+
 @implementer(IUploader)
 class Uploader(service.MultiService, log.PrefixingLogMixin):
     """I am a service that allows file uploading. I am a service-child of the
@@ -1796,9 +2247,33 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None, progress=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None, progress=None,
+                 segments_in_flight=None, pipeline_memory=None, threads=0,
+                 upload_cache=None, query_servers=None, query_timeout=None,
+                 adaptive_segment_size=False, resume_db=None):
         self._helper_furl = helper_furl
+        # pick each file's segment size with adaptive_segment_size()
+        # instead of always using the client's max_segment_size
+        self._adaptive_segment_size = adaptive_segment_size
+        # how many servers each upload asks at once, and how long it waits
+        # for them (see Tahoe2ServerSelector)
+        self._query_servers = query_servers
+        self._query_timeout = query_timeout
+        self._segments_in_flight = segments_in_flight
+        self._pipeline_memory = pipeline_memory
+        # with threads>0, uploads do their hashing, encryption and erasure
+        # coding in a pool of that many threads instead of the reactor's
+        self._threads = threads
+        self._threadpool = None
+        # an UploadCache remembers where convergent uploads went, so
+        # uploading the same file again only has to renew its leases
+        self._upload_cache = upload_cache
         self.stats_provider = stats_provider
+        if stats_provider and upload_cache is not None:
+            stats_provider.register_producer(upload_cache)
+        # an UploadResumeDB lets a convergent upload that was interrupted
+        # skip the blocks that the servers kept
+        self._resume_db = resume_db
         self._history = history
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
@@ -1808,10 +2283,37 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
 
     def startService(self):
         service.MultiService.startService(self)
+        if self._threads:
+            self._threadpool = ThreadPool(0, self._threads, name="uploader")
+            self._threadpool.start()
         if self._helper_furl:
             self.parent.tub.connectTo(self._helper_furl,
                                       self._got_helper)
 
+    def stopService(self):
+        if self._threadpool is not None:
+            self._threadpool.stop()
+            self._threadpool = None
+        if self._upload_cache is not None:
+            self._upload_cache.close()
+        if self._resume_db is not None:
+            self._resume_db.close()
+        return service.MultiService.stopService(self)
+
+    def _adapt_segment_size(self, uploadable, size, default_params):
+        k = getattr(uploadable, "encoding_param_k", None) or default_params["k"]
+        (round_trip_time, bandwidth) = (None, None)
+        # the segment size is part of a convergent file's storage index, so
+        # it must not depend on how the network happens to be doing
+        if getattr(uploadable, "convergence", None) is None:
+            servers = self.parent.get_storage_broker().get_connected_servers()
+            (round_trip_time, bandwidth) = estimate_link(servers)
+        params = default_params.copy()
+        params["max_segment_size"] = adaptive_segment_size(
+            size, k, default_params["max_segment_size"],
+            round_trip_time, bandwidth)
+        return params
+
     def _got_helper(self, helper):
         self.log("got helper connection, getting versions")
         default = { "http://allmydata.org/tahoe/protocols/helper/v1" :
@@ -1850,6 +2352,9 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
             default_params = self.parent.get_encoding_parameters()
             precondition(isinstance(default_params, dict), default_params)
             precondition("max_segment_size" in default_params, default_params)
+            if self._adaptive_segment_size:
+                default_params = self._adapt_segment_size(uploadable, size,
+                                                          default_params)
             uploadable.set_default_encoding_parameters(default_params)
             if progress:
                 progress.set_progress_total(size)
@@ -1862,7 +2367,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 uploader = LiteralUploader(progress=progress)
                 return uploader.start(uploadable)
             else:
-                eu = EncryptAnUploadable(uploadable, self._parentmsgid)
+                eu = EncryptAnUploadable(uploadable, self._parentmsgid,
+                                         threadpool=self._threadpool)
                 d2 = defer.succeed(None)
                 storage_broker = self.parent.get_storage_broker()
                 if self._helper:
@@ -1872,7 +2378,19 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder, progress=progress, reactor=reactor)
+                    upload_cache = None
+                    resume_db = None
+                    if getattr(uploadable, "convergence", None) is not None:
+                        upload_cache = self._upload_cache
+                        resume_db = self._resume_db
+                    uploader = CHKUploader(storage_broker, secret_holder, progress=progress, reactor=reactor,
+                                           segments_in_flight=self._segments_in_flight,
+                                           pipeline_memory=self._pipeline_memory,
+                                           threadpool=self._threadpool,
+                                           upload_cache=upload_cache,
+                                           query_servers=self._query_servers,
+                                           query_timeout=self._query_timeout,
+                                           resume_db=resume_db)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
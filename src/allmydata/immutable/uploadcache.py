@@ -0,0 +1,161 @@
+"""
+A client-side record of recent convergent immutable uploads.
+
+The storage index of a convergent upload is derived from the convergence
+secret, the encoding parameters and the plaintext, so uploading the same
+file twice produces the same storage index, and the same verifycap. The
+UploadCache remembers, for each storage index that this client uploaded,
+the verifycap and which servers the shares went to. The CHKUploader looks
+there first: if enough of those servers still hold their shares, it renews
+the leases on them and skips the encoding entirely.
+
+Entries are forgotten after 'ttl' seconds, and the least recently used ones
+are evicted once there are more than 'max_entries' of them.
+"""
+
+from __future__ import print_function
+
+import json, sys, time
+
+from zope.interface import implementer
+
+from allmydata.interfaces import IStatsProducer
+from allmydata.util import base32
+from allmydata.util.dbutil import get_db, DBError
+
+# upload cache schema version 1
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE uploads
+(
+ storage_index VARCHAR(32) PRIMARY KEY,  -- base32
+ verifycap     VARCHAR(256),             -- URI:CHK-Verifier:...
+ placement     TEXT,                     -- JSON {shnum: [base32 serverid]}
+ uploaded      TIMESTAMP,
+ last_used     TIMESTAMP
+);
+
+CREATE INDEX uploads_last_used ON uploads (last_used);
+"""
+
+
+def get_upload_cache(dbfile, stderr=sys.stderr, max_entries=10000,
+                     ttl=7*24*60*60):
+    # Open or create the given upload cache file. The parent directory must
+    # exist. Returns None if the file cannot be used.
+    try:
+        (sqlite3, db) = get_db(dbfile, stderr, create_version=(SCHEMA_v1, 1),
+                               dbname="upload cache")
+        return UploadCache(sqlite3, db, max_entries=max_entries, ttl=ttl)
+    except DBError as e:
+        print(e, file=stderr)
+        return None
+
+
+@implementer(IStatsProducer)
+class UploadCache(object):
+    """I map the storage index of a convergent upload to its verifycap and
+    the servers that were last known to hold its shares."""
+
+    def __init__(self, sqlite_module, connection, max_entries=10000,
+                 ttl=7*24*60*60):
+        self.sqlite_module = sqlite_module
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # a hit is an entry whose shares were still there, a miss is an
+        # upload with no fresh entry, and a stale entry is one whose shares
+        # were not found (that upload counts as a miss too)
+        self.counters = {"hits": 0, "misses": 0, "stale": 0}
+
+    def _now(self):
+        return time.time()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, storage_index):
+        """Return (verifycapstr, placement) for the given storage index, or
+        None if there is no fresh entry for it. placement is a dict mapping
+        shnum to a set of serverids."""
+        now = self._now()
+        c = self.cursor
+        c.execute("SELECT verifycap, placement, uploaded FROM uploads"
+                  " WHERE storage_index=?", (base32.b2a(storage_index),))
+        row = c.fetchone()
+        if not row:
+            return None
+        (verifycapstr, placement, uploaded) = row
+        if self.ttl is not None and uploaded + self.ttl < now:
+            self.remove(storage_index)
+            return None
+        c.execute("UPDATE uploads SET last_used=? WHERE storage_index=?",
+                  (now, base32.b2a(storage_index)))
+        self.connection.commit()
+        placement = dict([(int(shnum), set([base32.a2b(str(s))
+                                            for s in serverids]))
+                          for (shnum, serverids)
+                          in json.loads(placement).items()])
+        return (str(verifycapstr), placement)
+
+    def add(self, storage_index, verifycapstr, placement):
+        """Remember that the file with the given storage index was uploaded
+        as verifycapstr, with its shares placed according to placement
+        ({shnum: set(serverids)})."""
+        now = self._now()
+        placement = json.dumps(dict([(str(shnum), sorted([base32.b2a(s)
+                                                          for s in serverids]))
+                                     for (shnum, serverids)
+                                     in placement.items()]))
+        self.cursor.execute("INSERT OR REPLACE INTO uploads"
+                            " (storage_index, verifycap, placement,"
+                            "  uploaded, last_used)"
+                            " VALUES (?,?,?,?,?)",
+                            (base32.b2a(storage_index), verifycapstr,
+                             placement, now, now))
+        self._evict()
+        self.connection.commit()
+
+    def remove(self, storage_index):
+        self.cursor.execute("DELETE FROM uploads WHERE storage_index=?",
+                            (base32.b2a(storage_index),))
+        self.connection.commit()
+
+    def _evict(self):
+        c = self.cursor
+        if self.ttl is not None:
+            c.execute("DELETE FROM uploads WHERE uploaded < ?",
+                      (self._now() - self.ttl,))
+        c.execute("SELECT COUNT(*) FROM uploads")
+        excess = c.fetchone()[0] - self.max_entries
+        if excess > 0:
+            c.execute("DELETE FROM uploads WHERE storage_index IN"
+                      " (SELECT storage_index FROM uploads"
+                      "  ORDER BY last_used ASC LIMIT ?)", (excess,))
+
+    def count(self, name):
+        self.counters[name] += 1
+
+    def get_entries(self):
+        self.cursor.execute("SELECT COUNT(*) FROM uploads")
+        return self.cursor.fetchone()[0]
+
+    def get_hit_rate(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        if not lookups:
+            return None
+        return 1.0 * self.counters["hits"] / lookups
+
+    def get_stats(self):
+        stats = {"uploader.dedup_cache.entries": self.get_entries()}
+        for (name, value) in self.counters.items():
+            stats["uploader.dedup_cache.%s" % name] = value
+        hit_rate = self.get_hit_rate()
+        if hit_rate is not None:
+            stats["uploader.dedup_cache.hit_rate"] = hit_rate
+        return stats
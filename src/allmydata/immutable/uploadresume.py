@@ -0,0 +1,136 @@
+"""
+A client-side record of convergent immutable uploads that are in progress.
+
+If the client goes away in the middle of an upload, storage servers that
+advertise an 'incoming-grace-period' keep the partial shares for that long.
+The storage index of a convergent upload is derived from the convergence
+secret, the encoding parameters and the plaintext, so when the same file is
+uploaded again it gets the same storage index, the same key and the same
+blocks. The UploadResumeDB remembers, for each storage index that this client
+started to upload, the encoding parameters and which server each share was
+placed on. When the CHKUploader finds an entry for the file it is about to
+upload, it asks those servers which blocks they already hold, and does not
+send them again.
+
+No keys are stored here: the key is recomputed from the file. Entries are
+removed when the upload finishes, and forgotten after 'ttl' seconds.
+"""
+
+from __future__ import print_function
+
+import json, sys, time
+
+from allmydata.util import base32
+from allmydata.util.dbutil import get_db, DBError
+
+# upload resume schema version 1
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE uploads
+(
+ storage_index VARCHAR(32) PRIMARY KEY,  -- base32
+ params        TEXT,                     -- JSON [k, happy, n, segment_size]
+ placement     TEXT,                     -- JSON {shnum: base32 serverid}
+ started       TIMESTAMP,
+ updated       TIMESTAMP
+);
+"""
+
+
+def get_upload_resume_db(dbfile, stderr=sys.stderr, ttl=7*24*60*60):
+    # Open or create the given upload resume file. The parent directory must
+    # exist. Returns None if the file cannot be used.
+    try:
+        (sqlite3, db) = get_db(dbfile, stderr, create_version=(SCHEMA_v1, 1),
+                               dbname="upload resume")
+        return UploadResumeDB(sqlite3, db, ttl=ttl)
+    except DBError as e:
+        print(e, file=stderr)
+        return None
+
+
+class UploadResumeDB(object):
+    """I map the storage index of an unfinished convergent upload to its
+    encoding parameters and its share placement."""
+
+    def __init__(self, sqlite_module, connection, ttl=7*24*60*60):
+        self.sqlite_module = sqlite_module
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.ttl = ttl
+
+    def _now(self):
+        return time.time()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, storage_index):
+        """Return (params, placement) for the given storage index, or None
+        if there is no fresh entry for it. params is a tuple of (k, happy,
+        n, segment_size), and placement is a dict mapping shnum to serverid
+        (empty if the upload never got that far)."""
+        c = self.cursor
+        c.execute("SELECT params, placement, started"
+                  " FROM uploads WHERE storage_index=?",
+                  (base32.b2a(storage_index),))
+        row = c.fetchone()
+        if not row:
+            return None
+        (params, placement, started) = row
+        if self.ttl is not None and started + self.ttl < self._now():
+            self.remove(storage_index)
+            return None
+        placement = dict([(int(shnum), base32.a2b(str(serverid)))
+                          for (shnum, serverid)
+                          in json.loads(placement).items()])
+        return (tuple(json.loads(params)), placement)
+
+    def start(self, storage_index, params):
+        """Remember that an upload of the given storage index, with params
+        (k, happy, n, segment_size), has begun. An earlier entry with the
+        same params keeps its placement until set_placement() replaces it,
+        so that an upload which is interrupted again before it has placed
+        its shares can still be resumed. An entry with different params is
+        forgotten."""
+        now = self._now()
+        c = self.cursor
+        if self.ttl is not None:
+            c.execute("DELETE FROM uploads WHERE started < ?",
+                      (now - self.ttl,))
+        si_s = base32.b2a(storage_index)
+        params = json.dumps(list(params))
+        c.execute("UPDATE uploads SET updated=?"
+                  " WHERE storage_index=? AND params=?",
+                  (now, si_s, params))
+        if not c.rowcount:
+            c.execute("INSERT OR REPLACE INTO uploads"
+                      " (storage_index, params, placement, started, updated)"
+                      " VALUES (?,?,?,?,?)",
+                      (si_s, params, "{}", now, now))
+        self.connection.commit()
+
+    def set_placement(self, storage_index, placement):
+        """Record which server ({shnum: serverid}) each share is being
+        uploaded to."""
+        placement = json.dumps(dict([(str(shnum), base32.b2a(serverid))
+                                     for (shnum, serverid)
+                                     in placement.items()]))
+        self.cursor.execute("UPDATE uploads SET placement=?, updated=?"
+                            " WHERE storage_index=?",
+                            (placement, self._now(),
+                             base32.b2a(storage_index)))
+        self.connection.commit()
+
+    def remove(self, storage_index):
+        self.cursor.execute("DELETE FROM uploads WHERE storage_index=?",
+                            (base32.b2a(storage_index),))
+        self.connection.commit()
+
+    def get_entries(self):
+        self.cursor.execute("SELECT COUNT(*) FROM uploads")
+        return self.cursor.fetchone()[0]
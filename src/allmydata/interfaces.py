@@ -18,6 +18,7 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_BUCKETS_BATCH = 100 # storage indexes per get_buckets_batch() query
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -49,6 +50,16 @@ class RIBucketWriter(RemoteInterface):
         """
         return None
 
+    def get_written():
+        """Return the parts of the share that have been written so far, as a
+        list of (offset, length) runs in ascending order (at most 1000 of
+        them). A client that is resuming an interrupted upload uses this to
+        skip the blocks that the server already holds. Servers that keep
+        partial shares for this say so with a non-zero
+        'incoming-grace-period' in their version dictionary.
+        """
+        return ListOf(TupleOf(Offset, Offset), maxLength=1000)
+
 
 class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
@@ -112,7 +123,12 @@ class RIStorageServer(RemoteInterface):
                               must still be a unique value identifying the
                               lease. XXX stop relying on it to be unique.
         @param canary: If the canary is lost before close(), the bucket is
-                       deleted.
+                       deleted, unless the server advertises a non-zero
+                       'incoming-grace-period' (in seconds) in its version
+                       dictionary. Such a server keeps the partial share
+                       for that long, and hands the same bucket back to a
+                       client that allocates it again with the same
+                       renew_secret and allocated_size.
         @return: tuple of (alreadygot, allocated), where alreadygot is what we
                  already have and allocated is what we hereby agree to accept.
                  New leases are added for shares in both lists.
@@ -149,6 +165,19 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_batch(storage_indexes=ListOf(StorageIndex,
+                                                 maxLength=MAX_BUCKETS_BATCH)):
+        """Do get_buckets() for several storage indexes in a single
+        round-trip. Returns a dictionary with one key per storage index for
+        which I hold any shares, mapping to the same {sharenum: bucket}
+        dictionary that get_buckets() would have returned. Storage indexes
+        for which I hold no shares are left out.
+
+        Servers that offer this method say so by setting
+        'get-buckets-batch' in their version dictionary."""
+        return DictOf(StorageIndex,
+                      DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_BUCKETS_BATCH)
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -336,6 +365,13 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.get_buckets``
         """
 
+    def get_buckets_batch(
+            storage_indexes,
+    ):
+        """
+        :see: ``RIStorageServer.get_buckets_batch``
+        """
+
     def slot_readv(
             storage_index,
             shares,
@@ -366,6 +402,90 @@ class IStorageServer(Interface):
         """
 
 
+class IStorageBackend(Interface):
+    """
+    Objects of this kind live on the server side. A StorageServer uses one
+    to decide where its immutable shares are kept. Mutable slots are always
+    kept one file per share in the server's shares/ directory.
+
+    Shares are named by (storage_index, shnum). Lease operations go through
+    the objects returned by get_share_leases(), which offer the lease half
+    of the ShareFile interface.
+    """
+    name = Attribute("a short string, the value of [storage]backend=")
+
+    def list_buckets(prefix):
+        """
+        Return a sorted list of the base32-encoded storage indexes, starting
+        with 'prefix', for which I hold at least one share. The crawlers use
+        this to walk every share on the server.
+        """
+
+    def have_shares():
+        """
+        Return True if I hold any shares at all.
+        """
+
+    def get_bucket_shares(storage_index):
+        """
+        Yield (shnum, filename) for each share of 'storage_index' that is
+        kept in a file of its own under the shares/ directory.
+        """
+
+    def get_container_shares(storage_index):
+        """
+        Return a list of (shnum, size) for each share of 'storage_index'
+        that is kept inside a container file rather than in a file of its
+        own.
+        """
+
+    def get_shnums(storage_index):
+        """
+        Return a sorted list of the share numbers I hold for
+        'storage_index', wherever they are kept.
+        """
+
+    def has_share(storage_index, shnum):
+        """
+        Return True if this share exists, or is currently being uploaded.
+        """
+
+    def get_share_leases(storage_index, shnum):
+        """
+        Return an object for this share which offers get_leases(),
+        add_lease(), renew_lease(), add_or_renew_lease() and cancel_lease().
+        """
+
+    def make_bucket_writer(storage_index, shnum, max_size, lease_info,
+                           canary):
+        """
+        Return a new BucketWriter for an immutable share of up to 'max_size'
+        bytes.
+        """
+
+    def make_bucket_reader(storage_index, shnum):
+        """
+        Return a BucketReader for an existing immutable share.
+        """
+
+    def share_closed(storage_index, shnum, size):
+        """
+        Called after a BucketWriter has successfully finished a share that
+        takes up 'size' bytes.
+        """
+
+    def get_stats():
+        """
+        Return a dictionary of numeric statistics about my storage, which the
+        StorageServer publishes as storage_server.$NAME.$KEY .
+        """
+
+    def close():
+        """
+        Called when the StorageServer shuts down.
+        """
+
+
 class IStorageBucketWriter(Interface):
     """
     Objects of this kind live on the client side.
@@ -413,6 +533,13 @@ class IStorageBucketWriter(Interface):
         @return: a Deferred that fires (with None) when the operation completes
         """
 
+    def get_written_blocks():
+        """Ask the server which of my blocks it already holds, from an
+        earlier upload of this share that was interrupted.
+
+        @return: a Deferred that fires with a set of segment numbers
+        """
+
     def close():
         """Finish writing and close the bucket. The share is not finalized
         until this method is called: if the uploading client disconnects
@@ -556,6 +683,12 @@ class IServer(IDisplayableServer):
         DeadReferenceErrors once the connection is lost.
         """
 
+    def get_link_estimate():
+        """
+        Return a ``LinkEstimate`` of the round-trip time to this server and
+        of its write bandwidth, as measured by uploads.
+        """
+
 
 
 
@@ -902,6 +1035,10 @@ class IMutableFileVersion(IReadable):
     def get_sequence_number():
         """Return the sequence number of this version."""
 
+    def get_root_hash():
+        """Return the root hash of this version's share hash tree. Two
+        versions with the same root hash have the same contents."""
+
     def get_servermap():
         """Return the IMutableFileServerMap instance that was used to create
         this object.
@@ -2176,8 +2313,12 @@ class IUploadResults(Interface):
           helper_total : initial helper query to helper finished pushing
           cumulative_fetch : helper waiting for ciphertext requests
           total_fetch : helper start to last ciphertext response
-          cumulative_encoding : just time spent in zfec
+          cumulative_reading : time spent reading and encrypting segments
+          cumulative_encoding : reading plus time spent in zfec
           cumulative_sending : just time spent waiting for storage servers
+          segment_pipeline : first segment read to last segment sent
+          stage_overlap : how much of encoding and sending happened while
+                          other segments were being encoded or sent
           hashes_and_close : last segment push to shareholder close
           total_encode_and_push : first encode to shareholder close
         """
@@ -2722,6 +2863,9 @@ class IUploadStatus(Interface):
         """Return an integer with the number of bytes that will eventually
         be uploaded for this file. Returns None if the size is not yet known.
         """
+    def get_segment_size():
+        """Return the segment size chosen for this upload, or None if it
+        has not been chosen yet."""
     def using_helper():
         """Return True if this upload is using a Helper, False if not."""
 
@@ -2824,8 +2968,8 @@ class RIControlClient(RemoteInterface):
 
     def get_memory_usage():
         """Return a dict describes the amount of memory currently in use. The
-        keys are 'VmPeak', 'VmSize', and 'VmData'. The values are integers,
-        measuring memory consupmtion in bytes."""
+        keys are 'VmPeak', 'VmSize', 'VmRSS', and 'VmData'. The values are
+        integers, measuring memory consupmtion in bytes."""
         return DictOf(str, int)
 
     def speed_test(count=int, size=int, mutable=Any()):
@@ -2857,6 +3001,17 @@ UploadResults = Any() #DictOf(str, str)
 class RIEncryptedUploadable(RemoteInterface):
     __remote_name__ = "RIEncryptedUploadable.tahoe.allmydata.com"
 
+    def get_version():
+        """
+        Return a dictionary of version information. Uploadables that set
+        'pipelined-reads' under
+        http://allmydata.org/tahoe/protocols/helper/chk-upload/v1 answer
+        several outstanding read_encrypted() calls in the order they were
+        made. Older ones have no get_version() at all, and must only be
+        asked for one piece at a time.
+        """
+        return DictOf(str, Any())
+
     def get_size():
         return Offset
 
@@ -746,6 +746,14 @@ class MutableFileVersion(object):
         return self._version[0] # verinfo[0] == the sequence number
 
 
+    def get_root_hash(self):
+        """
+        Get the root hash of the share hash tree of the mutable version
+        that I represent.
+        """
+        return self._version[1] # verinfo[1] == the root hash
+
+
     # TODO: Terminology?
     def get_writekey(self):
         """
@@ -19,7 +19,9 @@ class NodeMaker(object):
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None,
+                 readahead=None, readahead_memory=None, segment_cache=None,
+                 metadata_cache=None):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -29,6 +31,11 @@ class NodeMaker(object):
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        # for immutable downloads, see DownloadNode
+        self.readahead = readahead
+        self.readahead_memory = readahead_memory
+        self.segment_cache = segment_cache
+        self.metadata_cache = metadata_cache
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
@@ -36,10 +43,18 @@ class NodeMaker(object):
         return LiteralFileNode(cap)
     def _create_immutable(self, cap):
         return ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
-                                 self.terminator, self.history)
+                                 self.terminator, self.history,
+                                 readahead=self.readahead,
+                                 readahead_memory=self.readahead_memory,
+                                 segment_cache=self.segment_cache,
+                                 metadata_cache=self.metadata_cache)
     def _create_immutable_verifier(self, cap):
         return CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
-                                  self.terminator, self.history)
+                                  self.terminator, self.history,
+                                  readahead=self.readahead,
+                                  readahead_memory=self.readahead_memory,
+                                  segment_cache=self.segment_cache,
+                                  metadata_cache=self.metadata_cache)
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
@@ -0,0 +1,126 @@
+import os, re
+
+from zope.interface import implementer
+from allmydata.interfaces import IStorageBackend
+from allmydata.util import fileutil
+from allmydata.storage.common import storage_index_to_dir
+from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
+
+# A storage backend decides where a StorageServer keeps its immutable
+# shares. Mutable slots are rewritten in place by slot_testv_and_writev, so
+# they always stay one file per share in the shares/ directory, whichever
+# backend is in use.
+#
+#  "disk": every share is a file of its own, in the layout described at the
+#          top of storage/server.py
+#  "packed": new immutable shares are appended to a few large container
+#            files (see storage/packed.py)
+
+BACKENDS = ("disk", "packed")
+
+# $SHARENUM matches this regex:
+NUM_RE=re.compile("^[0-9]+$")
+
+
+@implementer(IStorageBackend)
+class DiskBackend(object):
+    """I keep each share in its own file:
+    storage/shares/$START/$STORAGEINDEX/$SHARENUM ."""
+
+    name = "disk"
+
+    def __init__(self, server):
+        self.server = server
+
+    def close(self):
+        pass
+
+    def get_stats(self):
+        return {}
+
+    def list_buckets(self, prefix):
+        try:
+            buckets = os.listdir(os.path.join(self.server.sharedir, prefix))
+        except EnvironmentError:
+            return []
+        buckets.sort()
+        return buckets
+
+    def have_shares(self):
+        return bool(set(os.listdir(self.server.sharedir)) - set(["incoming"]))
+
+    def get_bucket_shares(self, storage_index):
+        """Return a list of (shnum, pathname) tuples for files that hold
+        shares for this storage_index. In each tuple, 'shnum' will always be
+        the integer form of the last component of 'pathname'."""
+        storagedir = os.path.join(self.server.sharedir,
+                                  storage_index_to_dir(storage_index))
+        share_index = self.server.share_index
+        if share_index is not None:
+            shares = share_index.get_shares(storage_index)
+            if shares is not None:
+                for shnum in sorted(shares):
+                    yield (shnum, os.path.join(storagedir, "%d" % shnum))
+                return
+        try:
+            for f in os.listdir(storagedir):
+                if NUM_RE.match(f):
+                    filename = os.path.join(storagedir, f)
+                    yield (int(f), filename)
+        except OSError:
+            # Commonly caused by there being no buckets at all.
+            pass
+
+    def get_container_shares(self, storage_index):
+        return []
+
+    def get_shnums(self, storage_index):
+        return sorted([shnum for (shnum, filename)
+                       in self.get_bucket_shares(storage_index)])
+
+    def _get_final_path(self, storage_index, shnum):
+        return os.path.join(self.server.sharedir,
+                            storage_index_to_dir(storage_index),
+                            "%d" % shnum)
+
+    def _get_incoming_path(self, storage_index, shnum):
+        return os.path.join(self.server.incomingdir,
+                            storage_index_to_dir(storage_index),
+                            "%d" % shnum)
+
+    def has_share(self, storage_index, shnum):
+        # Note that we report shnums that have a partial share (in
+        # incoming/), so the server doesn't create BucketWriters for them:
+        # if a second upload occurs while the first is still in progress,
+        # the second uploader will use different storage servers.
+        return (os.path.exists(self._get_final_path(storage_index, shnum)) or
+                os.path.exists(self._get_incoming_path(storage_index, shnum)))
+
+    def get_share_leases(self, storage_index, shnum):
+        filename = self._get_final_path(storage_index, shnum)
+        if self.server.leasedb is not None:
+            return self.server.leasedb.get_share(storage_index, shnum,
+                                                 filename)
+        return ShareFile(filename)
+
+    def make_bucket_writer(self, storage_index, shnum, max_size, lease_info,
+                           canary):
+        finalhome = self._get_final_path(storage_index, shnum)
+        bw = BucketWriter(self.server,
+                          self._get_incoming_path(storage_index, shnum),
+                          finalhome, max_size, lease_info, canary,
+                          buffered=self.server.buffered_writes,
+                          fsync=self.server.fsync)
+        fileutil.make_dirs(os.path.dirname(finalhome))
+        return bw
+
+    def make_bucket_reader(self, storage_index, shnum):
+        return BucketReader(self.server,
+                            self._get_final_path(storage_index, shnum),
+                            storage_index, shnum,
+                            self.server.share_file_pool)
+
+    def share_closed(self, storage_index, shnum, size):
+        if self.server.share_index is not None:
+            self.server.share_index.add_share(storage_index, shnum, size,
+                                              "immutable")
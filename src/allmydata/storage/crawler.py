@@ -1,8 +1,10 @@
 
-import os, time, struct
+import os, time, struct, bisect
 import cPickle as pickle
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
 from twisted.application import service
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 from allmydata.storage.common import si_b2a
 from allmydata.util import fileutil
 
@@ -57,6 +59,20 @@ class ShareCrawler(service.MultiService):
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    A crawler whose per-bucket work is mostly waiting for the disk can set
+    'threads' to a positive number to crawl in threaded mode instead. Each
+    bucket is then handled in two steps: read_bucket() is called in one of
+    'threads' worker threads, where it should do the stat()/read() calls
+    that dominate on a cold cache (disk I/O releases the GIL, so several of
+    them can be in flight at once), and its return value is handed to
+    process_bucket_data() in the reactor thread, which updates self.state
+    and may modify the shares. Buckets are read in batches of
+    'threaded_batch_size', in order, and processed in order, so the
+    statefile means the same as in the normal mode. Instead of a CPU
+    percentage, threaded mode is limited to 'allowed_io_rate' buckets per
+    second (or not at all, if it is None). process_prefixdir() is not used
+    in threaded mode.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -64,11 +80,20 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # these are used in threaded mode, when threads > 0
+    threads = 0 # how many buckets to read at the same time
+    allowed_io_rate = 100 # buckets per second, or None for no limit
+    threaded_batch_size = 64 # buckets to read before merging the results
 
-    def __init__(self, server, statefile, allowed_cpu_percentage=None):
+    def __init__(self, server, statefile, allowed_cpu_percentage=None,
+                 threads=None, allowed_io_rate=None):
         service.MultiService.__init__(self)
         if allowed_cpu_percentage is not None:
             self.allowed_cpu_percentage = allowed_cpu_percentage
+        if threads is not None:
+            self.threads = threads
+        if allowed_io_rate is not None:
+            self.allowed_io_rate = allowed_io_rate
         self.server = server
         self.sharedir = server.sharedir
         self.statefile = statefile
@@ -83,6 +108,8 @@ class ShareCrawler(service.MultiService):
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.last_save_time = None
+        self.threadpool = None
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -105,13 +132,17 @@ class ShareCrawler(service.MultiService):
 
          cycle-complete-percentage': float, from 0.0 to 100.0, indicating how
                                      far the crawler has progressed through
-                                     the current cycle
+                                     the current cycle, including the
+                                     buckets already done in the current
+                                     prefixdir
          remaining-sleep-time: float, seconds from now when we do more work
          estimated-cycle-complete-time-left:
                 float, seconds remaining until the current cycle is finished.
-                TODO: this does not yet include the remaining time left in
-                the current prefixdir, and it will be very inaccurate on fast
-                crawlers (which can process a whole prefix in a single tick)
+                This is extrapolated from the time that the last prefixdir
+                took, so it will be very inaccurate on fast crawlers (which
+                can process a whole prefix in a single tick)
+         estimated-cycle-complete-time: float, seconds-since-epoch when the
+                                        current cycle should be finished
          estimated-time-per-cycle: float, seconds required to do a complete
                                    cycle
 
@@ -132,17 +163,18 @@ class ShareCrawler(service.MultiService):
                                                           time.time())
         else:
             d["cycle-in-progress"] = True
-            pct = 100.0 * self.last_complete_prefix_index / len(self.prefixes)
+            done = (self.last_complete_prefix_index + 1
+                    + self.get_current_prefix_fraction())
+            pct = 100.0 * done / len(self.prefixes)
             d["cycle-complete-percentage"] = pct
             remaining = None
+            eta = None
             if self.last_prefix_elapsed_time is not None:
-                left = len(self.prefixes) - self.last_complete_prefix_index
+                left = len(self.prefixes) - done
                 remaining = left * self.last_prefix_elapsed_time
-                # TODO: remainder of this prefix: we need to estimate the
-                # per-bucket time, probably by measuring the time spent on
-                # this prefix so far, divided by the number of buckets we've
-                # processed.
+                eta = time.time() + remaining
             d["estimated-cycle-complete-time-left"] = remaining
+            d["estimated-cycle-complete-time"] = eta
             # it's possible to call get_progress() from inside a crawler's
             # finished_prefix() function
             d["remaining-sleep-time"] = self.minus_or_none(self.next_wake_time,
@@ -155,6 +187,17 @@ class ShareCrawler(service.MultiService):
         d["estimated-time-per-cycle"] = per_cycle
         return d
 
+    def get_current_prefix_fraction(self):
+        """Return the fraction (from 0.0 to 1.0) of the buckets in the
+        prefixdir being worked on that have already been processed."""
+        (i, buckets) = self.bucket_cache
+        if i != self.last_complete_prefix_index + 1 or not buckets:
+            return 0.0
+        last_bucket = self.state["last-complete-bucket"]
+        if last_bucket is None:
+            return 0.0
+        return bisect.bisect_right(buckets, last_bucket) / float(len(buckets))
+
     def get_state(self):
         """I return the current state of the crawler. This is a copy of my
         state dictionary.
@@ -234,8 +277,13 @@ class ShareCrawler(service.MultiService):
         pickle.dump(self.state, f)
         f.close()
         fileutil.move_into_place(tmpfile, self.statefile)
+        self.last_save_time = time.time()
 
     def startService(self):
+        if self.threads:
+            self.threadpool = ThreadPool(0, self.threads,
+                                         name=self.__class__.__name__)
+            self.threadpool.start()
         # arrange things to look like we were just sleeping, so
         # status/progress values work correctly
         self.sleeping_between_cycles = True
@@ -248,10 +296,17 @@ class ShareCrawler(service.MultiService):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        if self.threadpool is not None:
+            # this waits for the buckets being read right now. Their results
+            # are dropped, so they will be read again after a restart.
+            self.threadpool.stop()
+            self.threadpool = None
         self.save_state()
         return service.MultiService.stopService(self)
 
     def start_slice(self):
+        if self.threads:
+            return self.start_threaded_slice()
         start_slice = time.time()
         self.timer = None
         self.sleeping_between_cycles = False
@@ -291,7 +346,84 @@ class ShareCrawler(service.MultiService):
         self.yielding(sleep_time)
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
-    def start_current_prefix(self, start_slice):
+    def start_threaded_slice(self):
+        """Read the next batch of buckets in the worker threads, process
+        them when they have all been read, and then schedule the next
+        batch. Empty prefixdirs are skipped without yielding."""
+        start_slice = time.time()
+        self.timer = None
+        self.sleeping_between_cycles = False
+        self.current_sleep_time = None
+        self.next_wake_time = None
+        cycle = self.start_cycle()
+        while self.last_complete_prefix_index+1 < len(self.prefixes):
+            i = self.last_complete_prefix_index+1
+            prefix = self.prefixes[i]
+            prefixdir = os.path.join(self.sharedir, prefix)
+            last_bucket = self.state["last-complete-bucket"]
+            buckets = [b for b in self.get_buckets(i, prefix)
+                       if b > last_bucket][:self.threaded_batch_size]
+            if buckets:
+                d = self.read_buckets(prefix, prefixdir, buckets)
+                d.addCallback(self._process_bucket_batch, cycle, prefix,
+                              prefixdir, buckets, start_slice)
+                d.addErrback(log.err, "%s failed" % self.__class__.__name__)
+                return d
+            self.finish_prefix(i, cycle, prefix)
+        self.finish_cycle(cycle)
+        self._schedule_threaded_slice(start_slice, 0, True)
+
+    def read_buckets(self, prefix, prefixdir, buckets):
+        """Call read_bucket() for each of the given buckets in the worker
+        threads. Return a Deferred that fires with a list of the results,
+        in the same order."""
+        ds = [threads.deferToThreadPool(reactor, self.threadpool,
+                                        self.read_bucket,
+                                        prefix, prefixdir, bucket)
+              for bucket in buckets]
+        d = defer.gatherResults(ds, consumeErrors=True)
+        def _unwrap(f):
+            f.trap(defer.FirstError)
+            return f.value.subFailure
+        d.addErrback(_unwrap)
+        return d
+
+    def _process_bucket_batch(self, results, cycle, prefix, prefixdir,
+                              buckets, start_slice):
+        if not self.running:
+            # stopService() was called while the buckets were being read
+            return
+        for (bucket, data) in zip(buckets, results):
+            self.process_bucket_data(cycle, prefix, prefixdir, bucket, data)
+            self.state["last-complete-bucket"] = bucket
+        self._schedule_threaded_slice(start_slice, len(buckets), False)
+
+    def _schedule_threaded_slice(self, start_slice, num_buckets,
+                                 finished_cycle):
+        now = time.time()
+        # save the state about as often as the normal mode does
+        if (self.last_save_time is None or
+            now >= self.last_save_time + self.cpu_slice):
+            self.save_state()
+        if not self.running:
+            return
+        sleep_time = 0.0
+        if self.allowed_io_rate:
+            # sleep long enough to keep the average below allowed_io_rate
+            sleep_time = num_buckets / float(self.allowed_io_rate)
+            sleep_time -= now - start_slice
+        sleep_time = max(0.0, min(sleep_time, 299))
+        if finished_cycle:
+            sleep_time = max(sleep_time, self.minimum_cycle_time)
+        self.sleeping_between_cycles = finished_cycle
+        self.current_sleep_time = sleep_time # for status page
+        self.next_wake_time = now + sleep_time
+        self.yielding(sleep_time)
+        self.timer = reactor.callLater(sleep_time, self.start_slice)
+
+    def start_cycle(self):
+        """Start a new cycle, unless one is already in progress. Return
+        the number of the current cycle."""
         state = self.state
         if state["current-cycle"] is None:
             self.last_cycle_started_time = time.time()
@@ -301,36 +433,47 @@ class ShareCrawler(service.MultiService):
             else:
                 state["current-cycle"] = state["last-cycle-finished"] + 1
             self.started_cycle(state["current-cycle"])
-        cycle = state["current-cycle"]
+        return state["current-cycle"]
+
+    def get_buckets(self, i, prefix):
+        if i == self.bucket_cache[0]:
+            return self.bucket_cache[1]
+        # this includes buckets whose shares the backend keeps somewhere
+        # other than prefixdir
+        buckets = self.server.backend.list_buckets(prefix)
+        self.bucket_cache = (i, buckets)
+        return buckets
+
+    def finish_prefix(self, i, cycle, prefix):
+        self.last_complete_prefix_index = i
+
+        now = time.time()
+        if self.last_prefix_finished_time is not None:
+            elapsed = now - self.last_prefix_finished_time
+            self.last_prefix_elapsed_time = elapsed
+        self.last_prefix_finished_time = now
+
+        self.finished_prefix(cycle, prefix)
+
+    def start_current_prefix(self, start_slice):
+        cycle = self.start_cycle()
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
             # if we want to yield earlier, just raise TimeSliceExceeded()
             prefix = self.prefixes[i]
             prefixdir = os.path.join(self.sharedir, prefix)
-            if i == self.bucket_cache[0]:
-                buckets = self.bucket_cache[1]
-            else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
-                self.bucket_cache = (i, buckets)
+            buckets = self.get_buckets(i, prefix)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
-            self.last_complete_prefix_index = i
-
-            now = time.time()
-            if self.last_prefix_finished_time is not None:
-                elapsed = now - self.last_prefix_finished_time
-                self.last_prefix_elapsed_time = elapsed
-            self.last_prefix_finished_time = now
-
-            self.finished_prefix(cycle, prefix)
+            self.finish_prefix(i, cycle, prefix)
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
+        self.finish_cycle(cycle)
+
+    def finish_cycle(self, cycle):
+        state = self.state
         self.last_complete_prefix_index = -1
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
@@ -394,6 +537,27 @@ class ShareCrawler(service.MultiService):
         """
         pass
 
+    def read_bucket(self, prefix, prefixdir, storage_index_b32):
+        """In threaded mode, this is called in a worker thread to read
+        whatever process_bucket_data() will need to know about a single
+        bucket, and return it. It must not touch self.state, the server, or
+        anything else that the reactor thread might be using at the same
+        time: it should only read from the disk.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        return None
+
+    def process_bucket_data(self, cycle, prefix, prefixdir, storage_index_b32,
+                            data):
+        """In threaded mode, this is called in the reactor thread with the
+        return value of read_bucket(), in place of process_bucket(). The
+        default implementation ignores 'data' and calls process_bucket().
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        self.process_bucket(cycle, prefix, prefixdir, storage_index_b32)
+
     def finished_prefix(self, cycle, prefix):
         """Notify a subclass that the crawler has just finished processing a
         prefix directory (all buckets with the same two-character/10bit
@@ -2,8 +2,8 @@ import time, os, pickle, struct
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
-from twisted.python import log as twlog
+     UnknownImmutableContainerVersionError, si_a2b
+from twisted.python import log as twlog, failure
 
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
@@ -43,6 +43,11 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     All cycle-to-date values remain valid until the start of the next cycle.
 
+    In threaded mode (see ShareCrawler), the bucket directories and share
+    files are stat()ed, and the leases are read out of the share files (when
+    there is no leasedb), in the worker threads. Examining the leases,
+    cancelling them and deleting shares is still done in the reactor.
+
     """
 
     slow_start = 360 # wait 6 minutes after startup
@@ -52,7 +57,8 @@ class LeaseCheckingCrawler(ShareCrawler):
                  expiration_enabled, mode,
                  override_lease_duration, # used if expiration_mode=="age"
                  cutoff_date, # used if expiration_mode=="cutoff-date"
-                 sharetypes):
+                 sharetypes,
+                 threads=None, allowed_io_rate=None):
         self.historyfile = historyfile
         self.expiration_enabled = expiration_enabled
         self.mode = mode
@@ -68,7 +74,8 @@ class LeaseCheckingCrawler(ShareCrawler):
         else:
             raise ValueError("GC mode '%s' must be 'age' or 'cutoff-date'" % mode)
         self.sharetypes_to_expire = sharetypes
-        ShareCrawler.__init__(self, server, statefile)
+        ShareCrawler.__init__(self, server, statefile, threads=threads,
+                              allowed_io_rate=allowed_io_rate)
 
     def add_initial_state(self):
         # we fill ["cycle-to-date"] here (even though they will be reset in
@@ -112,20 +119,68 @@ class LeaseCheckingCrawler(ShareCrawler):
     def stat(self, fn):
         return os.stat(fn)
 
-    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+    def read_bucket(self, prefix, prefixdir, storage_index_b32):
+        """Return (the stat() of the bucket directory, or None if there is
+        none, and a list of (shnum, sharefile, share data) tuples, where the
+        share data comes from read_share())."""
         bucketdir = os.path.join(prefixdir, storage_index_b32)
-        s = self.stat(bucketdir)
-        would_keep_shares = []
-        wks = None
-
-        for fn in os.listdir(bucketdir):
+        try:
+            s = self.stat(bucketdir)
+            sharefiles = os.listdir(bucketdir)
+        except EnvironmentError:
+            # the backend keeps all of this bucket's shares in containers
+            return (None, [])
+        shares = []
+        for fn in sharefiles:
             try:
                 shnum = int(fn)
             except ValueError:
                 continue # non-numeric means not a sharefile
             sharefile = os.path.join(bucketdir, fn)
+            shares.append((shnum, sharefile, self.read_share(sharefile)))
+        return (s, shares)
+
+    def read_share(self, sharefilename):
+        """Return (the stat() of a share file, its ShareFile or
+        MutableShareFile, and a list of its leases), a Failure if the share
+        cannot be parsed, or None if it has just been deleted. When there is
+        a leasedb, only the stat() is done here, and the other two are
+        None."""
+        sf = None
+        leases = None
+        try:
+            if self.server.leasedb is None:
+                sf = get_share_file(sharefilename)
+                leases = list(sf.get_leases())
+            s = self.stat(sharefilename)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            return failure.Failure()
+        except EnvironmentError:
+            if os.path.exists(sharefilename):
+                raise
+            return None
+        return (s, sf, leases)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        data = self.read_bucket(prefix, prefixdir, storage_index_b32)
+        self.process_bucket_data(cycle, prefix, prefixdir, storage_index_b32,
+                                 data)
+
+    def process_bucket_data(self, cycle, prefix, prefixdir, storage_index_b32,
+                            data):
+        (s, shares) = data
+        would_keep_shares = []
+        wks = None
+
+        for (shnum, sharefile, share_data) in shares:
+            if share_data is None:
+                continue
             try:
-                wks = self.process_share(sharefile)
+                if isinstance(share_data, failure.Failure):
+                    share_data.raiseException()
+                wks = self.process_share(sharefile, share_data)
             except (UnknownMutableContainerVersionError,
                     UnknownImmutableContainerVersionError,
                     struct.error):
@@ -136,6 +191,12 @@ class LeaseCheckingCrawler(ShareCrawler):
                 wks = (1, 1, 1, "unknown")
             would_keep_shares.append(wks)
 
+        storage_index = si_a2b(storage_index_b32)
+        backend = self.server.backend
+        for (shnum, size) in backend.get_container_shares(storage_index):
+            wks = self.process_container_share(storage_index, shnum, size)
+            would_keep_shares.append(wks)
+
         sharetype = None
         if wks:
             # use the last share's sharetype as the buckettype
@@ -149,7 +210,9 @@ class LeaseCheckingCrawler(ShareCrawler):
         try:
             bucket_diskbytes = s.st_blocks * 512
         except AttributeError:
-            bucket_diskbytes = 0 # no stat().st_blocks on windows
+            # no stat().st_blocks on windows, and no bucket directory at all
+            # if every share is in a container
+            bucket_diskbytes = 0
         if sum([wks[0] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("original", bucket_diskbytes, sharetype)
         if sum([wks[1] for wks in would_keep_shares]) == 0:
@@ -157,19 +220,90 @@ class LeaseCheckingCrawler(ShareCrawler):
         if sum([wks[2] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
 
-    def process_share(self, sharefilename):
-        # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
+    def _parse_sharefilename(self, sharefilename):
+        # sharefilename is .../$START/$STORAGEINDEX/$SHARENUM
+        (bucketdir, shnum_s) = os.path.split(sharefilename)
+        return (si_a2b(os.path.basename(bucketdir)), int(shnum_s))
+
+    def get_share(self, sharefilename):
+        leasedb = self.server.leasedb
+        if leasedb is None:
+            return get_share_file(sharefilename)
+        (storage_index, shnum) = self._parse_sharefilename(sharefilename)
+        return leasedb.get_share(storage_index, shnum, sharefilename)
+
+    def process_share(self, sharefilename, share_data):
+        (s, sf, leases) = share_data
+        if sf is None:
+            # find out what kind of a share it is
+            sf = self.get_share(sharefilename)
+        sharebytes = s.st_size
+        try:
+            # note that stat(2) says that st_blocks is 512 bytes, and that
+            # st_blksize is "optimal file sys I/O ops blocksize", which is
+            # independent of the block-size that st_blocks uses.
+            diskbytes = s.st_blocks * 512
+        except AttributeError:
+            # the docs say that st_blocks is only on linux. I also see it on
+            # MacOS. But it isn't available on windows.
+            diskbytes = sharebytes
+
+        (would_keep_share, expired_leases) = self.examine_leases(sf,
+                                                                 sharebytes,
+                                                                 diskbytes,
+                                                                 leases)
+        if self.expiration_enabled and expired_leases and leases is not None:
+            expired_leases = self.still_expired(sf, expired_leases)
+        if self.expiration_enabled and expired_leases:
+            self.server.discard_share_file(sharefilename)
+            for li in expired_leases:
+                sf.cancel_lease(li.cancel_secret)
+            if not os.path.exists(sharefilename):
+                # the last lease is gone, and so is the share
+                (storage_index, shnum) = self._parse_sharefilename(sharefilename)
+                self.server.share_removed(storage_index, shnum, sharebytes)
+        return would_keep_share
+
+    def still_expired(self, sf, expired_leases):
+        """The leases of 'sf' were read by read_share(), maybe in a worker
+        thread while clients could still renew them. Return the ones from
+        'expired_leases' that have not been renewed (or removed) since."""
+        try:
+            current = dict([(li.cancel_secret, li.get_grant_renew_time_time())
+                            for li in sf.get_leases()])
+        except EnvironmentError:
+            return [] # the share has been deleted
+        return [li for li in expired_leases
+                if current.get(li.cancel_secret) == li.get_grant_renew_time_time()]
+
+    def process_container_share(self, storage_index, shnum, size):
+        backend = self.server.backend
+        sf = backend.get_share_leases(storage_index, shnum)
+        (would_keep_share, expired_leases) = self.examine_leases(sf, size,
+                                                                 size)
+        if self.expiration_enabled and expired_leases:
+            for li in expired_leases:
+                sf.cancel_lease(li.cancel_secret)
+            if not backend.has_share(storage_index, shnum):
+                self.server.share_removed(storage_index, shnum, size)
+        return would_keep_share
+
+    def examine_leases(self, sf, sharebytes, diskbytes, leases=None):
+        """Count the leases on one share, and the space that expiring it
+        would recover. Return a tuple of (would_keep_share, the leases that
+        have expired according to our configuration). If 'leases' is None,
+        they are read from 'sf'."""
         sharetype = sf.sharetype
         now = time.time()
-        s = self.stat(sharefilename)
+        if leases is None:
+            leases = sf.get_leases()
 
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
         expired_leases_configured = []
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
             original_expiration_time = li.get_expiration_time()
             grant_renew_time = li.get_grant_renew_time_time()
@@ -202,38 +336,26 @@ class LeaseCheckingCrawler(ShareCrawler):
 
         so_far = self.state["cycle-to-date"]
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
-        self.increment_space("examined", s, sharetype)
+        self.increment_space("examined", sharebytes, diskbytes, sharetype)
 
         would_keep_share = [1, 1, 1, sharetype]
 
-        if self.expiration_enabled:
-            for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
-
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
-            self.increment_space("original", s, sharetype)
+            self.increment_space("original", sharebytes, diskbytes, sharetype)
 
         if num_valid_leases_configured == 0:
             would_keep_share[1] = 0
-            self.increment_space("configured", s, sharetype)
+            self.increment_space("configured", sharebytes, diskbytes,
+                                 sharetype)
             if self.expiration_enabled:
                 would_keep_share[2] = 0
-                self.increment_space("actual", s, sharetype)
+                self.increment_space("actual", sharebytes, diskbytes,
+                                     sharetype)
 
-        return would_keep_share
+        return (would_keep_share, expired_leases_configured)
 
-    def increment_space(self, a, s, sharetype):
-        sharebytes = s.st_size
-        try:
-            # note that stat(2) says that st_blocks is 512 bytes, and that
-            # st_blksize is "optimal file sys I/O ops blocksize", which is
-            # independent of the block-size that st_blocks uses.
-            diskbytes = s.st_blocks * 512
-        except AttributeError:
-            # the docs say that st_blocks is only on linux. I also see it on
-            # MacOS. But it isn't available on windows.
-            diskbytes = sharebytes
+    def increment_space(self, a, sharebytes, diskbytes, sharetype):
         so_far_sr = self.state["cycle-to-date"]["space-recovered"]
         self.increment(so_far_sr, a+"-shares", 1)
         self.increment(so_far_sr, a+"-sharebytes", sharebytes)
@@ -303,6 +425,10 @@ class LeaseCheckingCrawler(ShareCrawler):
         # copy() needs to become a deepcopy
         h["space-recovered"] = s["space-recovered"].copy()
 
+        rec = s["space-recovered"]
+        self.server.space_accountant.lease_checker_cycle_finished(
+            rec.get("examined-sharebytes", 0) - rec.get("actual-sharebytes", 0))
+
         history = pickle.load(open(self.historyfile, "rb"))
         history[cycle] = h
         while len(history) > 10:
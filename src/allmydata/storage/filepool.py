@@ -0,0 +1,81 @@
+import os, sys
+from collections import OrderedDict
+
+# Downloaders read each immutable share in many small pieces (hash tree
+# nodes, then one block per segment), and without a pool every one of those
+# reads costs an open(), a seek() and a close(). The FilePool keeps the most
+# recently used share files open, so a busy download only pays for the seek
+# and the read.
+#
+# Immutable share data never changes once the share has been closed, so a
+# cached file object always returns the same bytes as a fresh one would.
+# The only thing to be careful about is deletion: a file that is held open
+# keeps its disk space allocated (and cannot be deleted at all on Windows),
+# so anything that removes a share file must discard() it first.
+#
+# Share files can also be deleted behind the server's back, by an
+# administrator (or by the unit tests). A reader must then fail just as it
+# would have without the pool, so every hit checks with fstat() that the
+# file still has a name. That costs much less than the open() it replaces.
+# Windows does not let anybody delete a file that we hold open, and its
+# fstat() does not report a link count, so the check is skipped there.
+
+CHECK_UNLINKED = sys.platform != "win32"
+
+DEFAULT_MAX_OPEN = 64
+
+class FilePool(object):
+    """I keep up to 'max_open' files open for reading, closing the least
+    recently used one when I need room for another."""
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        assert max_open > 0, max_open
+        self.max_open = max_open
+        self._files = OrderedDict() # filename -> file, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, filename):
+        f = self._files.pop(filename, None)
+        if f is not None and CHECK_UNLINKED and \
+               os.fstat(f.fileno()).st_nlink == 0:
+            # somebody deleted it: forget it, and try to open it again
+            f.close()
+            f = None
+        if f is None:
+            self.misses += 1
+            # unbuffered: a stdio buffer would keep returning the old bytes
+            # of a file that has been rewritten in place
+            f = open(filename, "rb", 0)
+            while len(self._files) >= self.max_open:
+                (ignored, oldf) = self._files.popitem(last=False)
+                oldf.close()
+        else:
+            self.hits += 1
+        self._files[filename] = f # now the most recently used
+        return f
+
+    def read(self, filename, offset, length):
+        """Return up to 'length' bytes from 'filename', starting at
+        'offset'."""
+        f = self._get(filename)
+        f.seek(offset)
+        return f.read(length)
+
+    def discard(self, filename):
+        """Close 'filename' if I have it open. Call this before deleting
+        the file."""
+        f = self._files.pop(filename, None)
+        if f is not None:
+            f.close()
+
+    def close_all(self):
+        while self._files:
+            (ignored, f) = self._files.popitem()
+            f.close()
+
+    def get_stats(self):
+        return {"open": len(self._files),
+                "hits": self.hits,
+                "misses": self.misses,
+                }
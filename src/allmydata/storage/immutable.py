@@ -1,16 +1,36 @@
-import os, stat, struct, time
+import os, sys, errno, stat, struct, time
 
-from foolscap.api import Referenceable
+from twisted.internet import defer, threads
+from twisted.python import failure
+from foolscap.api import Referenceable, eventually
 
 from zope.interface import implementer
 from allmydata.interfaces import RIBucketWriter, RIBucketReader
 from allmydata.util import base32, fileutil, log
+from allmydata.util.spans import Spans
 from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.latency import get_client_id
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
      DataTooLargeError
 
+# BucketWriters in buffered mode hold up to this many bytes of sequential
+# writes in memory before writing them to the share file
+WRITE_BUFFER_SIZE = 1024*1024
+
+# when a BucketWriter is closed, its share file (and, once the share has
+# been moved into place, the directories it was moved between) can be
+# fsynced:
+#  "none": never (the kernel writes it out eventually)
+#  "close": immediately, before remote_close() returns
+#  "group": by the StorageServer's GroupSyncer, together with any other
+#           shares that are closed at about the same time
+FSYNC_POLICIES = ("none", "close", "group")
+
+# get_written() reports at most this many (offset, length) runs
+MAX_WRITTEN_SPANS = 1000
+
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
 # RIBucketReader.read . The lease information is not accessible through these
@@ -40,11 +60,12 @@ class ShareFile(object):
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, pool=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If pool is provided, it is a FilePool which I will use for reading the header and the share data. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._pool = pool
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -65,10 +86,14 @@ class ShareFile(object):
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            f = open(self.home, 'rb')
             filesize = os.path.getsize(self.home)
-            (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
-            f.close()
+            if pool is not None:
+                header = pool.read(self.home, 0, 0xc)
+            else:
+                f = open(self.home, 'rb')
+                header = f.read(0xc)
+                f.close()
+            (version, unused, num_leases) = struct.unpack(">LLL", header)
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
                       (filename, version)
@@ -88,21 +113,31 @@ class ShareFile(object):
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return ""
+        if self._pool is not None:
+            return self._pool.read(self.home, seekpos, actuallength)
         f = open(self.home, 'rb')
         f.seek(seekpos)
         return f.read(actuallength)
 
-    def write_share_data(self, offset, data):
-        length = len(data)
+    def check_write(self, offset, length):
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
-        f = open(self.home, 'rb+')
+
+    def write_share_data(self, offset, data, f=None):
+        """If f is provided, it is a file object (opened in 'rb+' mode on
+        my share file) which I will write through and leave open."""
+        self.check_write(offset, len(data))
+        close = False
+        if f is None:
+            f = open(self.home, 'rb+')
+            close = True
         real_offset = self._data_offset+offset
         f.seek(real_offset)
         assert f.tell() == real_offset
         f.write(data)
-        f.close()
+        if close:
+            f.close()
 
     def _write_lease_record(self, f, lease_number, lease_info):
         offset = self._lease_offset + lease_number * self.LEASE_SIZE
@@ -194,41 +229,269 @@ class ShareFile(object):
         return space_freed
 
 
+def fsync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def fsync_dir(dirname):
+    """Make the entries of 'dirname' (e.g. a share that was just renamed
+    into it) durable. A directory that is gone has nothing left to sync."""
+    if sys.platform == "win32":
+        # directories cannot be opened (or fsynced) on Windows, and NTFS
+        # journals its metadata anyway
+        return
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_files(files):
+    for f in files:
+        fsync_file(f)
+
+def _fsync_all(files, dirnames):
+    _fsync_files(files)
+    for dirname in dirnames:
+        fsync_dir(dirname)
+
+class GroupSyncer(object):
+    """I fsync share files (and the directories they were moved into) on
+    behalf of BucketWriters, in a worker thread so the reactor is not
+    blocked while the disk catches up.
+
+    While one group is being synced, newly-closed files and newly-moved
+    shares queue up, and are all synced together once the current group is
+    done. This amortizes the cost of the journal commit behind each fsync
+    across all the shares that finish uploading at about the same time,
+    e.g. the N shares of one file being written to a single server, which
+    also share a single directory.
+    """
+
+    def __init__(self):
+        self._queue = [] # (files, dirnames, Deferred)
+        self._syncing = False
+        self.groups = 0
+
+    def sync(self, f):
+        """Return a Deferred that fires once 'f' has been fsynced."""
+        return self._enqueue([f], [])
+
+    def sync_dirs(self, dirnames):
+        """Return a Deferred that fires once all of 'dirnames' have been
+        fsynced."""
+        return self._enqueue([], dirnames)
+
+    def _enqueue(self, files, dirnames):
+        d = defer.Deferred()
+        self._queue.append((files, dirnames, d))
+        if not self._syncing:
+            self._syncing = True
+            # wait a turn, so shares closed in the same batch of messages
+            # join this group
+            eventually(self._sync_group)
+        return d
+
+    def _sync_group(self):
+        group, self._queue = self._queue, []
+        self.groups += 1
+        files = []
+        dirnames = []
+        for (fs, dns, ign) in group:
+            files.extend(fs)
+            for dirname in dns:
+                if dirname not in dirnames:
+                    dirnames.append(dirname)
+        d = threads.deferToThread(_fsync_all, files, dirnames)
+        def _done(res):
+            for (fs, dns, d2) in group:
+                if isinstance(res, failure.Failure):
+                    d2.errback(res)
+                else:
+                    d2.callback(None)
+            if self._queue:
+                self._sync_group()
+            else:
+                self._syncing = False
+        d.addBoth(_done)
+
+
 @implementer(RIBucketWriter)
 class BucketWriter(Referenceable):
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info,
+                 canary, buffered=False, fsync="none"):
+        precondition(fsync in FSYNC_POLICIES, fsync)
         self.ss = ss
         self.incominghome = incominghome
         self.finalhome = finalhome
         self._max_size = max_size # don't allow the client to write more than this
         self._canary = canary
+        self._client = get_client_id(canary)
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
+        self._closing = False
         self.throw_out_all_data = False
         self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
+        self._fsync = fsync
+        # in buffered mode, we hold the share file open until we're closed,
+        # and collect runs of sequential writes in _buffer
+        self._buffered = buffered
+        self._f = None
+        if buffered:
+            self._f = open(incominghome, 'rb+')
+        self._buffer = []
+        self._buffer_offset = 0
+        self._buffer_size = 0
+        # the parts of the share that the client has written so far
+        self._written = Spans()
+        # while the client is away, the StorageServer holds on to us until
+        # this time (see park_bucket_writer)
+        self.parked_until = None
 
     def allocated_size(self):
         return self._max_size
 
+    def resume(self, canary):
+        """Take up a parked upload again, on behalf of the client that holds
+        'canary'. The share keeps everything that was written to it before
+        the previous client went away."""
+        precondition(self.parked_until is not None)
+        self.parked_until = None
+        self._canary = canary
+        self._client = get_client_id(canary)
+        self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
+        if self._buffered:
+            self._f = open(self.incominghome, 'rb+')
+
+    def remote_get_written(self):
+        return [(start, length) for (start, length)
+                in self._written][:MAX_WRITTEN_SPANS]
+
     def remote_write(self, offset, data):
         start = time.time()
         precondition(not self.closed)
+        precondition(not self._closing)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
-        self.ss.add_latency("write", time.time() - start)
+        self._written.add(offset, len(data))
+        if self._f is None:
+            self._sharefile.write_share_data(offset, data)
+        else:
+            self._buffered_write(offset, data)
+        self.ss.add_latency("write", time.time() - start, size=len(data),
+                            client=self._client)
         self.ss.count("write")
 
+    def _buffered_write(self, offset, data):
+        self._sharefile.check_write(offset, len(data))
+        if self._buffer and offset != self._buffer_offset + self._buffer_size:
+            self._flush()
+        if not self._buffer:
+            self._buffer_offset = offset
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= WRITE_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        self._sharefile.write_share_data(self._buffer_offset,
+                                         "".join(self._buffer), f=self._f)
+        self._buffer = []
+        self._buffer_size = 0
+
     def remote_close(self):
         precondition(not self.closed)
+        precondition(not self._closing)
         start = time.time()
 
+        if self._f is not None:
+            self._flush()
+        f, self._f = self._f, None
+        if f is None and self._fsync != "none":
+            f = open(self.incominghome, 'rb+')
+        if self._fsync == "group":
+            self._closing = True
+            d = self.ss.group_syncer.sync(f)
+            def _synced(ign):
+                f.close()
+                filelen = self._move_into_place()
+                d2 = self.ss.group_syncer.sync_dirs(self._dirs_to_sync())
+                def _dirs_sync_failed(why):
+                    # the share is in place (and its data is on disk), so
+                    # it is not aborted, but the client must not be told
+                    # that it is safely stored
+                    log.msg("storage: unable to fsync directories for %s"
+                            % self.incominghome, failure=why,
+                            facility="tahoe.storage", level=log.WEIRD)
+                    self._finish_close(start, filelen)
+                    return why
+                def _dirs_synced(ign):
+                    self._finish_close(start, filelen)
+                d2.addCallbacks(_dirs_synced, _dirs_sync_failed)
+                return d2
+            def _sync_failed(why):
+                f.close()
+                log.msg("storage: unable to fsync sharefile %s"
+                        % self.incominghome, failure=why,
+                        facility="tahoe.storage", level=log.WEIRD)
+                self._closing = False
+                self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
+                self._abort()
+                return why
+            d.addCallbacks(_synced, _sync_failed)
+            return d
+        if self._fsync == "close":
+            fsync_file(f)
+        if f is not None:
+            f.close()
+        filelen = self._move_into_place()
+        if self._fsync == "close":
+            for dirname in self._dirs_to_sync():
+                fsync_dir(dirname)
+        self._finish_close(start, filelen)
+
+    def _finish_close(self, start, filelen):
+        self._remove_incoming_dirs()
+        self._sharefile = None
+        self.closed = True
+        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
+
+        self.ss.bucket_writer_closed(self, filelen)
+        self.ss.add_latency("close", time.time() - start, size=filelen,
+                            client=self._client)
+        self.ss.count("close")
+
+    def _move_into_place(self):
+        """Move the finished share from incoming/ to its final home, and
+        return the number of bytes it takes up there."""
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
+        return os.stat(self.finalhome)[stat.ST_SIZE]
+
+    def _dirs_to_sync(self):
+        """Return the directories that _move_into_place() changed, which
+        must be fsynced before the share can be considered stored."""
+        # self.finalhome is like storage/shares/ab/abcde/4 . The bucket
+        # directory (.../ab/abcde) was usually created for this upload, when
+        # the share was allocated, and so (more rarely) was the prefix
+        # directory, so their entries in shares/ must be durable too.
+        bucketdir = os.path.dirname(self.finalhome)
+        prefixdir = os.path.dirname(bucketdir)
+        return [bucketdir, prefixdir, os.path.dirname(prefixdir),
+                os.path.dirname(self.incominghome)]
+
+    def _remove_incoming_dirs(self):
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -253,31 +516,45 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
-        self._sharefile = None
-        self.closed = True
-        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
-        self.ss.bucket_writer_closed(self, filelen)
-        self.ss.add_latency("close", time.time() - start)
-        self.ss.count("close")
 
     def _disconnected(self):
-        if not self.closed:
+        if self.closed or self._closing:
+            return
+        if self.ss.incoming_grace_period:
+            self._park()
+        else:
             self._abort()
 
+    def _park(self):
+        # keep the partial share in incoming/, so that the client can pick
+        # up where it left off if it comes back (and asks to allocate the
+        # same share again) before the grace period is over
+        log.msg("storage: parking sharefile %s" % self.incominghome,
+                facility="tahoe.storage", level=log.UNUSUAL)
+        if self._f is not None:
+            self._flush()
+            self._f.close()
+            self._f = None
+        self.ss.park_bucket_writer(self)
+
     def remote_abort(self):
         log.msg("storage: aborting sharefile %s" % self.incominghome,
                 facility="tahoe.storage", level=log.UNUSUAL)
-        if not self.closed:
+        if not (self.closed or self._closing):
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
         self._abort()
         self.ss.count("abort")
 
     def _abort(self):
-        if self.closed:
+        if self.closed or self._closing:
+            # once remote_close() has been called, the client has sent us
+            # everything, so we let a group fsync finish the job
             return
 
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            self._buffer = []
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
@@ -296,9 +573,10 @@ class BucketWriter(Referenceable):
 @implementer(RIBucketReader)
 class BucketReader(Referenceable):
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 file_pool=None):
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        self._share_file = ShareFile(sharefname, pool=file_pool)
         self.storage_index = storage_index
         self.shnum = shnum
 
@@ -310,7 +588,7 @@ class BucketReader(Referenceable):
     def remote_read(self, offset, length):
         start = time.time()
         data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
+        self.ss.add_latency("read", time.time() - start, size=len(data))
         self.ss.count("read")
         return data
 
@@ -0,0 +1,222 @@
+import math, time
+
+# The StorageServer measures how long each remote operation takes. It used
+# to keep the last 1000 samples of each category in a list, and sort a copy
+# of every list whenever somebody asked for percentiles. Now each sample is
+# counted in a LatencyHistogram: a fixed set of logarithmic buckets, in the
+# style of HdrHistogram. Recording a sample is one dict update, memory does
+# not depend on the number of samples, and percentiles are read off the
+# bucket counts with a relative error of less than 1%.
+#
+# Every power of two is split into SUB_BUCKETS linear buckets, so a sample
+# of 'v' seconds lands in a bucket no wider than v/SUB_BUCKETS. Latencies
+# between a microsecond and a few hours cover about 34 powers of two, so a
+# histogram never holds more than a few thousand counters, and a typical one
+# far fewer.
+
+SUB_BUCKETS = 64
+
+# (fraction, name, minimum number of samples to report it)
+PERCENTILES = [(0.01, "01_0_percentile", 100),
+               (0.1, "10_0_percentile", 10),
+               (0.50, "50_0_percentile", 10),
+               (0.90, "90_0_percentile", 10),
+               (0.95, "95_0_percentile", 20),
+               (0.99, "99_0_percentile", 100),
+               (0.999, "99_9_percentile", 1000)]
+
+# the size classes used to break down the latencies of operations that
+# move share data: each one holds the sizes below its limit
+SIZE_CLASSES = [(4*1024, "4KiB"),
+                (64*1024, "64KiB"),
+                (1024*1024, "1MiB"),
+                (None, "large")]
+
+def get_size_class(size):
+    for (limit, name) in SIZE_CLASSES:
+        if limit is None or size < limit:
+            return name
+
+
+def get_client_id(rref):
+    """Return the tubid of the client at the other end of a
+    RemoteReference (such as the canary that comes with allocate_buckets),
+    or None if it is not a remote one."""
+    try:
+        return rref.getRemoteTubID()
+    except AttributeError:
+        return None
+
+
+class LatencyHistogram(object):
+    """I count latency samples in logarithmic buckets."""
+
+    def __init__(self):
+        self.buckets = {} # bucket number -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value <= 0:
+            return None
+        (mantissa, exponent) = math.frexp(value) # 0.5 <= mantissa < 1
+        sub = int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+        return exponent * SUB_BUCKETS + sub
+
+    def _bucket_value(self, bucket):
+        """Return the middle of a bucket's range."""
+        if bucket is None:
+            return 0.0
+        (exponent, sub) = divmod(bucket, SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 0.5) / (2.0 * SUB_BUCKETS), exponent)
+
+    def add(self, value):
+        value = max(value, 0.0) # the clock may have been stepped back
+        b = self._bucket(value)
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for (b, n) in other.buckets.items():
+            self.buckets[b] = self.buckets.get(b, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def get_percentiles(self, fractions):
+        """Return a list with the value at each of the given fractions
+        (sorted, between 0 and 1) of the samples. This is the sample with
+        rank int(fraction*count), to within the width of its bucket."""
+        results = []
+        if not self.count:
+            return [None] * len(fractions)
+        ranks = [int(f * self.count) for f in fractions]
+        seen = 0
+        i = 0
+        # the bucket for zero is None, which sorts before all numbers
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            while i < len(ranks) and ranks[i] < seen:
+                value = self._bucket_value(b)
+                results.append(min(max(value, self.min), self.max))
+                i += 1
+        while i < len(ranks):
+            results.append(self.max)
+            i += 1
+        return results
+
+    def get_stats(self):
+        """Return a dict in the format of StorageServer.get_latencies()."""
+        count = self.count
+        stats = {"samplesize": count}
+        if count > 1:
+            stats["mean"] = self.total / count
+        else:
+            stats["mean"] = None
+        values = self.get_percentiles([p for (p, name, minimum)
+                                       in PERCENTILES])
+        for ((p, name, minimum), value) in zip(PERCENTILES, values):
+            if count >= minimum:
+                stats[name] = value
+            else:
+                stats[name] = None
+        return stats
+
+
+class LatencyTracker(object):
+    """I keep a LatencyHistogram for each category of operation, for each
+    of the last 'windows' time windows of 'window_length' seconds. Windows
+    that are older than that are forgotten, so percentiles follow changes
+    in load.
+
+    Samples can also be broken down by the size class of the data that the
+    operation moved, and by the client that asked for it. To bound memory,
+    at most 'max_clients' clients are tracked in each window; the rest are
+    counted together as 'other'."""
+
+    window_length = 60
+    windows = 15
+    max_clients = 100
+
+    def __init__(self, categories):
+        self.categories = categories
+        # (start, {(category, breakdown, key): histogram}, set(clients)),
+        # oldest first. breakdown is None (all samples), "size" or "client".
+        self._windows = []
+
+    def _now(self):
+        return time.time()
+
+    def _current_window(self, now):
+        start = now - (now % self.window_length)
+        if not self._windows or self._windows[-1][0] < start:
+            self._windows.append((start, {}, set()))
+        self._expire(now)
+        return self._windows[-1]
+
+    def _expire(self, now):
+        oldest = now - self.window_length * self.windows
+        while self._windows and self._windows[0][0] <= oldest:
+            self._windows.pop(0)
+
+    def add(self, category, latency, size=None, client=None):
+        if category not in self.categories:
+            raise KeyError(category)
+        (start, histograms, clients) = self._current_window(self._now())
+        keys = [(category, None, None)]
+        if size is not None:
+            keys.append((category, "size", get_size_class(size)))
+        if client is not None:
+            if client not in clients:
+                if len(clients) < self.max_clients:
+                    clients.add(client)
+                else:
+                    client = "other"
+            keys.append((category, "client", client))
+        for key in keys:
+            if key not in histograms:
+                histograms[key] = LatencyHistogram()
+            histograms[key].add(latency)
+
+    def _merge(self, seconds):
+        now = self._now()
+        self._expire(now)
+        if seconds is None:
+            seconds = self.window_length * self.windows
+        merged = {}
+        for (start, histograms, clients) in self._windows:
+            if start + self.window_length <= now - seconds:
+                continue
+            for (key, h) in histograms.items():
+                if key not in merged:
+                    merged[key] = LatencyHistogram()
+                merged[key].merge(h)
+        return merged
+
+    def get_latencies(self, seconds=None):
+        """Return {category: stats} over the last 'seconds' (or all the
+        windows that I remember)."""
+        output = {}
+        for ((category, breakdown, key), h) in self._merge(seconds).items():
+            if breakdown is None:
+                output[category] = h.get_stats()
+        return output
+
+    def get_breakdown(self, breakdown, seconds=None):
+        """Return {category: {key: stats}}, where breakdown='size' keys
+        each category by size class and breakdown='client' by client."""
+        output = {}
+        for ((category, b, key), h) in self._merge(seconds).items():
+            if b == breakdown:
+                output.setdefault(category, {})[key] = h.get_stats()
+        return output
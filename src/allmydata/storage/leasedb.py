@@ -0,0 +1,290 @@
+import os, stat
+from contextlib import contextmanager
+
+from allmydata.util import idlib
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import timing_safe_compare
+from allmydata.storage.common import si_b2a
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.shares import get_share_file
+
+# The lease database replaces the lease records that are otherwise kept
+# inside each share file (see storage/immutable.py and storage/mutable.py).
+# Renewing a lease then costs one small sqlite transaction instead of an
+# open/seek/write/close on every share of the storage index, which matters
+# a great deal on servers with tens of millions of shares.
+#
+# Shares are migrated lazily: the first time the server (or the lease
+# checker) touches a share that is not yet listed in the 'shares' table, the
+# lease records are read out of the share file and copied into the
+# database. From then on the in-file lease slots are left alone, so a
+# server that has enabled the lease database should not go back to
+# in-file leases while expiration is enabled.
+
+LEASEDB_FILENAME = "leasedb.sqlite"
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL,   -- base32
+ shnum         INTEGER NOT NULL,
+ sharetype     VARCHAR(16) NOT NULL,   -- 'immutable' or 'mutable'
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE TABLE leases
+(
+ storage_index   VARCHAR(26) NOT NULL,
+ shnum           INTEGER NOT NULL,
+ owner_num       INTEGER NOT NULL,
+ renew_secret    BLOB NOT NULL,
+ cancel_secret   BLOB NOT NULL,
+ expiration_time INTEGER NOT NULL,
+ nodeid          BLOB,                 -- NULL for immutable shares
+ FOREIGN KEY (storage_index, shnum) REFERENCES shares (storage_index, shnum)
+  ON DELETE CASCADE
+);
+
+CREATE INDEX leases_by_share ON leases (storage_index, shnum);
+"""
+
+
+class LeaseDB(object):
+    """I hold the leases for every share in a StorageServer, in a single
+    sqlite database."""
+
+    def __init__(self, dbfile):
+        # WAL with synchronous=NORMAL turns each lease renewal into a
+        # sequential append, without an fsync per transaction. A crash can
+        # lose the most recent renewals, which clients repeat anyway.
+        (self.sqlite_module, self.connection) = get_db(
+            dbfile, create_version=(SCHEMA_v1, 1), dbname="leasedb",
+            journal_mode="WAL", synchronous="NORMAL")
+        self.cursor = self.connection.cursor()
+        self._transaction_depth = 0
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """Group every change made inside this context into a single
+        sqlite transaction, e.g. the renewal of all shares of one storage
+        index."""
+        self._transaction_depth += 1
+        try:
+            yield
+        finally:
+            self._transaction_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        if not self._transaction_depth:
+            self.connection.commit()
+
+    def get_sharetype(self, storage_index, shnum):
+        """Return 'immutable' or 'mutable' if this share has been recorded
+        in the database, or None if it has not (yet)."""
+        self.cursor.execute("SELECT sharetype FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_b2a(storage_index), shnum))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def get_share(self, storage_index, shnum, filename):
+        """Return a ShareLeases instance for the share that lives at
+        'filename', migrating its in-file leases into the database first if
+        necessary. If the file is not a share, this raises the same
+        exceptions as allmydata.storage.shares.get_share_file."""
+        sharetype = self.get_sharetype(storage_index, shnum)
+        if sharetype is None:
+            sharetype = self.migrate_share(storage_index, shnum, filename)
+        return ShareLeases(self, storage_index, shnum, filename, sharetype)
+
+    def migrate_share(self, storage_index, shnum, filename):
+        """Copy the lease records out of an existing share file into the
+        database, and return the share's type."""
+        sf = get_share_file(filename)
+        leases = list(sf.get_leases())
+        self._add_share(storage_index, shnum, sf.sharetype)
+        for lease_info in leases:
+            self._insert_lease(storage_index, shnum, lease_info)
+        self._commit()
+        return sf.sharetype
+
+    def add_new_share(self, storage_index, shnum, sharetype, lease_info):
+        """Record a freshly-created share and its first lease."""
+        self._add_share(storage_index, shnum, sharetype)
+        self._insert_lease(storage_index, shnum, lease_info)
+        self._commit()
+
+    def remove_share(self, storage_index, shnum):
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_b2a(storage_index), shnum))
+        self._commit()
+
+    def _add_share(self, storage_index, shnum, sharetype):
+        si_s = si_b2a(storage_index)
+        # a share that was deleted and later re-uploaded may have left stale
+        # leases behind, if its file was removed by something other than us
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        self.cursor.execute("INSERT INTO shares VALUES (?,?,?)",
+                            (si_s, shnum, sharetype))
+
+    def _insert_lease(self, storage_index, shnum, lease_info):
+        nodeid = lease_info.nodeid
+        if nodeid is not None:
+            nodeid = buffer(nodeid)
+        self.cursor.execute("INSERT INTO leases VALUES (?,?,?,?,?,?,?)",
+                            (si_b2a(storage_index), shnum,
+                             lease_info.owner_num,
+                             buffer(lease_info.renew_secret),
+                             buffer(lease_info.cancel_secret),
+                             int(lease_info.expiration_time),
+                             nodeid))
+
+    def _get_lease_rows(self, storage_index, shnum):
+        self.cursor.execute("SELECT rowid, owner_num, renew_secret,"
+                            "       cancel_secret, expiration_time, nodeid"
+                            " FROM leases"
+                            " WHERE storage_index=? AND shnum=?"
+                            " ORDER BY rowid",
+                            (si_b2a(storage_index), shnum))
+        rows = []
+        for (rowid, owner_num, renew_secret, cancel_secret,
+             expiration_time, nodeid) in self.cursor.fetchall():
+            if nodeid is not None:
+                nodeid = str(nodeid)
+            lease_info = LeaseInfo(owner_num,
+                                   str(renew_secret), str(cancel_secret),
+                                   expiration_time, nodeid)
+            rows.append((rowid, lease_info))
+        return rows
+
+    def get_leases(self, storage_index, shnum):
+        return [lease_info for (rowid, lease_info)
+                in self._get_lease_rows(storage_index, shnum)]
+
+    def add_lease(self, storage_index, shnum, lease_info):
+        self._insert_lease(storage_index, shnum, lease_info)
+        self._commit()
+
+    def renew_lease(self, storage_index, shnum, renew_secret, new_expire_time):
+        """Return True if a lease with this renew_secret was found (and
+        extended, if new_expire_time is later than its current expiration
+        time), else False."""
+        # compare the secrets in python rather than in a WHERE clause, to
+        # avoid a timing attack
+        for rowid, lease_info in self._get_lease_rows(storage_index, shnum):
+            if timing_safe_compare(lease_info.renew_secret, renew_secret):
+                if new_expire_time > lease_info.expiration_time:
+                    self.cursor.execute("UPDATE leases SET expiration_time=?"
+                                        " WHERE rowid=?",
+                                        (int(new_expire_time), rowid))
+                    self._commit()
+                return True
+        return False
+
+    def cancel_lease(self, storage_index, shnum, cancel_secret):
+        """Remove any leases with the given cancel_secret. Return a tuple of
+        (number of leases removed, number of leases remaining)."""
+        removed = 0
+        remaining = 0
+        for rowid, lease_info in self._get_lease_rows(storage_index, shnum):
+            if timing_safe_compare(lease_info.cancel_secret, cancel_secret):
+                self.cursor.execute("DELETE FROM leases WHERE rowid=?",
+                                    (rowid,))
+                removed += 1
+            else:
+                remaining += 1
+        if removed:
+            self._commit()
+        return (removed, remaining)
+
+    def get_lease_counts(self):
+        """Return a tuple of (number of shares, number of leases)."""
+        self.cursor.execute("SELECT COUNT(*) FROM shares")
+        (num_shares,) = self.cursor.fetchone()
+        self.cursor.execute("SELECT COUNT(*) FROM leases")
+        (num_leases,) = self.cursor.fetchone()
+        return (num_shares, num_leases)
+
+
+class ShareLeases(object):
+    """I offer the lease-related half of the ShareFile/MutableShareFile
+    interface (get_leases, add_lease, renew_lease, add_or_renew_lease,
+    cancel_lease), for a single share, backed by a LeaseDB instead of the
+    lease slots inside the share file."""
+
+    def __init__(self, leasedb, storage_index, shnum, filename, sharetype):
+        self._leasedb = leasedb
+        self.storage_index = storage_index
+        self.shnum = shnum
+        self.home = filename
+        self.sharetype = sharetype
+
+    def get_leases(self):
+        """Yields a LeaseInfo instance for all leases."""
+        for lease_info in self._leasedb.get_leases(self.storage_index,
+                                                   self.shnum):
+            yield lease_info
+
+    def add_lease(self, lease_info):
+        self._leasedb.add_lease(self.storage_index, self.shnum, lease_info)
+
+    def renew_lease(self, renew_secret, new_expire_time):
+        if self._leasedb.renew_lease(self.storage_index, self.shnum,
+                                     renew_secret, new_expire_time):
+            return
+        if self.sharetype == "mutable":
+            # like MutableShareFile.renew_lease, tell the client which
+            # servers accepted the leases we do have, in case the share was
+            # migrated here from somewhere else
+            accepting_nodeids = set([l.nodeid for l in self.get_leases()])
+            msg = ("Unable to renew non-existent lease. I have leases"
+                   " accepted by nodeids: ")
+            msg += ",".join([("'%s'" % idlib.nodeid_b2a(anid))
+                             for anid in accepting_nodeids])
+            msg += " ."
+            raise IndexError(msg)
+        raise IndexError("unable to renew non-existent lease")
+
+    def add_or_renew_lease(self, lease_info):
+        try:
+            self.renew_lease(lease_info.renew_secret,
+                             lease_info.expiration_time)
+        except IndexError:
+            self.add_lease(lease_info)
+
+    def cancel_lease(self, cancel_secret):
+        """Remove any leases with the given cancel_secret. If the last lease
+        is cancelled, the share will be removed. Return the number of
+        bytes that were freed. Raise IndexError if there was no lease with
+        the given cancel_secret."""
+        (removed, remaining) = self._leasedb.cancel_lease(self.storage_index,
+                                                          self.shnum,
+                                                          cancel_secret)
+        if not removed:
+            raise IndexError("unable to find matching lease to cancel")
+        space_freed = 0
+        if not remaining:
+            space_freed += self.remove_share_data()
+            self._leasedb.remove_share(self.storage_index, self.shnum)
+        return space_freed
+
+    def remove_share_data(self):
+        """Delete the share itself, after its last lease has been
+        cancelled. Return the number of bytes that were freed."""
+        space_freed = os.stat(self.home)[stat.ST_SIZE]
+        os.unlink(self.home)
+        return space_freed
@@ -52,9 +52,14 @@ class MutableShareFile(object):
     assert len(MAGIC) == 32
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
+    # When a write does not fit in the container, make it this much larger
+    # than it was, so that a share which keeps growing a little at a time
+    # does not have to move its extra leases on every write.
+    CONTAINER_GROWTH = 1.5
 
     def __init__(self, filename, parent=None):
         self.home = filename
+        self._f = None # set between open() and close()
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
             f = open(self.home, 'rb')
@@ -72,6 +77,45 @@ class MutableShareFile(object):
     def log(self, *args, **kwargs):
         return self.parent.log(*args, **kwargs)
 
+    def open(self):
+        """Keep the share file open until close() is called. In between,
+        all my methods use the same file object instead of opening the file
+        again, and the header fields are read only once. This is used to
+        apply all of the test, read and write vectors of a single
+        slot_testv_and_readv_and_writev call with a single open()."""
+        assert self._f is None
+        f = open(self.home, 'rb+')
+        (magic,
+         write_enabler_nodeid, write_enabler,
+         data_length, extra_lease_offset) = \
+         struct.unpack(">32s20s32sQQ", f.read(self.HEADER_SIZE))
+        self._f = f
+        self._write_enabler = (write_enabler, write_enabler_nodeid)
+        self._data_length = data_length
+        self._extra_lease_offset = extra_lease_offset
+        self._num_extra_leases = None
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def _open(self, mode):
+        if self._f is not None:
+            return self._f
+        return open(self.home, mode)
+
+    def _close(self, f):
+        if f is not self._f:
+            f.close()
+
+    def get_size(self):
+        """Return the size of the share file."""
+        if self._f is not None:
+            self._f.flush()
+            return os.fstat(self._f.fileno()).st_size
+        return os.stat(self.home).st_size
+
     def create(self, my_nodeid, write_enabler):
         assert not os.path.exists(self.home)
         data_length = 0
@@ -96,6 +140,8 @@ class MutableShareFile(object):
         os.unlink(self.home)
 
     def _read_data_length(self, f):
+        if f is self._f:
+            return self._data_length
         f.seek(self.DATA_LENGTH_OFFSET)
         (data_length,) = struct.unpack(">Q", f.read(8))
         return data_length
@@ -103,6 +149,8 @@ class MutableShareFile(object):
     def _write_data_length(self, f, data_length):
         f.seek(self.DATA_LENGTH_OFFSET)
         f.write(struct.pack(">Q", data_length))
+        if f is self._f:
+            self._data_length = data_length
 
     def _read_share_data(self, f, offset, length):
         precondition(offset >= 0)
@@ -119,6 +167,8 @@ class MutableShareFile(object):
         return data
 
     def _read_extra_lease_offset(self, f):
+        if f is self._f:
+            return self._extra_lease_offset
         f.seek(self.EXTRA_LEASE_OFFSET)
         (extra_lease_offset,) = struct.unpack(">Q", f.read(8))
         return extra_lease_offset
@@ -126,17 +176,34 @@ class MutableShareFile(object):
     def _write_extra_lease_offset(self, f, offset):
         f.seek(self.EXTRA_LEASE_OFFSET)
         f.write(struct.pack(">Q", offset))
+        if f is self._f:
+            self._extra_lease_offset = offset
 
     def _read_num_extra_leases(self, f):
+        if f is self._f and self._num_extra_leases is not None:
+            return self._num_extra_leases
         offset = self._read_extra_lease_offset(f)
         f.seek(offset)
         (num_extra_leases,) = struct.unpack(">L", f.read(4))
+        if f is self._f:
+            self._num_extra_leases = num_extra_leases
         return num_extra_leases
 
     def _write_num_extra_leases(self, f, num_leases):
         extra_lease_offset = self._read_extra_lease_offset(f)
         f.seek(extra_lease_offset)
         f.write(struct.pack(">L", num_leases))
+        if f is self._f:
+            self._num_extra_leases = num_leases
+
+    def _grow_container(self, f, needed_size):
+        """Make room for at least 'needed_size' bytes of share data, and
+        preferably CONTAINER_GROWTH times as much as there is now."""
+        if needed_size > self.MAX_SIZE:
+            raise DataTooLargeError()
+        old_size = self._read_extra_lease_offset(f) - self.DATA_OFFSET
+        new_size = max(needed_size, int(old_size * self.CONTAINER_GROWTH))
+        self._change_container_size(f, min(new_size, self.MAX_SIZE))
 
     def _change_container_size(self, f, new_container_size):
         if new_container_size > self.MAX_SIZE:
@@ -163,48 +230,6 @@ class MutableShareFile(object):
         f.write(extra_lease_data)
         self._write_extra_lease_offset(f, new_extra_lease_offset)
 
-    def _write_share_data(self, f, offset, data):
-        length = len(data)
-        precondition(offset >= 0)
-        data_length = self._read_data_length(f)
-        extra_lease_offset = self._read_extra_lease_offset(f)
-
-        if offset+length >= data_length:
-            # They are expanding their data size.
-
-            if self.DATA_OFFSET+offset+length > extra_lease_offset:
-                # TODO: allow containers to shrink. For now, they remain
-                # large.
-
-                # Their new data won't fit in the current container, so we
-                # have to move the leases. With luck, they're expanding it
-                # more than the size of the extra lease block, which will
-                # minimize the corrupt-the-share window
-                self._change_container_size(f, offset+length)
-                extra_lease_offset = self._read_extra_lease_offset(f)
-
-                # an interrupt here is ok.. the container has been enlarged
-                # but the data remains untouched
-
-            assert self.DATA_OFFSET+offset+length <= extra_lease_offset
-            # Their data now fits in the current container. We must write
-            # their new data and modify the recorded data size.
-
-            # Fill any newly exposed empty space with 0's.
-            if offset > data_length:
-                f.seek(self.DATA_OFFSET+data_length)
-                f.write('\x00'*(offset - data_length))
-                f.flush()
-
-            new_data_length = offset+length
-            self._write_data_length(f, new_data_length)
-            # an interrupt here will result in a corrupted share
-
-        # now all that's left to do is write out their data
-        f.seek(self.DATA_OFFSET+offset)
-        f.write(data)
-        return
-
     def _write_lease_record(self, f, lease_number, lease_info):
         extra_lease_offset = self._read_extra_lease_offset(f)
         num_extra_leases = self._read_num_extra_leases(f)
@@ -261,10 +286,10 @@ class MutableShareFile(object):
 
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
-        f = open(self.home, 'rb')
+        f = self._open('rb')
         for i, lease in self._enumerate_leases(f):
             yield lease
-        f.close()
+        self._close(f)
 
     def _enumerate_leases(self, f):
         for i in range(self._get_num_lease_slots(f)):
@@ -277,18 +302,18 @@ class MutableShareFile(object):
 
     def add_lease(self, lease_info):
         precondition(lease_info.owner_num != 0) # 0 means "no lease here"
-        f = open(self.home, 'rb+')
+        f = self._open('rb+')
         num_lease_slots = self._get_num_lease_slots(f)
         empty_slot = self._get_first_empty_lease_slot(f)
         if empty_slot is not None:
             self._write_lease_record(f, empty_slot, lease_info)
         else:
             self._write_lease_record(f, num_lease_slots, lease_info)
-        f.close()
+        self._close(f)
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
-        f = open(self.home, 'rb+')
+        f = self._open('rb+')
         for (leasenum,lease) in self._enumerate_leases(f):
             if timing_safe_compare(lease.renew_secret, renew_secret):
                 # yup. See if we need to update the owner time.
@@ -296,10 +321,10 @@ class MutableShareFile(object):
                     # yes
                     lease.expiration_time = new_expire_time
                     self._write_lease_record(f, leasenum, lease)
-                f.close()
+                self._close(f)
                 return
             accepting_nodeids.add(lease.nodeid)
-        f.close()
+        self._close(f)
         # Return the accepting_nodeids set, to give the client a chance to
         # update the leases on a share which has been migrated from its
         # original server to a new one.
@@ -361,6 +386,8 @@ class MutableShareFile(object):
         return 0
 
     def _read_write_enabler_and_nodeid(self, f):
+        if f is self._f:
+            return self._write_enabler
         f.seek(0)
         data = f.read(self.HEADER_SIZE)
         (magic,
@@ -371,11 +398,26 @@ class MutableShareFile(object):
         return (write_enabler, write_enabler_nodeid)
 
     def readv(self, readv):
-        datav = []
-        f = open(self.home, 'rb')
+        # Clients often ask for several adjacent fields at once (e.g. the
+        # header, the offset table and the signature), so read each run of
+        # adjacent vectors with a single seek+read and slice it up.
+        runs = [] # (run_offset, run_length, [(offset, length), ...])
         for (offset, length) in readv:
-            datav.append(self._read_share_data(f, offset, length))
-        f.close()
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                (run_offset, run_length, vectors) = runs[-1]
+                runs[-1] = (run_offset, run_length+length, vectors)
+            else:
+                vectors = []
+                runs.append((offset, length, vectors))
+            vectors.append((offset, length))
+        datav = []
+        f = self._open('rb')
+        for (run_offset, run_length, vectors) in runs:
+            data = self._read_share_data(f, run_offset, run_length)
+            for (offset, length) in vectors:
+                start = offset - run_offset
+                datav.append(data[start:start+length])
+        self._close(f)
         return datav
 
 #    def remote_get_length(self):
@@ -385,10 +427,10 @@ class MutableShareFile(object):
 #        return data_length
 
     def check_write_enabler(self, write_enabler, si_s):
-        f = open(self.home, 'rb+')
+        f = self._open('rb+')
         (real_write_enabler, write_enabler_nodeid) = \
                              self._read_write_enabler_and_nodeid(f)
-        f.close()
+        self._close(f)
         # avoid a timing attack
         #if write_enabler != real_write_enabler:
         if not timing_safe_compare(write_enabler, real_write_enabler):
@@ -405,27 +447,55 @@ class MutableShareFile(object):
 
     def check_testv(self, testv):
         test_good = True
-        f = open(self.home, 'rb+')
+        f = self._open('rb+')
         for (offset, length, operator, specimen) in testv:
             data = self._read_share_data(f, offset, length)
             if not testv_compare(data, operator, specimen):
                 test_good = False
                 break
-        f.close()
+        self._close(f)
         return test_good
 
     def writev(self, datav, new_length):
-        f = open(self.home, 'rb+')
         for (offset, data) in datav:
-            self._write_share_data(f, offset, data)
-        if new_length is not None:
-            cur_length = self._read_data_length(f)
-            if new_length < cur_length:
-                self._write_data_length(f, new_length)
-                # TODO: if we're going to shrink the share file when the
-                # share data has shrunk, then call
-                # self._change_container_size() here.
-        f.close()
+            precondition(offset >= 0)
+        # like readv(), write each run of adjacent vectors at once
+        runs = [] # (offset, [data, ...])
+        for (offset, data) in datav:
+            if runs and runs[-1][0] + sum(map(len, runs[-1][1])) == offset:
+                runs[-1][1].append(data)
+            else:
+                runs.append((offset, [data]))
+        end = max([offset+len(data) for (offset, data) in datav] or [0])
+
+        f = self._open('rb+')
+        if self.DATA_OFFSET + end > self._read_extra_lease_offset(f):
+            # Their new data won't fit in the current container, so we have
+            # to move the leases, once for all of their vectors. An
+            # interrupt while they are being moved will corrupt them.
+            self._grow_container(f, end)
+            # an interrupt here is ok.. the container has been enlarged but
+            # the data remains untouched
+        assert self.DATA_OFFSET + end <= self._read_extra_lease_offset(f)
+
+        old_data_length = data_length = self._read_data_length(f)
+        for (offset, pieces) in runs:
+            if offset > data_length:
+                # Fill any newly exposed empty space with 0's.
+                f.seek(self.DATA_OFFSET+data_length)
+                f.write('\x00'*(offset - data_length))
+            f.seek(self.DATA_OFFSET+offset)
+            data = "".join(pieces)
+            f.write(data)
+            data_length = max(data_length, offset+len(data))
+        if new_length is not None and new_length < data_length:
+            data_length = new_length
+            # TODO: if we're going to shrink the share file when the share
+            # data has shrunk, then call self._change_container_size() here.
+        if data_length != old_data_length:
+            # an interrupt before this will result in a corrupted share
+            self._write_data_length(f, data_length)
+        self._close(f)
 
 def testv_compare(a, op, b):
     assert op in ("lt", "le", "eq", "ne", "ge", "gt")
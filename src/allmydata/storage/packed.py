@@ -0,0 +1,399 @@
+import os, re, struct, time
+import cPickle as pickle
+
+from allmydata.util import fileutil, log
+from allmydata.util.assertutil import precondition
+from allmydata.storage.common import si_b2a
+from allmydata.storage.backend import DiskBackend
+from allmydata.storage.immutable import BucketWriter, BucketReader, \
+     WRITE_BUFFER_SIZE, fsync_file
+from allmydata.storage.leasedb import ShareLeases
+from allmydata.storage.lease import LeaseInfo
+
+# The packed backend keeps immutable shares inside a few large, append-only
+# container files, instead of one file (and, usually, one directory) per
+# share. A server with millions of small shares then has millions fewer
+# inodes for the kernel to cache and for backup tools to walk.
+#
+# storage/packed/$NUMBER.pack : containers, numbered from 0. New shares are
+#                               appended to the newest one, until it grows
+#                               past CONTAINER_SIZE.
+# storage/packed/index.pickle : the in-memory index, written at a clean
+#                               shutdown. If it is missing, the index is
+#                               rebuilt by reading every record header.
+#
+# Each container is a sequence of records:
+#  0x00: magic, four bytes, "TPK1"
+#  0x04: state, one byte: "S" for a live share, "D" once it has been deleted
+#  0x05: length of the storage index, one byte (always 16, except in tests)
+#  0x06: storage index, 16 bytes
+#  0x16: share number, four bytes big-endian
+#  0x1a: share data length, eight bytes big-endian = A
+#  0x22: share data (the same bytes as in a ShareFile, without its header)
+#  A+0x22: next record
+#
+# Share data is never modified once it has been appended. Deleting a share
+# only flips its state byte, and a container is removed once none of its
+# shares are live (unless it is still the one being appended to). Leases
+# are kept in the LeaseDB, so the packed backend requires one. A share is
+# appended before its lease is recorded, so after a crash, any share that
+# has no lease is given one (see _add_missing_leases).
+#
+# Mutable slots are still kept in the shares/ directory, and so are
+# immutable shares larger than MAX_PACKED_SHARE_SIZE (which are few, and
+# would cost a copy of the whole share to pack) and any immutable shares
+# that were uploaded before the backend was switched to "packed". Those can
+# still be read, and will expire normally.
+
+CONTAINER_SIZE = 256*1024*1024
+MAX_PACKED_SHARE_SIZE = 1024*1024
+
+RECORD_HEADER = ">4sc17pLQ"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+assert RECORD_HEADER_SIZE == 0x22, RECORD_HEADER_SIZE
+MAGIC = "TPK1"
+LIVE = "S"
+DELETED = "D"
+
+CONTAINER_RE=re.compile("^([0-9]+)\.pack$")
+
+
+class PackedShare(object):
+    """I read the data of one share from its container."""
+    sharetype = "immutable"
+
+    def __init__(self, filename, data_offset, data_length, pool):
+        self.home = filename
+        self._data_offset = data_offset
+        self._data_length = data_length
+        self._pool = pool
+
+    def read_share_data(self, offset, length):
+        precondition(offset >= 0)
+        # reads beyond the end of the data are truncated. Reads that start
+        # beyond the end of the data return an empty string.
+        actuallength = max(0, min(length, self._data_length-offset))
+        if actuallength == 0:
+            return ""
+        return self._pool.read(self.home, self._data_offset+offset,
+                               actuallength)
+
+
+class PackedShareLeases(ShareLeases):
+    """I am the LeaseDB half of a packed share. When my last lease is
+    cancelled, I delete the share from its container."""
+
+    def __init__(self, leasedb, storage_index, shnum, backend):
+        ShareLeases.__init__(self, leasedb, storage_index, shnum, None,
+                             "immutable")
+        self._backend = backend
+
+    def remove_share_data(self):
+        return self._backend.remove_share(self.storage_index, self.shnum)
+
+
+class PackedBucketWriter(BucketWriter):
+    """I receive a share in incoming/ like any BucketWriter, but when it is
+    complete I append it to a container instead of moving the file."""
+
+    def __init__(self, ss, backend, storage_index, shnum, incominghome,
+                 max_size, lease_info, canary, buffered=False, fsync="none"):
+        BucketWriter.__init__(self, ss, incominghome, None, max_size,
+                              lease_info, canary, buffered, fsync)
+        self._backend = backend
+        self._storage_index = storage_index
+        self._shnum = shnum
+
+    def _move_into_place(self):
+        f = open(self.incominghome, "rb")
+        f.seek(0x0c) # skip the ShareFile header
+        try:
+            size = self._backend.add_share(self._storage_index, self._shnum,
+                                           f, self._max_size,
+                                           sync=(self._fsync != "none"))
+        finally:
+            f.close()
+        os.remove(self.incominghome)
+        return size
+
+    def _dirs_to_sync(self):
+        # the container may have just been created
+        return [self._backend.packdir, os.path.dirname(self.incominghome)]
+
+
+class PackedBucketReader(BucketReader):
+    def __init__(self, ss, share, storage_index, shnum):
+        self.ss = ss
+        self._share_file = share
+        self.storage_index = storage_index
+        self.shnum = shnum
+
+
+class PackedBackend(DiskBackend):
+    """I append new immutable shares to container files, and find them
+    again through an in-memory index. Everything else is left to the
+    DiskBackend that I extend."""
+
+    name = "packed"
+
+    def __init__(self, server, packdir, container_size=CONTAINER_SIZE,
+                 max_packed_share_size=MAX_PACKED_SHARE_SIZE):
+        DiskBackend.__init__(self, server)
+        precondition(server.leasedb is not None)
+        self.packdir = packdir
+        self.container_size = container_size
+        self.max_packed_share_size = max_packed_share_size
+        self._picklefile = os.path.join(packdir, "index.pickle")
+        fileutil.make_dirs(packdir)
+        # storage index prefix -> {storage_index: {shnum: (container,
+        # record offset, data length)}}
+        self._prefixes = {}
+        # container -> [size in bytes, number of live shares]
+        self._containers = {}
+        if not self._load():
+            self._scan()
+
+    def _get_container_path(self, container):
+        return os.path.join(self.packdir, "%08d.pack" % container)
+
+    def _load(self):
+        try:
+            f = open(self._picklefile, "rb")
+            (prefixes, containers) = pickle.load(f)
+            f.close()
+        except Exception:
+            return False
+        # like the ShareIndex, the pickle is only written at a clean
+        # shutdown, and is removed as soon as it has been read
+        fileutil.remove_if_possible(self._picklefile)
+        self._prefixes = prefixes
+        self._containers = containers
+        return True
+
+    def _scan(self):
+        containers = []
+        for fn in os.listdir(self.packdir):
+            mo = CONTAINER_RE.match(fn)
+            if mo:
+                containers.append(int(mo.group(1)))
+        containers.sort()
+        for container in containers:
+            self._scan_container(container,
+                                 last=(container == containers[-1]))
+        log.msg(format="scanned %(containers)d share containers",
+                containers=len(containers), facility="tahoe.storage")
+        self._add_missing_leases()
+
+    def _add_missing_leases(self):
+        # a crash between add_share() and the StorageServer recording the
+        # share's first lease leaves a share that the lease checker would
+        # take for garbage. Like shares whose leases are migrated from their
+        # files, it gets a lease here. The uploader's secrets are lost, so
+        # this one has no owner and random secrets: the share lives for one
+        # lease period, during which its owner can add a lease of their own.
+        leasedb = self.server.leasedb
+        expire_time = time.time() + 31*24*60*60
+        added = 0
+        with leasedb.transaction():
+            for buckets in self._prefixes.values():
+                for (storage_index, shares) in buckets.items():
+                    for shnum in shares:
+                        if leasedb.get_sharetype(storage_index,
+                                                 shnum) is not None:
+                            continue
+                        lease_info = LeaseInfo(0, os.urandom(32),
+                                               os.urandom(32), expire_time,
+                                               self.server.my_nodeid)
+                        leasedb.add_new_share(storage_index, shnum,
+                                              "immutable", lease_info)
+                        added += 1
+        if added:
+            log.msg(format="added leases to %(shares)d packed shares that "
+                    "had none", shares=added,
+                    facility="tahoe.storage", level=log.UNUSUAL)
+
+    def _scan_container(self, container, last):
+        filename = self._get_container_path(container)
+        filesize = os.path.getsize(filename)
+        live = 0
+        pos = 0
+        f = open(filename, "rb")
+        try:
+            while pos < filesize:
+                header = f.read(RECORD_HEADER_SIZE)
+                if len(header) < RECORD_HEADER_SIZE:
+                    break
+                (magic, state, storage_index, shnum,
+                 length) = struct.unpack(RECORD_HEADER, header)
+                if (magic != MAGIC or
+                    pos + RECORD_HEADER_SIZE + length > filesize):
+                    break
+                if state == LIVE:
+                    self._add_to_index(storage_index, shnum,
+                                       (container, pos, length))
+                    live += 1
+                pos += RECORD_HEADER_SIZE + length
+                f.seek(pos)
+        finally:
+            f.close()
+        if pos < filesize:
+            # an append was interrupted by a crash, or the file is damaged.
+            # Nothing after this point can be trusted.
+            log.msg(format="share container %(fn)s is damaged after "
+                    "offset %(pos)d",
+                    fn=filename, pos=pos,
+                    facility="tahoe.storage", level=log.WEIRD)
+            if last:
+                f = open(filename, "rb+")
+                f.truncate(pos)
+                f.close()
+        if not live and not last:
+            os.unlink(filename)
+            return
+        self._containers[container] = [pos, live]
+
+    def close(self):
+        tmpfile = self._picklefile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump((self._prefixes, self._containers), f,
+                    pickle.HIGHEST_PROTOCOL)
+        f.close()
+        fileutil.move_into_place(tmpfile, self._picklefile)
+
+    def _add_to_index(self, storage_index, shnum, location):
+        buckets = self._prefixes.setdefault(si_b2a(storage_index)[:2], {})
+        buckets.setdefault(storage_index, {})[shnum] = location
+
+    def _get_packed(self, storage_index):
+        buckets = self._prefixes.get(si_b2a(storage_index)[:2], {})
+        return buckets.get(storage_index, {})
+
+    def _get_active_container(self):
+        if not self._containers:
+            container = 0
+        else:
+            container = max(self._containers)
+            if self._containers[container][0] < self.container_size:
+                return container
+            container += 1
+        self._containers[container] = [0, 0]
+        return container
+
+    def add_share(self, storage_index, shnum, f, length, sync=False):
+        """Append 'length' bytes of share data, read from the file 'f', to
+        the active container. Return the number of bytes appended."""
+        container = self._get_active_container()
+        filename = self._get_container_path(container)
+        pos = self._containers[container][0]
+        out = open(filename, "ab")
+        try:
+            out.write(struct.pack(RECORD_HEADER, MAGIC, LIVE, storage_index,
+                                  shnum, length))
+            remaining = length
+            while remaining:
+                data = f.read(min(remaining, WRITE_BUFFER_SIZE))
+                if not data:
+                    # the writer never filled the end of the share: pad it
+                    # with zeros, as a ShareFile would read back
+                    data = "\x00" * min(remaining, WRITE_BUFFER_SIZE)
+                out.write(data)
+                remaining -= len(data)
+            if sync:
+                fsync_file(out)
+        finally:
+            out.close()
+        self._add_to_index(storage_index, shnum, (container, pos, length))
+        size = RECORD_HEADER_SIZE + length
+        self._containers[container][0] += size
+        self._containers[container][1] += 1
+        return size
+
+    def remove_share(self, storage_index, shnum):
+        """Mark a share as deleted, and return the number of bytes that will
+        be recovered once its container is removed."""
+        shares = self._get_packed(storage_index)
+        (container, pos, length) = shares.pop(shnum)
+        if not shares:
+            self._prefixes[si_b2a(storage_index)[:2]].pop(storage_index)
+        filename = self._get_container_path(container)
+        f = open(filename, "rb+")
+        f.seek(pos + 4)
+        f.write(DELETED)
+        f.close()
+        self._containers[container][1] -= 1
+        if (self._containers[container][1] == 0 and
+            container != max(self._containers)):
+            self.server.discard_share_file(filename)
+            os.unlink(filename)
+            del self._containers[container]
+        return RECORD_HEADER_SIZE + length
+
+    def get_stats(self):
+        live_shares = 0
+        for buckets in self._prefixes.values():
+            for shares in buckets.values():
+                live_shares += len(shares)
+        return {"containers": len(self._containers),
+                "container-bytes": sum([size for (size, live)
+                                        in self._containers.values()]),
+                "shares": live_shares,
+                }
+
+    def list_buckets(self, prefix):
+        buckets = set(DiskBackend.list_buckets(self, prefix))
+        for storage_index in self._prefixes.get(prefix, {}):
+            buckets.add(si_b2a(storage_index))
+        return sorted(buckets)
+
+    def have_shares(self):
+        return (DiskBackend.have_shares(self) or
+                bool(self.get_stats()["shares"]))
+
+    def get_shnums(self, storage_index):
+        shnums = set(DiskBackend.get_shnums(self, storage_index))
+        shnums.update(self._get_packed(storage_index))
+        return sorted(shnums)
+
+    def get_container_shares(self, storage_index):
+        shares = self._get_packed(storage_index)
+        return [(shnum, RECORD_HEADER_SIZE + shares[shnum][2])
+                for shnum in sorted(shares)]
+
+    def has_share(self, storage_index, shnum):
+        return (shnum in self._get_packed(storage_index) or
+                DiskBackend.has_share(self, storage_index, shnum))
+
+    def get_share_leases(self, storage_index, shnum):
+        if shnum in self._get_packed(storage_index):
+            return PackedShareLeases(self.server.leasedb, storage_index,
+                                     shnum, self)
+        return DiskBackend.get_share_leases(self, storage_index, shnum)
+
+    def make_bucket_writer(self, storage_index, shnum, max_size, lease_info,
+                           canary):
+        if max_size > self.max_packed_share_size:
+            return DiskBackend.make_bucket_writer(self, storage_index, shnum,
+                                                  max_size, lease_info,
+                                                  canary)
+        return PackedBucketWriter(self.server, self, storage_index, shnum,
+                                  self._get_incoming_path(storage_index,
+                                                          shnum),
+                                  max_size, lease_info, canary,
+                                  buffered=self.server.buffered_writes,
+                                  fsync=self.server.fsync)
+
+    def make_bucket_reader(self, storage_index, shnum):
+        location = self._get_packed(storage_index).get(shnum)
+        if location is None:
+            return DiskBackend.make_bucket_reader(self, storage_index, shnum)
+        (container, pos, length) = location
+        share = PackedShare(self._get_container_path(container),
+                            pos + RECORD_HEADER_SIZE, length,
+                            self.server.share_file_pool)
+        return PackedBucketReader(self.server, share, storage_index, shnum)
+
+    def share_closed(self, storage_index, shnum, size):
+        if shnum not in self._get_packed(storage_index):
+            # a large share, in the shares/ directory
+            DiskBackend.share_closed(self, storage_index, shnum, size)
+        # otherwise add_share() has already put it in my index
@@ -1,21 +1,33 @@
-import os, re, weakref, struct, time
+import os, weakref, struct, time
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.internet import reactor
 
 from zope.interface import implementer
 from allmydata.interfaces import RIStorageServer, IStatsProducer
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.hashutil import timing_safe_compare
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
 _pyflakes_hush = [si_b2a, si_a2b, storage_index_to_dir] # re-exported
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.leasedb import LeaseDB, LEASEDB_FILENAME
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
-from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
+from allmydata.storage.immutable import ShareFile, GroupSyncer, \
+     FSYNC_POLICIES
+from allmydata.storage.backend import DiskBackend, BACKENDS
+from allmydata.storage.packed import PackedBackend
+from allmydata.storage.filepool import FilePool
+from allmydata.storage.space import SpaceAccountant
+from allmydata.storage.latency import LatencyTracker, get_client_id
+from allmydata.storage.common import UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError
 from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.shareindex import ShareIndex, ShareIndexingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
 
 # storage/
@@ -28,9 +40,8 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
-# $SHARENUM matches this regex:
-NUM_RE=re.compile("^[0-9]+$")
-
+# This is the layout of the "disk" backend (see storage/backend.py). The
+# "packed" backend keeps new immutable shares in storage/packed/ instead.
 
 
 @implementer(RIStorageServer, IStatsProducer)
@@ -45,7 +56,15 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 expiration_threads=0,
+                 expiration_io_rate=None,
+                 use_leasedb=False,
+                 share_index=None,
+                 buffered_writes=False,
+                 fsync="none",
+                 backend="disk",
+                 incoming_grace_period=0):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
@@ -67,25 +86,51 @@ class StorageServer(service.MultiService, Referenceable):
         self._clean_incomplete()
         fileutil.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
+        # BucketWriters whose client went away before closing them are kept
+        # here for incoming_grace_period seconds, in case it comes back to
+        # finish the upload. (storage_index, shnum) -> BucketWriter
+        self.incoming_grace_period = incoming_grace_period
+        self._parked_writers = {}
+        self._parked_timer = None
+        if backend not in BACKENDS:
+            raise ValueError("storage backend '%s' must be one of %s"
+                             % (backend, ", ".join(BACKENDS)))
+        self.leasedb = None
+        # the packed backend has nowhere else to keep its leases
+        if use_leasedb or backend == "packed":
+            self.leasedb = LeaseDB(os.path.join(storedir, LEASEDB_FILENAME))
+        # open immutable share files, shared by all BucketReaders
+        self.share_file_pool = FilePool()
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync policy '%s' must be one of %s"
+                             % (fsync, ", ".join(FSYNC_POLICIES)))
+        self.buffered_writes = buffered_writes
+        self.fsync = fsync
+        self.group_syncer = GroupSyncer()
         log.msg("StorageServer created", facility="tahoe.storage")
 
+        self.add_backend(backend)
+        self.add_space_accountant()
+
         if reserved_space:
             if self.get_available_space() is None:
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        self.latencies = LatencyTracker(["allocate", # immutable
+                                         "write",
+                                         "close",
+                                         "read",
+                                         "get",
+                                         "get_batch",
+                                         "writev", # mutable
+                                         "readv",
+                                         "add-lease", # both
+                                         "renew",
+                                         "cancel",
+                                         ])
         self.add_bucket_counter()
+        self.add_share_index(share_index)
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
@@ -94,33 +139,104 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_enabled, expiration_mode,
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
-                                   expiration_sharetypes)
+                                   expiration_sharetypes,
+                                   threads=expiration_threads,
+                                   allowed_io_rate=expiration_io_rate)
         self.lease_checker.setServiceParent(self)
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
+    def startService(self):
+        # the disk may have filled up or been emptied while we were down
+        self.space_accountant.refresh()
+        service.MultiService.startService(self)
+
+    def stopService(self):
+        if self._parked_timer:
+            self._parked_timer.cancel()
+            self._parked_timer = None
+        d = service.MultiService.stopService(self)
+        d.addBoth(self._close_share_files)
+        d.addBoth(self._close_backend)
+        if self.leasedb is not None:
+            d.addBoth(self._close_leasedb)
+        if self.share_index is not None:
+            d.addBoth(self._save_share_index)
+        d.addBoth(self._save_space_accountant)
+        return d
+
+    def _close_share_files(self, res):
+        self.share_file_pool.close_all()
+        return res
+
+    def _close_backend(self, res):
+        self.backend.close()
+        return res
+
+    def _save_share_index(self, res):
+        self.share_index.save()
+        return res
+
+    def _save_space_accountant(self, res):
+        self.space_accountant.save()
+        return res
+
+    def _close_leasedb(self, res):
+        self.leasedb.close()
+        return res
+
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        return self.backend.have_shares()
+
+    def add_backend(self, name):
+        if name == "packed":
+            self.backend = PackedBackend(self,
+                                         os.path.join(self.storedir, "packed"))
+        else:
+            self.backend = DiskBackend(self)
+
+    def add_space_accountant(self):
+        picklefile = os.path.join(self.storedir, "space.pickle")
+        self.space_accountant = SpaceAccountant(self.sharedir,
+                                                self.reserved_space,
+                                                picklefile)
+        if self.space_accountant.used is None and not self.have_shares():
+            # a new server: there is nothing to count
+            self.space_accountant.used = 0
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
         self.bucket_counter.setServiceParent(self)
 
+    def add_share_index(self, mode):
+        # mode is None, "memory", or "persistent"
+        self.share_index = None
+        if mode is None:
+            return
+        if mode not in ("memory", "persistent"):
+            raise ValueError("share index mode '%s' must be 'memory' or "
+                             "'persistent'" % (mode,))
+        picklefile = None
+        if mode == "persistent":
+            picklefile = os.path.join(self.storedir, "share_index.pickle")
+        self.share_index = ShareIndex(picklefile)
+        statefile = os.path.join(self.storedir, "share_indexer.state")
+        self.share_indexer = ShareIndexingCrawler(self, statefile,
+                                                  self.share_index)
+        self.share_indexer.setServiceParent(self)
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
-    def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+    def add_latency(self, category, latency, size=None, client=None):
+        self.latencies.add(category, latency, size, client)
 
-    def get_latencies(self):
+    def get_latencies(self, seconds=None):
         """Return a dict, indexed by category, that contains a dict of
         latency numbers for each category. If there are sufficient samples
         for unambiguous interpretation, each dict will contain the
@@ -130,35 +246,26 @@ class StorageServer(service.MultiService, Referenceable):
         samples for a given percentile to be interpreted unambiguously
         that percentile will be reported as None. If no samples have been
         collected for the given category, then that category name will
-        not be present in the return value. """
-        # note that Amazon's Dynamo paper says they use 99.9% percentile.
-        output = {}
-        for category in self.latencies:
-            if not self.latencies[category]:
-                continue
-            stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
-            stats["samplesize"] = count
-            samples.sort()
-            if count > 1:
-                stats["mean"] = sum(samples) / count
-            else:
-                stats["mean"] = None
+        not be present in the return value.
 
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
-            for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
-
-            output[category] = stats
-        return output
+        The numbers cover the last 'seconds' seconds, or (by default) as
+        far back as the LatencyTracker remembers, which is 15 minutes. """
+        # note that Amazon's Dynamo paper says they use 99.9% percentile.
+        return self.latencies.get_latencies(seconds)
+
+    def get_latencies_by_size(self, seconds=None):
+        """Like get_latencies(), but each category is further divided by
+        the amount of share data that the operation moved: {category:
+        {sizeclass: stats}}. Only allocate, write, read and close report a
+        size."""
+        return self.latencies.get_breakdown("size", seconds)
+
+    def get_latencies_by_client(self, seconds=None):
+        """Like get_latencies(), but each category is further divided by
+        the tubid of the client: {category: {tubid: stats}}. Only the
+        immutable upload operations (allocate, write, close) know who their
+        client is."""
+        return self.latencies.get_breakdown("client", seconds)
 
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
@@ -173,12 +280,30 @@ class StorageServer(service.MultiService, Referenceable):
         # contains numeric values.
         stats = { 'storage_server.allocated': self.allocated_size(), }
         stats['storage_server.reserved_space'] = self.reserved_space
+        if self.leasedb is not None:
+            (num_shares, num_leases) = self.leasedb.get_lease_counts()
+            stats['storage_server.leasedb.shares'] = num_shares
+            stats['storage_server.leasedb.leases'] = num_leases
+        if self.share_index is not None:
+            for name,v in self.share_index.get_stats().items():
+                stats['storage_server.share_index.%s' % name] = v
+        for name,v in self.backend.get_stats().items():
+            stats['storage_server.%s.%s' % (self.backend.name, name)] = v
+        for name,v in self.space_accountant.get_stats().items():
+            stats['storage_server.space.%s' % name] = v
+        for name,v in self.share_file_pool.get_stats().items():
+            stats['storage_server.file_pool.%s' % name] = v
         for category,ld in self.get_latencies().items():
             for name,v in ld.items():
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
+        for category,sizes in self.get_latencies_by_size().items():
+            for sizeclass,ld in sizes.items():
+                for name,v in ld.items():
+                    stats['storage_server.latencies_by_size.%s.%s.%s'
+                          % (category, sizeclass, name)] = v
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+            disk = self.space_accountant.get_disk_stats()
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -210,13 +335,10 @@ class StorageServer(service.MultiService, Referenceable):
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        return self.space_accountant.get_available_space()
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return self.space_accountant.allocated
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
@@ -232,6 +354,8 @@ class StorageServer(service.MultiService, Referenceable):
                       "delete-mutable-shares-with-zero-length-writev": True,
                       "fills-holes-with-zero-bytes": True,
                       "prevents-read-past-end-of-share-data": True,
+                      "get-buckets-batch": True,
+                      "incoming-grace-period": self.incoming_grace_period,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
@@ -248,15 +372,14 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("allocate")
         alreadygot = set()
         bucketwriters = {} # k: shnum, v: BucketWriter
-        si_dir = storage_index_to_dir(storage_index)
         si_s = si_b2a(storage_index)
 
         log.msg("storage: allocate_buckets %s" % si_s)
 
-        # in this implementation, the lease information (including secrets)
-        # goes into the share files themselves. It could also be put into a
-        # separate database. Note that the lease should not be added until
-        # the BucketWriter has been closed.
+        # the lease information (including secrets) goes into the share
+        # files themselves, or into self.leasedb if that is enabled. Note
+        # that the lease should not be added until the BucketWriter has been
+        # closed.
         expire_time = time.time() + 31*24*60*60
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
@@ -277,44 +400,54 @@ class StorageServer(service.MultiService, Referenceable):
         # they asked about: this will save them a lot of work. Add or update
         # leases for all of them: if they want us to hold shares for this
         # file, they'll want us to hold leases for this file.
-        for (shnum, fn) in self._get_bucket_shares(storage_index):
+        shnums = self.backend.get_shnums(storage_index)
+        if self.leasedb is not None:
+            with self.leasedb.transaction():
+                for sl in self._get_leasedb_shares(storage_index, shnums):
+                    sl.add_or_renew_lease(lease_info)
+        for shnum in shnums:
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
-            sf.add_or_renew_lease(lease_info)
+            if self.leasedb is None:
+                sf = self.backend.get_share_leases(storage_index, shnum)
+                sf.add_or_renew_lease(lease_info)
 
+        self._expire_parked_writers()
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
-                # great! we already have it. easy.
-                pass
-            elif os.path.exists(incominghome):
-                # Note that we don't create BucketWriters for shnums that
-                # have a partial share (in incoming/), so if a second upload
-                # occurs while the first is still in progress, the second
-                # uploader will use different storage servers.
+            bw = self._resume_bucket_writer(storage_index, shnum,
+                                            allocated_size, lease_info,
+                                            canary)
+            if bw is not None:
+                bucketwriters[shnum] = bw
+            elif self.backend.has_share(storage_index, shnum):
+                # great! we already have it (or somebody is uploading it
+                # right now). easy.
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
-                bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                bw = self.backend.make_bucket_writer(storage_index, shnum,
+                                                     max_space_per_bucket,
+                                                     lease_info, canary)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                self._active_writers[bw] = (storage_index, shnum, lease_info)
+                self.space_accountant.add_writer(bw, max_space_per_bucket)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
-
-        self.add_latency("allocate", time.time() - start)
+        self.add_latency("allocate", time.time() - start,
+                         size=allocated_size,
+                         client=get_client_id(canary))
         return alreadygot, bucketwriters
 
     def _iter_share_files(self, storage_index):
+        if self.leasedb is not None:
+            for sl in self._get_leasedb_shares(storage_index):
+                yield sl
+            return
         for shnum, filename in self._get_bucket_shares(storage_index):
             f = open(filename, 'rb')
             header = f.read(32)
@@ -330,6 +463,24 @@ class StorageServer(service.MultiService, Referenceable):
                 continue # non-sharefile
             yield sf
 
+    def _get_leasedb_shares(self, storage_index, shnums=None):
+        # Shares that are already in the lease database are not opened at
+        # all; only shares that need migrating get their header read. The
+        # caller should hold a leasedb transaction around this and its work
+        # on the shares, so that it is all committed at once.
+        if shnums is None:
+            shnums = self.backend.get_shnums(storage_index)
+        shares = []
+        for shnum in shnums:
+            try:
+                sl = self.backend.get_share_leases(storage_index, shnum)
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error):
+                continue # non-sharefile
+            shares.append(sl)
+        return shares
+
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
         start = time.time()
@@ -338,8 +489,13 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
-            sf.add_or_renew_lease(lease_info)
+        if self.leasedb is not None:
+            with self.leasedb.transaction():
+                for sl in self._get_leasedb_shares(storage_index):
+                    sl.add_or_renew_lease(lease_info)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                sf.add_or_renew_lease(lease_info)
         self.add_latency("add-lease", time.time() - start)
         return None
 
@@ -348,31 +504,106 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
-            sf.renew_lease(renew_secret, new_expire_time)
+        if self.leasedb is not None:
+            with self.leasedb.transaction():
+                for sl in self._get_leasedb_shares(storage_index):
+                    found_buckets = True
+                    sl.renew_lease(renew_secret, new_expire_time)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
         self.add_latency("renew", time.time() - start)
         if not found_buckets:
             raise IndexError("no such lease to renew")
 
+    def park_bucket_writer(self, bw):
+        """Called when the client of an unfinished BucketWriter goes away,
+        and incoming_grace_period is set. The partial share is kept, and
+        offered to the next client that allocates it (see
+        _resume_bucket_writer), until the grace period is over."""
+        (storage_index, shnum, lease_info) = self._active_writers[bw]
+        bw.parked_until = time.time() + self.incoming_grace_period
+        self._parked_writers[(storage_index, shnum)] = bw
+        self.count("park")
+        self._schedule_parked_expiry()
+
+    def _resume_bucket_writer(self, storage_index, shnum, allocated_size,
+                              lease_info, canary):
+        bw = self._parked_writers.get((storage_index, shnum))
+        if bw is None:
+            return None
+        (ign, ign, old_lease_info) = self._active_writers[bw]
+        if (bw.allocated_size() != allocated_size or
+            not timing_safe_compare(old_lease_info.renew_secret,
+                                    lease_info.renew_secret)):
+            # somebody else, or a different encoding of the file: they
+            # cannot use what is there
+            return None
+        del self._parked_writers[(storage_index, shnum)]
+        bw._sharefile.add_or_renew_lease(lease_info)
+        self._active_writers[bw] = (storage_index, shnum, lease_info)
+        bw.resume(canary)
+        self.count("resume")
+        return bw
+
+    def _expire_parked_writers(self):
+        now = time.time()
+        for (key, bw) in self._parked_writers.items():
+            if bw.parked_until <= now:
+                del self._parked_writers[key]
+                bw._abort()
+
+    def _schedule_parked_expiry(self):
+        # the partial shares of clients that never come back must not keep
+        # their space reserved until the next allocation, which may never
+        # happen, so a timer wakes up when the first of them expires
+        if self._parked_timer or not self._parked_writers:
+            return
+        first = min([bw.parked_until for bw in self._parked_writers.values()])
+        self._parked_timer = reactor.callLater(max(0, first - time.time()),
+                                               self._parked_timer_fired)
+
+    def _parked_timer_fired(self):
+        self._parked_timer = None
+        self._expire_parked_writers()
+        self._schedule_parked_expiry()
+
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, shnum, lease_info) = self._active_writers.pop(bw)
+        self.space_accountant.remove_writer(bw)
+        if not consumed_size:
+            # consumed_size is zero when the upload was aborted, and the
+            # share file has been removed
+            return
+        if self.leasedb is not None:
+            self.leasedb.add_new_share(storage_index, shnum, "immutable",
+                                       lease_info)
+        self.backend.share_closed(storage_index, shnum, consumed_size)
+        self.space_accountant.share_added(consumed_size)
+
+    def share_removed(self, storage_index, shnum, size):
+        """Called when a share of 'size' bytes has been deleted, e.g.
+        because its last lease expired."""
+        self.space_accountant.share_removed(size)
+        if self.leasedb is not None:
+            self.leasedb.remove_share(storage_index, shnum)
+        if self.share_index is not None:
+            self.share_index.remove_share(storage_index, shnum)
+
+    def discard_share_file(self, filename):
+        """Called before a share file is deleted, so that we do not keep it
+        open (which would keep its space allocated)."""
+        self.share_file_pool.discard(filename)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
-        the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        the integer form of the last component of 'pathname'. Shares that
+        the backend keeps elsewhere are not included."""
+        return self.backend.get_bucket_shares(storage_index)
 
     def remote_get_buckets(self, storage_index):
         start = time.time()
@@ -380,12 +611,28 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
         bucketreaders = {} # k: sharenum, v: BucketReader
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+        for shnum in self.backend.get_shnums(storage_index):
+            bucketreaders[shnum] = self.backend.make_bucket_reader(
+                storage_index, shnum)
         self.add_latency("get", time.time() - start)
         return bucketreaders
 
+    def remote_get_buckets_batch(self, storage_indexes):
+        start = time.time()
+        self.count("get_batch")
+        log.msg("storage: get_buckets_batch (%d storage indexes)"
+                % len(storage_indexes))
+        results = {} # k: storage_index, v: {sharenum: BucketReader}
+        for storage_index in storage_indexes:
+            bucketreaders = {}
+            for shnum in self.backend.get_shnums(storage_index):
+                bucketreaders[shnum] = self.backend.make_bucket_reader(
+                    storage_index, shnum)
+            if bucketreaders:
+                results[storage_index] = bucketreaders
+        self.add_latency("get_batch", time.time() - start)
+        return results
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -395,12 +642,11 @@ class StorageServer(service.MultiService, Referenceable):
 
         # since all shares get the same lease data, we just grab the leases
         # from the first share
-        try:
-            shnum, filename = self._get_bucket_shares(storage_index).next()
-            sf = ShareFile(filename)
-            return sf.get_leases()
-        except StopIteration:
+        shnums = self.backend.get_shnums(storage_index)
+        if not shnums:
             return iter([])
+        sf = self.backend.get_share_leases(storage_index, shnums[0])
+        return sf.get_leases()
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
                                                secrets,
@@ -414,20 +660,31 @@ class StorageServer(service.MultiService, Referenceable):
         (write_enabler, renew_secret, cancel_secret) = secrets
         # shares exist if there is a file for them
         bucketdir = os.path.join(self.sharedir, si_dir)
+        # each share file is opened once, and all the vectors are applied
+        # through that one file object
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
+        try:
+            for sharenum, filename in self._get_bucket_shares(storage_index):
                 msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
+                msf.open()
                 shares[sharenum] = msf
-        # write_enabler is good for all existing shares.
+                msf.check_write_enabler(write_enabler, si_s)
+            # write_enabler is good for all existing shares.
+            (testv_is_good, read_data) = self._slot_testv_and_readv_and_writev(
+                storage_index, secrets, test_and_write_vectors, read_vector,
+                bucketdir, shares)
+        finally:
+            for msf in shares.values():
+                msf.close()
 
-        # Now evaluate test vectors.
+        # all done
+        self.add_latency("writev", time.time() - start)
+        return (testv_is_good, read_data)
+
+    def _slot_testv_and_readv_and_writev(self, storage_index, secrets,
+                                         test_and_write_vectors, read_vector,
+                                         bucketdir, shares):
+        # Evaluate test vectors.
         testv_is_good = True
         for sharenum in test_and_write_vectors:
             (testv, datav, new_length) = test_and_write_vectors[sharenum]
@@ -450,40 +707,58 @@ class StorageServer(service.MultiService, Referenceable):
         for sharenum, share in shares.items():
             read_data[sharenum] = share.readv(read_vector)
 
+        if not testv_is_good:
+            return (testv_is_good, read_data)
+
+        (write_enabler, renew_secret, cancel_secret) = secrets
         ownerid = 1 # TODO
         expire_time = time.time() + 31*24*60*60   # one month
         lease_info = LeaseInfo(ownerid,
                                renew_secret, cancel_secret,
                                expire_time, self.my_nodeid)
 
-        if testv_is_good:
-            # now apply the write vectors
-            for sharenum in test_and_write_vectors:
-                (testv, datav, new_length) = test_and_write_vectors[sharenum]
-                if new_length == 0:
-                    if sharenum in shares:
-                        shares[sharenum].unlink()
+        # now apply the write vectors
+        for sharenum in test_and_write_vectors:
+            (testv, datav, new_length) = test_and_write_vectors[sharenum]
+            if new_length == 0:
+                if sharenum in shares:
+                    share = shares.pop(sharenum)
+                    size = share.get_size()
+                    share.close()
+                    share.unlink()
+                    self.share_removed(storage_index, sharenum, size)
+            else:
+                if sharenum in shares:
+                    old_size = shares[sharenum].get_size()
+                else:
+                    # allocate a new share
+                    allocated_size = 2000 # arbitrary, really
+                    share = self._allocate_slot_share(bucketdir, secrets,
+                                                      sharenum,
+                                                      allocated_size,
+                                                      owner_num=0)
+                    share.open()
+                    shares[sharenum] = share
+                    old_size = 0
+                shares[sharenum].writev(datav, new_length)
+                size = shares[sharenum].get_size()
+                self.space_accountant.share_added(size - old_size)
+                if self.share_index is not None:
+                    self.share_index.add_share(storage_index, sharenum,
+                                               size, "mutable")
+                # and update the lease
+                if self.leasedb is not None:
+                    filename = shares[sharenum].home
+                    sl = self.leasedb.get_share(storage_index, sharenum,
+                                                filename)
+                    sl.add_or_renew_lease(lease_info)
                 else:
-                    if sharenum not in shares:
-                        # allocate a new share
-                        allocated_size = 2000 # arbitrary, really
-                        share = self._allocate_slot_share(bucketdir, secrets,
-                                                          sharenum,
-                                                          allocated_size,
-                                                          owner_num=0)
-                        shares[sharenum] = share
-                    shares[sharenum].writev(datav, new_length)
-                    # and update the lease
                     shares[sharenum].add_or_renew_lease(lease_info)
 
-            if new_length == 0:
-                # delete empty bucket directories
-                if not os.listdir(bucketdir):
-                    os.rmdir(bucketdir)
-
-
-        # all done
-        self.add_latency("writev", time.time() - start)
+        if new_length == 0:
+            # delete empty bucket directories
+            if not os.listdir(bucketdir):
+                os.rmdir(bucketdir)
         return (testv_is_good, read_data)
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
@@ -502,20 +777,10 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
-            self.add_latency("readv", time.time() - start)
-            return {}
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for sharenum, filename in self._get_bucket_shares(storage_index):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
                 msf = MutableShareFile(filename, self)
                 datavs[sharenum] = msf.readv(readv)
         log.msg("returning shares %s" % (datavs.keys(),),
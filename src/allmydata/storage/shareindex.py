@@ -0,0 +1,173 @@
+import os, re, struct
+import cPickle as pickle
+
+from allmydata.util import fileutil, log
+from allmydata.storage.common import si_b2a, si_a2b
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.mutable import MutableShareFile
+
+# The share index lets the StorageServer answer "which shares do you have
+# for this storage index?" (get_buckets, slot_readv, slot_writev, and the
+# lease-renewal paths) from memory, instead of calling os.listdir() on the
+# bucket directory every time. On a cold cache that listdir costs a disk
+# seek or two, and it dominates DYHB latency.
+#
+# The index is filled in by the ShareIndexingCrawler, one prefix directory
+# at a time. Until a prefix has been crawled, lookups for storage indexes in
+# that prefix fall back to the filesystem.
+# The StorageServer keeps the index up to date as shares are created and
+# deleted, and every crawler cycle re-reads the disk, so changes made behind
+# the server's back are eventually noticed.
+
+NUM_RE=re.compile("^[0-9]+$")
+
+def get_sharetype(filename):
+    """Return 'mutable' or 'immutable' by looking at the header of a share
+    file, or None if it does not look like a share at all."""
+    f = open(filename, "rb")
+    header = f.read(32)
+    f.close()
+    if header == MutableShareFile.MAGIC:
+        return "mutable"
+    if header[:4] == struct.pack(">L", 1):
+        return "immutable"
+    return None
+
+
+class ShareIndex(object):
+    """I remember, for each storage index held by a StorageServer, which
+    shares are present: {shnum: (size, sharetype)}."""
+
+    def __init__(self, picklefile=None):
+        self._picklefile = picklefile
+        self._prefixes = {} # prefix -> {storage_index: {shnum: (size, type)}}
+        self._indexed_prefixes = set()
+        self.loaded = False
+        if picklefile is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            f = open(self._picklefile, "rb")
+            (prefixes, indexed_prefixes) = pickle.load(f)
+            f.close()
+        except Exception:
+            return
+        # the pickle is only written by a clean shutdown. Delete it now, so
+        # that a crash doesn't leave a stale index around for next time.
+        fileutil.remove_if_possible(self._picklefile)
+        self._prefixes = prefixes
+        self._indexed_prefixes = indexed_prefixes
+        self.loaded = True
+        log.msg(format="loaded share index with %(buckets)d buckets",
+                buckets=self.get_stats()["buckets"],
+                facility="tahoe.storage")
+
+    def save(self):
+        if self._picklefile is None:
+            return
+        tmpfile = self._picklefile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump((self._prefixes, self._indexed_prefixes), f,
+                    pickle.HIGHEST_PROTOCOL)
+        f.close()
+        fileutil.move_into_place(tmpfile, self._picklefile)
+
+    def _prefix(self, storage_index):
+        return si_b2a(storage_index)[:2]
+
+    def get_shares(self, storage_index):
+        """Return a dict mapping shnum to (size, sharetype) for the shares I
+        know about, or None if I don't know (yet) whether this storage index
+        has any shares."""
+        prefix = self._prefix(storage_index)
+        if prefix not in self._indexed_prefixes:
+            return None
+        return self._prefixes.get(prefix, {}).get(storage_index, {}).copy()
+
+    def set_prefix(self, prefix, buckets):
+        """Replace everything I know about one prefix directory, with the
+        result of a complete scan. After this, storage indexes in this
+        prefix that are not in 'buckets' are known to have no shares."""
+        self._prefixes[prefix] = dict([(si, shares.copy())
+                                       for (si, shares) in buckets.items()
+                                       if shares])
+        self._indexed_prefixes.add(prefix)
+
+    def add_share(self, storage_index, shnum, size, sharetype):
+        prefix = self._prefix(storage_index)
+        if prefix not in self._indexed_prefixes:
+            # the other shares in this prefix are not known yet, and the
+            # crawler will find this one along with them
+            return
+        buckets = self._prefixes.setdefault(prefix, {})
+        shares = buckets.setdefault(storage_index, {})
+        shares[shnum] = (size, sharetype)
+
+    def remove_share(self, storage_index, shnum):
+        buckets = self._prefixes.get(self._prefix(storage_index), {})
+        shares = buckets.get(storage_index)
+        if shares is None:
+            return
+        shares.pop(shnum, None)
+        if not shares:
+            del buckets[storage_index]
+
+    def get_stats(self):
+        num_buckets = 0
+        num_shares = 0
+        for buckets in self._prefixes.values():
+            num_buckets += len(buckets)
+            for shares in buckets.values():
+                num_shares += len(shares)
+        return {"buckets": num_buckets,
+                "shares": num_shares,
+                "indexed-prefixes": len(self._indexed_prefixes),
+                }
+
+
+class ShareIndexingCrawler(ShareCrawler):
+    """I walk all shares and record them in a ShareIndex.
+
+    Each prefix directory is read in a single step, without yielding in the
+    middle of it, so that the StorageServer cannot create or delete a share
+    in that prefix while I am looking at it.
+    """
+
+    slow_start = 0 # the index is only useful once it has been built
+    minimum_cycle_time = 24*60*60 # re-verify once per day
+
+    def __init__(self, server, statefile, index):
+        self.index = index
+        if not index.loaded:
+            # there is nothing to resume: start from the first prefix
+            fileutil.remove_if_possible(statefile)
+        ShareCrawler.__init__(self, server, statefile)
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        found = {}
+        for storage_index_b32 in buckets:
+            bucketdir = os.path.join(prefixdir, storage_index_b32)
+            shares = self.scan_bucket(bucketdir)
+            if shares:
+                found[si_a2b(storage_index_b32)] = shares
+        self.index.set_prefix(prefix, found)
+
+    def scan_bucket(self, bucketdir):
+        shares = {}
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            return shares
+        for f in filenames:
+            if not NUM_RE.match(f):
+                continue
+            filename = os.path.join(bucketdir, f)
+            try:
+                sharetype = get_sharetype(filename)
+                size = os.stat(filename).st_size
+            except EnvironmentError:
+                continue
+            if sharetype is not None:
+                shares[int(f)] = (size, sharetype)
+        return shares
@@ -0,0 +1,154 @@
+import weakref, time
+import cPickle as pickle
+
+from allmydata.util import fileutil, log
+
+# The StorageServer asks "how much space is left for new shares?" on every
+# allocate_buckets and get_version call. Answering that by calling statvfs()
+# and then adding up the allocations of every open BucketWriter costs a
+# syscall plus O(number of uploads in progress) each time, which adds up on
+# a busy server with thousands of concurrent uploads.
+#
+# The SpaceAccountant answers it from counters instead. statvfs() is called
+# when the server starts, and after that at most once every refresh_interval
+# seconds, when somebody asks. In between, the bytes that shares have gained
+# or lost since the last refresh are applied to the cached figure, and the
+# space promised to open BucketWriters is kept as a running total.
+
+
+class SpaceAccountant(object):
+    """I keep track of the space used and promised by a StorageServer.
+
+    'allocated' is the space promised to open BucketWriters (their maximum
+    size), which has not yet been consumed by a finished share.
+
+    'used' is the number of bytes held in share files. It is saved at clean
+    shutdown. After a crash, or on a server that did not count it before,
+    it is unknown (None) until the lease checker has finished a full cycle
+    and counted every share. Lease records that are appended to share
+    files (when the server does not use a leasedb) only show up in such a
+    recount."""
+
+    refresh_interval = 60
+
+    def __init__(self, sharedir, reserved_space=0, picklefile=None):
+        self.sharedir = sharedir
+        self.reserved_space = reserved_space
+        self._picklefile = picklefile
+        self.allocated = 0
+        self.used = None
+        self._writers = {} # weakref(BucketWriter) -> allocated size
+        self._disk = None
+        self._disk_error = None
+        self._delta = 0 # bytes gained by shares since the last refresh
+        self._last_refresh = None
+        if picklefile is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            f = open(self._picklefile, "rb")
+            state = pickle.load(f)
+            f.close()
+        except Exception:
+            return
+        # like the share index, this is only valid after a clean shutdown
+        fileutil.remove_if_possible(self._picklefile)
+        self.used = state["used"]
+
+    def save(self):
+        if self._picklefile is None or self.used is None:
+            return
+        tmpfile = self._picklefile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump({"used": self.used}, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        fileutil.move_into_place(tmpfile, self._picklefile)
+
+    def refresh(self):
+        """Ask the OS how much space is free."""
+        self._last_refresh = time.time()
+        self._delta = 0
+        try:
+            self._disk = fileutil.get_disk_stats(self.sharedir,
+                                                 self.reserved_space)
+            self._disk_error = None
+        except AttributeError, e:
+            # there is no API to get this information on this platform
+            self._disk = None
+            self._disk_error = e
+        except EnvironmentError, e:
+            log.msg("OS call to get disk statistics failed",
+                    level=log.UNUSUAL, facility="tahoe.storage")
+            self._disk = None
+            self._disk_error = e
+
+    def get_disk_stats(self):
+        """Return the dict from fileutil.get_disk_stats() as of the last
+        refresh, with the space consumed or freed since then applied to it.
+        Raise the same exceptions as fileutil.get_disk_stats()."""
+        if (self._last_refresh is None or
+            time.time() - self._last_refresh > self.refresh_interval):
+            self.refresh()
+        if self._disk is None:
+            raise self._disk_error
+        disk = self._disk.copy()
+        delta = self._delta
+        if "used" in disk:
+            disk["used"] += delta
+        for k in ("free_for_root", "free_for_nonroot", "avail"):
+            if k in disk:
+                disk[k] = max(disk[k] - delta, 0)
+        return disk
+
+    def get_available_space(self):
+        """Return the space left for shares (not counting what has been
+        promised to open BucketWriters), None if the platform has no API to
+        measure it, or 0 if measuring it failed."""
+        try:
+            return self.get_disk_stats()["avail"]
+        except AttributeError:
+            return None
+        except EnvironmentError:
+            return 0
+
+    def add_writer(self, bw, size):
+        """A BucketWriter has been promised 'size' bytes. The promise ends
+        with remove_writer(), or when the BucketWriter is garbage-collected
+        without being closed or aborted."""
+        def _gone(ref):
+            self.allocated -= self._writers.pop(ref, 0)
+        ref = weakref.ref(bw, _gone)
+        self._writers[ref] = size
+        self.allocated += size
+
+    def remove_writer(self, bw):
+        self.allocated -= self._writers.pop(weakref.ref(bw), 0)
+
+    def share_added(self, size):
+        """'size' bytes of share data have been written to disk. This is
+        also used for mutable shares that grow (or, with a negative size,
+        shrink)."""
+        self._delta += size
+        if self.used is not None:
+            self.used += size
+
+    def share_removed(self, size):
+        """A share of 'size' bytes has been deleted."""
+        self.share_added(-size)
+
+    def lease_checker_cycle_finished(self, sharebytes):
+        """The lease checker has looked at every share, and found
+        'sharebytes' bytes that were not deleted. Use that if I lost count,
+        e.g. because the server crashed."""
+        if self.used is None:
+            self.used = sharebytes
+
+    def get_stats(self):
+        stats = {"allocated": self.allocated,
+                 "open-writers": len(self._writers),
+                 "unrefreshed-bytes": self._delta,
+                 }
+        if self.used is not None:
+            stats["used"] = self.used
+        return stats
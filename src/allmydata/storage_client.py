@@ -275,6 +275,44 @@ class StubServer(object):
         return "?"
 
 
+class LinkEstimate(object):
+    """I keep a rough, smoothed estimate of the round-trip time to one
+    storage server, and of how fast it accepts share data, from the queries
+    and writes that uploads send to it."""
+
+    # each new sample moves the estimate this fraction of the way
+    WEIGHT = 0.25
+    # the time taken by smaller writes is mostly the round trip
+    MIN_TRANSFER_SIZE = 16*1024
+
+    def __init__(self):
+        self._round_trip_time = None
+        self._bandwidth = None
+
+    def _smooth(self, old, new):
+        if old is None:
+            return new
+        return old + self.WEIGHT * (new - old)
+
+    def record_round_trip(self, seconds):
+        self._round_trip_time = self._smooth(self._round_trip_time, seconds)
+
+    def record_transfer(self, size, seconds):
+        if size < self.MIN_TRANSFER_SIZE or seconds <= 0:
+            return
+        self._bandwidth = self._smooth(self._bandwidth, size / seconds)
+
+    def get_round_trip_time(self):
+        """Return the round-trip time in seconds, or None if unknown."""
+        return self._round_trip_time
+
+    def get_bandwidth(self):
+        """Return the write bandwidth in bytes per second, or None if
+        unknown. Writes queue up behind each other on one connection, so
+        this is a lower bound."""
+        return self._bandwidth
+
+
 @implementer(IServer)
 class NativeStorageServer(service.MultiService):
     """I hold information about a storage server that we want to connect to.
@@ -298,6 +336,8 @@ class NativeStorageServer(service.MultiService):
           "maximum-mutable-share-size": 2*1000*1000*1000, # maximum prior to v1.9.2
           "tolerates-immutable-read-overrun": False,
           "delete-mutable-shares-with-zero-length-writev": False,
+          "get-buckets-batch": False,
+          "incoming-grace-period": 0,
           "available-space": None,
           },
         "application-version": "unknown: no get_version()",
@@ -347,6 +387,7 @@ class NativeStorageServer(service.MultiService):
         self._reconnector = None
         self._trigger_cb = None
         self._on_status_changed = ObserverList()
+        self._link_estimate = LinkEstimate()
 
     def on_status_changed(self, status_changed):
         """
@@ -391,6 +432,8 @@ class NativeStorageServer(service.MultiService):
         return self.announcement
     def get_remote_host(self):
         return self.remote_host
+    def get_link_estimate(self):
+        return self._link_estimate
 
     def get_connection_status(self):
         last_received = None
@@ -554,6 +597,15 @@ class _StorageServer(object):
             storage_index,
         )
 
+    def get_buckets_batch(
+            self,
+            storage_indexes,
+    ):
+        return self._rref.callRemote(
+            "get_buckets_batch",
+            storage_indexes,
+        )
+
     def slot_readv(
             self,
             storage_index,
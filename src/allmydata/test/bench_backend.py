@@ -0,0 +1,127 @@
+"""
+Compare the "disk" storage backend, which keeps every share in a file of its
+own, against the "packed" backend, which appends small immutable shares to a
+few large container files.
+
+Three things are measured, all with small (1kB) shares:
+
+ * allocate: allocate_buckets, write and close every share of N storage
+   indexes
+ * read: get_buckets and read every share of N storage indexes
+ * startup: construct a StorageServer over a store holding N storage indexes
+   and look up the shares of each of them. "packed-clean" finds the index
+   pickled at the previous shutdown, "packed-crash" has to rebuild it by
+   scanning the containers.
+
+All files are freshly written and therefore sit in the page cache, so this
+mostly measures the per-share filesystem operations (open/create/rename/
+mkdir) that the packed backend avoids.
+
+Run with "python -m allmydata.test.bench_backend".
+"""
+
+from __future__ import print_function
+
+import os, shutil, tempfile
+
+from pyutil import benchutil # http://tahoe-lafs.org/trac/pyutil
+
+from allmydata.util import hashutil
+from allmydata.storage.server import StorageServer
+
+SHARES_PER_SI = 10
+SHARE_SIZE = 1000
+
+class FakeCanary(object):
+    def notifyOnDisconnect(self, f, *args, **kwargs):
+        return None
+    def dontNotifyOnDisconnect(self, marker):
+        pass
+
+class B(object):
+    def __init__(self, backend, clean_shutdown=True):
+        self.backend = backend
+        self.clean_shutdown = clean_shutdown
+        self.basedir = None
+        self.ss = None
+        self.sis = []
+
+    def _make_server(self):
+        return StorageServer(self.basedir, "\x00" * 20, backend=self.backend)
+
+    def _stop_server(self):
+        self.ss.stopService()
+        self.ss = None
+
+    def init_empty(self, N):
+        self.cleanup()
+        self.basedir = tempfile.mkdtemp(prefix="bench_backend")
+        self.ss = self._make_server()
+        self.sis = [hashutil.tagged_hash("si", "%d" % i)[:16]
+                    for i in range(N)]
+
+    def init_full(self, N):
+        self.init_empty(N)
+        self.allocate(N)
+
+    def init_stopped(self, N):
+        self.init_full(N)
+        self._stop_server()
+        if not self.clean_shutdown:
+            pickle = os.path.join(self.basedir, "packed", "index.pickle")
+            if os.path.exists(pickle):
+                os.unlink(pickle)
+
+    def allocate(self, N):
+        for si in self.sis:
+            rs = hashutil.tagged_hash("renew", si)
+            cs = hashutil.tagged_hash("cancel", si)
+            already, writers = self.ss.remote_allocate_buckets(
+                si, rs, cs, range(SHARES_PER_SI), SHARE_SIZE, FakeCanary())
+            for bw in writers.values():
+                bw.remote_write(0, "a" * SHARE_SIZE)
+                bw.remote_close()
+
+    def read(self, N):
+        for si in self.sis:
+            for br in self.ss.remote_get_buckets(si).values():
+                br.remote_read(0, SHARE_SIZE)
+
+    def startup(self, N):
+        self.ss = self._make_server()
+        for si in self.sis:
+            self.ss.backend.get_shnums(si)
+
+    def cleanup(self):
+        if self.ss is not None:
+            self._stop_server()
+        if self.basedir is not None:
+            shutil.rmtree(self.basedir)
+        self.basedir = None
+
+    def run_benchmarks(self):
+        name = self.backend
+        if self.backend == "packed":
+            name += self.clean_shutdown and "-clean" or "-crash"
+        for (what, func, initfunc) in [
+            ("allocate", self.allocate, self.init_empty),
+            ("read", self.read, self.init_full),
+            ("startup", self.startup, self.init_stopped),
+            ]:
+            if what != "startup" and not self.clean_shutdown:
+                continue
+            print("%s %s, %d shares of %d bytes per storage index"
+                  % (name, what, SHARES_PER_SI, SHARE_SIZE))
+            for N in 10, 100, 1000:
+                print("%5d" % N, end=' ')
+                benchutil.rep_bench(func, N, initfunc=initfunc,
+                                    runreps=5, UNITS_PER_SECOND=1000)
+            benchutil.print_bench_footer(UNITS_PER_SECOND=1000)
+            print("(milliseconds per storage index)")
+            print()
+        self.cleanup()
+
+if __name__ == "__main__":
+    B("disk").run_benchmarks()
+    B("packed").run_benchmarks()
+    B("packed", clean_shutdown=False).run_benchmarks()
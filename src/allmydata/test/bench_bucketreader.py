@@ -0,0 +1,91 @@
+"""
+Measure how quickly a StorageServer's BucketReaders can serve reads of
+4KiB, 128KiB and 1MiB, with and without the pool of open share files.
+
+The reads walk sequentially through one 4MiB share per storage index, the
+way a downloader fetches blocks, round-robin across several shares. The
+share files are freshly written and therefore sit in the page cache, so
+this measures the per-read CPU and syscall overhead rather than the disk.
+
+Run with "python -m allmydata.test.bench_bucketreader".
+"""
+
+from __future__ import print_function
+
+import shutil, tempfile
+
+from pyutil import benchutil # http://tahoe-lafs.org/trac/pyutil
+
+from allmydata.util import hashutil
+from allmydata.storage.server import StorageServer
+from allmydata.storage.immutable import BucketReader
+
+SHARES = 20
+SHARE_SIZE = 4*1024*1024
+
+class FakeCanary(object):
+    def notifyOnDisconnect(self, f, *args, **kwargs):
+        return None
+    def dontNotifyOnDisconnect(self, marker):
+        pass
+
+class B(object):
+    def __init__(self, use_pool):
+        self.use_pool = use_pool
+        self.basedir = tempfile.mkdtemp(prefix="bench_bucketreader")
+        self.ss = StorageServer(self.basedir, "\x00" * 20)
+        self.readers = []
+        self.sis = [hashutil.tagged_hash("si", "%d" % i)[:16]
+                    for i in range(SHARES)]
+        chunk = "a" * (1024*1024)
+        for si in self.sis:
+            already, writers = self.ss.remote_allocate_buckets(
+                si, hashutil.tagged_hash("renew", si),
+                hashutil.tagged_hash("cancel", si),
+                [0], SHARE_SIZE, FakeCanary())
+            for offset in range(0, SHARE_SIZE, len(chunk)):
+                writers[0].remote_write(offset, chunk)
+            writers[0].remote_close()
+        self.read_size = None
+
+    def init(self, N):
+        self.ss.share_file_pool.close_all()
+        self.readers = []
+        for si in self.sis:
+            if self.use_pool:
+                self.readers.append(self.ss.remote_get_buckets(si)[0])
+            else:
+                # a BucketReader without a pool opens the file every time
+                [(shnum, filename)] = self.ss._get_bucket_shares(si)
+                self.readers.append(BucketReader(self.ss, filename, si, shnum))
+
+    def read(self, N):
+        size = self.read_size
+        offset = 0
+        for i in range(N):
+            reader = self.readers[i % SHARES]
+            reader.remote_read(offset, size)
+            if i % SHARES == SHARES-1:
+                offset = (offset + size) % SHARE_SIZE
+
+    def cleanup(self):
+        self.ss.share_file_pool.close_all()
+        shutil.rmtree(self.basedir)
+
+    def run_benchmarks(self):
+        print("reading from %d shares, file pool=%s" % (SHARES, self.use_pool))
+        for read_size in 4*1024, 128*1024, 1024*1024:
+            self.read_size = read_size
+            print("%7d bytes per read" % read_size)
+            for N in 1000, 10000:
+                print("%5d" % N, end=' ')
+                benchutil.rep_bench(self.read, N, initfunc=self.init,
+                                    runreps=10, UNITS_PER_SECOND=1000000)
+        benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+        print("(microseconds per read)")
+        self.cleanup()
+
+if __name__ == "__main__":
+    for use_pool in (False, True):
+        B(use_pool).run_benchmarks()
+        print()
@@ -0,0 +1,248 @@
+"""
+A throughput, latency and memory benchmark suite that runs on a no-network
+grid of 10 servers in this process, so it needs no control FURL and no
+externally started nodes (unlike check_speed.py and check_memory.py).
+
+For each encoding in ENCODINGS (k, happy, n) this measures:
+
+ * immutable-upload, immutable-download: a random-key upload of each of
+   FILE_SIZES, and a download of it from a fresh filenode
+ * sdmf-publish, sdmf-retrieve, mdmf-publish, mdmf-retrieve: an overwrite
+   of a mutable file of each format with each of FILE_SIZES, and a read of
+   its best version (the RSA key generation for the file is not timed)
+ * dirnode-modify, dirnode-list: adding a child to a directory that already
+   has DIR_ENTRIES children, and listing it
+ * deep-traverse: deep-stats of a tree of DEEP_DIRS directories with
+   DEEP_FILES files each
+
+Each measurement is repeated REPEAT times. The results record every
+duration, the best and the mean, the throughput of the best run for the
+file operations, and the peak resident set size seen while they ran
+(sampled every 10ms from /proc/self/status, so it is 0 on platforms without
+one). A summary is printed as the benchmarks run, and all of the results are
+written as JSON, with the Tahoe-LAFS version, to stdout or to the file named
+on the command line, so that they can be compared between releases.
+
+Run with "python -m allmydata.test.bench_grid [results.json]".
+"""
+
+from __future__ import print_function
+
+import json, platform, shutil, sys, tempfile, time
+
+from twisted.application import service
+from twisted.internet import defer, reactor, task
+
+import allmydata
+from allmydata import uri
+from allmydata.control import get_memory_usage
+from allmydata.interfaces import SDMF_VERSION, MDMF_VERSION
+from allmydata.mutable.publish import MutableData
+from allmydata.test.bench_segment_size import ZeroUploadable
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+from allmydata.util.consumer import MemoryConsumer
+
+KiB = 1024
+MiB = 1024*KiB
+FILE_SIZES = [64*KiB, 1*MiB, 16*MiB]
+ENCODINGS = [(1, 3, 3), (3, 7, 10), (7, 10, 10)]
+REPEAT = 3
+DIR_ENTRIES = 100
+DEEP_DIRS = 10
+DEEP_FILES = 10
+
+class CountingConsumer(MemoryConsumer):
+    # count the bytes instead of keeping them, so they don't count towards
+    # the peak RSS
+    def __init__(self):
+        MemoryConsumer.__init__(self)
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+class PeakRSS(object):
+    """I sample the resident set size until stopped, and remember the
+    largest value I saw."""
+    INTERVAL = 0.01
+
+    def __init__(self):
+        self.peak = 0
+        self._loop = task.LoopingCall(self._sample)
+
+    def _sample(self):
+        self.peak = max(self.peak, get_memory_usage().get("VmRSS", 0))
+
+    def start(self):
+        self._loop.start(self.INTERVAL, now=True)
+
+    def stop(self):
+        self._loop.stop()
+        self._sample()
+        return self.peak
+
+def lit_cap(name):
+    return uri.LiteralFileURI("contents of %s" % (name,)).to_string()
+
+@defer.inlineCallbacks
+def measure(name, encoding, size, operation):
+    """Run operation() (which returns a Deferred) REPEAT times, print a
+    summary and return a dict of the results."""
+    (k, happy, n) = encoding
+    durations = []
+    rss = PeakRSS()
+    rss.start()
+    try:
+        for i in range(REPEAT):
+            start = time.time()
+            yield operation()
+            durations.append(time.time() - start)
+    finally:
+        peak_rss = rss.stop()
+    result = {"benchmark": name,
+              "k": k, "happy": happy, "n": n,
+              "size": size,
+              "seconds": durations,
+              "best": min(durations),
+              "mean": sum(durations) / len(durations),
+              "peak_rss": peak_rss,
+              }
+    line = "%-18s %2d/%-2d %9s %9.3fs %9.3fs" % (name, k, n,
+                                                 size is None and "-" or size,
+                                                 result["best"],
+                                                 result["mean"])
+    if size is not None:
+        result["bytes_per_second"] = size / result["best"]
+        line += " %8.2fMB/s" % (result["bytes_per_second"] / 1e6)
+    else:
+        line += "            "
+    print(line + " %7.1fMiB" % (1.0 * peak_rss / MiB), file=sys.stderr)
+    defer.returnValue(result)
+
+@defer.inlineCallbacks
+def immutable_benchmarks(client, encoding, size):
+    caps = []
+    def _upload():
+        d = client.upload(ZeroUploadable(size))
+        d.addCallback(lambda results: caps.append(results.get_uri()))
+        return d
+    def _download():
+        node = client.create_node_from_uri(caps[-1])
+        return node.read(CountingConsumer())
+    results = []
+    results.append((yield measure("immutable-upload", encoding, size,
+                                  _upload)))
+    results.append((yield measure("immutable-download", encoding, size,
+                                  _download)))
+    defer.returnValue(results)
+
+@defer.inlineCallbacks
+def mutable_benchmarks(client, encoding, size, version, prefix):
+    node = yield client.create_mutable_file(version=version)
+    def _publish():
+        return node.overwrite(MutableData("\x00" * size))
+    def _retrieve():
+        fresh = client.create_node_from_uri(node.get_uri())
+        d = fresh.get_best_readable_version()
+        d.addCallback(lambda version: version.read(CountingConsumer()))
+        return d
+    results = []
+    results.append((yield measure(prefix + "-publish", encoding, size,
+                                  _publish)))
+    results.append((yield measure(prefix + "-retrieve", encoding, size,
+                                  _retrieve)))
+    defer.returnValue(results)
+
+@defer.inlineCallbacks
+def dirnode_benchmarks(client, encoding):
+    dirnode = yield client.create_dirnode(initial_children=dict(
+        [(u"file%d" % i,
+          (client.create_node_from_uri(lit_cap(i)), {}))
+         for i in range(DIR_ENTRIES)]))
+    added = []
+    def _modify():
+        cap = lit_cap("added%d" % len(added))
+        added.append(cap)
+        return dirnode.set_uri(u"added%d" % len(added), cap, cap)
+    def _list():
+        return client.create_node_from_uri(dirnode.get_uri()).list()
+
+    root = yield client.create_dirnode()
+    for i in range(DEEP_DIRS):
+        yield root.create_subdirectory(u"dir%d" % i, initial_children=dict(
+            [(u"file%d" % j,
+              (client.create_node_from_uri(lit_cap((i, j))), {}))
+             for j in range(DEEP_FILES)]))
+    def _deep_traverse():
+        fresh = client.create_node_from_uri(root.get_uri())
+        return fresh.start_deep_stats().when_done()
+
+    results = []
+    results.append((yield measure("dirnode-modify", encoding, None,
+                                  _modify)))
+    results.append((yield measure("dirnode-list", encoding, None, _list)))
+    results.append((yield measure("deep-traverse", encoding, None,
+                                  _deep_traverse)))
+    defer.returnValue(results)
+
+@defer.inlineCallbacks
+def run_benchmarks():
+    basedir = tempfile.mkdtemp(prefix="bench_grid")
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    parent = service.MultiService()
+    parent.startService()
+    results = []
+    try:
+        g = NoNetworkGrid(basedir, num_clients=1, num_servers=10,
+                          client_config_hooks={}, port_assigner=port_assigner)
+        g.setServiceParent(parent)
+        c = g.clients[0]
+        print("benchmark          k/n       size      best      mean"
+              "   throughput  peak RSS", file=sys.stderr)
+        for encoding in ENCODINGS:
+            (k, happy, n) = encoding
+            c.encoding_params["k"] = k
+            c.encoding_params["happy"] = happy
+            c.encoding_params["n"] = n
+            for size in FILE_SIZES:
+                results.extend((yield immutable_benchmarks(c, encoding,
+                                                           size)))
+                results.extend((yield mutable_benchmarks(c, encoding, size,
+                                                         SDMF_VERSION,
+                                                         "sdmf")))
+                results.extend((yield mutable_benchmarks(c, encoding, size,
+                                                         MDMF_VERSION,
+                                                         "mdmf")))
+            results.extend((yield dirnode_benchmarks(c, encoding)))
+    finally:
+        yield parent.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(basedir)
+    defer.returnValue({"version": allmydata.__full_version__,
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "time": time.time(),
+                       "repeat": REPEAT,
+                       "num_servers": 10,
+                       "results": results,
+                       })
+
+def write_results(results, filename):
+    if filename is None:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        with open(filename, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    filename = None
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    d = run_benchmarks()
+    d.addCallback(write_results, filename)
+    d.addErrback(lambda f: print(f, file=sys.stderr))
+    d.addBoth(lambda ign: reactor.stop())
+    reactor.run()
@@ -0,0 +1,91 @@
+"""
+Measure the CPU time of the passes that a convergent immutable upload makes
+over its plaintext, on a file of SIZE bytes (1GiB by default, or the number
+of MiB given on the command line):
+
+ * convergence key: FileHandle hashing the whole file to compute the
+   convergent encryption key
+ * hash-only: EncryptAnUploadable.read_encrypted(hash_only=True), which is
+   how a client catches up when a helper resumes an interrupted upload. This
+   used to encrypt the data and throw the ciphertext away, because AES-CTR
+   encryptors could not start in the middle of the key stream.
+ * hash+encrypt: read_encrypted(hash_only=False), the pass that produces
+   the ciphertext, and what a hash-only pass used to cost.
+
+The plaintext is all zeros and never touches the disk.
+
+Run with "python -m allmydata.test.bench_hash_only [MiB]".
+"""
+
+from __future__ import print_function
+
+import os, sys
+
+from twisted.internet import defer, reactor
+
+from allmydata.client import _Client
+from allmydata.immutable import upload
+
+MiB = 1024*1024
+READ_SIZE = 1*MiB
+
+class ZeroFile(object):
+    def __init__(self, size):
+        self.size = size
+        self.pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, length):
+        length = max(min(length, self.size - self.pos), 0)
+        self.pos += length
+        return "\x00" * length
+
+def cpu_time():
+    (user, system) = os.times()[:2]
+    return user + system
+
+@defer.inlineCallbacks
+def read_all(size, hash_only):
+    u = upload.FileHandle(ZeroFile(size), convergence="")
+    u.set_default_encoding_parameters(_Client.DEFAULT_ENCODING_PARAMETERS)
+    eu = upload.EncryptAnUploadable(u)
+    yield eu.get_storage_index() # computes the convergence key
+    start = cpu_time()
+    left = size
+    while left:
+        length = min(left, READ_SIZE)
+        yield eu.read_encrypted(length, hash_only=hash_only)
+        left -= length
+    defer.returnValue(cpu_time() - start)
+
+@defer.inlineCallbacks
+def run_benchmarks(size):
+    print("convergent upload of %d bytes, CPU seconds per pass" % size)
+    u = upload.FileHandle(ZeroFile(size), convergence="")
+    u.set_default_encoding_parameters(_Client.DEFAULT_ENCODING_PARAMETERS)
+    start = cpu_time()
+    yield u.get_encryption_key()
+    print("convergence key: %6.2fs" % (cpu_time() - start))
+    hash_only = yield read_all(size, hash_only=True)
+    print("hash-only:       %6.2fs" % hash_only)
+    hash_and_encrypt = yield read_all(size, hash_only=False)
+    print("hash+encrypt:    %6.2fs" % hash_and_encrypt)
+    print("skipping encryption saves %.0f%% of a hash-only pass"
+          % (100 * (1 - hash_only / hash_and_encrypt)))
+
+if __name__ == "__main__":
+    size = 1024*MiB
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1]) * MiB
+    d = run_benchmarks(size)
+    d.addErrback(lambda f: print(f))
+    d.addBoth(lambda ign: reactor.stop())
+    reactor.run()
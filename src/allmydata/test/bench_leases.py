@@ -0,0 +1,86 @@
+"""
+Compare lease-renewal throughput of a StorageServer that keeps its leases in
+the share files against one that keeps them in a LeaseDB.
+
+The share files used here are freshly written and therefore sit in the page
+cache, so this measures the CPU cost of each approach. On a real server the
+in-file variant additionally pays a random read and a random write for every
+share of the storage index, while the LeaseDB appends to a single WAL file.
+
+Run with "python -m allmydata.test.bench_leases".
+"""
+
+from __future__ import print_function
+
+import shutil, tempfile
+
+from pyutil import benchutil # http://tahoe-lafs.org/trac/pyutil
+
+from allmydata.util import hashutil
+from allmydata.storage.server import StorageServer
+
+SHARES_PER_SI = 10
+
+class FakeCanary(object):
+    def notifyOnDisconnect(self, f, *args, **kwargs):
+        return None
+    def dontNotifyOnDisconnect(self, marker):
+        pass
+
+class B(object):
+    def __init__(self, use_leasedb):
+        self.use_leasedb = use_leasedb
+        self.basedir = None
+        self.ss = None
+        self.sis = []
+
+    def _secrets(self, si):
+        return (hashutil.tagged_hash("renew", si),
+                hashutil.tagged_hash("cancel", si))
+
+    def init(self, N):
+        self.cleanup()
+        self.basedir = tempfile.mkdtemp(prefix="bench_leases")
+        self.ss = StorageServer(self.basedir, "\x00" * 20,
+                                use_leasedb=self.use_leasedb)
+        self.sis = [hashutil.tagged_hash("si", "%d" % i)[:16]
+                    for i in range(N)]
+        for si in self.sis:
+            (rs, cs) = self._secrets(si)
+            already, writers = self.ss.remote_allocate_buckets(
+                si, rs, cs, range(SHARES_PER_SI), 1000, FakeCanary())
+            for bw in writers.values():
+                bw.remote_write(0, "a" * 1000)
+                bw.remote_close()
+        # renew each share once, so the leasedb variant has migrated
+        # everything before we start measuring
+        self.renew(N)
+
+    def renew(self, N):
+        for si in self.sis:
+            (rs, cs) = self._secrets(si)
+            self.ss.remote_renew_lease(si, rs)
+
+    def cleanup(self):
+        if self.ss is not None and self.ss.leasedb is not None:
+            self.ss.leasedb.close()
+        if self.basedir is not None:
+            shutil.rmtree(self.basedir)
+        self.ss = None
+        self.basedir = None
+
+    def run_benchmarks(self):
+        print("renewing leases on %d shares per storage index, leasedb=%s"
+              % (SHARES_PER_SI, self.use_leasedb))
+        for N in 10, 100, 1000:
+            print("%5d" % N, end=' ')
+            benchutil.rep_bench(self.renew, N, initfunc=self.init,
+                                runreps=10, UNITS_PER_SECOND=1000)
+        benchutil.print_bench_footer(UNITS_PER_SECOND=1000)
+        print("(milliseconds per storage index)")
+        self.cleanup()
+
+if __name__ == "__main__":
+    for use_leasedb in (False, True):
+        B(use_leasedb).run_benchmarks()
+        print()
@@ -0,0 +1,112 @@
+"""
+Measure random-key immutable uploads with different segment sizes, on a
+no-network grid of 10 servers with 3-of-10 encoding.
+
+For files of 1MiB, 16MiB and 128MiB, each of the fixed segment sizes in
+SEGMENT_SIZES that is smaller than the file is tried, then a single
+segment, and then the size that upload.adaptive_segment_size() picks (with
+no link measurements, since there is no network). For each one this prints
+the number of segments, the upload time, and how many bytes the servers
+stored per byte of file (10/3 = 3.33 would be no overhead at all: the rest
+is hashes, headers and padding).
+
+Run with "python -m allmydata.test.bench_segment_size".
+"""
+
+from __future__ import print_function
+
+import os, shutil, tempfile, time
+
+from twisted.application import service
+from twisted.internet import defer, reactor
+
+from allmydata.immutable import upload
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+from allmydata.util import mathutil
+
+KiB = 1024
+MiB = 1024*KiB
+FILE_SIZES = [1*MiB, 16*MiB, 128*MiB]
+SEGMENT_SIZES = [32*KiB, 128*KiB, 512*KiB, 1*MiB, 4*MiB]
+
+class ZeroUploadable(upload.Data):
+    # the random key keeps zeros from compressing or converging
+    def __init__(self, size):
+        upload.Data.__init__(self, "", convergence=None)
+        self._size = size
+        self._pos = 0
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def read(self, length):
+        length = min(length, self._size - self._pos)
+        self._pos += length
+        return defer.succeed(["\x00" * length])
+
+def stored_bytes(grid):
+    total = 0
+    for server in grid.servers_by_number.values():
+        for (dirpath, dirnames, filenames) in os.walk(server.sharedir):
+            for name in filenames:
+                total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+def clear_shares(grid):
+    for server in grid.servers_by_number.values():
+        shutil.rmtree(server.sharedir)
+        os.mkdir(server.sharedir)
+
+@defer.inlineCallbacks
+def time_upload(grid, client, file_size, segment_size):
+    client.encoding_params["max_segment_size"] = segment_size
+    start = time.time()
+    yield client.upload(ZeroUploadable(file_size))
+    elapsed = time.time() - start
+    overhead = 1.0 * stored_bytes(grid) / file_size
+    clear_shares(grid)
+    defer.returnValue((elapsed, overhead))
+
+@defer.inlineCallbacks
+def run_benchmarks():
+    basedir = tempfile.mkdtemp(prefix="bench_segment_size")
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    parent = service.MultiService()
+    parent.startService()
+    try:
+        g = NoNetworkGrid(basedir, num_clients=1, num_servers=10,
+                          client_config_hooks={}, port_assigner=port_assigner)
+        g.setServiceParent(parent)
+        c = g.clients[0]
+        c.encoding_params["k"] = 3
+        c.encoding_params["happy"] = 7
+        c.encoding_params["n"] = 10
+        print("random-key uploads, 3-of-10")
+        print("file size  segment size  segments     time  stored/size")
+        for file_size in FILE_SIZES:
+            runs = [("%dK" % (segment_size // KiB), segment_size)
+                    for segment_size in SEGMENT_SIZES
+                    if segment_size < file_size]
+            runs.append(("%dK" % (file_size // KiB), file_size))
+            adaptive = upload.adaptive_segment_size(file_size, 3, 128*KiB)
+            runs.append(("%d (adaptive)" % adaptive, adaptive))
+            for (label, segment_size) in runs:
+                segment_size = mathutil.next_multiple(segment_size, 3)
+                (elapsed, overhead) = yield time_upload(g, c, file_size,
+                                                        segment_size)
+                print("%8dK  %-18s %7d %7.2fs %10.4f"
+                      % (file_size // KiB, label,
+                         mathutil.div_ceil(file_size, segment_size),
+                         elapsed, overhead))
+    finally:
+        yield parent.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+    d = run_benchmarks()
+    d.addErrback(lambda f: print(f))
+    d.addBoth(lambda ign: reactor.stop())
+    reactor.run()
@@ -0,0 +1,112 @@
+"""
+Measure immutable-upload server selection on synthetic grids of 10, 100 and
+1000 servers.
+
+ * placement: happiness_upload.share_placement() for N shares (half as many
+   as there are servers, at most 256) over all of the servers, a quarter of
+   which already hold one share and a tenth of which are read-only. This
+   is run with the Hopcroft-Karp matching that share_placement() now uses,
+   and with the Edmonds-Karp max-flow it used before, which rebuilt the
+   whole residual network after every edge (that one is skipped for 1000
+   servers, where it takes hours).
+ * happiness: servers_of_happiness() of the placement that was found.
+ * selection: the whole of Tahoe2ServerSelector.get_shareholders(), timed
+   by a 3-of-10 upload to fake storage servers that answer every query on
+   the next reactor turn (the upload's "peer_selection" timing).
+
+Run with "python -m allmydata.test.bench_server_selection".
+"""
+
+from __future__ import print_function
+
+import random, time
+
+from twisted.internet import defer, reactor
+
+from allmydata.immutable import happiness_upload, upload
+from allmydata.util.happinessutil import servers_of_happiness
+from allmydata.test.test_upload import FakeClient, DATA
+
+def edmonds_karp_mappings(graph, shareIndices):
+    # what happiness_upload._compute_maximum_graph used to do
+    if graph == []:
+        return {}
+    dim = len(graph)
+    flow_function = [[0 for sh in xrange(dim)] for s in xrange(dim)]
+    residual_graph, residual_function = happiness_upload.residual_network(
+        graph, flow_function)
+    while happiness_upload.augmenting_path_for(residual_graph):
+        path = happiness_upload.augmenting_path_for(residual_graph)
+        delta = min(residual_function[u][v] for (u, v) in path)
+        for (u, v) in path:
+            flow_function[u][v] += delta
+            flow_function[v][u] -= delta
+            residual_graph, residual_function = happiness_upload.residual_network(
+                graph, flow_function)
+    new_mappings = {}
+    for shareIndex in shareIndices:
+        peer = residual_graph[shareIndex]
+        if peer == [dim - 1]:
+            new_mappings.setdefault(shareIndex, None)
+        else:
+            new_mappings.setdefault(shareIndex, peer[0])
+    return new_mappings
+
+def make_grid(num_servers):
+    rand = random.Random(num_servers)
+    peers = ["server%04d" % i for i in range(num_servers)]
+    shares = ["share%03d" % i for i in range(min(num_servers // 2, 256))]
+    readonly_peers = set(rand.sample(peers, num_servers // 10))
+    peers_to_shares = {}
+    for peer in rand.sample(peers, num_servers // 4):
+        peers_to_shares[peer] = set([rand.choice(shares)])
+    return (set(peers), readonly_peers, set(shares), peers_to_shares)
+
+def time_placement(grid, maximum_graph):
+    original = happiness_upload._compute_maximum_graph
+    happiness_upload._compute_maximum_graph = maximum_graph
+    try:
+        start = time.time()
+        places = happiness_upload.share_placement(*grid)
+        return (time.time() - start, places)
+    finally:
+        happiness_upload._compute_maximum_graph = original
+
+@defer.inlineCallbacks
+def time_selection(num_servers):
+    node = FakeClient(mode="good", num_servers=num_servers)
+    node.encoding_params = {"k": 3, "happy": 7, "n": 10,
+                            "max_segment_size": 128*1024}
+    u = upload.Uploader()
+    u.running = True
+    u.parent = node
+    results = yield u.upload(upload.Data(DATA, convergence=None))
+    defer.returnValue(results.get_timings()["peer_selection"])
+
+@defer.inlineCallbacks
+def run_benchmarks():
+    print("servers shares  placement  (old)   happiness  selection")
+    for num_servers in 10, 100, 1000:
+        grid = make_grid(num_servers)
+        (elapsed, places) = time_placement(
+            grid, happiness_upload._compute_maximum_graph)
+        if num_servers <= 100:
+            (old_elapsed, ign) = time_placement(grid, edmonds_karp_mappings)
+            old = "%7.3fs" % old_elapsed
+        else:
+            old = "      -"
+        sharemap = dict([(share, set([peer]))
+                         for (share, peer) in places.items()])
+        start = time.time()
+        servers_of_happiness(sharemap)
+        happiness = time.time() - start
+        selection = yield time_selection(num_servers)
+        print("%7d %6d %9.3fs %s %9.3fs %9.3fs"
+              % (num_servers, len(grid[2]), elapsed, old, happiness,
+                 selection))
+
+if __name__ == "__main__":
+    d = run_benchmarks()
+    d.addErrback(lambda f: print(f))
+    d.addBoth(lambda ign: reactor.stop())
+    reactor.run()
@@ -0,0 +1,115 @@
+"""
+Measure what immutable uploads do to the rest of a node, with the hashing,
+encryption and erasure coding done in the reactor thread (upload.threads=0,
+the default) or in a pool of upload threads.
+
+1, 4 and 16 uploads of SIZE bytes each are started at the same time, with
+3-of-10 encoding. The shareholders throw the blocks away, so there is no
+network or disk involved, only CPU. For each run this prints:
+
+ * MB/s: the total number of bytes uploaded per second of wall-clock time
+ * lag: how late a timer that is meant to fire every 10ms actually fires
+   (median and maximum, in milliseconds). This is about how long a web or
+   SFTP request that arrives during the uploads has to wait for the reactor.
+
+Run with "python -m allmydata.test.bench_upload_threads".
+"""
+
+from __future__ import print_function
+
+import os, time
+
+from zope.interface import implementer
+from twisted.internet import defer, reactor, task
+from twisted.python.threadpool import ThreadPool
+
+from allmydata.immutable import encode, upload
+from allmydata.interfaces import IStorageBucketWriter
+
+SIZE = 4*1000*1000
+INTERVAL = 0.01
+
+@implementer(IStorageBucketWriter)
+class DiscardingBucketWriter(object):
+    def __init__(self, peerid):
+        self.peerid = peerid
+
+    def get_peerid(self):
+        return self.peerid
+
+    def _ok(self, *args):
+        return defer.succeed(None)
+
+    put_header = put_block = put_crypttext_hashes = _ok
+    put_block_hashes = put_share_hashes = put_uri_extension = close = _ok
+
+    def abort(self):
+        pass
+
+def upload_one(data, threadpool):
+    u = upload.Data(data, convergence=None)
+    u.set_default_encoding_parameters({"k": 3, "happy": 7, "n": 10,
+                                       "max_segment_size": 128*1024})
+    eu = upload.EncryptAnUploadable(u, threadpool=threadpool)
+    e = encode.Encoder(threadpool=threadpool)
+    d = e.set_encrypted_uploadable(eu)
+    def _start(ign):
+        shareholders = {}
+        servermap = {}
+        for shnum in range(10):
+            shareholders[shnum] = DiscardingBucketWriter("peer%d" % shnum)
+            servermap[shnum] = set(["peer%d" % shnum])
+        e.set_shareholders(shareholders, servermap)
+        return e.start()
+    d.addCallback(_start)
+    return d
+
+class LagMeter(object):
+    def __init__(self):
+        self.lags = []
+        self.last = None
+        self.loop = task.LoopingCall(self.tick)
+
+    def tick(self):
+        now = time.time()
+        if self.last is not None:
+            self.lags.append(max(now - self.last - INTERVAL, 0.0))
+        self.last = now
+
+    def start(self):
+        self.loop.start(INTERVAL)
+
+    def stop(self):
+        self.loop.stop()
+        lags = sorted(self.lags) or [0.0]
+        return (lags[len(lags) // 2], lags[-1])
+
+@defer.inlineCallbacks
+def run_benchmarks():
+    data = os.urandom(SIZE)
+    print("%d-byte uploads, 3-of-10" % SIZE)
+    print("threads uploads    MB/s  lag median   lag max")
+    for threads in 0, 4:
+        threadpool = None
+        if threads:
+            threadpool = ThreadPool(0, threads, name="bench_upload_threads")
+            threadpool.start()
+        for uploads in 1, 4, 16:
+            meter = LagMeter()
+            meter.start()
+            start = time.time()
+            yield defer.gatherResults([upload_one(data, threadpool)
+                                       for i in range(uploads)])
+            elapsed = time.time() - start
+            (median, worst) = meter.stop()
+            print("%7d %7d %7.1f %9.1fms %7.1fms"
+                  % (threads, uploads, uploads * SIZE / elapsed / 1e6,
+                     median * 1000, worst * 1000))
+        if threadpool:
+            threadpool.stop()
+
+if __name__ == "__main__":
+    d = run_benchmarks()
+    d.addErrback(lambda f: print(f))
+    d.addBoth(lambda ign: reactor.stop())
+    reactor.run()
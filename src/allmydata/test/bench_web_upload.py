@@ -0,0 +1,134 @@
+"""
+Measure how long a large PUT /uri takes to reach the storage servers, on a
+no-network grid of 10 servers (3-of-10 encoding) with a real web-API
+server. Three kinds of request are compared:
+
+ * convergent: the default. The body is spooled to a temporary file, then
+   read once to compute the convergent key and again to encrypt it.
+ * random-key, chunked: random-key=true without a Content-Length, so the
+   body is still spooled to a temporary file before the upload starts.
+ * random-key, streamed: random-key=true with a Content-Length. The upload
+   starts when the headers arrive, and the body is encoded as it comes in.
+
+For each one this prints the time until the first block was written to a
+storage server, and the time until the response arrived. The body is SIZE
+bytes of zeros (64MiB by default, or the number of MiB given on the command
+line), produced as fast as the web server will take it.
+
+Run with "python -m allmydata.test.bench_web_upload [MiB]".
+"""
+
+from __future__ import print_function
+
+import os, shutil, sys, tempfile, time
+
+from twisted.application import service
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from allmydata.storage.immutable import BucketWriter
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+
+MiB = 1024*1024
+
+class ZeroFile(object):
+    def __init__(self, size):
+        self.size = size
+        self.pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, length):
+        length = max(min(length, self.size - self.pos), 0)
+        self.pos += length
+        return "\x00" * length
+
+    def close(self):
+        pass
+
+class ChunkedBodyProducer(FileBodyProducer):
+    def _determineLength(self, fObj):
+        return UNKNOWN_LENGTH
+
+class FirstWrite(object):
+    """I remember when a share block was first written."""
+    def __init__(self):
+        self.when = None
+        self._original = BucketWriter.remote_write
+
+    def install(self):
+        original = self._original
+        def remote_write(bw, offset, data):
+            if self.when is None:
+                self.when = time.time()
+            return original(bw, offset, data)
+        BucketWriter.remote_write = remote_write
+
+    def uninstall(self):
+        BucketWriter.remote_write = self._original
+
+@defer.inlineCallbacks
+def put(url, size, query, chunked):
+    producer_class = chunked and ChunkedBodyProducer or FileBodyProducer
+    body = producer_class(ZeroFile(size), readSize=64*1024)
+    first = FirstWrite()
+    first.install()
+    try:
+        start = time.time()
+        response = yield Agent(reactor).request("PUT", url + "uri" + query,
+                                                Headers(), body)
+        yield readBody(response)
+        done = time.time()
+    finally:
+        first.uninstall()
+    assert response.code == 200, response.code
+    defer.returnValue((first.when - start, done - start))
+
+@defer.inlineCallbacks
+def run_benchmarks(size):
+    basedir = tempfile.mkdtemp(prefix="bench_web_upload")
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    parent = service.MultiService()
+    parent.startService()
+    try:
+        g = NoNetworkGrid(basedir, num_clients=1, num_servers=10,
+                          client_config_hooks={}, port_assigner=port_assigner)
+        g.setServiceParent(parent)
+        c = g.clients[0]
+        c.encoding_params["k"] = 3
+        c.encoding_params["happy"] = 7
+        c.encoding_params["n"] = 10
+        url = c.getServiceNamed("webish").getURL()
+        print("PUT of %d bytes, 3-of-10" % size)
+        print("                      first block   response")
+        for (name, query, chunked) in [("convergent", "", False),
+                                       ("random-key, chunked",
+                                        "?random-key=true", True),
+                                       ("random-key, streamed",
+                                        "?random-key=true", False)]:
+            (first, total) = yield put(url, size, query, chunked)
+            print("%-20s %11.2fs %9.2fs" % (name, first, total))
+    finally:
+        yield parent.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+    size = 64*MiB
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1]) * MiB
+    d = run_benchmarks(size)
+    d.addErrback(lambda f: print(f))
+    d.addBoth(lambda ign: reactor.stop())
+    reactor.run()
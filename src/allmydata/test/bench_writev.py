@@ -0,0 +1,121 @@
+"""
+Measure slot_testv_and_readv_and_writev on a mutable share that is updated
+with many small writes, the way a busy MDMF directory is.
+
+Each update tests and reads the 41-byte checkstring, overwrites WRITES
+scattered 100-byte blocks and appends APPEND bytes, so the share keeps
+growing. Two variants are compared:
+
+ * open-once: StorageServer.remote_slot_testv_and_readv_and_writev, which
+   opens each share file once per call and grows the container by
+   MutableShareFile.CONTAINER_GROWTH at a time
+ * per-method: the steps the server used to take, where each of
+   check_write_enabler, check_testv, readv, writev and add_or_renew_lease
+   opens the share file on its own and every stat() goes through the path,
+   with the container grown to exactly the size needed (moving the extra
+   leases on every append)
+
+The share file sits in the page cache, so this mostly measures syscalls.
+
+Run with "python -m allmydata.test.bench_writev".
+"""
+
+from __future__ import print_function
+
+import os, shutil, tempfile, time
+
+from pyutil import benchutil # http://tahoe-lafs.org/trac/pyutil
+
+from allmydata.util import hashutil
+from allmydata.storage.server import StorageServer
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.lease import LeaseInfo
+
+SHARE_SIZE = 100000
+WRITES = 20
+APPEND = 200
+
+class B(object):
+    def __init__(self, open_once):
+        self.open_once = open_once
+        self.basedir = None
+        self.ss = None
+        self.si = hashutil.tagged_hash("si", "bench")[:16]
+        self.secrets = (hashutil.tagged_hash("we", "bench"),
+                        hashutil.tagged_hash("renew", "bench"),
+                        hashutil.tagged_hash("cancel", "bench"))
+        self.length = 0
+
+    def init(self, N):
+        self.cleanup()
+        self.basedir = tempfile.mkdtemp(prefix="bench_writev")
+        self.ss = StorageServer(self.basedir, "\x00" * 20)
+        self.ss.remote_slot_testv_and_readv_and_writev(
+            self.si, self.secrets,
+            {0: ([], [(0, "a" * SHARE_SIZE)], None)}, [])
+        self.length = SHARE_SIZE
+        [(shnum, self.filename)] = self.ss._get_bucket_shares(self.si)
+
+    def _vectors(self):
+        checkstring = "b" * 41
+        step = self.length // WRITES
+        datav = [(0, checkstring)]
+        datav += [(i * step + 100, "c" * 100) for i in range(WRITES)]
+        datav.append((self.length, "d" * APPEND))
+        self.length += APPEND
+        testv = [(0, 41, "ne", "x")]
+        readv = [(0, 41)]
+        return (testv, datav, readv)
+
+    def update(self, N):
+        for i in range(N):
+            (testv, datav, readv) = self._vectors()
+            if self.open_once:
+                self.ss.remote_slot_testv_and_readv_and_writev(
+                    self.si, self.secrets, {0: (testv, datav, None)}, readv)
+            else:
+                self.update_per_method(testv, datav, readv)
+
+    def update_per_method(self, testv, datav, readv):
+        (write_enabler, renew_secret, cancel_secret) = self.secrets
+        msf = MutableShareFile(self.filename, self.ss)
+        msf.check_write_enabler(write_enabler, "si")
+        assert msf.check_testv(testv)
+        msf.readv(readv)
+        os.stat(self.filename)
+        for vector in datav:
+            # one vector at a time, so the container is enlarged by each
+            # append, like _write_share_data() used to do
+            msf.writev([vector], None)
+        os.stat(self.filename)
+        msf.add_or_renew_lease(LeaseInfo(1, renew_secret, cancel_secret,
+                                         time.time() + 31*24*60*60,
+                                         "\x00" * 20))
+
+    def cleanup(self):
+        if self.basedir is not None:
+            shutil.rmtree(self.basedir)
+        self.ss = None
+        self.basedir = None
+
+    def run_benchmarks(self):
+        growth = MutableShareFile.CONTAINER_GROWTH
+        if not self.open_once:
+            MutableShareFile.CONTAINER_GROWTH = 1.0
+        try:
+            print("%s: %d small writes and an append per update"
+                  % (self.open_once and "open-once" or "per-method", WRITES))
+            for N in 10, 100, 1000:
+                print("%5d" % N, end=' ')
+                benchutil.rep_bench(self.update, N, initfunc=self.init,
+                                    runreps=5, UNITS_PER_SECOND=1000000)
+            benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+            print("(microseconds per update)")
+            print()
+        finally:
+            MutableShareFile.CONTAINER_GROWTH = growth
+            self.cleanup()
+
+if __name__ == "__main__":
+    B(open_once=False).run_benchmarks()
+    B(open_once=True).run_benchmarks()
@@ -530,6 +530,11 @@ class FakeMutableFileNode(object):
     def get_best_mutable_version(self):
         return defer.succeed(self)
 
+    def get_root_hash(self):
+        # the real one changes whenever the contents do
+        return hashutil.tagged_hash("fake root hash",
+                                    self._download_best_version())
+
     # Ditto for this, which is an implementation of IWriteable.
     # XXX: Declare that the same is implemented.
     def update(self, data, offset):
@@ -33,6 +33,7 @@ from allmydata.util.hashutil import permute_server_hash
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.interfaces import IStorageBroker, IServer
 from allmydata.storage_client import (
+    LinkEstimate,
     _StorageServer,
 )
 from .common import (
@@ -116,6 +117,10 @@ class LocalWrapper(object):
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "get_buckets_batch":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        buckets[shnum] = LocalWrapper(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -143,6 +148,7 @@ class NoNetworkServer(object):
     def __init__(self, serverid, rref):
         self.serverid = serverid
         self.rref = rref
+        self.link_estimate = LinkEstimate()
     def __repr__(self):
         return "<NoNetworkServer for %s>" % self.get_name()
     # Special method used by copy.copy() and copy.deepcopy(). When those are
@@ -175,6 +181,8 @@ class NoNetworkServer(object):
         return _StorageServer(lambda: self.rref)
     def get_version(self):
         return self.rref.version
+    def get_link_estimate(self):
+        return self.link_estimate
 
 @implementer(IStorageBroker)
 class NoNetworkStorageBroker(object):
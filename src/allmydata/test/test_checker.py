@@ -3,6 +3,8 @@ import json
 import os.path, shutil
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.python.failure import Failure
+from foolscap.api import DeadReferenceError
 from allmydata import check_results, uri
 from allmydata import uri as tahoe_uri
 from allmydata.util import base32
@@ -10,6 +12,7 @@ from allmydata.web import check_results as web_check_results
 from allmydata.storage_client import StorageFarmBroker, NativeStorageServer
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.monitor import Monitor
+from allmydata.immutable import checker
 from allmydata.test.no_network import GridTestMixin
 from allmydata.immutable.upload import Data
 from allmydata.test.common_web import WebRenderingMixin
@@ -309,6 +312,56 @@ class WebResultsRendering(unittest.TestCase, WebRenderingMixin):
         d.addCallback(_got_lit_results)
         return d
 
+class FakeBatchServer(object):
+    def __init__(self, serverid):
+        self.serverid = serverid
+        self.queries = [] # (batch, Deferred)
+    def get_storage_server(self):
+        return self
+    def get_version(self):
+        return {"http://allmydata.org/tahoe/protocols/storage/v1":
+                {"get-buckets-batch": True}}
+    def get_serverid(self):
+        return self.serverid
+    def get_name(self):
+        return self.serverid
+    def get_buckets_batch(self, storage_indexes):
+        d = defer.Deferred()
+        self.queries.append((storage_indexes, d))
+        return d
+
+class PrefetchBuckets(unittest.TestCase):
+    def test_one_batch_at_a_time(self):
+        self.patch(checker, "MAX_BUCKETS_BATCH", 2)
+        a = FakeBatchServer("a")
+        b = FakeBatchServer("b")
+        sis = ["si%d" % i for i in range(5)]
+        d = checker.prefetch_buckets([a, b], sis)
+        fired = []
+        d.addCallback(fired.append)
+        self.failUnlessEqual([batch for (batch, ign) in a.queries],
+                             [["si0", "si1"]])
+        self.failUnlessEqual(len(b.queries), 1)
+        a.queries[0][1].callback({"si0": {0: "bucket"}})
+        self.failUnlessEqual([batch for (batch, ign) in a.queries],
+                             [["si0", "si1"], ["si2", "si3"]])
+        self.failUnlessEqual(len(b.queries), 1)
+        # a failed batch is logged, and the next one is still sent
+        b.queries[0][1].errback(Failure(DeadReferenceError("gone")))
+        self.failUnlessEqual(len(b.queries), 2)
+        a.queries[1][1].callback({})
+        b.queries[1][1].callback({})
+        a.queries[2][1].callback({"si4": {1: "bucket"}})
+        self.failIf(fired)
+        self.failUnlessEqual([batch for (batch, ign) in b.queries][2],
+                             ["si4"])
+        b.queries[2][1].callback({})
+        results = fired[0]
+        self.failUnlessEqual(results["si0"], {"a": {0: "bucket"}})
+        self.failUnlessEqual(results["si1"], {"a": {}})
+        self.failUnlessEqual(results["si2"], {"a": {}, "b": {}})
+        self.failUnlessEqual(results["si4"], {"a": {1: "bucket"}, "b": {}})
+
 class BalancingAct(GridTestMixin, unittest.TestCase):
     # test for #1115 regarding the 'count-good-share-hosts' metric
 
@@ -299,6 +299,193 @@ class Basic(testutil.ReallyEqualMixin, testutil.NonASCIIPathMixin, unittest.Test
         with self.assertRaises(ValueError):
             yield client.create_client(basedir)
 
+    @defer.inlineCallbacks
+    def test_write_options(self):
+        """
+        buffered_writes, fsync and incoming_grace_period options are
+        propagated
+        """
+        basedir = "client.Basic.test_write_options"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "buffered_writes = true\n" + \
+                           "fsync = group\n" + \
+                           "incoming_grace_period = 600\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.buffered_writes, True)
+        self.failUnlessEqual(ss.fsync, "group")
+        self.failUnlessEqual(ss.incoming_grace_period, 600)
+
+    @defer.inlineCallbacks
+    def test_packed_backend(self):
+        """
+        backend=packed selects the packed backend, and turns on the leasedb
+        """
+        basedir = "client.Basic.test_packed_backend"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "backend = packed\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.backend.name, "packed")
+        self.failUnless(ss.leasedb)
+
+    @defer.inlineCallbacks
+    def test_threaded_lease_checker(self):
+        """
+        expire.threads and expire.io_rate configure the lease checker
+        """
+        basedir = "client.Basic.test_threaded_lease_checker"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "expire.threads = 8\n" + \
+                           "expire.io_rate = 500\n")
+        c = yield client.create_client(basedir)
+        lc = c.getServiceNamed("storage").lease_checker
+        self.failUnlessEqual(lc.threads, 8)
+        self.failUnlessEqual(lc.allowed_io_rate, 500)
+
+    @defer.inlineCallbacks
+    def test_upload_pipeline(self):
+        """
+        upload.segments_in_flight, upload.pipeline_memory, upload.threads,
+        upload.query_servers, upload.query_timeout and
+        upload.adaptive_segment_size configure the uploader
+        """
+        basedir = "client.Basic.test_upload_pipeline"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.segments_in_flight = 5\n" + \
+                           "upload.pipeline_memory = 1MiB\n" + \
+                           "upload.threads = 4\n" + \
+                           "upload.query_servers = 12\n" + \
+                           "upload.query_timeout = 2.5\n" + \
+                           "upload.adaptive_segment_size = true\n")
+        c = yield client.create_client(basedir)
+        uploader = c.getServiceNamed("uploader")
+        self.failUnlessEqual(uploader._segments_in_flight, 5)
+        self.failUnlessEqual(uploader._pipeline_memory, 1024*1024)
+        self.failUnlessEqual(uploader._threads, 4)
+        self.failUnlessEqual(uploader._query_servers, 12)
+        self.failUnlessEqual(uploader._query_timeout, 2.5)
+        self.failUnlessEqual(uploader._adaptive_segment_size, True)
+        self.failUnlessEqual(uploader._upload_cache, None)
+        self.failUnlessEqual(uploader._resume_db, None)
+
+    @defer.inlineCallbacks
+    def test_upload_resumable(self):
+        """
+        upload.resumable gives the uploader a record of unfinished uploads
+        in the private directory
+        """
+        basedir = "client.Basic.test_upload_resumable"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.resumable = true\n")
+        c = yield client.create_client(basedir)
+        db = c.getServiceNamed("uploader")._resume_db
+        self.addCleanup(db.close)
+        self.failUnlessEqual(db.get_entries(), 0)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "upload-resume.sqlite")))
+
+    @defer.inlineCallbacks
+    def test_upload_dedup_cache(self):
+        """
+        upload.dedup_cache gives the uploader a cache in the private
+        directory, and its statistics are reported
+        """
+        basedir = "client.Basic.test_upload_dedup_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "upload.dedup_cache = true\n" + \
+                           "upload.dedup_cache.max_entries = 50\n" + \
+                           "upload.dedup_cache.ttl = 2 days\n")
+        c = yield client.create_client(basedir)
+        cache = c.getServiceNamed("uploader")._upload_cache
+        self.addCleanup(cache.close)
+        self.failUnlessEqual(cache.max_entries, 50)
+        self.failUnlessEqual(cache.ttl, 2*24*60*60)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "upload-cache.sqlite")))
+        stats = c.stats_provider.get_stats()["stats"]
+        self.failUnlessEqual(stats["uploader.dedup_cache.entries"], 0)
+
+    @defer.inlineCallbacks
+    def test_download_segment_cache(self):
+        """
+        download.segment_cache_size gives immutable downloads a shared
+        segment cache, and its statistics are reported
+        """
+        basedir = "client.Basic.test_download_segment_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "download.segment_cache_size = 2MiB\n")
+        c = yield client.create_client(basedir)
+        self.failUnlessEqual(c.segment_cache.max_size, 2*1024*1024)
+        self.failUnlessIdentical(c.nodemaker.segment_cache, c.segment_cache)
+        stats = c.stats_provider.get_stats()["stats"]
+        self.failUnlessEqual(stats["downloader.segment_cache.hits"], 0)
+
+    @defer.inlineCallbacks
+    def test_download_segment_cache_disabled(self):
+        basedir = "client.Basic.test_download_segment_cache_disabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.failUnlessEqual(c.segment_cache, None)
+        self.failUnlessEqual(c.nodemaker.segment_cache, None)
+
+    @defer.inlineCallbacks
+    def test_download_metadata_cache(self):
+        """
+        download.metadata_cache gives immutable downloads a cache in the
+        private directory, and its statistics are reported
+        """
+        basedir = "client.Basic.test_download_metadata_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "download.metadata_cache = true\n" + \
+                           "download.metadata_cache.max_entries = 50\n")
+        c = yield client.create_client(basedir)
+        cache = c.nodemaker.metadata_cache
+        self.addCleanup(cache.close)
+        self.failUnlessEqual(cache.max_entries, 50)
+        self.failUnless(os.path.exists(os.path.join(basedir, "private",
+                                                    "download-cache.sqlite")))
+        stats = c.stats_provider.get_stats()["stats"]
+        self.failUnlessEqual(stats["downloader.metadata_cache.entries"], 0)
+
+    @defer.inlineCallbacks
+    def test_fsync_bad(self):
+        """
+        fsync option produces errors on unknown policies
+        """
+        basedir = "client.Basic.test_fsync_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "fsync = sometimes\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
     @defer.inlineCallbacks
     def test_web_apiauthtoken(self):
         """
@@ -881,6 +1068,27 @@ class Run(unittest.TestCase, testutil.StallMixin):
         c2.setServiceParent(self.sparent)
         yield c2.disownServiceParent()
 
+    @defer.inlineCallbacks
+    def test_download_metadata_cache_closed(self):
+        # the download metadata cache is closed when the client stops
+        basedir = "test_client.Run.test_download_metadata_cache_closed"
+        os.mkdir(basedir)
+        dummy = "pb://wl74cyahejagspqgy4x5ukrvfnevlknt@127.0.0.1:58889/bogus"
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG_I % dummy +
+                       "download.metadata_cache = true\n")
+        c = yield client.create_client(basedir)
+        cache = c.nodemaker.metadata_cache
+        closed = []
+        real_close = cache.close
+        def close():
+            closed.append(True)
+            real_close()
+        cache.close = close
+        c.setServiceParent(self.sparent)
+        yield c.disownServiceParent()
+        self.failUnlessEqual(closed, [True])
+
 class NodeMaker(testutil.ReallyEqualMixin, unittest.TestCase):
 
     @defer.inlineCallbacks
@@ -1,6 +1,6 @@
 from __future__ import print_function
 
-import time
+import time, threading
 import os.path
 from twisted.trial import unittest
 from twisted.application import service
@@ -83,6 +83,29 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class ThreadedCrawler(ShareCrawler):
+    slow_start = 0
+    threads = 4
+    allowed_io_rate = None
+    threaded_batch_size = 3
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.all_buckets = []
+        self.reader_threads = set()
+        self.sleep_times = []
+        self.finished_d = defer.Deferred()
+    def read_bucket(self, prefix, prefixdir, storage_index_b32):
+        self.reader_threads.add(threading.current_thread())
+        return os.listdir(os.path.join(prefixdir, storage_index_b32))
+    def process_bucket_data(self, cycle, prefix, prefixdir, storage_index_b32,
+                            data):
+        self.all_buckets.append((storage_index_b32, data))
+    def yielding(self, sleep_time):
+        if not self.sleeping_between_cycles:
+            self.sleep_times.append(sleep_time)
+    def finished_cycle(self, cycle):
+        eventually(self.finished_d.callback, None)
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -329,6 +352,69 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+    def test_threaded(self):
+        self.basedir = "crawler/Basic/threaded"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        # put several buckets in the same prefixdir, so it takes more than
+        # one batch
+        sis = [self.write(i, ss, serverid, tail=i) for i in range(8)]
+        sis += [self.write(i, ss, serverid) for i in range(8, 10)]
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadedCrawler(ss, statefile, allowed_io_rate=1000)
+        self.failUnlessEqual(c.allowed_io_rate, 1000)
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            # every bucket was read in a worker thread, and processed in
+            # order
+            self.failUnlessEqual(c.all_buckets,
+                                 [(si, ["0"]) for si in sorted(sis)])
+            self.failIfIn(threading.current_thread(), c.reader_threads)
+            self.failUnless(len(c.reader_threads) <= 4, c.reader_threads)
+            # it slept between batches to keep to allowed_io_rate
+            self.failUnless(c.sleep_times)
+            for sleep_time in c.sleep_times:
+                self.failUnless(0.0 <= sleep_time <= 0.003, sleep_time)
+            self.failUnless(c.timer)
+            self.failUnless(c.sleeping_between_cycles)
+            self.failUnlessEqual(c.current_sleep_time, c.minimum_cycle_time)
+            s = c.get_state()
+            self.failUnlessEqual(s["last-cycle-finished"], 0)
+            self.failUnlessEqual(s["last-complete-bucket"], None)
+        d.addCallback(_check)
+        d.addCallback(lambda ign: c.disownServiceParent())
+        def _stopped(ign):
+            self.failIf(c.threadpool)
+        d.addCallback(_stopped)
+        return d
+
+    def test_progress_in_prefix(self):
+        self.basedir = "crawler/Basic/progress_in_prefix"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ShareCrawler(ss, statefile)
+        c.state["current-cycle"] = 0
+        c.last_complete_prefix_index = 4
+        c.bucket_cache = (5, ["a", "b", "c", "d"])
+        c.state["last-complete-bucket"] = "b"
+        c.last_prefix_elapsed_time = 2.0
+        p = c.get_progress()
+        self.failUnlessEqual(p["cycle-in-progress"], True)
+        self.failUnlessEqual(p["cycle-complete-percentage"],
+                             100.0 * 5.5 / 1024)
+        left = p["estimated-cycle-complete-time-left"]
+        self.failUnlessEqual(left, (1024 - 5.5) * 2.0)
+        eta = p["estimated-cycle-complete-time"]
+        self.failUnless(abs(eta - (time.time() + left)) < 60, eta)
+
     def OFF_test_cpu_usage(self):
         # this test can't actually assert anything, because too many
         # buildslave machines are slow. But on a fast developer machine, it
@@ -270,6 +270,37 @@ class TestRegression(unittest.TestCase):
             str(ctx.exception)
         )
 
+    def test_offset(self):
+        '''
+        an encryptor created with an offset produces the same ciphertext as
+        one that has already encrypted that many bytes
+        '''
+        plaintext = b''.join([six.int2byte(i % 256) for i in range(200)])
+        for iv in (None, self.IV, b'\xff' * 16):
+            whole = aes.encrypt_data(aes.create_encryptor(self.AES_KEY, iv),
+                                     plaintext)
+            for offset in (0, 1, 15, 16, 17, 100, 199):
+                k = aes.create_encryptor(self.AES_KEY, iv, offset=offset)
+                self.assertEqual(aes.encrypt_data(k, plaintext[offset:]),
+                                 whole[offset:])
+                k = aes.create_decryptor(self.AES_KEY, iv, offset=offset)
+                self.assertEqual(aes.decrypt_data(k, whole[offset:]),
+                                 plaintext[offset:])
+
+    def test_incorrect_offset(self):
+        '''
+        offset must be a non-negative integer
+        '''
+        key = b'\x00' * 16
+        with self.assertRaises(ValueError) as ctx:
+            aes.create_encryptor(key, offset=-1)
+        self.assertIn(
+            "must not be negative",
+            str(ctx.exception)
+        )
+        with self.assertRaises(TypeError):
+            aes.create_encryptor(key, offset=1.5)
+
 
 class TestEd25519(unittest.TestCase):
     """
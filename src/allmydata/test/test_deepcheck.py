@@ -3,6 +3,7 @@ import os, json, urllib
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
+from allmydata import dirnode
 from allmydata.immutable import upload
 from allmydata.mutable.common import UnrecoverableFileError
 from allmydata.mutable.publish import MutableData
@@ -1157,6 +1158,126 @@ class DeepCheckWebBad(DeepCheckBase, unittest.TestCase):
 
         return d
 
+class BatchedBuckets(GridTestMixin, unittest.TestCase):
+    # deep-check should ask each server about all the files in a directory
+    # with a single get_buckets_batch() query
+
+    FILES = 5
+
+    def _create(self):
+        c0 = self.g.clients[0]
+        d = c0.create_dirnode()
+        def _created_root(n):
+            self.root = n
+            return n.create_subdirectory(u"subdir")
+        d.addCallback(_created_root)
+        def _add_files(subdir):
+            d2 = defer.succeed(None)
+            for i in range(self.FILES):
+                up = upload.Data("large enough for CHK %d" % i * 100, "")
+                d2.addCallback(lambda ign, i=i, up=up:
+                               subdir.add_file(u"%d" % i, up))
+            return d2
+        d.addCallback(_add_files)
+        d.addCallback(lambda ign: self.root.add_file(u"top",
+                                  upload.Data("another CHK file" * 100, "")))
+        def _clear(ign):
+            for ss in self.g.wrappers_by_id.values():
+                ss._clear_counters()
+        d.addCallback(_clear)
+        return d
+
+    def _count(self, methname):
+        return dict([(serverid, ss.counter_by_methname.get(methname, 0))
+                     for (serverid, ss) in self.g.wrappers_by_id.items()])
+
+    def _check_deep(self, verify, repair=False):
+        self.basedir = "deepcheck/BatchedBuckets/%s-%s" % (verify, repair)
+        self.set_up_grid()
+        d = self._create()
+        if repair:
+            d.addCallback(lambda ign:
+                          self.root.start_deep_check_and_repair(verify).when_done())
+        else:
+            d.addCallback(lambda ign:
+                          self.root.start_deep_check(verify).when_done())
+        def _check(results):
+            c = results.get_counters()
+            healthy = "count-objects-healthy"
+            if repair:
+                healthy = "count-objects-healthy-pre-repair"
+            self.failUnlessEqual(c["count-objects-checked"], 2+self.FILES+1)
+            self.failUnlessEqual(c[healthy], 2+self.FILES+1)
+            for count in self._count("get_buckets").values():
+                self.failUnlessEqual(count, 0)
+            # one query for the root, one for subdir
+            for count in self._count("get_buckets_batch").values():
+                self.failUnlessEqual(count, 2)
+        d.addCallback(_check)
+        return d
+
+    def test_check(self):
+        return self._check_deep(verify=False)
+
+    def test_verify(self):
+        return self._check_deep(verify=True)
+
+    def test_repair(self):
+        return self._check_deep(verify=False, repair=True)
+
+    def test_bounded_prefetch(self):
+        self.basedir = "deepcheck/BatchedBuckets/bounded_prefetch"
+        self.set_up_grid()
+        self.patch(dirnode, "DEEP_CHECK_PREFETCH", 2)
+        held = []
+        real_check_node = dirnode.DeepChecker._check_node
+        def _check_node(checker, node, childpath):
+            held.append(len(checker._prefetched_buckets))
+            return real_check_node(checker, node, childpath)
+        self.patch(dirnode.DeepChecker, "_check_node", _check_node)
+        d = self._create()
+        d.addCallback(lambda ign: self.root.start_deep_check().when_done())
+        def _check(results):
+            c = results.get_counters()
+            self.failUnlessEqual(c["count-objects-healthy"], 2+self.FILES+1)
+            self.failUnless(max(held) <= 2, held)
+            for count in self._count("get_buckets").values():
+                self.failUnlessEqual(count, 0)
+            # one query for the root, and three for the five files in subdir
+            for count in self._count("get_buckets_batch").values():
+                self.failUnlessEqual(count, 4)
+        d.addCallback(_check)
+        return d
+
+    def test_old_server(self):
+        self.basedir = "deepcheck/BatchedBuckets/old_server"
+        self.set_up_grid()
+        old_serverid = sorted(self.g.wrappers_by_id.keys())[0]
+        wrapper = self.g.wrappers_by_id[old_serverid]
+        # pretend this server predates get_buckets_batch
+        wrapper.version = {
+            "http://allmydata.org/tahoe/protocols/storage/v1":
+            dict(wrapper.version["http://allmydata.org/tahoe/protocols/storage/v1"]),
+            }
+        del wrapper.version["http://allmydata.org/tahoe/protocols/storage/v1"]["get-buckets-batch"]
+        d = self._create()
+        d.addCallback(lambda ign: self.root.start_deep_check().when_done())
+        def _check(results):
+            c = results.get_counters()
+            self.failUnlessEqual(c["count-objects-healthy"], 2+self.FILES+1)
+            get_buckets = self._count("get_buckets")
+            get_buckets_batch = self._count("get_buckets_batch")
+            for serverid in self.g.wrappers_by_id:
+                if serverid == old_serverid:
+                    self.failUnlessEqual(get_buckets[serverid], self.FILES+1)
+                    self.failUnlessEqual(get_buckets_batch[serverid], 0)
+                else:
+                    self.failUnlessEqual(get_buckets[serverid], 0)
+                    self.failUnlessEqual(get_buckets_batch[serverid], 2)
+        d.addCallback(_check)
+        return d
+
+
 class Large(DeepCheckBase, unittest.TestCase):
     def test_lots_of_lits(self):
         self.basedir = "deepcheck/Large/lots_of_lits"
@@ -6,21 +6,24 @@ from __future__ import print_function
 
 import six
 import os
+from six.moves import StringIO
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.util import base32, fileutil, spans, log, hashutil
 from allmydata.util.consumer import download_to_data, MemoryConsumer
-from allmydata.immutable import upload, layout
+from allmydata.immutable import upload, layout, downloadcache
 from allmydata.test.no_network import GridTestMixin, NoNetworkServer
-from allmydata.test.common import ShouldFailMixin
+from allmydata.test.common import ShouldFailMixin, _corrupt_uri_extension
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError, \
      DownloadStopped
 from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.node import DownloadNode, _known_hashes
+from allmydata.immutable.downloader.segcache import SegmentCache
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 
@@ -1221,6 +1224,455 @@ class DownloadV2(_Base, unittest.TestCase):
         d.addCallback(_uploaded)
         return d
 
+class ReadAhead(_Base, unittest.TestCase):
+    def setUp(self):
+        d = defer.maybeDeferred(_Base.setUp, self)
+        # remember the most segments that were fetched at the same time
+        self.most_active = 0
+        original = DownloadNode._start_new_segment
+        def _start_new_segment(node):
+            original(node)
+            self.most_active = max(self.most_active,
+                                   len(node._active_segments))
+        self.patch(DownloadNode, "_start_new_segment", _start_new_segment)
+        return d
+
+    def _upload(self, readahead=None, readahead_memory=None):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs of 72 bytes
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.c0.nodemaker.readahead = readahead
+            self.c0.nodemaker.readahead_memory = readahead_memory
+            return self.c0.create_node_from_uri(ur.get_uri())
+        d.addCallback(_uploaded)
+        return d
+
+    def _read(self, n, consumer, offset=0, size=None):
+        d = n.read(consumer, offset, size)
+        def _read(c):
+            self.failUnlessEqual("".join(c.chunks),
+                                 plaintext[offset:][:size])
+            return n._cnode._download_status.read_events[-1]["readahead"]
+        d.addCallback(_read)
+        return d
+
+    def test_readahead(self):
+        d = self._upload(readahead=2)
+        d.addCallback(self._read, MemoryConsumer())
+        def _check(readahead):
+            self.failUnlessEqual(readahead, 2)
+            self.failUnlessEqual(self.most_active, 3)
+        d.addCallback(_check)
+        return d
+
+    def test_off(self):
+        d = self._upload()
+        d.addCallback(self._read, MemoryConsumer())
+        def _check(readahead):
+            self.failUnlessEqual(readahead, 0)
+            self.failUnlessEqual(self.most_active, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_memory(self):
+        # only two more segments fit in 150 bytes
+        d = self._upload(readahead=4, readahead_memory=150)
+        d.addCallback(self._read, MemoryConsumer())
+        def _check(readahead):
+            self.failUnlessEqual(readahead, 2)
+            self.failUnlessEqual(self.most_active, 3)
+        d.addCallback(_check)
+        return d
+
+    def test_end_of_read(self):
+        # nothing beyond the end of the read is fetched
+        d = self._upload(readahead=4)
+        d.addCallback(self._read, MemoryConsumer(), 0, 150) # segs 0-2
+        def _check(readahead):
+            # seg1 is waited for, and only seg2 is read ahead
+            self.failUnlessEqual(readahead, 1)
+            self.failUnlessEqual(self.most_active, 2)
+        d.addCallback(_check)
+        return d
+
+    def test_single_segment(self):
+        d = self._upload(readahead=4)
+        d.addCallback(self._read, MemoryConsumer(), 80, 20) # seg 1
+        def _check(readahead):
+            self.failUnlessEqual(readahead, 0)
+            self.failUnlessEqual(self.most_active, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_pause(self):
+        d = self._upload(readahead=2)
+        d.addCallback(self._read, PausingConsumer())
+        return d
+
+    def test_stop(self):
+        d = self._upload(readahead=2)
+        def _read(n):
+            self.n = n
+            return self.shouldFail(DownloadStopped, "test_stop",
+                                   "our Consumer called stopProducing()",
+                                   n.read, StoppingConsumer())
+        d.addCallback(_read)
+        d.addCallback(flushEventualQueue)
+        def _check(ign):
+            # the segments that were read ahead have been cancelled
+            node = self.n._cnode._node
+            self.failUnlessEqual(node._segment_requests, [])
+            self.failUnlessEqual(node._active_segments, {})
+        d.addCallback(_check)
+        return d
+
+class SegmentSize(_Base, unittest.TestCase):
+    def _upload(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs of 72 bytes
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.uri = ur.get_uri()
+            self.n = self.c0.create_node_from_uri(self.uri)
+            return self.n
+        d.addCallback(_uploaded)
+        return d
+
+    def _check_no_segments(self):
+        # the UEB was fetched, but no segment was
+        node = self.n._cnode._node
+        self.failUnless(node.have_UEB)
+        self.failUnlessEqual(node._active_segments, {})
+        self.failUnlessEqual(self.n._cnode._download_status.segment_events,
+                             [])
+
+    def test_segsize(self):
+        d = self._upload()
+        d.addCallback(lambda n: n._cnode.get_segment_size())
+        def _got_segsize(segsize):
+            self.failUnlessEqual(segsize, 72)
+            self._check_no_segments()
+            # now that it is known, it does not need the servers
+            return self.n._cnode.get_segment_size()
+        d.addCallback(_got_segsize)
+        d.addCallback(self.failUnlessEqual, 72)
+        return d
+
+    def test_simultaneous(self):
+        d = self._upload()
+        def _get(n):
+            return defer.gatherResults([n._cnode.get_segment_size(),
+                                        n._cnode.get_segment_size()])
+        d.addCallback(_get)
+        d.addCallback(self.failUnlessEqual, [72, 72])
+        return d
+
+    def test_then_read(self):
+        d = self._upload()
+        d.addCallback(lambda n: n._cnode.get_segment_size())
+        d.addCallback(lambda ign: download_to_data(self.n))
+        d.addCallback(self.failUnlessEqual, plaintext)
+        return d
+
+    def test_corrupt_UEB(self):
+        d = self._upload()
+        def _corrupt(n):
+            # only one share has a good UEB
+            self.corrupt_shares_numbered(self.uri, range(9),
+                                         _corrupt_uri_extension)
+            return n._cnode.get_segment_size()
+        d.addCallback(_corrupt)
+        def _got_segsize(segsize):
+            self.failUnlessEqual(segsize, 72)
+            self._check_no_segments()
+        d.addCallback(_got_segsize)
+        return d
+
+    def test_no_shares(self):
+        d = self._upload()
+        def _delete(n):
+            self.delete_shares_numbered(self.uri, range(10))
+            return self.shouldFail(NoSharesError, "test_no_shares",
+                                   "no shares could provide the UEB",
+                                   n._cnode.get_segment_size)
+        d.addCallback(_delete)
+        def _retry(ign):
+            # a failure is not remembered
+            node = self.n._cnode._node
+            self.failUnlessEqual(node._segsize_fetcher, None)
+            self.failUnlessEqual(node._segsize_requests, [])
+        d.addCallback(_retry)
+        return d
+
+class SegmentCaching(unittest.TestCase):
+    def test_lru(self):
+        cache = SegmentCache(25)
+        cache.add("key", 0, 0, "a"*10)
+        cache.add("key", 1, 10, "b"*10)
+        self.failUnlessEqual(cache.get("key", 0), (0, "a"*10))
+        # segment 1 is now the least recently used one
+        cache.add("key", 2, 20, "c"*10)
+        self.failUnlessEqual(cache.get("key", 1), None)
+        self.failUnlessEqual(cache.get("key", 0), (0, "a"*10))
+        self.failUnlessEqual(cache.get("key", 2), (20, "c"*10))
+        self.failUnlessEqual(cache.get("other", 2), None)
+        self.failUnlessEqual(cache.get_size(), 20)
+        self.failUnlessEqual(cache.counters,
+                             {"hits": 3, "misses": 2, "evictions": 1})
+
+    def test_replace(self):
+        cache = SegmentCache(25)
+        cache.add("key", 0, 0, "a"*10)
+        cache.add("key", 0, 0, "a"*10)
+        self.failUnlessEqual(cache.get_size(), 10)
+        self.failUnlessEqual(cache.counters["evictions"], 0)
+
+    def test_too_big(self):
+        cache = SegmentCache(25)
+        cache.add("key", 0, 0, "a"*10)
+        cache.add("key", 1, 10, "b"*30)
+        self.failUnlessEqual(cache.get("key", 1), None)
+        self.failUnlessEqual(cache.get("key", 0), (0, "a"*10))
+
+    def test_stats(self):
+        cache = SegmentCache(25)
+        cache.add("key", 0, 0, "a"*10)
+        cache.get("key", 0)
+        cache.get("key", 1)
+        self.failUnlessEqual(cache.get_stats(),
+                             {"downloader.segment_cache.entries": 1,
+                              "downloader.segment_cache.size": 10,
+                              "downloader.segment_cache.hits": 1,
+                              "downloader.segment_cache.misses": 1,
+                              "downloader.segment_cache.evictions": 0})
+
+class SharedSegmentCache(_Base, unittest.TestCase):
+    def _upload(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.cache = SegmentCache(1000)
+        self.c0.nodemaker.segment_cache = self.cache
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs of 72 bytes
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.uri = ur.get_uri()
+            return self.c0.create_node_from_uri(self.uri)
+        d.addCallback(_uploaded)
+        return d
+
+    def _read(self, n, offset=0, size=None):
+        d = n.read(MemoryConsumer(), offset, size)
+        def _read(c):
+            self.failUnlessEqual("".join(c.chunks),
+                                 plaintext[offset:][:size])
+            return n
+        d.addCallback(_read)
+        return d
+
+    def test_reread(self):
+        d = self._upload()
+        d.addCallback(self._read)
+        def _read_again(n):
+            # the first segment is fetched before the segment size is
+            # known, so the cache is not asked for it
+            self.failUnlessEqual(self.cache.counters,
+                                 {"hits": 0, "misses": 4, "evictions": 0})
+            # the second read does not need the servers at all
+            self.delete_shares_numbered(self.uri, range(10))
+            return self._read(n, 100, 200)
+        d.addCallback(_read_again)
+        def _check(n):
+            self.failUnlessEqual(self.cache.counters,
+                                 {"hits": 4, "misses": 4, "evictions": 0})
+        d.addCallback(_check)
+        return d
+
+    def test_new_node(self):
+        d = self._upload()
+        d.addCallback(self._read)
+        def _read_new_node(ign):
+            n = self.c0.nodemaker._create_immutable(uri.from_string(self.uri))
+            return self._read(n)
+        d.addCallback(_read_new_node)
+        def _check(ign):
+            # only the first segment was fetched again
+            self.failUnlessEqual(self.cache.counters,
+                                 {"hits": 4, "misses": 4, "evictions": 0})
+        d.addCallback(_check)
+        return d
+
+    def test_eviction(self):
+        d = self._upload()
+        def _shrink(n):
+            # room for two segments
+            self.cache.max_size = 150
+            return n
+        d.addCallback(_shrink)
+        d.addCallback(self._read)
+        d.addCallback(self._read, 300, 60) # the last segment
+        def _check(n):
+            self.failUnlessEqual(self.cache.counters,
+                                 {"hits": 1, "misses": 4, "evictions": 3})
+            # segments 3 and 4 (the 22-byte tail) are left
+            self.failUnlessEqual(self.cache.get_size(), 72+22)
+        d.addCallback(_check)
+        return d
+
+class MetadataCache(_Base, unittest.TestCase):
+    def _get_cache(self, **kwargs):
+        dbfile = os.path.join(self.basedir, "download-cache.sqlite")
+        cache = downloadcache.get_download_cache(dbfile, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_cache(self):
+        self.basedir = "download/MetadataCache/cache"
+        fileutil.make_dirs(self.basedir)
+        cache = self._get_cache(max_entries=2)
+        now = [1000.0]
+        cache._now = lambda: now[0]
+        self.failUnlessEqual(cache.get("si1", "ueb1"), None)
+        cache.add("si1", "ueb1", "UEB1", {0: "h0", 1: "h1"}, {0: "c0"},
+                  {0: set(["a"]), 1: set(["b", "c"])})
+        self.failUnlessEqual(cache.get("si1", "ueb1"),
+                             ("UEB1", {0: "h0", 1: "h1"}, {0: "c0"},
+                              {0: set(["a"]), 1: set(["b", "c"])}))
+        # the UEB hash is part of the key
+        self.failUnlessEqual(cache.get("si1", "ueb2"), None)
+        now[0] += 1
+        cache.add("si2", "ueb2", "UEB2", {}, {}, {})
+        now[0] += 1
+        cache.get("si1", "ueb1")
+        # si2 is now the least recently used entry
+        now[0] += 1
+        cache.add("si3", "ueb3", "UEB3", {}, {}, {})
+        self.failUnlessEqual(cache.get_entries(), 2)
+        self.failUnlessEqual(cache.get("si2", "ueb2"), None)
+        self.failUnlessEqual(cache.get("si3", "ueb3")[0], "UEB3")
+        cache.remove("si1", "ueb1")
+        self.failUnlessEqual(cache.get("si1", "ueb1"), None)
+        self.failUnlessEqual(cache.get_entries(), 1)
+
+    def test_bad_file(self):
+        self.basedir = "download/MetadataCache/bad_file"
+        fileutil.make_dirs(self.basedir)
+        dbfile = os.path.join(self.basedir, "download-cache.sqlite")
+        fileutil.write(dbfile, "not a database")
+        stderr = StringIO()
+        self.failUnlessEqual(downloadcache.get_download_cache(dbfile, stderr),
+                             None)
+        self.failUnlessIn("download cache file is unusable",
+                          stderr.getvalue())
+
+    def _upload(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.cache = self._get_cache()
+        self.c0.nodemaker.metadata_cache = self.cache
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70 # 5 segs of 72 bytes
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.uri = ur.get_uri()
+        d.addCallback(_uploaded)
+        return d
+
+    def _new_node(self, ign=None):
+        # not the one in the nodemaker's cache
+        n = self.c0.nodemaker._create_immutable(uri.from_string(self.uri))
+        # this is what reads from the cache
+        n._cnode._maybe_create_download_node()
+        return n
+
+    def _read(self, n):
+        d = download_to_data(n)
+        def _check(data):
+            self.failUnlessEqual(data, plaintext)
+            return n._cnode._download_status
+        d.addCallback(_check)
+        return d
+
+    def _fetched(self, ds):
+        return sum([r["response_length"] for r in ds.block_requests])
+
+    def test_download(self):
+        d = self._upload()
+        d.addCallback(self._new_node)
+        def _read_first(n):
+            self.first_node = n._cnode._node
+            return self._read(n)
+        d.addCallback(_read_first)
+        def _read_again(ds):
+            self.first_fetched = self._fetched(ds)
+            self.failUnlessEqual(self.cache.counters,
+                                 {"hits": 0, "misses": 1, "bad": 0})
+            self.failUnlessEqual(self.cache.get_entries(), 1)
+            n = self._new_node()
+            node = n._cnode._node
+            # the new node already knows the layout
+            self.failUnless(node.have_UEB)
+            self.failUnlessEqual(node.segment_size, 72)
+            self.failUnlessEqual(node.guessed_segment_size, 72)
+            self.failIf(node.ciphertext_hash_tree.needed_hashes(4))
+            # and every share hash that the first one validated (which are
+            # only the hash chains of the shares that it used)
+            share_hashes = _known_hashes(self.first_node.share_hash_tree)
+            self.failUnless(len(share_hashes) > 1, share_hashes)
+            self.failUnlessEqual(_known_hashes(node.share_hash_tree),
+                                 share_hashes)
+            self.failUnless(node._sharefinder._preferred_serverids)
+            self.failUnlessEqual(self.cache.counters,
+                                 {"hits": 1, "misses": 1, "bad": 0})
+            return self._read(n)
+        d.addCallback(_read_again)
+        def _check(ds):
+            self.failUnless(self._fetched(ds) < self.first_fetched,
+                            (self._fetched(ds), self.first_fetched))
+            stats = self.cache.get_stats()
+            self.failUnlessEqual(stats["downloader.metadata_cache.hits"], 1)
+            self.failUnlessEqual(stats["downloader.metadata_cache.entries"],
+                                 1)
+        d.addCallback(_check)
+        return d
+
+    def test_bad_entry(self):
+        d = self._upload()
+        d.addCallback(self._new_node)
+        d.addCallback(self._read)
+        def _corrupt(ign):
+            u = uri.from_string(self.uri)
+            si = u.get_storage_index()
+            ueb_hash = u.uri_extension_hash
+            (UEB, share_hashes, crypttext_hashes,
+             servers) = self.cache.get(si, ueb_hash)
+            crypttext_hashes[max(crypttext_hashes)] = "\x00" * 32
+            self.cache.add(si, ueb_hash, UEB, share_hashes, crypttext_hashes,
+                           servers)
+            n = self._new_node()
+            # the entry was dropped, and the node fetches the hashes again
+            # (the UEB in it still matched the verifycap, so that was kept)
+            self.failUnlessEqual(self.cache.get_entries(), 0)
+            self.failUnless(n._cnode._node.have_UEB)
+            self.failUnlessEqual(self.cache.counters,
+                                 {"hits": 0, "misses": 2, "bad": 1})
+            return self._read(n)
+        d.addCallback(_corrupt)
+        def _check(ds):
+            # and saves them again
+            self.failUnlessEqual(self.cache.get_entries(), 1)
+        d.addCallback(_check)
+        return d
+
 class Status(unittest.TestCase):
     def test_status(self):
         now = 12345.1
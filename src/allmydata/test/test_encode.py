@@ -2,14 +2,16 @@ from zope.interface import implementer
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.python.failure import Failure
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, flushEventualQueue
 from allmydata import uri
 from allmydata.immutable import encode, upload, checker
 from allmydata.util import hashutil
 from allmydata.util.assertutil import _assert
 from allmydata.util.consumer import download_to_data
-from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader
+from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
+     UploadUnhappinessError
 from allmydata.test.no_network import GridTestMixin
+from allmydata.test.common_util import ShouldFailMixin
 
 class LostPeerError(Exception):
     pass
@@ -347,6 +349,123 @@ class Encode(unittest.TestCase):
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
 
+class SlowBucketWriter(FakeBucketReaderWriterProxy):
+    # put_block() waits until the test fires the Deferred left in 'pending'
+    def __init__(self, pending, mode="good", peerid="peer"):
+        FakeBucketReaderWriterProxy.__init__(self, mode, peerid)
+        self.pending = pending
+
+    def put_block(self, segmentnum, data):
+        d = defer.Deferred()
+        self.pending.append((segmentnum, d))
+        d.addCallback(lambda ign:
+                      FakeBucketReaderWriterProxy.put_block(self, segmentnum,
+                                                            data))
+        return d
+
+class Pipeline(ShouldFailMixin, unittest.TestCase):
+    NUM_SEGMENTS = 5
+
+    def make_encoder(self, mode="good", **kwargs):
+        # 3-of-10, five 30-byte segments
+        e = encode.Encoder(**kwargs)
+        u = upload.Data(make_data(150), convergence="some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 30,
+                                           'k': 3, 'happy': 10, 'n': 10})
+        eu = upload.EncryptAnUploadable(u)
+        d = e.set_encrypted_uploadable(eu)
+        self.pending = []
+        self.shareholders = {}
+        def _ready(res):
+            servermap = {}
+            for shnum in range(10):
+                peer = SlowBucketWriter(self.pending, mode,
+                                        peerid="peer%d" % shnum)
+                self.shareholders[shnum] = peer
+                servermap[shnum] = set([peer.get_peerid()])
+            e.set_shareholders(self.shareholders, servermap)
+            self.failUnlessEqual(e.get_param("num_segments"),
+                                 self.NUM_SEGMENTS)
+            return e
+        d.addCallback(_ready)
+        return d
+
+    def segments_pending(self):
+        return sorted(set([segnum for (segnum, d) in self.pending]))
+
+    def send_segment(self, segnum):
+        for (n, d) in self.pending[:]:
+            if n == segnum:
+                self.pending.remove((n, d))
+                d.callback(None)
+        return flushEventualQueue()
+
+    @defer.inlineCallbacks
+    def test_window(self):
+        e = yield self.make_encoder(segments_in_flight=3)
+        self.failUnlessEqual(e.get_segment_window(), 3)
+        done = []
+        d = e.start()
+        d.addCallback(done.append)
+        yield flushEventualQueue()
+        # the first three segments have been read, encoded and handed to
+        # the shareholders. The fourth waits until one of them is sent.
+        self.failUnlessEqual(self.segments_pending(), [0, 1, 2])
+        yield self.send_segment(1)
+        self.failUnlessEqual(self.segments_pending(), [0, 2, 3])
+        yield self.send_segment(0)
+        self.failUnlessEqual(self.segments_pending(), [2, 3, 4])
+        for segnum in [2, 3]:
+            yield self.send_segment(segnum)
+        self.failIf(done)
+        yield self.send_segment(4)
+        yield d
+        self.failUnlessEqual(len(done), 1)
+        for peer in self.shareholders.values():
+            self.failUnless(peer.closed)
+            self.failUnlessEqual(sorted(peer.blocks.keys()),
+                                 range(self.NUM_SEGMENTS))
+        timings = e.get_times()
+        for name in ["cumulative_reading", "cumulative_encoding",
+                     "cumulative_sending", "segment_pipeline",
+                     "stage_overlap"]:
+            self.failUnless(timings[name] >= 0.0, (name, timings))
+        self.failUnless(timings["cumulative_reading"]
+                        <= timings["cumulative_encoding"], timings)
+        self.failUnless(timings["segment_pipeline"]
+                        <= timings["total_encode_and_push"], timings)
+
+    @defer.inlineCallbacks
+    def test_memory_budget(self):
+        # each segment holds 30 bytes of ciphertext and 10 blocks of 10
+        # bytes, so only one of them fits in 200 bytes
+        e = yield self.make_encoder(segments_in_flight=3, pipeline_memory=200)
+        self.failUnlessEqual(e.get_segment_window(), 1)
+        d = e.start()
+        yield flushEventualQueue()
+        for segnum in range(self.NUM_SEGMENTS):
+            self.failUnlessEqual(self.segments_pending(), [segnum])
+            yield self.send_segment(segnum)
+        yield d
+
+    @defer.inlineCallbacks
+    def test_lost_shareholder(self):
+        # every shareholder fails to take segment 1, while segments 2 and 3
+        # are already on their way
+        e = yield self.make_encoder(mode="lost", segments_in_flight=3)
+        d = e.start()
+        yield flushEventualQueue()
+        self.failUnlessEqual(self.segments_pending(), [0, 1, 2])
+        yield self.send_segment(0)
+        yield self.send_segment(1)
+        # the upload gave up before reading any more segments
+        self.failUnlessEqual(self.segments_pending(), [2, 3])
+        yield self.send_segment(2)
+        yield self.send_segment(3)
+        yield self.shouldFail(UploadUnhappinessError, "lost", None,
+                              lambda: d)
+
+
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
     # a series of 3*3 tests to check out edge conditions. One axis is how the
@@ -40,6 +40,67 @@ class HappinessUtils(unittest.TestCase):
         )
 
 
+class Matching(unittest.TestCase):
+    """
+    test-cases for maximum_matching, the Hopcroft-Karp algorithm
+    """
+
+    def test_empty(self):
+        self.assertEqual({}, happiness_upload.maximum_matching({}))
+        self.assertEqual({}, happiness_upload.maximum_matching({'peer0': []}))
+
+    def test_augmenting(self):
+        # a greedy matching would give share0 to peer0 and leave peer1 with
+        # nothing; the augmenting path moves peer0 over to share1
+        graph = {
+            'peer0': ['share0', 'share1'],
+            'peer1': ['share0'],
+        }
+        self.assertEqual(
+            {'peer0': 'share1', 'peer1': 'share0'},
+            happiness_upload.maximum_matching(graph)
+        )
+
+    def test_large(self):
+        # a chain of 1000 servers, each of which can hold its own share or
+        # the next one; the greedy matching of server i to share i+1 has to
+        # be undone along one long path
+        graph = dict([(i, [i + 1, i]) for i in range(1000)])
+        graph[999] = [999]
+        matching = happiness_upload.maximum_matching(graph)
+        self.assertEqual(1000, len(matching))
+        self.assertEqual(1000, len(set(matching.values())))
+
+    @given(
+        sets(elements=text(min_size=1, max_size=3), min_size=1, max_size=6),
+        sets(elements=text(min_size=1, max_size=3), min_size=1, max_size=6),
+    )
+    def test_maximum(self, peers, shares):
+        """
+        maximum_matching finds a matching as large as an exhaustive search
+        does
+        """
+        peers = sorted(peers)
+        shares = sorted(shares)
+        graph = dict([(peer, [share for (j, share) in enumerate(shares)
+                              if (i + j) % 3])
+                      for (i, peer) in enumerate(peers)])
+        matching = happiness_upload.maximum_matching(graph)
+        for (peer, share) in matching.items():
+            self.assertIn(share, graph[peer])
+        self.assertEqual(len(set(matching.values())), len(matching))
+
+        def largest(peers, used):
+            if not peers:
+                return 0
+            best = largest(peers[1:], used)
+            for share in graph[peers[0]]:
+                if share not in used:
+                    best = max(best, 1 + largest(peers[1:], used | {share}))
+            return best
+        self.assertEqual(largest(peers, set()), len(matching))
+
+
 class Happiness(unittest.TestCase):
 
     def test_placement_simple(self):
@@ -3,7 +3,8 @@ from twisted.internet import defer
 from twisted.trial import unittest
 from twisted.application import service
 
-from foolscap.api import Tub, fireEventually, flushEventualQueue
+from foolscap.api import Tub, fireEventually, flushEventualQueue, \
+     DeadReferenceError
 
 from allmydata.crypto import aes
 from allmydata.storage.server import si_b2a
@@ -62,6 +63,42 @@ class Helper_fake_upload(offloaded.Helper):
                                   lp)
         return uh
 
+class CHKUploadHelper_reading(CHKUploadHelper_fake):
+    # read all of the ciphertext before pretending to upload it, and note
+    # whether any of it was read before the fetch was done
+    def start_encrypted(self, eu):
+        self.ciphertext = []
+        self.read_before_fetched = False
+        d = eu.get_size()
+        def _read(size):
+            if size == 0:
+                return
+            d2 = eu.read_encrypted(7000, False)
+            def _got(data):
+                self.ciphertext.extend(data)
+                if not self._fetcher.when_done().called:
+                    self.read_before_fetched = True
+                return _read(size - sum([len(piece) for piece in data]))
+            d2.addCallback(_got)
+            return d2
+        d.addCallback(_read)
+        d.addCallback(lambda ign:
+                      CHKUploadHelper_fake.start_encrypted(self, eu))
+        return d
+
+class Helper_reading(offloaded.Helper):
+    def _make_chk_upload_helper(self, storage_index, lp):
+        si_s = si_b2a(storage_index)
+        incoming_file = os.path.join(self._chk_incoming, si_s)
+        encoding_file = os.path.join(self._chk_encoding, si_s)
+        uh = CHKUploadHelper_reading(storage_index, self,
+                                     self._storage_broker,
+                                     self._secret_holder,
+                                     incoming_file, encoding_file,
+                                     lp, pipelined=self._pipelined)
+        self.upload_helper = uh
+        return uh
+
 class Helper_already_uploaded(Helper_fake_upload):
     def _check_chk(self, storage_index, lp):
         res = upload.HelperUploadResults()
@@ -128,12 +165,13 @@ class AssistedUpload(unittest.TestCase):
         # bogus host/port
         t.setLocation("bogus:1234")
 
-    def setUpHelper(self, basedir, helper_class=Helper_fake_upload):
+    def setUpHelper(self, basedir, helper_class=Helper_fake_upload,
+                    pipelined=False):
         fileutil.make_dirs(basedir)
         self.helper = h = helper_class(basedir,
                                        self.s.storage_broker,
                                        self.s.secret_holder,
-                                       None, None)
+                                       None, None, pipelined=pipelined)
         self.helper_furl = self.tub.registerReference(h)
 
     def tearDown(self):
@@ -246,3 +284,106 @@ class AssistedUpload(unittest.TestCase):
         d.addCallback(_check_empty)
 
         return d
+
+    def _upload_and_read(self, basedir, pipelined):
+        self.basedir = basedir
+        self.setUpHelper(self.basedir, helper_class=Helper_reading,
+                         pipelined=pipelined)
+        self.patch(offloaded.CHKCiphertextFetcher, "CHUNK_SIZE", 1000)
+        reads = {"outstanding": 0, "most": 0}
+        original = upload.RemoteEncryptedUploadable._read_at
+        def _read_at(eu, offset, length):
+            d = fireEventually()
+            d.addCallback(lambda ign: original(eu, offset, length))
+            def _done(res):
+                reads["outstanding"] -= 1
+                return res
+            d.addBoth(_done)
+            return d
+        def remote_read_encrypted(eu, offset, length):
+            reads["outstanding"] += 1
+            reads["most"] = max(reads["most"], reads["outstanding"])
+            return original_remote(eu, offset, length)
+        original_remote = upload.RemoteEncryptedUploadable.remote_read_encrypted
+        self.patch(upload.RemoteEncryptedUploadable, "_read_at", _read_at)
+        self.patch(upload.RemoteEncryptedUploadable, "remote_read_encrypted",
+                   remote_read_encrypted)
+
+        u = upload.Uploader(self.helper_furl)
+        u.setServiceParent(self.s)
+        d = wait_a_few_turns()
+        def _ready(res):
+            assert u._helper
+            return upload_data(u, DATA, convergence="some convergence string")
+        d.addCallback(_ready)
+        def _uploaded(results):
+            self.failUnlessIn("CHK", results.get_uri())
+            uh = self.helper.upload_helper
+            k = FakeClient.DEFAULT_ENCODING_PARAMETERS["k"]
+            n = FakeClient.DEFAULT_ENCODING_PARAMETERS["n"]
+            segsize = mathutil.next_multiple(len(DATA), k)
+            key = hashutil.convergence_hash(k, n, segsize, DATA,
+                                            "some convergence string")
+            crypttext = aes.encrypt_data(aes.create_encryptor(key), DATA)
+            self.failUnlessEqual("".join(uh.ciphertext), crypttext)
+            files = os.listdir(os.path.join(self.basedir, "CHK_encoding"))
+            self.failUnlessEqual(files, [])
+            files = os.listdir(os.path.join(self.basedir, "CHK_incoming"))
+            self.failUnlessEqual(files, [])
+            return (reads["most"], uh.read_before_fetched)
+        d.addCallback(_uploaded)
+        return d
+
+    def test_pipelined(self):
+        d = self._upload_and_read("helper/AssistedUpload/test_pipelined",
+                                  pipelined=True)
+        def _check((most_reads, read_before_fetched)):
+            self.failUnlessEqual(most_reads,
+                                 offloaded.CHKCiphertextFetcher.FETCH_WINDOW)
+            self.failUnless(read_before_fetched)
+            stats = self.helper.get_stats()
+            self.failUnlessEqual(stats["chk_upload_helper.fetched_bytes"],
+                                 len(DATA))
+            self.failUnless(stats["chk_upload_helper.fetch_time"] > 0)
+            self.failUnless(stats["chk_upload_helper.upload_time"] > 0)
+        d.addCallback(_check)
+        return d
+
+    def test_not_pipelined(self):
+        d = self._upload_and_read("helper/AssistedUpload/test_not_pipelined",
+                                  pipelined=False)
+        def _check((most_reads, read_before_fetched)):
+            self.failUnlessEqual(most_reads, 1)
+            self.failIf(read_before_fetched)
+            stats = self.helper.get_stats()
+            self.failUnless(stats["chk_upload_helper.fetch_time"] > 0)
+        d.addCallback(_check)
+        return d
+
+    def test_pipelined_get_version_fails(self):
+        # if asking the client for its version fails, it gets one read at a
+        # time, rather than no reads at all
+        def add_version_to_remote_reference(rref, default):
+            return defer.fail(DeadReferenceError("get_version failed"))
+        self.patch(offloaded, "add_version_to_remote_reference",
+                   add_version_to_remote_reference)
+        d = self._upload_and_read(
+            "helper/AssistedUpload/test_pipelined_get_version_fails",
+            pipelined=True)
+        def _check((most_reads, read_before_fetched)):
+            self.failUnlessEqual(most_reads, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_pipelined_old_client(self):
+        # a client without get_version() gets one read at a time
+        self.patch(upload.RemoteEncryptedUploadable, "remote_get_version",
+                   None)
+        del upload.RemoteEncryptedUploadable.remote_get_version
+        d = self._upload_and_read(
+            "helper/AssistedUpload/test_pipelined_old_client", pipelined=True)
+        def _check((most_reads, read_before_fetched)):
+            self.failUnlessEqual(most_reads, 1)
+            self.failUnless(read_before_fetched)
+        d.addCallback(_check)
+        return d
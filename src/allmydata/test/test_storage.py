@@ -1,20 +1,26 @@
-import time, os.path, platform, stat, re, json, struct, shutil
+import time, os.path, platform, stat, re, json, struct, shutil, sqlite3
 
 from twisted.trial import unittest
 
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.application import service
 from foolscap.api import fireEventually
 import itertools
 from allmydata import interfaces
 from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
+from allmydata.storage import server as storage_server
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
+from allmydata.storage.filepool import FilePool
+from allmydata.storage.latency import LatencyHistogram
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     si_b2a
 from allmydata.storage.lease import LeaseInfo
-from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.crawler import BucketCountingCrawler, \
+     TimeSliceExceeded
 from allmydata.storage.expirer import LeaseCheckingCrawler
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
@@ -70,7 +76,7 @@ class Bucket(unittest.TestCase):
 
     def bucket_writer_closed(self, bw, consumed):
         pass
-    def add_latency(self, category, latency):
+    def add_latency(self, category, latency, size=None, client=None):
         pass
     def count(self, name, delta=1):
         pass
@@ -108,6 +114,37 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
 
+    def test_buffered_readwrite(self):
+        incoming, final = self.make_workdir("test_buffered_readwrite")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary(), buffered=True, fsync="close")
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        # nothing has been written yet
+        self.failUnlessEqual(os.path.getsize(incoming), 0x0c + 200 + 72)
+        self.failUnlessEqual(fileutil.read(incoming)[0x0c:0x0c+50],
+                             "\x00"*50)
+        # non-sequential writes are fine too
+        bw.remote_write(100, "d"*50)
+        bw.remote_write(50, "c"*50)
+        self.failUnlessRaises(DataTooLargeError,
+                              bw.remote_write, 150, "e"*51)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_read(0, 150),
+                             "a"*25 + "b"*25 + "c"*50 + "d"*50)
+        self.failUnlessEqual(len(list(ShareFile(final).get_leases())), 1)
+
+    def test_buffered_abort(self):
+        incoming, final = self.make_workdir("test_buffered_abort")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary(), buffered=True)
+        bw.remote_write(0, "a"*25)
+        bw.remote_abort()
+        self.failIf(os.path.exists(incoming))
+        self.failIf(os.path.exists(final))
+
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
         # file):
@@ -141,7 +178,7 @@ class Bucket(unittest.TestCase):
         fileutil.write(final, share_file_data)
 
         class MockStorageServer(object):
-            def add_latency(self, category, latency):
+            def add_latency(self, category, latency, size=None, client=None):
                 pass
             def count(self, name, delta=1):
                 pass
@@ -204,7 +241,7 @@ class BucketProxy(unittest.TestCase):
 
     def bucket_writer_closed(self, bw, consumed):
         pass
-    def add_latency(self, category, latency):
+    def add_latency(self, category, latency, size=None, client=None):
         pass
     def count(self, name, delta=1):
         pass
@@ -485,6 +522,33 @@ class Server(unittest.TestCase):
         for i,wb in writers.items():
             wb.remote_abort()
 
+    def test_declares_get_buckets_batch(self):
+        ss = self.create("test_declares_get_buckets_batch")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('get-buckets-batch'), sv1)
+
+    def test_get_buckets_batch(self):
+        ss = self.create("test_get_buckets_batch")
+        self.failUnlessEqual(ss.remote_get_buckets_batch(["si1", "si2"]), {})
+
+        for (si, sharenums) in [("si1", [0,1,2]), ("si2", [3])]:
+            already,writers = self.allocate(ss, si, sharenums, 75)
+            for i,wb in writers.items():
+                wb.remote_write(0, "%25d" % i)
+                wb.remote_close()
+        # an open bucket is not readable yet
+        already,writers = self.allocate(ss, "si3", [0], 75)
+
+        b = ss.remote_get_buckets_batch(["si1", "si2", "si3", "si4"])
+        self.failUnlessEqual(set(b.keys()), set(["si1", "si2"]))
+        self.failUnlessEqual(set(b["si1"].keys()), set([0,1,2]))
+        self.failUnlessEqual(set(b["si2"].keys()), set([3]))
+        self.failUnlessEqual(b["si1"][1].remote_read(0, 25), "%25d" % 1)
+        self.failUnlessEqual(b["si2"][3].remote_read(0, 25), "%25d" % 3)
+        for wb in writers.values():
+            wb.remote_abort()
+
     def test_bad_container_version(self):
         ss = self.create("test_bad_container_version")
         a,w = self.allocate(ss, "si1", [0], 10)
@@ -520,6 +584,119 @@ class Server(unittest.TestCase):
         self.failUnlessEqual(already, set())
         self.failUnlessEqual(set(writers.keys()), set([0,1,2]))
 
+    def test_disconnect_grace_period(self):
+        ss = self.create("test_disconnect_grace_period")
+        ss.incoming_grace_period = 3600
+        sv1 = ss.remote_get_version()['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnlessEqual(sv1["incoming-grace-period"], 3600)
+        renew = hashutil.tagged_hash("blah", "renew")
+        cancel = hashutil.tagged_hash("blah", "cancel")
+        canary = FakeCanary()
+        already,writers = ss.remote_allocate_buckets("si1", renew, cancel,
+                                                     set([0,1]), 100, canary)
+        self.failUnlessEqual(set(writers.keys()), set([0,1]))
+        writers[0].remote_write(0, "a"*10)
+        writers[0].remote_write(10, "b"*10)
+        writers[0].remote_write(50, "c"*25)
+        self.failUnlessEqual(writers[0].remote_get_written(),
+                             [(0, 20), (50, 25)])
+        for (f,args,kwargs) in canary.disconnectors.values():
+            f(*args, **kwargs)
+        self.failUnlessEqual(len(ss._parked_writers), 2)
+
+        # somebody else, or a different size, gets nothing
+        already2,writers2 = ss.remote_allocate_buckets(
+            "si1", hashutil.tagged_hash("blah", "other"), cancel,
+            set([0]), 100, FakeCanary())
+        self.failUnlessEqual(writers2, {})
+        already2,writers2 = ss.remote_allocate_buckets("si1", renew, cancel,
+                                                       set([0]), 99,
+                                                       FakeCanary())
+        self.failUnlessEqual(writers2, {})
+
+        # the same client gets its partial share back, and can finish it
+        canary2 = FakeCanary()
+        already2,writers2 = ss.remote_allocate_buckets("si1", renew, cancel,
+                                                       set([0]), 100,
+                                                       canary2)
+        self.failUnlessIdentical(writers2[0], writers[0])
+        self.failUnlessEqual(writers2[0].remote_get_written(),
+                             [(0, 20), (50, 25)])
+        self.failUnlessEqual(len(canary2.disconnectors), 1)
+        writers2[0].remote_write(20, "d"*30)
+        writers2[0].remote_write(75, "e"*25)
+        writers2[0].remote_close()
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 100),
+                             "a"*10 + "b"*10 + "d"*30 + "c"*25 + "e"*25)
+
+        # share 1 is deleted once its grace period is over
+        writers[1].parked_until = time.time() - 1
+        incominghome = writers[1].incominghome
+        self.failUnless(os.path.exists(incominghome))
+        del writers, writers2
+        already3,writers3 = ss.remote_allocate_buckets("si1", renew, cancel,
+                                                       set([1]), 100,
+                                                       FakeCanary())
+        self.failUnlessEqual(already3, set([0]))
+        self.failUnlessEqual(set(writers3.keys()), set([1]))
+        self.failUnlessEqual(writers3[1].remote_get_written(), [])
+        self.failUnlessEqual(ss._parked_writers, {})
+
+    def test_parked_writers_expire(self):
+        # a parked share is deleted when its grace period is over, even if
+        # nobody allocates anything after that
+        clock = Clock()
+        self.patch(storage_server, "reactor", clock)
+        ss = self.create("test_parked_writers_expire")
+        ss.incoming_grace_period = 3600
+        canary = FakeCanary()
+        already,writers = ss.remote_allocate_buckets(
+            "si1", hashutil.tagged_hash("blah", "renew"),
+            hashutil.tagged_hash("blah", "cancel"), set([0]), 100, canary)
+        writers[0].remote_write(0, "a"*10)
+        allocated = ss.space_accountant.allocated
+        self.failUnless(allocated > 0, allocated)
+        for (f,args,kwargs) in canary.disconnectors.values():
+            f(*args, **kwargs)
+        self.failUnlessEqual(len(ss._parked_writers), 1)
+        self.failUnless(ss._parked_timer.active())
+        incominghome = writers[0].incominghome
+        self.failUnless(os.path.exists(incominghome))
+
+        writers[0].parked_until = time.time() - 1
+        del writers
+        clock.advance(3600)
+        self.failUnlessEqual(ss._parked_writers, {})
+        self.failIf(os.path.exists(incominghome))
+        self.failUnlessEqual(ss.space_accountant.allocated, 0)
+        self.failUnlessEqual(ss._parked_timer, None)
+
+    def test_parked_timer_cancelled(self):
+        ss = self.create("test_parked_timer_cancelled")
+        ss.incoming_grace_period = 3600
+        canary = FakeCanary()
+        ss.remote_allocate_buckets("si1", hashutil.tagged_hash("blah", "renew"),
+                                   hashutil.tagged_hash("blah", "cancel"),
+                                   set([0]), 100, canary)
+        for (f,args,kwargs) in canary.disconnectors.values():
+            f(*args, **kwargs)
+        timer = ss._parked_timer
+        self.failUnless(timer.active())
+        d = ss.disownServiceParent()
+        d.addCallback(lambda ign: self.failIf(timer.active()))
+        return d
+
+    def test_abort_grace_period(self):
+        # an explicit abort is not kept around
+        ss = self.create("test_abort_grace_period")
+        ss.incoming_grace_period = 3600
+        already,writers = self.allocate(ss, "si1", [0], 75)
+        writers[0].remote_write(0, "a"*25)
+        writers[0].remote_abort()
+        self.failUnlessEqual(ss._parked_writers, {})
+        self.failIf(os.path.exists(writers[0].incominghome))
+
     def test_reserved_space(self):
         reserved = 10000
         allocated = 0
@@ -584,6 +761,71 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    def test_space_accounting(self):
+        calls = []
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            calls.append(whichdir)
+            return {'total': 20000, 'used': 5000, 'free_for_root': 15000,
+                    'free_for_nonroot': 15000, 'avail': 15000}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+
+        ss = self.create("test_space_accounting")
+        ncalls = len(calls)
+        canary = FakeCanary(True)
+        already,writers = self.allocate(ss, "vid1", [0,1,2], 1000, canary)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.allocated"], 3000)
+        self.failUnlessEqual(stats["storage_server.space.allocated"], 3000)
+        self.failUnlessEqual(stats["storage_server.space.open-writers"], 3)
+        self.failUnlessEqual(stats["storage_server.space.used"], 0)
+
+        # one share is finished, one is aborted, and one is abandoned: none
+        # of them hold an allocation any more
+        writers[0].remote_write(0, "a"*25)
+        writers[0].remote_close()
+        writers[1].remote_abort()
+        del already
+        del writers
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.allocated"], 0)
+        self.failUnlessEqual(stats["storage_server.space.open-writers"], 0)
+        used = stats["storage_server.space.used"]
+        self.failUnless(used >= 25, used)
+        self.failUnlessEqual(stats["storage_server.space.unrefreshed-bytes"],
+                             used)
+        self.failUnlessEqual(ss.get_available_space(), 15000 - used)
+        self.failUnlessEqual(stats["storage_server.disk_avail"], 15000 - used)
+        # none of that needed to ask the OS
+        self.failUnlessEqual(len(calls), ncalls)
+
+        ss.space_accountant.refresh()
+        self.failUnlessEqual(len(calls), ncalls+1)
+        self.failUnlessEqual(ss.get_available_space(), 15000)
+        self.failUnlessEqual(ss.space_accountant.used, used)
+
+    def test_space_accounting_restart(self):
+        ss = self.create("test_space_accounting_restart")
+        already,writers = self.allocate(ss, "vid1", [0,1,2], 100)
+        for bw in writers.values():
+            bw.remote_write(0, "a"*100)
+            bw.remote_close()
+        used = ss.space_accountant.used
+        self.failUnless(used >= 300, used)
+
+        # a clean shutdown remembers the count
+        d = ss.disownServiceParent()
+        def _restarted(ign):
+            ss2 = self.create("test_space_accounting_restart")
+            self.failUnlessEqual(ss2.space_accountant.used, used)
+            # a crash does not save the count
+            ss2.disownServiceParent()
+            os.unlink(os.path.join(ss2.storedir, "space.pickle"))
+            ss3 = self.create("test_space_accounting_restart")
+            self.failUnlessEqual(ss3.space_accountant.used, None)
+            self.failIfIn("storage_server.space.used", ss3.get_stats())
+        d.addCallback(_restarted)
+        return d
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -778,6 +1020,646 @@ class Server(unittest.TestCase):
         self.failUnlessIn("This share tastes like dust.", report)
 
 
+class BufferedServer(Server):
+    """Run all of the Server tests again, with buffered BucketWriters that
+    fsync each share when it is closed."""
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "BufferedServer", name)
+        return basedir
+
+    def create(self, name, reserved_space=0, klass=StorageServer):
+        workdir = self.workdir(name)
+        ss = klass(workdir, "\x00" * 20, reserved_space=reserved_space,
+                   stats_provider=FakeStatsProvider(),
+                   buffered_writes=True, fsync="close")
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_bad_fsync_policy(self):
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_bad_fsync_policy"),
+                              "\x00" * 20, fsync="always")
+
+    def test_group_fsync(self):
+        workdir = self.workdir("test_group_fsync")
+        ss = StorageServer(workdir, "\x00" * 20, fsync="group")
+        ss.setServiceParent(self.sparent)
+        already,writers = self.allocate(ss, "si1", [0,1,2], 75)
+        for i,wb in writers.items():
+            wb.remote_write(0, "%25d" % i)
+        ds = [wb.remote_close() for wb in writers.values()]
+        # the shares are not visible until they have been synced
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        # but an abort can no longer discard them
+        writers[0].remote_abort()
+        d = defer.gatherResults(ds)
+        def _synced(ign):
+            # all three were synced in one group, and then their
+            # directories in another
+            self.failUnlessEqual(ss.group_syncer.groups, 2)
+            b = ss.remote_get_buckets("si1")
+            self.failUnlessEqual(set(b.keys()), set([0,1,2]))
+            self.failUnlessEqual(b[1].remote_read(0, 25), "%25d" % 1)
+            self.failUnlessEqual(ss.allocated_size(), 0)
+        d.addCallback(_synced)
+        return d
+
+    def _record_fsyncs(self):
+        synced = []
+        real_fsync = os.fsync
+        def _fsync(fd):
+            s = os.fstat(fd)
+            synced.append((s.st_dev, s.st_ino))
+            return real_fsync(fd)
+        self.patch(os, "fsync", _fsync)
+        return synced
+
+    def _inode(self, path):
+        s = os.stat(path)
+        return (s.st_dev, s.st_ino)
+
+    def _check_dirs_synced(self, synced, dirs):
+        for (name, inode) in dirs:
+            self.failUnlessIn(inode, synced, name)
+
+    def test_close_fsyncs_dirs(self):
+        if platform.system() == "Windows":
+            raise unittest.SkipTest("directories cannot be fsynced on Windows")
+        ss = self.create("test_close_fsyncs_dirs")
+        already,writers = self.allocate(ss, "si1", [0], 75)
+        wb = writers[0]
+        wb.remote_write(0, "%25d" % 0)
+        incomingdir = self._inode(os.path.dirname(wb.incominghome))
+        synced = self._record_fsyncs()
+        wb.remote_close()
+        sharedir = os.path.dirname(wb.finalhome)
+        self._check_dirs_synced(synced,
+            [("incoming", incomingdir),
+             ("bucket", self._inode(sharedir)),
+             # the bucket directory was new, so its prefix changed too
+             ("prefix", self._inode(os.path.dirname(sharedir)))])
+
+    def test_group_fsyncs_dirs(self):
+        if platform.system() == "Windows":
+            raise unittest.SkipTest("directories cannot be fsynced on Windows")
+        workdir = self.workdir("test_group_fsyncs_dirs")
+        ss = StorageServer(workdir, "\x00" * 20, fsync="group")
+        ss.setServiceParent(self.sparent)
+        already,writers = self.allocate(ss, "si1", [0,1,2], 75)
+        for i,wb in writers.items():
+            wb.remote_write(0, "%25d" % i)
+        incomingdir = self._inode(os.path.dirname(writers[0].incominghome))
+        synced = self._record_fsyncs()
+        d = defer.gatherResults([wb.remote_close()
+                                 for wb in writers.values()])
+        def _synced(ign):
+            sharedir = os.path.dirname(writers[0].finalhome)
+            self._check_dirs_synced(synced,
+                [("incoming", incomingdir),
+                 ("bucket", self._inode(sharedir))])
+            # the three files were synced in one group, and the directory
+            # they were all moved into was synced once, in the next one
+            self.failUnlessEqual(ss.group_syncer.groups, 2)
+            self.failUnlessEqual(synced.count(self._inode(sharedir)), 1)
+        d.addCallback(_synced)
+        return d
+
+
+class FilePoolTest(unittest.TestCase):
+    def make_files(self, name, count):
+        basedir = os.path.join("storage", "FilePool", name)
+        fileutil.make_dirs(basedir)
+        filenames = []
+        for i in range(count):
+            fn = os.path.join(basedir, "%d" % i)
+            fileutil.write(fn, ("%d" % i) * 100)
+            filenames.append(fn)
+        return filenames
+
+    def test_read(self):
+        fn = self.make_files("test_read", 1)[0]
+        pool = FilePool(max_open=2)
+        self.failUnlessEqual(pool.read(fn, 10, 5), "00000")
+        self.failUnlessEqual(pool.read(fn, 95, 10), "00000")
+        self.failUnlessEqual(pool.read(fn, 200, 10), "")
+        self.failUnlessEqual(pool.get_stats(),
+                             {"open": 1, "hits": 2, "misses": 1})
+        pool.close_all()
+        self.failUnlessEqual(pool.get_stats()["open"], 0)
+
+    def test_lru(self):
+        fns = self.make_files("test_lru", 3)
+        pool = FilePool(max_open=2)
+        pool.read(fns[0], 0, 1)
+        pool.read(fns[1], 0, 1)
+        pool.read(fns[0], 0, 1) # now fns[1] is the least recently used
+        pool.read(fns[2], 0, 1) # which evicts fns[1]
+        self.failUnlessEqual(pool.get_stats(),
+                             {"open": 2, "hits": 1, "misses": 3})
+        pool.read(fns[0], 0, 1)
+        self.failUnlessEqual(pool.get_stats()["hits"], 2)
+        pool.read(fns[1], 0, 1)
+        self.failUnlessEqual(pool.get_stats()["misses"], 4)
+        pool.close_all()
+
+    def test_discard(self):
+        fn = self.make_files("test_discard", 1)[0]
+        pool = FilePool()
+        self.failUnlessEqual(pool.read(fn, 0, 2), "00")
+        pool.discard(fn)
+        self.failUnlessEqual(pool.get_stats()["open"], 0)
+        os.unlink(fn)
+        self.failUnlessRaises(IOError, pool.read, fn, 0, 2)
+        pool.discard("no-such-file")
+
+    def test_changed_behind_our_back(self):
+        fns = self.make_files("test_changed_behind_our_back", 3)
+        pool = FilePool()
+        for (fn, c) in zip(fns, "012"):
+            self.failUnlessEqual(pool.read(fn, 0, 2), c*2)
+        # a file that is rewritten in place is read afresh
+        fileutil.write(fns[2], "new")
+        self.failUnlessEqual(pool.read(fns[2], 0, 3), "new")
+        if os.name == "nt":
+            raise unittest.SkipTest("open files cannot be deleted on Windows")
+        os.unlink(fns[0])
+        self.failUnlessRaises(IOError, pool.read, fns[0], 0, 2)
+        self.failUnlessEqual(pool.get_stats()["open"], 2)
+        # so is a file that was replaced
+        os.unlink(fns[1])
+        fileutil.write(fns[1], "new")
+        self.failUnlessEqual(pool.read(fns[1], 0, 3), "new")
+        pool.close_all()
+
+    def test_server_readers_share_files(self):
+        basedir = os.path.join("storage", "FilePool", "test_server")
+        ss = StorageServer(basedir, "\x00" * 20)
+        already,writers = ss.remote_allocate_buckets("si1", "\x00"*32,
+                                                     "\x00"*32, [0], 100,
+                                                     FakeCanary())
+        writers[0].remote_write(0, "a"*100)
+        writers[0].remote_close()
+        for i in range(3):
+            b = ss.remote_get_buckets("si1")
+            self.failUnlessEqual(b[0].remote_read(10, 10), "a"*10)
+        # only the first reader had to open the file
+        self.failUnlessEqual(ss.share_file_pool.get_stats(),
+                             {"open": 1, "hits": 5, "misses": 1})
+        self.failUnlessEqual(ss.get_stats()["storage_server.file_pool.open"],
+                             1)
+        d = defer.maybeDeferred(ss.stopService)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(ss.share_file_pool.get_stats()["open"],
+                                           0))
+        return d
+
+
+class LeaseDBServer(Server):
+    """Run all of the Server tests again, with leases kept in a LeaseDB
+    instead of in the share files."""
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "LeaseDBServer", name)
+        return basedir
+
+    def create(self, name, reserved_space=0, klass=StorageServer):
+        workdir = self.workdir(name)
+        ss = klass(workdir, "\x00" * 20, reserved_space=reserved_space,
+                   stats_provider=FakeStatsProvider(), use_leasedb=True)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_leasedb_file(self):
+        ss = self.create("test_leasedb_file")
+        self.failUnless(os.path.exists(os.path.join(ss.storedir,
+                                                    "leasedb.sqlite")))
+        already,writers = self.allocate(ss, "si1", [0,1,2], 75)
+        for wb in writers.values():
+            wb.remote_close()
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.leasedb.shares"], 3)
+        self.failUnlessEqual(stats["storage_server.leasedb.leases"], 3)
+
+    def test_aborted_share_has_no_lease(self):
+        ss = self.create("test_aborted_share_has_no_lease")
+        already,writers = self.allocate(ss, "si1", [0,1], 75)
+        writers[0].remote_close()
+        writers[1].remote_abort()
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si1", 0), "immutable")
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si1", 1), None)
+
+    def test_renew_does_not_touch_share_files(self):
+        ss = self.create("test_renew_does_not_touch_share_files")
+        rs0 = hashutil.tagged_hash("blah", "renew")
+        cs0 = hashutil.tagged_hash("blah", "cancel")
+        already,writers = ss.remote_allocate_buckets("si0", rs0, cs0,
+                                                     [0,1], 75, FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, "a"*75)
+            wb.remote_close()
+        filenames = [fn for (shnum, fn) in ss._get_bucket_shares("si0")]
+        before = [open(fn, "rb").read() for fn in filenames]
+        old_expiration = list(ss.get_leases("si0"))[0].expiration_time
+
+        ss.remote_renew_lease("si0", rs0)
+        rs1 = hashutil.tagged_hash("blah", "renew-1")
+        cs1 = hashutil.tagged_hash("blah", "cancel-1")
+        ss.remote_add_lease("si0", rs1, cs1)
+
+        after = [open(fn, "rb").read() for fn in filenames]
+        self.failUnlessEqual(before, after)
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual(set([l.renew_secret for l in leases]),
+                             set([rs0, rs1]))
+        self.failUnless(leases[0].expiration_time >= old_expiration)
+
+    def _committed_shares(self, ss, storage_index):
+        db = sqlite3.connect(os.path.join(ss.storedir, "leasedb.sqlite"))
+        try:
+            rows = db.execute("SELECT shnum FROM shares WHERE storage_index=?",
+                              (si_b2a(storage_index),)).fetchall()
+        finally:
+            db.close()
+        return set([shnum for (shnum,) in rows])
+
+    def test_failed_renew_commits(self):
+        ss = self.create("test_failed_renew_commits")
+        rs0 = hashutil.tagged_hash("blah", "renew")
+        cs0 = hashutil.tagged_hash("blah", "cancel")
+        already,writers = ss.remote_allocate_buckets("si0", rs0, cs0,
+                                                     [0,1], 75, FakeCanary())
+        for wb in writers.values():
+            wb.remote_close()
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si0", cs0)
+        already,writers = self.allocate(ss, "si1", [0], 75)
+        writers[0].remote_close()
+        self.failUnlessEqual(self._committed_shares(ss, "si1"), set([0]))
+
+    def test_abandoned_share_iteration_commits(self):
+        ss = self.create("test_abandoned_share_iteration_commits")
+        already,writers = self.allocate(ss, "si0", [0,1], 75)
+        for wb in writers.values():
+            wb.remote_close()
+        # a caller that stops looking at the shares part way through must
+        # not leave a transaction open behind it
+        shares = ss._iter_share_files("si0")
+        shares.next()
+        already,writers = self.allocate(ss, "si1", [0], 75)
+        writers[0].remote_close()
+        self.failUnlessEqual(self._committed_shares(ss, "si1"), set([0]))
+
+    def test_migrate_leases(self):
+        # shares created by a server without a leasedb keep their leases in
+        # the share files. They must be picked up when the leasedb is turned
+        # on later.
+        workdir = self.workdir("test_migrate_leases")
+        ss = StorageServer(workdir, "\x00" * 20)
+        ss.setServiceParent(self.sparent)
+        rs0 = hashutil.tagged_hash("blah", "renew")
+        cs0 = hashutil.tagged_hash("blah", "cancel")
+        already,writers = ss.remote_allocate_buckets("si0", rs0, cs0,
+                                                     [0,1], 75, FakeCanary())
+        for wb in writers.values():
+            wb.remote_close()
+        rs1 = hashutil.tagged_hash("blah", "renew-1")
+        cs1 = hashutil.tagged_hash("blah", "cancel-1")
+        ss.remote_add_lease("si0", rs1, cs1)
+        ss.disownServiceParent()
+
+        ss = self.create("test_migrate_leases")
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si0", 0), None)
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual(set([l.renew_secret for l in leases]),
+                             set([rs0, rs1]))
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si0", 0), "immutable")
+
+        ss.remote_renew_lease("si0", rs1)
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si0", 1), "immutable")
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si0", cs0)
+
+    def test_mutable_leases(self):
+        ss = self.create("test_mutable_leases")
+        secrets = (hashutil.tagged_hash("blah", "we"),
+                   hashutil.tagged_hash("blah", "renew"),
+                   hashutil.tagged_hash("blah", "cancel"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        data = "x" * 100
+        writev("si1", secrets, {0: ([], [(0,data)], None)}, [])
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si1", 0), "mutable")
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 1)
+
+        ss.remote_renew_lease("si1", secrets[1])
+        e = self.failUnlessRaises(IndexError,
+                                  ss.remote_renew_lease, "si1", secrets[2])
+        self.failUnlessIn("I have leases accepted by nodeids:", str(e))
+
+        # deleting the share also removes it from the leasedb
+        writev("si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si1", 0), None)
+        self.failUnlessEqual(ss.leasedb.get_leases("si1", 0), [])
+
+
+class ShareIndexServer(Server, pollmixin.PollMixin):
+    """Run all of the Server tests again, with an in-memory share index."""
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "ShareIndexServer", name)
+        return basedir
+
+    def create(self, name, reserved_space=0, klass=StorageServer,
+               share_index="memory"):
+        workdir = self.workdir(name)
+        ss = klass(workdir, "\x00" * 20, reserved_space=reserved_space,
+                   stats_provider=FakeStatsProvider(),
+                   share_index=share_index)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def wait_for_index(self, ss):
+        def _done():
+            s = ss.share_indexer.get_state()
+            return s["last-cycle-finished"] is not None
+        return self.poll(_done)
+
+    def _no_listdir(self, *args):
+        self.fail("os.listdir should not have been called")
+
+    def test_bad_mode(self):
+        self.failUnlessRaises(ValueError, self.create, "test_bad_mode",
+                              share_index="bogus")
+
+    def test_lookups_avoid_disk(self):
+        ss = self.create("test_lookups_avoid_disk")
+        already,writers = self.allocate(ss, "si1", [0,1,2], 75)
+        for wb in writers.values():
+            wb.remote_write(0, "a"*75)
+            wb.remote_close()
+        d = self.wait_for_index(ss)
+        def _indexed(ign):
+            already,writers = self.allocate(ss, "si2", [3], 75)
+            writers[3].remote_close()
+            secrets = (hashutil.tagged_hash("blah", "we"),
+                       hashutil.tagged_hash("blah", "renew"),
+                       hashutil.tagged_hash("blah", "cancel"))
+            writev = ss.remote_slot_testv_and_readv_and_writev
+            writev("si3", secrets, {0: ([], [(0,"data")], None)}, [])
+
+            self.patch(os, "listdir", self._no_listdir)
+            self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                                 set([0,1,2]))
+            self.failUnlessEqual(set(ss.remote_get_buckets("si2").keys()),
+                                 set([3]))
+            self.failUnlessEqual(ss.remote_get_buckets("nonexistent"), {})
+            self.failUnlessEqual(ss.remote_slot_readv("si3", [], [(0,4)]),
+                                 {0: ["data"]})
+            self.failUnlessEqual(ss.remote_slot_readv("nonexistent", [],
+                                                      [(0,4)]),
+                                 {})
+            ss.remote_renew_lease("si3", secrets[1])
+
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.share_index.buckets"],
+                                 3)
+            self.failUnlessEqual(stats["storage_server.share_index.shares"],
+                                 5)
+            self.failUnlessEqual(
+                stats["storage_server.share_index.indexed-prefixes"], 1024)
+        d.addCallback(_indexed)
+        return d
+
+    def test_deleted_shares(self):
+        ss = self.create("test_deleted_shares")
+        d = self.wait_for_index(ss)
+        def _indexed(ign):
+            secrets = (hashutil.tagged_hash("blah", "we"),
+                       hashutil.tagged_hash("blah", "renew"),
+                       hashutil.tagged_hash("blah", "cancel"))
+            writev = ss.remote_slot_testv_and_readv_and_writev
+            writev("si1", secrets, {0: ([], [(0,"data")], None),
+                                    1: ([], [(0,"data")], None)}, [])
+            self.failUnlessEqual(ss.share_index.get_shares("si1").keys(),
+                                 [0, 1])
+            writev("si1", secrets, {0: ([], [], 0)}, [])
+            self.failUnlessEqual(ss.share_index.get_shares("si1").keys(),
+                                 [1])
+            already,writers = self.allocate(ss, "si2", [0], 75)
+            writers[0].remote_abort()
+            self.failUnlessEqual(ss.share_index.get_shares("si2"), {})
+        d.addCallback(_indexed)
+        return d
+
+    def test_new_share_before_crawl(self):
+        # shares that were on disk before the server started
+        ss = self.create("test_new_share_before_crawl", share_index=None)
+        already,writers = self.allocate(ss, "si1", [0,1], 75)
+        for wb in writers.values():
+            wb.remote_close()
+        ss.disownServiceParent()
+        ss = self.create("test_new_share_before_crawl")
+        # a new share in a prefix that has not been crawled yet must not
+        # hide the old ones
+        already,writers = self.allocate(ss, "si1", [2], 75)
+        self.failUnlessEqual(already, set([0,1]))
+        writers[2].remote_close()
+        self.failUnlessEqual(ss.share_index.get_shares("si1"), None)
+        self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                             set([0,1,2]))
+        d = self.wait_for_index(ss)
+        def _indexed(ign):
+            self.failUnlessEqual(sorted(ss.share_index.get_shares("si1")),
+                                 [0,1,2])
+            self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                                 set([0,1,2]))
+        d.addCallback(_indexed)
+        return d
+
+    def test_persistent(self):
+        ss = self.create("test_persistent", share_index="persistent")
+        already,writers = self.allocate(ss, "si1", [0,1], 75)
+        for wb in writers.values():
+            wb.remote_close()
+        d = self.wait_for_index(ss)
+        d.addCallback(lambda ign: ss.disownServiceParent())
+        def _restart(ign):
+            picklefile = os.path.join(ss.storedir, "share_index.pickle")
+            self.failUnless(os.path.exists(picklefile))
+            ss2 = self.create("test_persistent", share_index="persistent")
+            self.failUnless(ss2.share_index.loaded)
+            # a crash from now on must not leave a stale index behind
+            self.failIf(os.path.exists(picklefile))
+            self.patch(os, "listdir", self._no_listdir)
+            self.failUnlessEqual(set(ss2.remote_get_buckets("si1").keys()),
+                                 set([0,1]))
+            self.failUnlessEqual(ss2.remote_get_buckets("si2"), {})
+        d.addCallback(_restart)
+        return d
+
+
+class PackedServer(Server):
+    """Run all of the Server tests again, with immutable shares kept in
+    containers by the packed backend."""
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "PackedServer", name)
+        return basedir
+
+    def create(self, name, reserved_space=0, klass=StorageServer):
+        workdir = self.workdir(name)
+        ss = klass(workdir, "\x00" * 20, reserved_space=reserved_space,
+                   stats_provider=FakeStatsProvider(), backend="packed")
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def write_shares(self, ss, storage_index, sharenums, size):
+        already,writers = self.allocate(ss, storage_index, sharenums, size)
+        for shnum,wb in writers.items():
+            wb.remote_write(0, ("%d" % shnum) * size)
+            wb.remote_close()
+
+    def test_bad_backend(self):
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_bad_backend"), "\x00" * 20,
+                              backend="bogus")
+
+    def test_shares_are_packed(self):
+        ss = self.create("test_shares_are_packed")
+        self.failUnless(ss.leasedb)
+        self.write_shares(ss, "si1", [0,1,2], 100)
+        self.write_shares(ss, "si2", [3], 50)
+        # no share files were created
+        self.failUnlessEqual(os.listdir(ss.sharedir), ["incoming"])
+        self.failUnlessEqual(os.listdir(ss.incomingdir), [])
+        self.failUnlessEqual(os.listdir(ss.backend.packdir), ["00000000.pack"])
+        self.failUnless(ss.have_shares())
+
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(set(b.keys()), set([0,1,2]))
+        self.failUnlessEqual(b[1].remote_read(0, 5), "11111")
+        self.failUnlessEqual(b[1].remote_read(95, 10), "11111")
+        self.failUnlessEqual(b[1].remote_read(100, 10), "")
+        self.failUnlessEqual(ss.remote_get_buckets("si2")[3].remote_read(0, 50),
+                             "3" * 50)
+        already,writers = self.allocate(ss, "si1", [2,3], 100)
+        self.failUnlessEqual(already, set([0,1,2]))
+        self.failUnlessEqual(set(writers.keys()), set([3]))
+        writers[3].remote_abort()
+
+        prefix = si_b2a("si1")[:2]
+        self.failUnlessIn(si_b2a("si1"), ss.backend.list_buckets(prefix))
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.packed.containers"], 1)
+        self.failUnlessEqual(stats["storage_server.packed.shares"], 4)
+        self.failUnlessEqual(stats["storage_server.packed.container-bytes"],
+                             4*0x22 + 350)
+
+    def test_large_shares_are_not_packed(self):
+        ss = self.create("test_large_shares_are_not_packed")
+        ss.backend.max_packed_share_size = 100
+        self.write_shares(ss, "si1", [0], 100)
+        self.write_shares(ss, "si1", [1], 101)
+        self.failUnlessEqual(ss.backend.get_container_shares("si1"),
+                             [(0, 0x22 + 100)])
+        self.failUnlessEqual([shnum for (shnum, fn)
+                              in ss._get_bucket_shares("si1")], [1])
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 200), "0" * 100)
+        self.failUnlessEqual(b[1].remote_read(0, 200), "1" * 101)
+
+    def test_restart(self):
+        ss = self.create("test_restart")
+        self.write_shares(ss, "si1", [0,1], 100)
+        ss.disownServiceParent()
+        picklefile = os.path.join(ss.backend.packdir, "index.pickle")
+        self.failUnless(os.path.exists(picklefile))
+
+        # a clean restart loads the index
+        ss = self.create("test_restart")
+        self.failIf(os.path.exists(picklefile))
+        self.write_shares(ss, "si2", [0], 100)
+        self.failUnlessEqual(ss.remote_get_buckets("si1")[1].remote_read(0, 5),
+                             "11111")
+
+        # after a crash, the index is rebuilt from the containers
+        ss.backend.get_share_leases("si1", 0).cancel_lease(
+            list(ss.get_leases("si1"))[0].cancel_secret)
+        ss.disownServiceParent()
+        os.unlink(picklefile)
+        ss2 = self.create("test_restart")
+        self.failUnlessEqual(set(ss2.remote_get_buckets("si1").keys()),
+                             set([1]))
+        self.failUnlessEqual(ss2.remote_get_buckets("si2")[0].remote_read(0, 5),
+                             "00000")
+        self.failUnlessEqual(ss2.get_stats()["storage_server.packed.shares"],
+                             2)
+
+    def test_crash_before_lease(self):
+        # a share that was appended, but whose lease was never recorded
+        # because the server crashed, gets a lease when the index is rebuilt
+        ss = self.create("test_crash_before_lease")
+        self.write_shares(ss, "si1", [0,1], 100)
+        [old_lease] = ss.leasedb.get_leases("si1", 0)
+        ss.leasedb.remove_share("si1", 1)
+        ss.disownServiceParent()
+        os.unlink(os.path.join(ss.backend.packdir, "index.pickle"))
+
+        ss = self.create("test_crash_before_lease")
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si1", 1), "immutable")
+        [lease] = ss.leasedb.get_leases("si1", 1)
+        self.failIfEqual(lease.renew_secret, old_lease.renew_secret)
+        self.failUnless(lease.get_expiration_time() > time.time())
+        # the other share kept the lease it had
+        [lease] = ss.leasedb.get_leases("si1", 0)
+        self.failUnlessEqual(lease.renew_secret, old_lease.renew_secret)
+
+    def test_bad_container_version(self):
+        # a damaged record (e.g. from a crash in the middle of an append)
+        # ends the container: it and everything after it are dropped
+        ss = self.create("test_bad_container_version")
+        self.write_shares(ss, "si1", [0], 10)
+        self.write_shares(ss, "si2", [0], 10)
+        ss.disownServiceParent()
+        fn = os.path.join(ss.backend.packdir, "00000000.pack")
+        os.unlink(os.path.join(ss.backend.packdir, "index.pickle"))
+        f = open(fn, "rb+")
+        f.seek(0x22 + 10)
+        f.write("XXXX")
+        f.close()
+
+        ss = self.create("test_bad_container_version")
+        self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                             set([0]))
+        self.failUnlessEqual(ss.remote_get_buckets("si2"), {})
+        self.failUnlessEqual(os.path.getsize(fn), 0x22 + 10)
+
+    def test_empty_containers_are_removed(self):
+        ss = self.create("test_empty_containers_are_removed")
+        ss.backend.container_size = 250
+        self.write_shares(ss, "si1", [0,1], 100)
+        self.write_shares(ss, "si2", [0,1], 100)
+        self.failUnlessEqual(sorted(os.listdir(ss.backend.packdir)),
+                             ["00000000.pack", "00000001.pack"])
+        def cancel(si, shnum):
+            sl = ss.backend.get_share_leases(si, shnum)
+            return sl.cancel_lease(list(sl.get_leases())[0].cancel_secret)
+
+        self.failUnlessEqual(cancel("si1", 0), 0x22 + 100)
+        self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                             set([1]))
+        self.failUnlessEqual(len(os.listdir(ss.backend.packdir)), 2)
+        cancel("si1", 1)
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        self.failUnlessEqual(ss.leasedb.get_sharetype("si1", 1), None)
+        # the first container is empty now
+        self.failUnlessEqual(os.listdir(ss.backend.packdir),
+                             ["00000001.pack"])
+        # but the one that is still being appended to is kept
+        cancel("si2", 0)
+        cancel("si2", 1)
+        self.failUnlessEqual(os.listdir(ss.backend.packdir),
+                             ["00000001.pack"])
+        self.failIf(ss.have_shares())
+
 
 class MutableServer(unittest.TestCase):
 
@@ -938,6 +1820,93 @@ class MutableServer(unittest.TestCase):
         read_answer = read("si1", [0], [(0,10)])
         self.failUnlessEqual(read_answer, {})
 
+
+    def test_container_growth(self):
+        ss = self.create("test_container_growth")
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(),
+                      set([0]), 100)
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        def container_size():
+            f = open(fn, "rb")
+            offset = MutableShareFile(fn)._read_extra_lease_offset(f)
+            f.close()
+            return offset - MutableShareFile.DATA_OFFSET
+        rstaraw("si1", secrets, {0: ([], [(0, "a"*1000)], None)}, [])
+        self.failUnlessEqual(container_size(), 1000)
+        # growing the share makes the container half again as large, so the
+        # next few small appends don't have to move the leases
+        rstaraw("si1", secrets, {0: ([], [(1000, "b"*10)], None)}, [])
+        self.failUnlessEqual(container_size(), 1500)
+        rstaraw("si1", secrets, {0: ([], [(1010, "c"*490)], None)}, [])
+        self.failUnlessEqual(container_size(), 1500)
+        # the slack is not visible to readers
+        answer = ss.remote_slot_readv("si1", [0], [(0, 2000)])
+        self.failUnlessEqual(answer, {0: ["a"*1000 + "b"*10 + "c"*490]})
+        self.failUnlessEqual(len(list(MutableShareFile(fn).get_leases())), 2)
+        # a large write grows it to what is needed
+        rstaraw("si1", secrets, {0: ([], [(0, "d"*4000)], None)}, [])
+        self.failUnlessEqual(container_size(), 4000)
+
+    def test_writev_vectors(self):
+        ss = self.create("test_writev_vectors")
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(),
+                      set([0]), 100)
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        # many small vectors, adjacent and not, in one call
+        datav = [(i, "%d" % (i % 10)) for i in range(100)]
+        datav += [(200, "x"), (150, "y"), (150, "z")]
+        answer = rstaraw("si1", secrets,
+                         {0: ([(0, 1, "eq", "")], datav, None)},
+                         [(0, 5)])
+        self.failUnlessEqual(answer, (True, {0: [""]}))
+        expected = ("0123456789" * 10 + "\x00" * 50 + "z" + "\x00" * 49
+                    + "x")
+        answer = ss.remote_slot_readv("si1", [0], [(0, 1000)])
+        self.failUnlessEqual(answer, {0: [expected]})
+        # the test vectors see the data as it was before this call's writes
+        answer = rstaraw("si1", secrets,
+                         {0: ([(0, 3, "eq", "012")], [(0, "abc")], 150)},
+                         [(0, 3)])
+        self.failUnlessEqual(answer, (True, {0: ["012"]}))
+        answer = ss.remote_slot_readv("si1", [0], [(0, 1000)])
+        self.failUnlessEqual(answer, {0: ["abc" + expected[3:150]]})
+
+        # a vector that would make the container too large is refused
+        # before any of them are written
+        TOOBIG = MutableShareFile.MAX_SIZE + 10
+        self.failUnlessRaises(DataTooLargeError,
+                              rstaraw, "si1", secrets,
+                              {0: ([], [(0, "def"), (TOOBIG, "a")], None)},
+                              [])
+        answer = ss.remote_slot_readv("si1", [0], [(0, 3)])
+        self.failUnlessEqual(answer, {0: ["abc"]})
+
+    def test_open_share(self):
+        ss = self.create("test_open_share")
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(),
+                      set([0]), 100)
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        msf = MutableShareFile(fn)
+        msf.open()
+        msf.writev([(0, "a"*100)], None)
+        msf.add_or_renew_lease(LeaseInfo(1, "r"*32, "c"*32, 1000, "n"*20))
+        msf.writev([(100, "b"*100)], None)
+        self.failUnlessEqual(msf.get_size(), os.stat(fn).st_size)
+        self.failUnlessEqual(msf.readv([(0, 300)]), ["a"*100 + "b"*100])
+        msf.close()
+        # and another instance, which reads the header afresh, agrees
+        msf2 = MutableShareFile(fn)
+        self.failUnlessEqual(msf2.readv([(0, 300)]), ["a"*100 + "b"*100])
+        self.failUnlessEqual(len(list(msf2.get_leases())), 2)
+        self.failUnless(msf2.check_testv([(100, 1, "eq", "b")]))
+
     def test_allocate(self):
         ss = self.create("test_allocate")
         self.allocate(ss, "si1", "we1", self._lease_secret.next(),
@@ -1209,6 +2178,13 @@ class MutableServer(unittest.TestCase):
                                       1: ["1"*10],
                                       2: ["2"*10]})
 
+        # adjacent vectors are read together, but must be returned
+        # separately, and truncated individually at the end of the data
+        answer = read("si1", [0], [(0, 10), (10, 80), (90, 20), (110, 5),
+                                   (5, 5), (95, 10)])
+        self.failUnlessEqual(answer, {0: ["0"*10, "0"*80, "0"*10, "",
+                                          "0"*5, "0"*5]})
+
     def compare_leases_without_timestamps(self, leases_a, leases_b):
         self.failUnlessEqual(len(leases_a), len(leases_b))
         for i in range(len(leases_a)):
@@ -2813,6 +3789,11 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # the histogram buckets are less than 1% wide
+        self.failUnless(abs(value - expected) <= 0.01 * expected,
+                        (value, expected, output))
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2829,27 +3810,27 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
         self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
+        self.failUnlessClose(output["renew"]["01_0_percentile"],  10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
         self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
         self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
@@ -2859,7 +3840,7 @@ class Stats(unittest.TestCase):
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
         self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
@@ -2869,7 +3850,7 @@ class Stats(unittest.TestCase):
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2879,6 +3860,105 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+    def test_latency_windows(self):
+        ss = self.create("test_latency_windows")
+        now = [1000000.0]
+        ss.latencies._now = lambda: now[0]
+        for i in range(100):
+            ss.add_latency("read", 1.0)
+        now[0] += 10*60
+        for i in range(100):
+            ss.add_latency("read", 3.0)
+        self.failUnlessEqual(ss.get_latencies()["read"]["samplesize"], 200)
+        self.failUnlessEqual(ss.get_latencies()["read"]["mean"], 2.0)
+        # the last minute only has the slow ones
+        output = ss.get_latencies(60)
+        self.failUnlessEqual(output["read"]["samplesize"], 100)
+        self.failUnlessClose(output["read"]["50_0_percentile"], 3.0, output)
+        # after 15 minutes, the fast ones are forgotten
+        now[0] += 6*60
+        self.failUnlessEqual(ss.get_latencies()["read"]["samplesize"], 100)
+        now[0] += 15*60
+        self.failUnlessEqual(ss.get_latencies(), {})
+        self.failUnlessEqual(ss.latencies._windows, [])
+
+    def test_latency_breakdown(self):
+        class FakeRemoteCanary(FakeCanary):
+            def __init__(self, tubid):
+                FakeCanary.__init__(self)
+                self.tubid = tubid
+            def getRemoteTubID(self):
+                return self.tubid
+        ss = self.create("test_latency_breakdown")
+        for (tubid, size) in [("client1", 1000), ("client2", 100000)]:
+            already,writers = ss.remote_allocate_buckets(
+                "si-"+tubid, "\x00"*32, "\x00"*32, [0], size,
+                FakeRemoteCanary(tubid))
+            writers[0].remote_write(0, "a"*size)
+            writers[0].remote_close()
+            ss.remote_get_buckets("si-"+tubid)[0].remote_read(0, size)
+
+        by_size = ss.get_latencies_by_size()
+        self.failUnlessEqual(sorted(by_size.keys()),
+                             ["allocate", "close", "read", "write"])
+        self.failUnlessEqual(sorted(by_size["write"].keys()),
+                             ["1MiB", "4KiB"])
+        self.failUnlessEqual(by_size["read"]["4KiB"]["samplesize"], 1)
+        by_client = ss.get_latencies_by_client()
+        self.failUnlessEqual(sorted(by_client.keys()),
+                             ["allocate", "close", "write"])
+        self.failUnlessEqual(sorted(by_client["close"].keys()),
+                             ["client1", "client2"])
+        stats = ss.get_stats()
+        self.failUnlessIn("storage_server.latencies_by_size.read.1MiB.samplesize",
+                          stats)
+
+        # only so many clients are told apart
+        ss.latencies.max_clients = 2
+        ss.add_latency("write", 1.0, client="client3")
+        self.failUnlessEqual(sorted(ss.get_latencies_by_client()["write"]),
+                             ["client1", "client2", "other"])
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_empty(self):
+        h = LatencyHistogram()
+        self.failUnlessEqual(h.get_percentiles([0.5]), [None])
+        self.failUnlessEqual(h.get_stats()["samplesize"], 0)
+
+    def test_accuracy(self):
+        h = LatencyHistogram()
+        samples = [0.0] + [1.0001**i * 1e-6 for i in range(200000)]
+        for s in samples:
+            h.add(s)
+        fractions = [0.0, 0.01, 0.5, 0.99, 0.999]
+        for (f, value) in zip(fractions, h.get_percentiles(fractions)):
+            expected = samples[int(f*len(samples))]
+            self.failUnless(abs(value - expected) <= 0.01 * expected,
+                            (f, value, expected))
+        # memory depends on the range of the samples, not their number
+        self.failUnless(len(h.buckets) < 40*64, len(h.buckets))
+        self.failUnlessEqual(h.min, 0.0)
+        self.failUnlessEqual(h.get_percentiles([1.0]), [h.max])
+
+    def test_merge(self):
+        a = LatencyHistogram()
+        b = LatencyHistogram()
+        for i in range(100):
+            a.add(0.001 * i)
+            b.add(0.001 * (i + 100))
+        a.merge(b)
+        self.failUnlessEqual(a.count, 200)
+        self.failUnlessEqual(a.min, 0.0)
+        self.failUnlessEqual(a.max, 0.199)
+        [median] = a.get_percentiles([0.5])
+        self.failUnless(abs(median - 0.1) < 0.001, median)
+
+    def test_negative(self):
+        h = LatencyHistogram()
+        h.add(-1.0)
+        self.failUnlessEqual(h.get_percentiles([0.5]), [0.0])
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -3446,6 +4526,185 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_expire_age_leasedb(self):
+        basedir = "storage/LeaseCrawler/expire_age_leasedb"
+        fileutil.make_dirs(basedir)
+        # create the shares (with in-file leases) first, then switch the
+        # server over to a leasedb: the crawler migrates the leases as it
+        # goes, and then expires them from the database
+        old_ss = StorageServer(basedir, "\x00" * 20)
+        self.make_shares(old_ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        now = time.time()
+        sf0 = list(old_ss._iter_share_files(immutable_si_0))[0]
+        self.backdate_lease(sf0, self.renew_secrets[0], now - 1000)
+        sf1 = list(old_ss._iter_share_files(immutable_si_1))[0]
+        self.backdate_lease(sf1, self.renew_secrets[1], now - 1000)
+        sf2 = list(old_ss._iter_share_files(mutable_si_2))[0]
+        self.backdate_lease(sf2, self.renew_secrets[3], now - 1000)
+        sf3 = list(old_ss._iter_share_files(mutable_si_3))[0]
+        self.backdate_lease(sf3, self.renew_secrets[4], now - 1000)
+        del old_ss
+
+        ss = InstrumentedStorageServer(basedir, "\x00" * 20,
+                                       expiration_enabled=True,
+                                       expiration_mode="age",
+                                       expiration_override_lease_duration=2000,
+                                       use_leasedb=True)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        ss.setServiceParent(self.s)
+
+        def count_shares(si):
+            return len(list(ss._get_bucket_shares(si)))
+        def count_leases(si):
+            return len(list(ss.get_leases(si)))
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+            self.failUnlessEqual(ss.leasedb.get_lease_counts(), (2, 2))
+            # the in-file leases were left alone
+            self.failUnlessEqual(len(list(sf1.get_leases())), 2)
+
+            last = lc.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_space_used_recounted(self):
+        basedir = "storage/LeaseCrawler/space_used_recounted"
+        fileutil.make_dirs(basedir)
+        ss = InstrumentedStorageServer(basedir, "\x00" * 20)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        used = 0
+        for si in self.sis:
+            for (shnum, fn) in ss._get_bucket_shares(si):
+                used += os.stat(fn).st_size
+        # pretend that the server crashed, and lost count
+        ss.space_accountant.used = None
+        ss.setServiceParent(self.s)
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(ss.space_accountant.used, used)
+            self.failUnlessEqual(ss.get_stats()["storage_server.space.used"],
+                                 used)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_expire_cutoff_date_packed(self):
+        basedir = "storage/LeaseCrawler/expire_cutoff_date_packed"
+        fileutil.make_dirs(basedir)
+        # every lease was granted before this cutoff, so every share goes
+        now = time.time()
+        ss = InstrumentedStorageServer(basedir, "\x00" * 20,
+                                       expiration_enabled=True,
+                                       expiration_mode="cutoff-date",
+                                       expiration_cutoff_date=int(now+3600),
+                                       backend="packed")
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        self.failUnlessEqual(ss.backend.get_container_shares(immutable_si_1),
+                             [(0, 0x22 + 1000)])
+        ss.setServiceParent(self.s)
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            for si in self.sis:
+                self.failUnlessEqual(ss.backend.get_shnums(si), [])
+            self.failUnlessEqual(ss.leasedb.get_lease_counts(), (0, 0))
+            self.failUnlessEqual(ss.backend.get_stats()["shares"], 0)
+
+            last = lc.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-buckets-immutable"], 2)
+            self.failUnlessEqual(rec["actual-shares-immutable"], 2)
+            self.failUnlessEqual(rec["actual-sharebytes-immutable"],
+                                 2 * (0x22 + 1000))
+            self.failUnlessEqual(rec["actual-shares-mutable"], 2)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_expire_cutoff_date_threaded(self):
+        basedir = "storage/LeaseCrawler/expire_cutoff_date_threaded"
+        fileutil.make_dirs(basedir)
+        now = time.time()
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="cutoff-date",
+                           expiration_cutoff_date=int(now+3600),
+                           expiration_threads=2,
+                           expiration_io_rate=1000)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.failUnlessEqual(lc.threads, 2)
+        self.failUnlessEqual(lc.allowed_io_rate, 1000)
+        self.make_shares(ss)
+        ss.setServiceParent(self.s)
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            for si in self.sis:
+                self.failUnlessEqual(ss.backend.get_shnums(si), [])
+            last = lc.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-buckets"], 4)
+            self.failUnlessEqual(rec["actual-shares-immutable"], 2)
+            self.failUnlessEqual(rec["actual-shares-mutable"], 2)
+            self.failUnlessEqual(last["leases-per-share-histogram"],
+                                 {1: 2, 2: 2})
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_renewed_after_read(self):
+        basedir = "storage/LeaseCrawler/renewed_after_read"
+        fileutil.make_dirs(basedir)
+        now = time.time()
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="cutoff-date",
+                           expiration_cutoff_date=int(now+3600))
+        lc = ss.lease_checker
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        si_s = si_b2a(immutable_si_0)
+        prefixdir = os.path.join(ss.sharedir, si_s[:2])
+        data = lc.read_bucket(si_s[:2], prefixdir, si_s)
+        # in threaded mode, a client can renew the lease after it has been
+        # read, but before it is processed
+        sharefile = os.path.join(prefixdir, si_s, "0")
+        ShareFile(sharefile).renew_lease(self.renew_secrets[0],
+                                         int(now + 40*24*60*60))
+        lc.process_bucket_data(0, si_s[:2], prefixdir, si_s, data)
+        self.failUnlessEqual(ss.backend.get_shnums(immutable_si_0), [0])
+        rec = lc.state["cycle-to-date"]["space-recovered"]
+        self.failUnlessEqual(rec["examined-shares"], 1)
+        self.failUnlessEqual(rec["actual-shares"], 1)
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
@@ -3776,6 +5035,11 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         lc = ss.lease_checker
         lc.slow_start = 0
         lc.cpu_slice = -1.0 # stop quickly
+        # the progress-measurer counts finished prefixes, and the buckets
+        # done in the current one, so never let the crawler finish anything
+        def _stop_before_first_prefix(*args):
+            raise TimeSliceExceeded()
+        lc.process_prefixdir = _stop_before_first_prefix
 
         self.make_shares(ss)
 
@@ -3783,14 +5047,11 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
 
         d = fireEventually()
         def _check(ignored):
-            # this should fire after the first bucket is complete, but before
-            # the first prefix is complete, so the progress-measurer won't
+            # this should fire after the first cycle has started, but before
+            # anything is complete, so the progress-measurer won't
             # think we've gotten far enough to raise our percent-complete
             # above 0%, triggering the cannot-predict-the-future code in
-            # expirer.py . This will have to change if/when the
-            # progress-measurer gets smart enough to count buckets (we'll
-            # have to interrupt it even earlier, before it's finished the
-            # first bucket).
+            # expirer.py .
             s = lc.get_state()
             if "cycle-to-date" not in s:
                 d2 = fireEventually()
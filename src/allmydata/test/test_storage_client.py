@@ -5,7 +5,7 @@ from allmydata.util import base32, yamlutil
 from twisted.trial import unittest
 from twisted.internet.defer import succeed, inlineCallbacks
 
-from allmydata.storage_client import NativeStorageServer
+from allmydata.storage_client import NativeStorageServer, LinkEstimate
 from allmydata.storage_client import StorageFarmBroker
 
 
@@ -43,6 +43,21 @@ class TestNativeStorageServer(unittest.TestCase):
         nss = NativeStorageServer("server_id", ann, None, {})
         self.assertEqual(nss.get_nickname(), "")
 
+class TestLinkEstimate(unittest.TestCase):
+    def test_estimate(self):
+        link = LinkEstimate()
+        self.assertEqual(link.get_round_trip_time(), None)
+        self.assertEqual(link.get_bandwidth(), None)
+        link.record_round_trip(0.2)
+        self.assertEqual(link.get_round_trip_time(), 0.2)
+        link.record_round_trip(0.6)
+        self.assertAlmostEqual(link.get_round_trip_time(), 0.3)
+        # small writes don't say much about the bandwidth
+        link.record_transfer(1000, 0.01)
+        self.assertEqual(link.get_bandwidth(), None)
+        link.record_transfer(100000, 0.1)
+        self.assertEqual(link.get_bandwidth(), 1000000)
+
 class TestStorageFarmBroker(unittest.TestCase):
 
     def test_static_servers(self):
@@ -5,15 +5,18 @@ from six.moves import cStringIO as StringIO
 from twisted.trial import unittest
 from twisted.python.failure import Failure
 from twisted.internet import defer, task
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, flushEventualQueue
 
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
-from allmydata.immutable import upload, encode
+from allmydata.crypto import aes
+from allmydata.immutable import upload, encode, uploadcache, uploadresume, \
+     layout
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
-from allmydata.util import log, base32
+from allmydata.util import log, base32, fileutil
 from allmydata.util.assertutil import precondition
 from allmydata.util.deferredutil import DeferredListShouldSucceed
+from allmydata.util.consumer import download_to_data
 from allmydata.test.no_network import GridTestMixin
 from allmydata.test.common_util import ShouldFailMixin
 from allmydata.util.happinessutil import servers_of_happiness, \
@@ -359,6 +362,30 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_data_large_threaded(self):
+        # hashing, encryption and erasure coding in a thread pool give the
+        # same file as doing them in the reactor thread
+        self.set_encoding_parameters(25, 25, 100, int(SIZE_LARGE / 2.5))
+        data = self.get_data(SIZE_LARGE)
+        threaded = upload.Uploader(threads=2)
+        threaded.parent = self.node
+        threaded.startService()
+        self.addCleanup(threaded.stopService)
+        self.failUnless(threaded._threadpool)
+        uris = []
+        d = threaded.upload(upload.Data(data, convergence="converge"))
+        d.addCallback(extract_uri)
+        d.addCallback(uris.append)
+        d.addCallback(lambda ign:
+                      self.u.upload(upload.Data(data, convergence="converge")))
+        d.addCallback(extract_uri)
+        d.addCallback(uris.append)
+        def _check(ign):
+            self._check_large(uris[0], SIZE_LARGE)
+            self.failUnlessEqual(uris[0], uris[1])
+        d.addCallback(_check)
+        return d
+
     def test_filehandle_zero(self):
         data = self.get_data(SIZE_ZERO)
         d = upload_filehandle(self.u, StringIO(data))
@@ -414,9 +441,9 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         return d
 
 class ServerErrors(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
-    def make_node(self, mode, num_servers=10):
+    def make_node(self, mode, num_servers=10, **kwargs):
         self.node = FakeClient(mode, num_servers)
-        self.u = upload.Uploader()
+        self.u = upload.Uploader(**kwargs)
         self.u.running = True
         self.u.parent = self.node
 
@@ -561,6 +588,19 @@ class ServerErrors(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         clock.advance(15)
         return d
 
+    def test_query_timeout(self):
+        clock = task.Clock()
+        self.make_node("timeout", query_timeout=5)
+        self.set_encoding_parameters(k=25, happy=1, n=50)
+        d = self.shouldFail(
+            UploadUnhappinessError, __name__,
+            "server selection failed",
+            upload_data, self.u, DATA, reactor=clock,
+        )
+        clock.advance(5)
+        clock.advance(5)
+        return d
+
 
 
 class FullServer(unittest.TestCase):
@@ -581,9 +621,9 @@ class FullServer(unittest.TestCase):
 
 class ServerSelection(unittest.TestCase):
 
-    def make_client(self, num_servers=50):
+    def make_client(self, num_servers=50, **kwargs):
         self.node = FakeClient(mode="good", num_servers=num_servers)
-        self.u = upload.Uploader()
+        self.u = upload.Uploader(**kwargs)
         self.u.running = True
         self.u.parent = self.node
 
@@ -756,6 +796,21 @@ class ServerSelection(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_query_servers(self):
+        # with query_servers=7, only the first 7 servers are offered shares
+        self.make_client(40, query_servers=7)
+        self.set_encoding_parameters(3, 7, 10)
+        data = self.get_data(SIZE_LARGE)
+        d = upload_data(self.u, data)
+        def _check(res):
+            servers_contacted = [s for s in self.node.last_servers
+                                 if s._alloc_queries != 0]
+            self.failUnlessEqual(len(servers_contacted), 7)
+            self.failUnlessEqual(sum([len(s.allocated) for s
+                                      in servers_contacted]), 10)
+        d.addCallback(_check)
+        return d
+
 class StorageIndex(unittest.TestCase):
     def test_params_must_matter(self):
         DATA = "I am some data"
@@ -823,6 +878,103 @@ class StorageIndex(unittest.TestCase):
         d.addCallback(_done)
         return d
 
+class AdaptiveSegmentSize(unittest.TestCase):
+    def test_policy(self):
+        segsize = upload.adaptive_segment_size
+        # small files are a single segment
+        self.failUnlessEqual(segsize(1000, 3, 128*1024), 1002)
+        # a little more than one segment is split into two equal ones
+        self.failUnlessEqual(segsize(200*1000, 3, 128*1024), 100002)
+        # large files have at most ADAPTIVE_SEGMENTS segments, of at most
+        # ADAPTIVE_MAX_SEGMENT_SIZE
+        self.failUnlessEqual(segsize(64*MiB, 1, 128*1024), 256*1024)
+        self.failUnlessEqual(segsize(10*1024*MiB, 1, 128*1024), MiB)
+        # unless max_segment_size is already larger
+        self.failUnlessEqual(segsize(100*MiB, 1, 2*MiB), 2*MiB)
+        # with a 100ms round trip at 1MB/s, each of the 4 blocks of a
+        # segment should take at least that long to send
+        self.failUnlessEqual(segsize(10*MiB, 4, 128*1024,
+                                     round_trip_time=0.1, bandwidth=1000*1000),
+                             388364)
+
+    def make_uploader(self):
+        self.node = FakeClient(mode="good", num_servers=10)
+        self.node.encoding_params = {"k": 3, "happy": 7, "n": 10,
+                                     "max_segment_size": 128*1024}
+        self.u = upload.Uploader(adaptive_segment_size=True)
+        self.u.running = True
+        self.u.parent = self.node
+
+    def upload(self, data, convergence):
+        d = self.u.upload(upload.Data(data, convergence=convergence))
+        def _uploaded(results):
+            [uploader] = self.u._all_uploads.keys()
+            self.u._all_uploads.clear()
+            return uploader.get_upload_status().get_segment_size()
+        d.addCallback(_uploaded)
+        return d
+
+    @defer.inlineCallbacks
+    def test_upload(self):
+        self.make_uploader()
+        for server in self.node.storage_broker.get_connected_servers():
+            link = server.get_link_estimate()
+            link.record_round_trip(0.1)
+            link.record_transfer(1000*1000, 1.0)
+        data = "a" * (1000*1000)
+        # the link is only taken into account for random-key uploads
+        segment_size = yield self.upload(data, convergence=None)
+        self.failUnlessEqual(segment_size, 250002)
+        segment_size = yield self.upload(data, convergence="")
+        self.failUnlessEqual(segment_size, 125001)
+
+    @defer.inlineCallbacks
+    def test_measure(self):
+        self.make_uploader()
+        yield self.upload("a" * (1000*1000), convergence=None)
+        for server in self.node.storage_broker.get_connected_servers():
+            link = server.get_link_estimate()
+            self.failIfEqual(link.get_round_trip_time(), None)
+            self.failIfEqual(link.get_bandwidth(), None)
+
+
+class HashOnly(unittest.TestCase):
+    def make_uploadable(self, data):
+        u = upload.Data(data, convergence="")
+        u.set_default_encoding_parameters(_Client.DEFAULT_ENCODING_PARAMETERS)
+        return upload.EncryptAnUploadable(u)
+
+    @defer.inlineCallbacks
+    def test_skip(self):
+        # a hash-only read does not encrypt anything, but the data after it
+        # is encrypted just as if it had
+        DATA = "".join([chr(i % 256) for i in range(3000)])
+        eu = self.make_uploadable(DATA)
+        eu.CHUNKSIZE = 700
+        whole = yield eu.read_encrypted(len(DATA), hash_only=False)
+        whole = "".join(whole)
+        expected_hash = yield eu.get_plaintext_hash()
+
+        encrypted = []
+        def _encrypt_data(encryptor, plaintext):
+            encrypted.append(len(plaintext))
+            return real_encrypt_data(encryptor, plaintext)
+        real_encrypt_data = aes.encrypt_data
+        self.patch(aes, "encrypt_data", _encrypt_data)
+
+        for skip in (1, 16, 1001):
+            eu = self.make_uploadable(DATA)
+            eu.CHUNKSIZE = 700
+            skipped = yield eu.read_encrypted(skip, hash_only=True)
+            self.failUnlessEqual(skipped, [])
+            self.failUnlessEqual(encrypted, [])
+            rest = yield eu.read_encrypted(len(DATA) - skip, hash_only=False)
+            self.failUnlessEqual("".join(rest), whole[skip:])
+            self.failUnlessEqual(sum(encrypted), len(DATA) - skip)
+            h = yield eu.get_plaintext_hash()
+            self.failUnlessEqual(h, expected_hash)
+            del encrypted[:]
+
 # copied from python docs because itertools.combinations was added in
 # python 2.6 and we support >= 2.4.
 def combinations(iterable, r):
@@ -2194,6 +2346,285 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         f.close()
         return None
 
+class FakeProducer(object):
+    paused = False
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+
+class Streaming(unittest.TestCase):
+    def test_read(self):
+        u = upload.StreamingUploadable(10, buffer_size=4)
+        p = FakeProducer()
+        u.registerProducer(p, True)
+        self.failUnlessEqual(self.successResultOf(u.get_size()), 10)
+        self.failUnlessEqual(u.convergence, None)
+        d = u.read(3)
+        self.assertNoResult(d)
+        u.write("ab")
+        self.assertNoResult(d)
+        u.write("cdefg")
+        self.failUnlessEqual("".join(self.successResultOf(d)), "abc")
+        # four bytes are still waiting to be read
+        self.failIf(p.paused)
+        u.write("h")
+        self.failUnless(p.paused)
+        self.failUnlessEqual("".join(self.successResultOf(u.read(4))), "defg")
+        self.failIf(p.paused)
+        d = u.read(3)
+        self.assertNoResult(d)
+        self.failIf(u.is_finished())
+        u.write("ij")
+        self.failUnless(u.is_finished())
+        self.failUnlessEqual("".join(self.successResultOf(d)), "hij")
+
+    def test_read_longer_than_buffer(self):
+        u = upload.StreamingUploadable(20, buffer_size=4)
+        p = FakeProducer()
+        u.registerProducer(p, True)
+        u.write("abcdef")
+        self.failUnless(p.paused)
+        # this cannot be satisfied from the buffer, so the producer must
+        # keep going until it can
+        d = u.read(10)
+        self.failIf(p.paused)
+        u.write("ghi")
+        self.failIf(p.paused)
+        self.assertNoResult(d)
+        u.write("jklmn")
+        self.failUnlessEqual("".join(self.successResultOf(d)), "abcdefghij")
+        self.failIf(p.paused)
+        u.write("opqrst")
+        self.failUnless(p.paused)
+        self.failUnlessEqual("".join(self.successResultOf(u.read(10))),
+                             "klmnopqrst")
+        self.failIf(p.paused)
+        self.failUnless(u.is_finished())
+
+    def test_short(self):
+        u = upload.StreamingUploadable(10)
+        d = u.read(8)
+        u.write("abcde")
+        u.finish()
+        self.failureResultOf(d, EOFError)
+
+    def test_too_long(self):
+        u = upload.StreamingUploadable(4)
+        d = u.read(4)
+        u.write("abcde")
+        self.failureResultOf(d, ValueError)
+
+    def test_upload(self):
+        DATA = "data" * 100000
+        c = FakeClient(mode="good")
+        u = upload.Uploader()
+        u.running = True
+        u.parent = c
+        uploadable = upload.StreamingUploadable(len(DATA))
+        d = u.upload(uploadable)
+        for i in range(0, len(DATA), 1000):
+            uploadable.write(DATA[i:i+1000])
+        def _done(results):
+            u = uri.from_string(results.get_uri())
+            self.failUnlessEqual(u.size, len(DATA))
+        d.addCallback(_done)
+        return d
+
+
+class DedupCache(GridTestMixin, unittest.TestCase):
+    def _get_cache(self, **kwargs):
+        dbfile = os.path.join(self.basedir, "upload-cache.sqlite")
+        cache = uploadcache.get_upload_cache(dbfile, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_cache(self):
+        self.basedir = "upload/DedupCache/cache"
+        fileutil.make_dirs(self.basedir)
+        cache = self._get_cache(max_entries=2, ttl=100)
+        now = [1000.0]
+        cache._now = lambda: now[0]
+        self.failUnlessEqual(cache.get("si1"), None)
+        cache.add("si1", "URI:CHK-Verifier:1", {0: set(["a"]), 1: set(["b"])})
+        self.failUnlessEqual(cache.get("si1"),
+                             ("URI:CHK-Verifier:1",
+                              {0: set(["a"]), 1: set(["b"])}))
+        now[0] += 1
+        cache.add("si2", "URI:CHK-Verifier:2", {0: set(["a", "b"])})
+        now[0] += 1
+        cache.get("si1")
+        # si2 is now the least recently used entry
+        now[0] += 1
+        cache.add("si3", "URI:CHK-Verifier:3", {})
+        self.failUnlessEqual(cache.get_entries(), 2)
+        self.failUnlessEqual(cache.get("si2"), None)
+        # si1 is too old
+        now[0] += 99
+        self.failUnlessEqual(cache.get("si1"), None)
+        self.failUnlessEqual(cache.get("si3")[0], "URI:CHK-Verifier:3")
+        self.failUnlessEqual(cache.get_entries(), 1)
+
+    def test_bad_file(self):
+        self.basedir = "upload/DedupCache/bad_file"
+        fileutil.make_dirs(self.basedir)
+        dbfile = os.path.join(self.basedir, "upload-cache.sqlite")
+        fileutil.write(dbfile, "not a database")
+        stderr = StringIO()
+        self.failUnlessEqual(uploadcache.get_upload_cache(dbfile, stderr),
+                             None)
+        self.failUnlessIn("upload cache file is unusable", stderr.getvalue())
+
+    @defer.inlineCallbacks
+    def test_upload(self):
+        self.basedir = "upload/DedupCache/upload"
+        self.set_up_grid()
+        cache = self._get_cache()
+        c0 = self.g.clients[0]
+        c0.getServiceNamed("uploader")._upload_cache = cache
+        DATA = "data" * 10000
+
+        ur1 = yield c0.upload(upload.Data(DATA, convergence=""))
+        self.failUnlessEqual(ur1.get_pushed_shares(), 10)
+        self.failUnlessEqual(cache.counters,
+                             {"hits": 0, "misses": 1, "stale": 0})
+
+        ur2 = yield c0.upload(upload.Data(DATA, convergence=""))
+        self.failUnlessEqual(ur2.get_uri(), ur1.get_uri())
+        self.failUnlessEqual(ur2.get_pushed_shares(), 0)
+        self.failUnlessEqual(ur2.get_preexisting_shares(), 10)
+        self.failUnlessEqual(cache.counters,
+                             {"hits": 1, "misses": 1, "stale": 0})
+        self.failUnlessEqual(cache.get_hit_rate(), 0.5)
+        stats = cache.get_stats()
+        self.failUnlessEqual(stats["uploader.dedup_cache.hits"], 1)
+        self.failUnlessEqual(stats["uploader.dedup_cache.entries"], 1)
+
+        # a different convergence secret gives a different file
+        ur3 = yield c0.upload(upload.Data(DATA, convergence="other"))
+        self.failUnlessEqual(ur3.get_pushed_shares(), 10)
+        # non-convergent uploads do not use the cache at all
+        yield c0.upload(upload.Data(DATA, convergence=None))
+        self.failUnlessEqual(cache.counters,
+                             {"hits": 1, "misses": 2, "stale": 0})
+        self.failUnlessEqual(cache.get_entries(), 2)
+
+        # once the shares are gone, the file is uploaded again
+        self.delete_shares_numbered(ur1.get_uri(), range(10))
+        ur4 = yield c0.upload(upload.Data(DATA, convergence=""))
+        self.failUnlessEqual(ur4.get_uri(), ur1.get_uri())
+        self.failUnlessEqual(ur4.get_pushed_shares(), 10)
+        self.failUnlessEqual(cache.counters,
+                             {"hits": 1, "misses": 3, "stale": 1})
+        self.failUnlessEqual(len(self.find_uri_shares(ur1.get_uri())), 10)
+
+
+class StallingData(upload.Data):
+    # reads stop (forever) once 'limit' bytes have been read
+    def __init__(self, data, convergence, limit):
+        upload.Data.__init__(self, data, convergence)
+        self._limit = limit
+        self.stalled = False
+
+    def read(self, length):
+        if self._filehandle.tell() >= self._limit:
+            self.stalled = True
+            return defer.Deferred()
+        return upload.Data.read(self, length)
+
+class ResumableUpload(GridTestMixin, unittest.TestCase):
+    def _get_db(self, **kwargs):
+        dbfile = os.path.join(self.basedir, "upload-resume.sqlite")
+        db = uploadresume.get_upload_resume_db(dbfile, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def test_db(self):
+        self.basedir = "upload/ResumableUpload/db"
+        fileutil.make_dirs(self.basedir)
+        db = self._get_db(ttl=100)
+        now = [1000.0]
+        db._now = lambda: now[0]
+        self.failUnlessEqual(db.get("si1"), None)
+        db.start("si1", (3, 7, 10, 131073))
+        self.failUnlessEqual(db.get("si1"), ((3, 7, 10, 131073), {}))
+        db.set_placement("si1", {0: "a"*20, 1: "b"*20})
+        self.failUnlessEqual(db.get("si1"),
+                             ((3, 7, 10, 131073), {0: "a"*20, 1: "b"*20}))
+        # starting again keeps the placement, in case this attempt is
+        # interrupted before it places the shares itself
+        db.start("si1", (3, 7, 10, 131073))
+        self.failUnlessEqual(db.get("si1"),
+                             ((3, 7, 10, 131073), {0: "a"*20, 1: "b"*20}))
+        db.set_placement("si1", {0: "c"*20})
+        self.failUnlessEqual(db.get("si1"),
+                             ((3, 7, 10, 131073), {0: "c"*20}))
+        # but different encoding parameters make it useless
+        db.start("si1", (3, 7, 10, 4096))
+        self.failUnlessEqual(db.get("si1"), ((3, 7, 10, 4096), {}))
+        db.start("si2", (1, 1, 1, 1000))
+        db.remove("si2")
+        self.failUnlessEqual(db.get("si2"), None)
+        now[0] += 101
+        self.failUnlessEqual(db.get("si1"), None)
+        self.failUnlessEqual(db.get_entries(), 0)
+
+    @defer.inlineCallbacks
+    def test_resume(self):
+        self.basedir = "upload/ResumableUpload/resume"
+        self.set_up_grid()
+        for (i, ss) in self.g.servers_by_number.items():
+            ss.incoming_grace_period = 3600
+            wrapper = self.g.wrappers_by_id[ss.my_nodeid]
+            wrapper.version = ss.remote_get_version()
+        db = self._get_db()
+        c0 = self.g.clients[0]
+        c0.encoding_params["max_segment_size"] = 3000
+        uploader = c0.getServiceNamed("uploader")
+        uploader._resume_db = db
+        blocks_sent = []
+        real_put_block = layout.WriteBucketProxy.put_block
+        def put_block(wbp, segmentnum, data):
+            blocks_sent.append(segmentnum)
+            return real_put_block(wbp, segmentnum, data)
+        self.patch(layout.WriteBucketProxy, "put_block", put_block)
+        DATA = "".join([chr(i % 251) for i in range(30000)])
+
+        # the first attempt stops after 4 of its 10 segments, and then the
+        # client goes away
+        u = StallingData(DATA, convergence="", limit=12000)
+        uploader.upload(u)
+        while not u.stalled:
+            yield fireEventually()
+        yield flushEventualQueue()
+        first_blocks = len(blocks_sent)
+        self.failUnless(first_blocks >= 10, first_blocks)
+        [(params, placement)] = [
+            db.get(base32.a2b(str(row[0])))
+            for row in db.cursor.execute("SELECT storage_index FROM uploads")]
+        self.failUnlessEqual(params, (3, 7, 10, 3000))
+        self.failUnlessEqual(len(placement), 10)
+        for ss in self.g.servers_by_number.values():
+            for bw in list(ss._active_writers):
+                for (f, args, kwargs) in bw._canary.disconnectors.values():
+                    f(*args, **kwargs)
+        parked = sum([len(ss._parked_writers)
+                      for ss in self.g.servers_by_number.values()])
+        self.failUnlessEqual(parked, 10)
+
+        # the second attempt only sends the blocks that are missing
+        del blocks_sent[:]
+        ur = yield c0.upload(upload.Data(DATA, convergence=""))
+        self.failUnlessEqual(len(blocks_sent) + first_blocks, 10 * 10)
+        self.failUnlessEqual(db.get_entries(), 0)
+        self.failUnlessEqual(ur.get_pushed_shares(), 10)
+        for ss in self.g.servers_by_number.values():
+            self.failUnlessEqual(ss._parked_writers, {})
+        n = c0.create_node_from_uri(ur.get_uri())
+        downloaded = yield download_to_data(n)
+        self.failUnlessEqual(downloaded, DATA)
+
+
 # TODO:
 #  upload with exactly 75 servers (shares_of_happiness)
 #  have a download fail
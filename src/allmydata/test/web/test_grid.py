@@ -4,17 +4,24 @@ import os.path, re, urllib
 import json
 from six.moves import StringIO
 from nevow import rend
+from zope.interface import implementer
 from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
 from allmydata import uri, dirnode
 from allmydata.util import base32
 from allmydata.util.encodingutil import to_str
 from allmydata.util.consumer import download_to_data
 from allmydata.util.netstring import split_netstring
+from allmydata.util.pollmixin import PollMixin
 from allmydata.unknown import UnknownNode
 from allmydata.storage.shares import get_share_file
 from allmydata.scripts.debug import CorruptShareOptions, corrupt_share
 from allmydata.immutable import upload
 from allmydata.mutable import publish
+from allmydata.web import filenode
 from .. import common_util as testutil
 from ..common import WebErrorMixin, ShouldFailMixin
 from ..no_network import GridTestMixin
@@ -1235,6 +1242,112 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
 
         return d
 
+    def test_GET_multiple_ranges(self):
+        self.basedir = "web/Grid/GET_multiple_ranges"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        DATA = "".join(["%03d" % i for i in range(1000)])
+        self.uris = {}
+        u = upload.Data(DATA, convergence="")
+        u.max_segment_size = 500 # 6 segments
+        d = c0.upload(u)
+        def _stash_uri(ur, which):
+            self.uris[which] = ur.get_uri()
+        d.addCallback(_stash_uri, "immutable")
+        d.addCallback(lambda ign:
+            c0.create_mutable_file(publish.MutableData(DATA)))
+        def _stash_mutable_uri(n, which):
+            self.uris[which] = n.get_uri()
+        d.addCallback(_stash_mutable_uri, "mutable")
+
+        # the first two ranges are read together, the others one at a time
+        self.patch(filenode, "MULTIPART_READ_GAP", 1000)
+        ranges = [(10, 19), (600, 1609), (2990, 2999)]
+        def _get(which):
+            headers = {"range": "bytes=" + ",".join(["%d-%d" % r
+                                                     for r in ranges])}
+            url = "uri/" + urllib.quote(self.uris[which])
+            return self.GET(url, headers=headers, return_response=True)
+        def _check(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(status, "206")
+            ctype = headers.getRawHeaders("content-type")[0]
+            boundary = ctype.split("boundary=", 1)[1]
+            chunks = res.split("\r\n--%s" % boundary)
+            self.failUnlessReallyEqual(chunks[-1], "--\r\n")
+            self.failUnlessReallyEqual(len(chunks), len(ranges) + 2)
+            for ((first, last), chunk) in zip(ranges, chunks[1:-1]):
+                (part_headers, data) = chunk.split("\r\n\r\n", 1)
+                self.failUnlessIn("Content-Range: bytes %d-%d/%d"
+                                  % (first, last, len(DATA)), part_headers)
+                self.failUnlessReallyEqual(data, DATA[first:last+1])
+        d.addCallback(lambda ign: _get("immutable"))
+        d.addCallback(_check)
+        d.addCallback(lambda ign: _get("mutable"))
+        d.addCallback(_check)
+        return d
+
+    def test_GET_multiple_ranges_segment_size(self):
+        # ranges in the same segment are read together, even if that
+        # segment is larger than MULTIPART_READ_GAP
+        self.basedir = "web/Grid/GET_multiple_ranges_segment_size"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        DATA = "".join(["%03d" % i for i in range(1000)])
+        u = upload.Data(DATA, convergence="")
+        u.max_segment_size = 3000 # 1 segment
+        d = c0.upload(u)
+        self.patch(filenode, "MULTIPART_READ_GAP", 100)
+        reads = []
+        real_group_parts = filenode.FileDownloader.group_parts
+        def group_parts(downloader, parts, gap):
+            spans = real_group_parts(downloader, parts, gap)
+            reads.append(len(spans))
+            return spans
+        self.patch(filenode.FileDownloader, "group_parts", group_parts)
+        ranges = [(10, 19), (600, 609), (2990, 2999)]
+        def _get(ur):
+            headers = {"range": "bytes=" + ",".join(["%d-%d" % r
+                                                     for r in ranges])}
+            url = "uri/" + urllib.quote(ur.get_uri())
+            return self.GET(url, headers=headers, return_response=True)
+        d.addCallback(_get)
+        def _check(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(status, "206")
+            for (first, last) in ranges:
+                self.failUnlessIn(DATA[first:last+1], res)
+            self.failUnlessReallyEqual(reads, [1])
+        d.addCallback(_check)
+        return d
+
+    @defer.inlineCallbacks
+    def test_GET_multiple_ranges_encoding(self):
+        # the content-encoding that goes with the filename would describe
+        # the whole multipart body, so it is only sent for a single range.
+        # (treq would decode the body and drop the header, so use an Agent)
+        self.basedir = "web/Grid/GET_multiple_ranges_encoding"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        DATA = "".join(["%03d" % i for i in range(1000)])
+        ur = yield c0.upload(upload.Data(DATA, convergence=""))
+        url = (self.client_baseurls[0] + "file/%s/@@named=/data.tar.gz"
+               % urllib.quote(ur.get_uri()))
+        def _get(ranges):
+            return Agent(reactor).request("GET", url,
+                                          Headers({"range": [ranges]}))
+        response = yield _get("bytes=1-3")
+        body = yield readBody(response)
+        self.failUnlessReallyEqual(response.code, 206)
+        self.failUnlessReallyEqual(body, DATA[1:4])
+        self.failUnlessReallyEqual(
+            response.headers.getRawHeaders("content-encoding"), ["gzip"])
+        response = yield _get("bytes=1-3,10-12")
+        body = yield readBody(response)
+        self.failUnlessReallyEqual(response.code, 206)
+        self.failIf(response.headers.hasHeader("content-encoding"))
+        self.failUnlessIn("Content-Type: application/x-tar", body)
+
     def test_blacklist(self):
         # download from a blacklisted URI, get an error
         self.basedir = "web/Grid/blacklist"
@@ -1374,3 +1487,97 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
         return d
 
 
+
+
+@implementer(IBodyProducer)
+class HeldBody(object):
+    """I send the first half of my data, and the rest once release() is
+    called."""
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+        self._consumer = None
+        self._done = None
+
+    def startProducing(self, consumer):
+        self._consumer = consumer
+        consumer.write(self.data[:len(self.data) // 2])
+        self._done = defer.Deferred()
+        return self._done
+
+    def release(self):
+        self._consumer.write(self.data[len(self.data) // 2:])
+        self._done.callback(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class StreamingPut(GridTestMixin, PollMixin, WebErrorMixin,
+                   unittest.TestCase):
+    def _shares_allocated(self):
+        return sum([ss.allocated_size()
+                    for ss in self.g.servers_by_number.values()])
+
+    @defer.inlineCallbacks
+    def test_put(self):
+        self.basedir = "web/StreamingPut/put"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        DATA = "streaming data" * 100000
+        body = HeldBody(DATA)
+        d = Agent(reactor).request("PUT",
+                                   self.client_baseurls[0] + "uri?random-key=true",
+                                   Headers(), body)
+        # the upload starts before the whole body has been sent
+        yield self.poll(lambda: self._shares_allocated() > 0)
+        body.release()
+        response = yield d
+        self.failUnlessEqual(response.code, 200)
+        filecap = yield readBody(response)
+        n = c0.create_node_from_uri(filecap)
+        data = yield download_to_data(n)
+        self.failUnlessEqual(data, DATA)
+
+    @defer.inlineCallbacks
+    def test_put_chunked(self):
+        # without a Content-Length, the body is spooled as before, but it
+        # still gets a random key
+        self.basedir = "web/StreamingPut/put_chunked"
+        self.set_up_grid()
+        DATA = "chunked data" * 1000
+        filecaps = []
+        for i in range(2):
+            body = HeldBody(DATA)
+            body.length = UNKNOWN_LENGTH
+            d = Agent(reactor).request("PUT",
+                                       self.client_baseurls[0] + "uri?random-key=true",
+                                       Headers(), body)
+            yield self.poll(lambda: body._consumer is not None)
+            body.release()
+            response = yield d
+            filecap = yield readBody(response)
+            filecaps.append(filecap)
+        self.failIfEqual(filecaps[0], filecaps[1])
+        data = yield self.GET("uri/%s" % urllib.quote(filecaps[0]))
+        self.failUnlessEqual(data, DATA)
+
+    @defer.inlineCallbacks
+    def test_put_mutable(self):
+        self.basedir = "web/StreamingPut/put_mutable"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        n = yield c0.create_mutable_file(publish.MutableData("old contents"))
+        yield self.shouldHTTPError("put_mutable", 400, "Bad Request",
+                                   "random-key=true", self.PUT,
+                                   "uri/%s?random-key=true"
+                                   % urllib.quote(n.get_uri()),
+                                   data="new contents")
+        data = yield n.download_best_version()
+        self.failUnlessEqual(data, "old contents")
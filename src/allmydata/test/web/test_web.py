@@ -34,10 +34,10 @@ from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
 from allmydata.nodemaker import NodeMaker
 from allmydata.frontends.magic_folder import QueuedItem
-from allmydata.web import status
+from allmydata.web import status, filenode as web_filenode
 from allmydata.web.common import WebError, MultiFormatPage
 from allmydata.util import fileutil, base32, hashutil
-from allmydata.util.consumer import download_to_data
+from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.util.encodingutil import to_str
 from ...util.connection_status import ConnectionStatus
 from ..common import FakeCHKFileNode, FakeMutableFileNode, \
@@ -1271,6 +1271,110 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got)
         return d
 
+    def _parse_byteranges(self, res, headers):
+        # returns a list of (content-range, data), one for each part
+        ctype = headers.getRawHeaders("content-type")[0]
+        self.failUnless(ctype.startswith("multipart/byteranges; boundary="),
+                        ctype)
+        boundary = ctype.split("boundary=", 1)[1]
+        chunks = res.split("\r\n--%s" % boundary)
+        self.failUnlessReallyEqual(chunks[0], "")
+        self.failUnlessReallyEqual(chunks[-1], "--\r\n")
+        parts = []
+        for chunk in chunks[1:-1]:
+            (part_headers, data) = chunk.split("\r\n\r\n", 1)
+            part_headers = part_headers.split("\r\n")
+            self.failUnlessReallyEqual(part_headers[:2],
+                                       ["", "Content-Type: text/plain"])
+            parts.append((part_headers[2], data))
+        return parts
+
+    def test_GET_FILEURL_multiple_ranges(self):
+        headers = {"range": "bytes=1-3,10-12,-2"}
+        length  = len(self.BAR_CONTENTS)
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failIf(headers.hasHeader("content-range"))
+            parts = self._parse_byteranges(res, headers)
+            self.failUnlessReallyEqual(parts, [
+                ("Content-Range: bytes 1-3/%d" % length,
+                 self.BAR_CONTENTS[1:4]),
+                ("Content-Range: bytes 10-12/%d" % length,
+                 self.BAR_CONTENTS[10:13]),
+                ("Content-Range: bytes %d-%d/%d" % (length-2, length-1,
+                                                    length),
+                 self.BAR_CONTENTS[-2:]),
+                ])
+        d.addCallback(_got)
+        return d
+
+    def test_GET_FILEURL_multiple_ranges_separate_reads(self):
+        # ranges that are far enough apart are read one at a time
+        self.patch(web_filenode, "MULTIPART_READ_GAP", 3)
+        headers = {"range": "bytes=0-1,4-5,12-"}
+        length  = len(self.BAR_CONTENTS)
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(int(status), 206)
+            parts = self._parse_byteranges(res, headers)
+            self.failUnlessReallyEqual(parts, [
+                ("Content-Range: bytes 0-1/%d" % length,
+                 self.BAR_CONTENTS[0:2]),
+                ("Content-Range: bytes 4-5/%d" % length,
+                 self.BAR_CONTENTS[4:6]),
+                ("Content-Range: bytes 12-%d/%d" % (length-1, length),
+                 self.BAR_CONTENTS[12:]),
+                ])
+        d.addCallback(_got)
+        return d
+
+    def test_GET_FILEURL_overlapping_ranges(self):
+        # ranges that overlap or touch are coalesced, here into one
+        headers = {"range": "bytes=5-10,1-7,11-12"}
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(headers.getRawHeaders("content-range")[0],
+                                       "bytes 1-12/%d" % len(self.BAR_CONTENTS))
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS[1:13])
+        d.addCallback(_got)
+        return d
+
+    def test_GET_FILEURL_ranges_partly_unsatisfiable(self):
+        # only the ranges that start beyond the end of the file are ignored
+        headers = {"range": "bytes=100-200,1-3"}
+        d = self.GET(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failUnlessReallyEqual(headers.getRawHeaders("content-range")[0],
+                                       "bytes 1-3/%d" % len(self.BAR_CONTENTS))
+            self.failUnlessReallyEqual(res, self.BAR_CONTENTS[1:4])
+        d.addCallback(_got)
+        return d
+
+    def test_HEAD_FILEURL_multiple_ranges(self):
+        headers = {"range": "bytes=1-3,10-12"}
+        d = self.HEAD(self.public_url + "/foo/bar.txt", headers=headers,
+                     return_response=True)
+        def _got(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(res, "")
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failIf(headers.hasHeader("content-range"))
+            self.failUnless(headers.getRawHeaders("content-type")[0]
+                            .startswith("multipart/byteranges; boundary="))
+        d.addCallback(_got)
+        return d
+
     def test_HEAD_FILEURL(self):
         d = self.HEAD(self.public_url + "/foo/bar.txt", return_response=True)
         def _got(res_and_status_and_headers):
@@ -1523,6 +1627,50 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
 
         return d
 
+    def test_GET_mutable_etag(self):
+        url = self.public_url + "/foo/quux.txt"
+        etags = []
+        d = self.GET(url, return_response=True)
+        def _got_first(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(res, self.QUUX_CONTENTS)
+            etags.append(headers.getRawHeaders("etag")[0])
+            # the same version gives the same ETag, so this short-circuits
+            return self.GET(url, return_response=True,
+                            headers={"If-None-Match": etags[0]})
+        d.addCallback(_got_first)
+        def _got_cached(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(int(status), http.NOT_MODIFIED)
+            self.failUnlessReallyEqual(res, "")
+            return self.PUT(url, "new contents")
+        d.addCallback(_got_cached)
+        # a new version gets a new ETag
+        d.addCallback(lambda ign:
+                      self.GET(url, return_response=True,
+                               headers={"If-None-Match": etags[0]}))
+        def _got_new(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            self.failUnlessReallyEqual(int(status), 200)
+            self.failUnlessReallyEqual(res, "new contents")
+            self.failIfEqual(headers.getRawHeaders("etag")[0], etags[0])
+        d.addCallback(_got_new)
+        return d
+
+    def test_HEAD_FILEURL_etag(self):
+        d = self.HEAD("/uri/%s" % self._bar_txt_uri, return_response=True)
+        def _got(res_and_status_and_headers):
+            (res, status, headers) = res_and_status_and_headers
+            etag = headers.getRawHeaders("etag")[0]
+            return self.HEAD("/uri/%s" % self._bar_txt_uri,
+                             return_response=True,
+                             headers={"If-None-Match": etag})
+        d.addCallback(_got)
+        d.addCallback(lambda res_and_status_and_headers:
+                      self.failUnlessReallyEqual(res_and_status_and_headers[1],
+                                                 http.NOT_MODIFIED))
+        return d
+
     # TODO: version of this with a Unicode filename
     def test_GET_FILEURL_save(self):
         d = self.GET(self.public_url + "/foo/bar.txt?filename=bar.txt&save=true",
@@ -4651,3 +4799,17 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         # doesn't reveal anything. This addresses #1720.
         d.addCallback(lambda e: self.assertEquals(str(e), "404 Not Found"))
         return d
+
+
+class ByteRangesConsumer(unittest.TestCase):
+    def test_write(self):
+        data = "".join([chr(ord("a") + i) for i in range(20)])
+        parts = [(2, 4, "<1>"), (6, 6, "<2>"), (9, 15, "<3>")]
+        # every way of splitting the span (2-15) into two writes
+        for split in range(2, 16):
+            consumer = MemoryConsumer()
+            c = web_filenode.ByteRangesConsumer(consumer, 2, parts)
+            c.write(data[2:split])
+            c.write(data[split:16])
+            self.failUnlessEqual("".join(consumer.chunks),
+                                 "<1>cde<2>g<3>jklmnop", split)
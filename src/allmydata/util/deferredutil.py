@@ -2,7 +2,7 @@
 import time
 
 from foolscap.api import eventually, fireEventually
-from twisted.internet import defer, reactor, error
+from twisted.internet import defer, reactor, error, threads
 from twisted.python.failure import Failure
 
 from allmydata.util import log
@@ -101,6 +101,16 @@ def eventually_errback(d):
 def eventual_chain(source, target):
     source.addCallbacks(eventually_callback(target), eventually_errback(target))
 
+def run_in_threadpool(threadpool, f, *args, **kwargs):
+    """
+    Call f(*args, **kwargs) in one of the threads of 'threadpool', or right
+    away (in the reactor thread) if 'threadpool' is None. I return a Deferred
+    that fires with its result.
+    """
+    if threadpool is None:
+        return defer.maybeDeferred(f, *args, **kwargs)
+    return threads.deferToThreadPool(reactor, threadpool, f, *args, **kwargs)
+
 
 class HookMixin(object):
     """
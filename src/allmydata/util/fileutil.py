@@ -4,7 +4,7 @@ from __future__ import print_function
 Futz with files like a pro.
 """
 
-import sys, exceptions, os, stat, tempfile, time, binascii
+import sys, exceptions, os, stat, tempfile, time
 import six
 from collections import namedtuple
 from errno import ENOENT
@@ -106,12 +106,7 @@ class EncryptedTemporaryFile(object):
         self.key = os.urandom(16)  # AES-128
 
     def _crypt(self, offset, data):
-        offset_big = offset // 16
-        offset_small = offset % 16
-        iv = binascii.unhexlify("%032x" % offset_big)
-        cipher = aes.create_encryptor(self.key, iv)
-        # this is just to advance the counter
-        aes.encrypt_data(cipher, b"\x00" * offset_small)
+        cipher = aes.create_encryptor(self.key, offset=offset)
         return aes.encrypt_data(cipher, data)
 
     def close(self):
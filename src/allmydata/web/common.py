@@ -15,6 +15,7 @@ from allmydata.interfaces import ExistingChildError, NoSuchChildError, \
      FileTooLargeError, NotEnoughSharesError, NoSharesError, \
      EmptyPathnameComponentError, MustBeDeepImmutableError, \
      MustBeReadonlyError, MustNotBeUnknownRWError, SDMF_VERSION, MDMF_VERSION
+from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.common import UnrecoverableFileError
 from allmydata.util import abbreviate
 from allmydata.util.hashutil import timing_safe_compare
@@ -102,6 +103,41 @@ def parse_offset_arg(offset):
     return offset
 
 
+def can_stream_put(path, args):
+    """
+    Can the body of a PUT to 'path' (with query args 'args') be uploaded as
+    it arrives? Only a new immutable file with random-key=true can: a
+    convergent key is a hash of the whole file, mutable files are built in
+    memory, and t=uri reads the body all at once.
+    """
+    def arg(name, default):
+        return args.get(name, [default])[0]
+    if not path.startswith("/uri/") and path != "/uri":
+        return False
+    if arg("t", "").strip() or arg("offset", None) is not None:
+        return False
+    try:
+        if not boolean_of_arg(arg("random-key", "false")):
+            return False
+        if boolean_of_arg(arg("mutable", "false")):
+            return False
+    except WebError:
+        return False # let the handler complain about it
+    return arg("format", "CHK").upper() == "CHK"
+
+def get_put_uploadable(req, client):
+    """
+    Return an IUploadable for the new immutable file in the body of a PUT.
+    """
+    uploadable = getattr(req, "streaming_upload", None)
+    if uploadable is not None:
+        return uploadable
+    convergence = client.convergence
+    if boolean_of_arg(get_arg(req, "random-key", "false")):
+        convergence = None
+    return FileHandle(req.content, convergence=convergence)
+
+
 def get_root(ctx_or_req):
     req = IRequest(ctx_or_req)
     # the addSlash=True gives us one extra (empty) segment
@@ -1,14 +1,17 @@
 
-import json
+import json, os
 
+from zope.interface import implementer
 from twisted.web import http, static
 from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
 from nevow import url, rend
 from nevow.inevow import IRequest
 
-from allmydata.interfaces import ExistingChildError
+from allmydata.interfaces import ExistingChildError, DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.monitor import Monitor
 from allmydata.immutable.upload import FileHandle
+from allmydata.immutable.filenode import ImmutableFileNode
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.mutable.common import MODE_READ
 from allmydata.util import log, base32
@@ -18,7 +21,7 @@ from allmydata.blacklist import FileProhibited, ProhibitedNode
 from allmydata.web.common import text_plain, WebError, RenderMixin, \
      boolean_of_arg, get_arg, should_create_intermediate_directories, \
      MyExceptionHandler, parse_replace_arg, parse_offset_arg, \
-     get_format, get_mutable_type, get_filenode_metadata
+     get_format, get_mutable_type, get_filenode_metadata, get_put_uploadable
 from allmydata.web.check_results import CheckResultsRenderer, \
      CheckAndRepairResultsRenderer, LiteralCheckResultsRenderer
 from allmydata.web.info import MoreInfo
@@ -39,7 +42,7 @@ class ReplaceMeMixin(object):
             d.addCallback(_uploaded)
         else:
             assert file_format == "CHK"
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = get_put_uploadable(req, client)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -236,6 +239,9 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
                 raise ExistingChildError()
 
             if self.node.is_mutable():
+                if getattr(req, "streaming_upload", None) is not None:
+                    raise WebError("PUT to a mutable file: random-key=true"
+                                   " only applies to immutable files")
                 # Are we a readonly filenode? We shouldn't allow callers
                 # to try to replace us if we are.
                 if self.node.is_readonly():
@@ -346,6 +352,46 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return d
 
 
+# The ranges of a multipart/byteranges response that are closer together than
+# the file's segment size are fetched with a single read() (and the bytes
+# between them are discarded), since a read() that started in the segment
+# where the previous one ended would have to fetch that segment again. This
+# is the gap used when the segment size cannot be learned.
+MULTIPART_READ_GAP = DEFAULT_MAX_SEGMENT_SIZE
+
+@implementer(IConsumer)
+class ByteRangesConsumer(object):
+    """I sit between a read() of a span of the file and the request. I write
+    the parts of a multipart/byteranges response that fall in that span,
+    each preceded by its headers, and discard the bytes between them."""
+
+    def __init__(self, consumer, offset, parts):
+        self._consumer = consumer
+        self._offset = offset # of the next byte that will be written to me
+        self._parts = list(parts) # [(first, last, headers)], in order
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+    def write(self, data):
+        start = self._offset
+        end = start + len(data)
+        self._offset = end
+        while self._parts:
+            (first, last, headers) = self._parts[0]
+            if first >= end:
+                break
+            if first >= start:
+                self._consumer.write(headers)
+            self._consumer.write(data[max(first, start)-start:
+                                      min(last+1, end)-start])
+            if last >= end:
+                break
+            self._parts.pop(0)
+
+
 class FileDownloader(rend.Page):
     def __init__(self, filenode, filename):
         rend.Page.__init__(self)
@@ -400,6 +446,62 @@ class FileDownloader(rend.Page):
         except ValueError:
             return None
 
+    def coalesce_ranges(self, ranges):
+        # Drop the ranges that start beyond the end of the file, truncate
+        # the others, and merge the ones that overlap or touch. Returns a
+        # sorted list of (first,last) inclusive range tuples, which is empty
+        # if none of the ranges could be satisfied.
+        filesize = self.filenode.get_size()
+        coalesced = []
+        for (first, last) in sorted(ranges):
+            if first >= filesize:
+                continue
+            first = max(0, first)
+            last = min(filesize-1, last)
+            if coalesced and first <= coalesced[-1][1] + 1:
+                coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], last))
+            else:
+                coalesced.append((first, last))
+        return coalesced
+
+    def get_multipart_read_gap(self):
+        # Return a Deferred that fires with the gap below which the parts
+        # of a multipart/byteranges response are fetched with one read():
+        # the file's segment size, if it can be learned. For an immutable
+        # file, this fetches the UEB that the first read() needs anyway.
+        if not isinstance(self.filenode, ImmutableFileNode):
+            return defer.succeed(MULTIPART_READ_GAP)
+        d = self.filenode.get_segment_size()
+        def _no_segment_size(f):
+            # the read() will report the problem
+            return MULTIPART_READ_GAP
+        d.addErrback(_no_segment_size)
+        return d
+
+    def group_parts(self, parts, gap):
+        # Return a list of (first, size, parts) spans, one for each group of
+        # parts that are closer together than 'gap'.
+        spans = []
+        for (first, last, headers) in parts:
+            if spans and first - (spans[-1][0] + spans[-1][1]) < gap:
+                spans[-1][1] = last - spans[-1][0] + 1
+                spans[-1][2].append((first, last, headers))
+            else:
+                spans.append([first, last - first + 1,
+                              [(first, last, headers)]])
+        return spans
+
+    def get_etag(self):
+        si = self.filenode.get_storage_index()
+        if not si:
+            return None # LIT files, whose contents are in the URI
+        if self.filenode.is_mutable():
+            # this names the version of the file that we are about to read
+            return "%s-%s" % (base32.b2a(si),
+                              base32.b2a(self.filenode.get_root_hash()))
+        # the same one that FileNodeHandler.render_GET uses
+        return "%s-" % base32.b2a(si)
+
     def renderHTTP(self, ctx):
         req = IRequest(ctx)
         gte = static.getTypeAndEncoding
@@ -421,36 +523,62 @@ class FileDownloader(rend.Page):
 
         filesize = self.filenode.get_size()
         assert isinstance(filesize, (int,long)), filesize
-        first, size = 0, None
+        # each span is (first, size, parts), where parts is None for a
+        # response that is not multipart/byteranges
+        spans = [(0, None, None)]
+        # the (first, last, headers) of each part of a multipart/byteranges
+        # response, which are grouped into spans once the segment size is
+        # known
+        parts = None
         contentsize = filesize
+        trailer = ""
         req.setHeader("accept-ranges", "bytes")
 
-        # TODO: for mutable files, use the roothash. For LIT, hash the data.
-        # or maybe just use the URI for CHK and LIT.
+        # if the client already has this version of the file then we can
+        # short-circuit the whole process.
+        etag = self.get_etag()
+        if etag and req.setETag(etag):
+            return ""
+
         rangeheader = req.getHeader('range')
         if rangeheader:
             ranges = self.parse_range_header(rangeheader)
 
             # ranges = None means the header didn't parse, so ignore
-            # the header as if it didn't exist.  If is more than one
-            # range, then just return the first for now, until we can
-            # generate multipart/byteranges.
+            # the header as if it didn't exist.
             if ranges is not None:
-                first, last = ranges[0]
-
-                if first >= filesize:
+                ranges = self.coalesce_ranges(ranges)
+                if not ranges:
                     raise WebError('First beyond end of file',
                                    http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                else:
-                    first = max(0, first)
-                    last = min(filesize-1, last)
-
-                    req.setResponseCode(http.PARTIAL_CONTENT)
+                req.setResponseCode(http.PARTIAL_CONTENT)
+                if len(ranges) == 1:
+                    first, last = ranges[0]
                     req.setHeader('content-range',"bytes %s-%s/%s" %
                                   (str(first), str(last),
                                    str(filesize)))
                     contentsize = last - first + 1
-                    size = contentsize
+                    spans = [(first, contentsize, None)]
+                else:
+                    boundary = base32.b2a(os.urandom(16))
+                    req.setHeader("content-type",
+                                  "multipart/byteranges; boundary=%s"
+                                  % boundary)
+                    # a content-encoding would describe the whole multipart
+                    # body, rather than the parts
+                    req.responseHeaders.removeHeader("content-encoding")
+                    parts = []
+                    contentsize = 0
+                    for (first, last) in ranges:
+                        headers = ("\r\n--%s\r\n"
+                                   "Content-Type: %s\r\n"
+                                   "Content-Range: bytes %d-%d/%d\r\n"
+                                   "\r\n" % (boundary, ctype,
+                                              first, last, filesize))
+                        contentsize += len(headers) + last - first + 1
+                        parts.append((first, last, headers))
+                    trailer = "\r\n--%s--\r\n" % boundary
+                    contentsize += len(trailer)
 
         req.setHeader("content-length", b"%d" % contentsize)
         if req.method == "HEAD":
@@ -461,7 +589,31 @@ class FileDownloader(rend.Page):
             finished.append(True)
         req.notifyFinish().addBoth(_request_finished)
 
-        d = self.filenode.read(req, first, size)
+        # the spans are read one after another, from the same filenode, so
+        # they share its knowledge of where the shares are
+        def _read(ign, first, size, parts):
+            if finished:
+                return
+            if parts is None:
+                return self.filenode.read(req, first, size)
+            return self.filenode.read(ByteRangesConsumer(req, first, parts),
+                                      first, size)
+        def _write_trailer(ign):
+            if not finished:
+                req.write(trailer)
+        def _read_spans(spans):
+            d2 = defer.succeed(None)
+            for (first, size, span_parts) in spans:
+                d2.addCallback(_read, first, size, span_parts)
+            return d2
+        if parts is None:
+            d = _read_spans(spans)
+        else:
+            d = self.get_multipart_read_gap()
+            d.addCallback(lambda gap: _read_spans(self.group_parts(parts,
+                                                                   gap)))
+        if trailer:
+            d.addCallback(_write_trailer)
 
         def _finished(ign):
             if not finished:
@@ -104,6 +104,9 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
     def data_time_cumulative_sending(self, ctx, data):
         return self._get_time("cumulative_sending")
 
+    def data_time_stage_overlap(self, ctx, data):
+        return self._get_time("stage_overlap")
+
     def data_time_hashes_and_close(self, ctx, data):
         return self._get_time("hashes_and_close")
 
@@ -137,7 +140,9 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
             if (time1 is None or time2 is None):
                 return None
             else:
-                return compute_rate(file_size, time1+time2)
+                # don't count the time when both were happening twice
+                overlap = r.get_timings().get("stage_overlap", 0.0)
+                return compute_rate(file_size, time1+time2-overlap)
         d.addCallback(_convert)
         return d
 
@@ -189,6 +194,12 @@ class UploadStatusPage(UploadResultsRendererMixin, rend.Page):
             return "(unknown)"
         return size
 
+    def render_segment_size(self, ctx, data):
+        segment_size = data.get_segment_size()
+        if segment_size is None:
+            return "(unknown)"
+        return segment_size
+
     def render_progress_hash(self, ctx, data):
         progress = data.get_progress()[0]
         # TODO: make an ascii-art bar
@@ -519,7 +530,7 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
         t = T.table(align="left",class_="status-download-events")
         t[T.tr[T.th["range"], T.th["start"], T.th["finish"], T.th["got"],
                T.th["time"], T.th["decrypttime"], T.th["pausedtime"],
-               T.th["speed"]]]
+               T.th["readahead"], T.th["speed"]]]
         for r_ev in self.download_status.read_events:
             start = r_ev["start"]
             length = r_ev["length"]
@@ -538,7 +549,7 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
                    T.td[srt(r_ev["start_time"])], T.td[srt(r_ev["finish_time"])],
                    T.td[bytes], T.td[rtt],
                    T.td[decrypt_time], T.td[paused],
-                   T.td[speed],
+                   T.td[r_ev["readahead"]], T.td[speed],
                    ]]
 
         l[T.h2["Read Events:"], t]
@@ -6,12 +6,13 @@ from nevow import rend, url, tags as T
 from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.web.common import getxmlfile, get_arg, boolean_of_arg, \
-     convert_children_json, WebError, get_format, get_mutable_type
+     convert_children_json, WebError, get_format, get_mutable_type, \
+     get_put_uploadable
 from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = get_put_uploadable(req, client)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.get_uri())
     # that fires with the URI of the new file
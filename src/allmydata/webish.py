@@ -2,15 +2,20 @@ import re, time
 from twisted.application import service, strports, internet
 from twisted.web import http, static
 from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.address import (
     IPv4Address,
     IPv6Address,
 )
 from nevow import appserver, inevow
+from foolscap.api import eventually
+from six.moves import cStringIO as StringIO
 from allmydata.util import log, fileutil
+from allmydata.immutable.upload import StreamingUploadable
 
 from allmydata.web import introweb, root
-from allmydata.web.common import IOpHandleTable, MyExceptionHandler
+from allmydata.web.common import IOpHandleTable, MyExceptionHandler, \
+     can_stream_put
 
 # we must override twisted.web.http.Request.requestReceived with a version
 # that doesn't use cgi.parse_multipart() . Since we actually use Nevow, we
@@ -23,12 +28,83 @@ parse_qs = http.parse_qs
 class MyRequest(appserver.NevowRequest, object):
     fields = None
     _tahoe_request_had_error = None
+    # a StreamingUploadable for the body of a PUT that is processed while
+    # the body is still arriving
+    streaming_upload = None
+    _streaming_request = None
+
+    def gotLength(self, length):
+        """Called by channel when the request headers have been received.
+
+        Normally the body is spooled to self.content (a temporary file, if it
+        is large), and the request is processed when all of it is there. A
+        PUT of a new immutable file with random-key=true does not have to
+        wait: it is processed right away, and the body goes to a
+        StreamingUploadable as it arrives, so a large upload neither waits
+        for the whole body nor writes it to disk first. Reading from the
+        connection is paused while the uploader falls behind.
+        """
+        command = getattr(self.channel, "_command", None)
+        path = getattr(self.channel, "_path", None)
+        version = getattr(self.channel, "_version", None)
+        producer = IPushProducer(self.channel.transport, None)
+        if length and command == "PUT" and path and producer is not None:
+            x = path.split('?', 1)
+            args = {}
+            if len(x) == 2:
+                args = parse_qs(x[1], 1)
+            if can_stream_put(x[0], args):
+                self.content = StringIO()
+                self.streaming_upload = StreamingUploadable(length)
+                self.streaming_upload.registerProducer(producer, True)
+                self._streaming_request = (command, path, version)
+                # wait until the channel has answered any "Expect:
+                # 100-continue" before we start the response
+                eventually(self._start_streaming_request)
+                return
+        appserver.NevowRequest.gotLength(self, length)
+
+    def _start_streaming_request(self):
+        if self._streaming_request is None or self._lostConnection:
+            return
+        (command, path, version) = self._streaming_request
+        self._streaming_request = None
+        self._process_request(command, path, version)
+
+    def handleContentChunk(self, data):
+        if self.streaming_upload is not None:
+            self.streaming_upload.write(data)
+        else:
+            appserver.NevowRequest.handleContentChunk(self, data)
+
+    def connectionLost(self, reason):
+        if self.streaming_upload is not None:
+            self.streaming_upload.fail(reason)
+        appserver.NevowRequest.connectionLost(self, reason)
+
+    def finishRequest(self, success):
+        if (self.streaming_upload is not None
+            and not self.streaming_upload.is_finished()):
+            # we are answering before the whole body has arrived (probably
+            # with an error), so the rest of it must not be mistaken for
+            # the next request on this connection
+            self.channel.persistent = False
+        return appserver.NevowRequest.finishRequest(self, success)
 
     def requestReceived(self, command, path, version):
         """Called by channel when all data has been received.
 
         This method is not intended for users.
         """
+        if self.streaming_upload is not None:
+            self.streaming_upload.finish()
+            if self._streaming_request is None:
+                # already being processed
+                return
+            self._streaming_request = None
+        self._process_request(command, path, version)
+
+    def _process_request(self, command, path, version):
         self.content.seek(0,0)
         self.args = {}
         self.stack = []